@@ -36,7 +36,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'deep_export = deep_training.tools.export_transformers:export',
+            'deep_export = deep_training.tools.export_transformers:main',
+            'deep_merge_lora = deep_training.tools.merge_lora:main',
         ],
     }
 
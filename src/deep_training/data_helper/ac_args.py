@@ -11,4 +11,32 @@ from transformers.utils import (
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
-TrainingArgumentsAC =TrainingArgumentsHF
\ No newline at end of file
+@dataclass
+class TrainingArgumentsAC(TrainingArgumentsHF):
+    low_overhead_loop: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "train loop without per micro-step host sync: loss / nan filter aggregated on device , "
+                "progress bar and logs updated only at logging_steps."
+            )
+        },
+    )
+    prefetch_to_device: bool = field(
+        default=True,
+        metadata={
+            "help": (
+                "low_overhead_loop only , copy next batch to device on a side cuda stream , "
+                "accelerate device placement of the train dataloader is disabled."
+            )
+        },
+    )
+    empty_cache_threshold: Optional[float] = field(
+        default=0.9,
+        metadata={
+            "help": (
+                "low_overhead_loop only , call torch.cuda.empty_cache only when reserved / total memory exceeds "
+                "this ratio. None or <= 0 to disable."
+            )
+        },
+    )
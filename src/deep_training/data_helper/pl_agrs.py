@@ -16,9 +16,9 @@ class TrainingArguments(_ArgumentsBase):
     optimizer: str = field(
         default='adamw',
         metadata={"help": "one of lamb,adam,adamw_hf,adamw,adamw_torch,adamw_torch_fused,adamw_torch_xla,adamw_apex_fused,"
-                          "adafactor,adamw_anyprecision,sgd,adagrad,adamw_bnb_8bit,adamw_8bit,lion,lion_8bit,lion_32bit,"
-                          "paged_adamw_32bit,paged_adamw_8bit,paged_lion_32bit,paged_lion_8bit,"
-                          "lamb_fused_dp adagrad_cpu_dp adam_cpu_dp adam_fused_dp"},
+                          "adafactor,adamw_anyprecision,sgd,adagrad,adamw_bnb_8bit,adamw_8bit,lion,lion_foreach,lion_8bit,lion_32bit,"
+                          "paged_adamw_32bit,paged_adamw_8bit,paged_lion_32bit,paged_lion_8bit,adamw_8bit_blockwise,lion_8bit_blockwise,"
+                          "lamb_foreach,lamb_fused_dp adagrad_cpu_dp adam_cpu_dp adam_fused_dp"},
     )
     optimizer_args: Optional[str] = field(default=None,metadata={"help": "sample a=100,b=10 "})
     scheduler_type: str = field(
@@ -53,6 +53,7 @@ class TrainingArguments(_ArgumentsBase):
         #     'minibatch_replays': 2, # free
         #     'alpha': 0.1, # pgd
         #     'epsilon': 1.0 # pgd,fgm
+        #     'sparse': True, # fgm,fgsm,pgd,free 只扰动 batch 中出现的 embedding 行 , restore 也只恢复这些行 , False 为整个词表备份恢复
         # },
         default=None,
         metadata={"help": "对抗训练"},
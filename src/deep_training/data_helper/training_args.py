@@ -105,6 +105,16 @@ class ModelArguments(_ArgumentsBase):
         },
     )
 
+    lazy_load: bool = field(
+        default=False,
+        metadata={
+            "help": "meta device 构造模型 , 多线程直接从本地 safetensors / bin shard 加载 , 跳过随机初始化 . "
+                    "量化加载 (load_in_8bit / load_in_4bit / quantization_config) , device_map='auto' 或非本地路径时回退到 from_pretrained"
+        },
+    )
+    load_workers: Optional[int] = field(
+        default=None, metadata={"help": "lazy_load 的加载线程数 , 默认 min(shard 数 , 8)"})
+
     model_custom: Optional[Dict] = field(
         default=None, metadata={"help": "自定义参数 for model args"})
 
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/4 9:30
+# @FileName: alibi.py
+"""
+    ALiBi attention , 按 query 分块计算 bias , 不再缓存 (n_head, max_pos, max_pos) 的 bias
+    bias[h, i, j] = slope_h * (j - i) , j > i 时屏蔽
+    (baichuan 原实现推理时用 slope_h * j , 两者每行只差常数 , softmax 结果相同 , 相对距离在低精度下更准确)
+    每层每块只临时生成 [b or 1, n_head, block, sk] 的 bias , 块大小由 max_bias_elements 控制 ,
+    峰值与上下文长度线性相关 , 与 model_max_length 无关
+    整行被屏蔽的 query (例如 padding 位置) 该行 bias 置 0 : sdpa 内部无法像 eager 一样把分数截断到 finfo.min ,
+    float16 下 score + finfo.min 会溢出为 -inf , 整行 -inf 时 softmax 为 NaN ; 置 0 后两条路径结果一致且有限
+"""
+import math
+from functools import lru_cache
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+__all__ = [
+    'alibi_slopes',
+    'alibi_bias',
+    'alibi_attention',
+]
+
+
+def _get_interleave(n):
+    def _get_slopes_power_of_2(n):
+        start = 2 ** (-(2 ** -(math.log2(n) - 3)))
+        ratio = start
+        return [start * ratio ** i for i in range(n)]
+
+    if math.log2(n).is_integer():
+        return _get_slopes_power_of_2(n)
+    closest_power_of_2 = 2 ** math.floor(math.log2(n))
+    return _get_slopes_power_of_2(closest_power_of_2) + \
+        _get_interleave(2 * closest_power_of_2)[0::2][:n - closest_power_of_2]
+
+
+@lru_cache(maxsize=16)
+def alibi_slopes(n_head: int, device=None) -> torch.Tensor:
+    '''
+        [n_head] float32 , 按 device 缓存 , 不作为 buffer 注册 (不受 skip_init / meta 加载影响)
+    '''
+    return torch.tensor(_get_interleave(n_head), dtype=torch.float32, device=device)
+
+
+def _keep_mask(attention_mask: torch.Tensor, q_start: int, q_len: int, k_len: int) -> torch.Tensor:
+    '''
+        attention_mask: [b, sk] (0 为 padding , 可用不同正整数区分 packing 的样本) 或 [b, sk, sk] (1 为可见)
+        返回 [b, q_len, k_len] bool
+    '''
+    if attention_mask.dim() == 2:
+        mask = attention_mask[:, -k_len:]
+        rows = mask[:, q_start: q_start + q_len, None]
+        cols = mask[:, None, :]
+        return ((rows * cols) > 0) & (rows == cols)
+    offset = attention_mask.size(1) - k_len
+    return attention_mask[:, offset + q_start: offset + q_start + q_len, -k_len:] > 0
+
+
+def alibi_bias(slopes: torch.Tensor, q_start: int, q_len: int, k_len: int, dtype=torch.float32,
+               attention_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    '''
+        query 绝对位置 [q_start, q_start + q_len) 对全部 k_len 个 key 的 bias
+        返回 [1 or b, n_head, q_len, k_len] , 屏蔽位置为 finfo(dtype).min , 整行被屏蔽时该行为 0
+    '''
+    device = slopes.device
+    i = torch.arange(q_start, q_start + q_len, device=device).unsqueeze(-1)
+    j = torch.arange(k_len, device=device).unsqueeze(0)
+    rel = j - i
+    bias = (slopes.view(-1, 1, 1) * rel.to(slopes.dtype)).to(dtype)
+    min_value = torch.finfo(dtype).min
+    bias = bias.masked_fill_((rel > 0).unsqueeze(0), min_value).unsqueeze(0)
+    if attention_mask is not None:
+        keep = _keep_mask(attention_mask, q_start, q_len, k_len)
+        bias = bias.masked_fill(~keep.unsqueeze(1), min_value)
+        # 只在 device 上判断 , 不同步 host
+        dead = ~(keep & (rel <= 0)).any(-1)
+        bias = bias.masked_fill(dead[:, None, :, None], 0)
+    return bias
+
+
+def alibi_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, slopes: torch.Tensor,
+                    attention_mask: Optional[torch.Tensor] = None, block_size: Optional[int] = None,
+                    max_bias_elements=2 ** 26, output_attentions=False):
+    '''
+        query: [b, h, sq, d] , key / value: [b, h, sk, d] , query 对应 key 的最后 sq 个位置
+        block_size 为 None 时按 max_bias_elements 推算 , 每块 bias 不超过该元素数
+        output_attentions 或 torch 不支持 sdpa 时走 eager , 否则每块调用 scaled_dot_product_attention
+        返回 (attn_output [b, h, sq, d] , attn_weights [b, h, sq, sk] or None)
+    '''
+    bsz, n_head, q_len, head_dim = query.shape
+    k_len = key.size(2)
+    past = k_len - q_len
+    if block_size is None or block_size <= 0:
+        rows = n_head * k_len * (bsz if attention_mask is not None else 1)
+        block_size = max(1, max_bias_elements // max(rows, 1))
+    use_sdpa = not output_attentions and hasattr(F, 'scaled_dot_product_attention')
+    outputs, weights = [], []
+    for start in range(0, q_len, block_size):
+        length = min(block_size, q_len - start)
+        bias = alibi_bias(slopes, past + start, length, k_len, dtype=query.dtype, attention_mask=attention_mask)
+        q = query[:, :, start: start + length]
+        if use_sdpa:
+            outputs.append(F.scaled_dot_product_attention(q, key, value, attn_mask=bias))
+            continue
+        attn_weights = torch.matmul(q, key.transpose(2, 3)) / math.sqrt(head_dim) + bias
+        attn_weights = torch.max(attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min,
+                                                            device=attn_weights.device))
+        attn_weights = torch.nn.functional.softmax(attn_weights, dim=-1)
+        outputs.append(torch.matmul(attn_weights, value))
+        if output_attentions:
+            weights.append(attn_weights)
+    attn_output = outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=2)
+    attn_weights = None
+    if output_attentions:
+        attn_weights = weights[0] if len(weights) == 1 else torch.cat(weights, dim=2)
+    return attn_output, attn_weights
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/3 10:40
+# @FileName: attention_backend.py
+"""
+    attention 后端选择 , GLM 系列共用
+    eager : 原始实现 , 显式构造 [b, np, sq, sk] 分数矩阵 , 可返回 attention_probs
+    sdpa : torch.nn.functional.scaled_dot_product_attention , 由 torch 选择 kernel
+    mem_efficient : sdpa 且禁用 math kernel , 只用 flash / memory-efficient kernel , 不会物化完整分数矩阵 ,
+                    当前输入没有可用 kernel 时回退到 sdpa
+"""
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+__all__ = [
+    'ATTN_BACKENDS',
+    'sdpa_available',
+    'resolve_attn_backend',
+    'sdpa_attention',
+]
+
+ATTN_BACKENDS = ('eager', 'sdpa', 'mem_efficient')
+
+
+def sdpa_available() -> bool:
+    return hasattr(F, 'scaled_dot_product_attention')
+
+
+def resolve_attn_backend(config, default='sdpa') -> str:
+    '''
+        config.attn_backend 为 None 时使用 default , torch 不支持 sdpa 时回退到 eager
+    '''
+    backend = getattr(config, 'attn_backend', None) or default
+    if backend not in ATTN_BACKENDS:
+        raise ValueError('attn_backend must be one of {}, got {}'.format(ATTN_BACKENDS, backend))
+    if backend != 'eager' and not sdpa_available():
+        backend = 'eager'
+    return backend
+
+
+def _mem_efficient_context():
+    try:
+        from torch.nn.attention import sdpa_kernel, SDPBackend
+        return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+    except ImportError:
+        return torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False)
+
+
+def sdpa_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                   attention_mask: Optional[torch.Tensor] = None, is_causal=False, dropout_p=0.0,
+                   scale: Optional[float] = None, backend='sdpa') -> torch.Tensor:
+    '''
+        query / key / value: [b, np, s, hn] , attention_mask 为 bool (True 表示可见) 或加性 float mask
+    '''
+    kwargs = {}
+    if scale is not None:
+        kwargs['scale'] = scale
+    if backend == 'mem_efficient' and query.is_cuda:
+        try:
+            with _mem_efficient_context():
+                return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask,
+                                                      dropout_p=dropout_p, is_causal=is_causal, **kwargs)
+        except RuntimeError:
+            # 没有满足条件的 kernel (例如 float32 + 老显卡) , 交给 torch 自动选择
+            pass
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask,
+                                          dropout_p=dropout_p, is_causal=is_causal, **kwargs)
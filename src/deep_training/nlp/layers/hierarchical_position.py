@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/22 9:30
+# @FileName: hierarchical_position.py
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+__all__ = [
+    'HierarchicalPositionEmbedding'
+]
+
+
+class HierarchicalPositionEmbedding(nn.Embedding):
+    r'''
+        层次分解位置编码 https://kexue.fm/archives/7947
+        u = (w - alpha * w[0]) / (1 - alpha)
+        e[p] = alpha * u[p // n] + (1 - alpha) * u[p % n]
+             = w[p % n] + alpha / (1 - alpha) * (w[p // n] - w[0])
+        展开后只需要从原始 weight 中取行 , 不再对整张表做变换 , 梯度也只回传到用到的行
+        position_ids 可以是任意形状 , 支持 packed 序列
+    '''
+    def __init__(self, num_embeddings, embedding_dim, alpha=0.4, **kwargs):
+        super(HierarchicalPositionEmbedding, self).__init__(num_embeddings, embedding_dim, **kwargs)
+        assert 0 < alpha < 1
+        self.alpha = alpha
+        self.scale = alpha / (1 - alpha)
+
+    @classmethod
+    def from_embedding(cls, embedding: nn.Embedding, alpha=0.4):
+        # 共享原 weight , state_dict 的 key 与优化器中的参数都保持不变
+        return cls(embedding.num_embeddings, embedding.embedding_dim,
+                   alpha=alpha,
+                   padding_idx=embedding.padding_idx,
+                   max_norm=embedding.max_norm,
+                   norm_type=embedding.norm_type,
+                   scale_grad_by_freq=embedding.scale_grad_by_freq,
+                   sparse=embedding.sparse,
+                   _weight=embedding.weight)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        x_idx = torch.div(input, self.num_embeddings, rounding_mode='floor')
+        y_idx = input - x_idx * self.num_embeddings
+        # 两次取行合并为一次
+        embeddings_x, embeddings_y = F.embedding(
+            torch.stack((x_idx, y_idx)), self.weight, self.padding_idx, self.max_norm,
+            self.norm_type, self.scale_grad_by_freq, self.sparse).unbind(0)
+        return torch.add(embeddings_y, embeddings_x - self.weight[0], alpha=self.scale)
+
+    def extra_repr(self) -> str:
+        return super(HierarchicalPositionEmbedding, self).extra_repr() + ', alpha={}'.format(self.alpha)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/3 10:10
+# @FileName: kv_cache.py
+"""
+    预分配 , 原地追加的 kv cache
+    每层持有一个 KVCacheBuffer , 返回的 (key , value) 是预分配 buffer 前缀的视图 ,
+    仍以 tuple 形式放在 past_key_values 中 , 与 generate / _reorder_cache 兼容
+    下一步传回的 cache 正是上次返回的前缀时 , 新 token 直接写入 buffer 尾部 , 不再 torch.cat
+    其余情况 (beam search 重排后的新张量 , 外部传入的 cache , 容量不足) 重新分配并拷贝一次
+    buffer 只通过返回的视图保持存活 (这里只保存弱引用) , generate 结束后随 past_key_values 一起释放
+
+    QuantizedKVCache : int8 / int4 量化 kv cache , 每个 token 每个 head 一组 (scale , min)
+    past_key_values 中每层为 (key_q , value_q , key_meta , value_meta) , 布局与原 key / value 相同 ,
+    只有最后一维变为 head_dim (int8) , head_dim // 2 (int4 两个一组打包) , 2 (scale , min)
+    past_key_values[0][0].shape[seq_dim] 仍为历史长度 , _reorder_cache 按 batch index_select 同样适用
+    历史部分读取时反量化 , 本步新 token 直接使用全精度值
+"""
+import weakref
+from typing import Optional, Tuple
+
+import torch
+
+__all__ = [
+    'KVCacheBuffer',
+    'quantize_kv',
+    'dequantize_kv',
+    'QuantizedKVCache',
+    'build_kv_quantizer',
+]
+
+
+def _same_shape_except(a: torch.Tensor, b: torch.Tensor, dim: int) -> bool:
+    return a.dim() == b.dim() and a.shape[:dim] == b.shape[:dim] and a.shape[dim + 1:] == b.shape[dim + 1:]
+
+
+class KVCacheBuffer:
+    '''
+        seq_dim: 序列所在维度 , chatglm / chatglm2 / chatglm3 为 0 ([s, b, np, hn]) , glm4 为 2 ([b, np, s, hn])
+        block_size: 容量按 block_size 对齐 , 扩容时至少翻倍 , 摊还后每步 O(1) 分配
+        block_size <= 0 或需要梯度时退化为 torch.cat
+    '''
+    def __init__(self, seq_dim=0, block_size=256):
+        self.seq_dim = seq_dim
+        self.block_size = block_size
+        self.length = 0
+        self._key_ref = None
+        self._value_ref = None
+
+    def reset(self):
+        self.length = 0
+        self._key_ref = None
+        self._value_ref = None
+
+    @property
+    def enabled(self):
+        return self.block_size is not None and self.block_size > 0
+
+    def _buffers(self) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        if self._key_ref is None:
+            return None, None
+        return self._key_ref(), self._value_ref()
+
+    def _owns(self, cache_k: torch.Tensor, cache_v: torch.Tensor, buf_k, buf_v) -> bool:
+        if buf_k is None or buf_v is None:
+            return False
+        seq_dim = self.seq_dim
+        return (cache_k.data_ptr() == buf_k.data_ptr() and cache_v.data_ptr() == buf_v.data_ptr()
+                and cache_k.size(seq_dim) == self.length and cache_k.stride() == buf_k.stride()
+                and cache_k.dtype == buf_k.dtype and _same_shape_except(cache_k, buf_k, seq_dim))
+
+    @staticmethod
+    def _requires_grad(kv_cache, key: torch.Tensor, value: torch.Tensor) -> bool:
+        # 训练 (含 p-tuning 的 prefix past) 时保持 torch.cat , 不在 buffer 上做原地写
+        if not torch.is_grad_enabled():
+            return False
+        tensors = (key, value) if kv_cache is None else (key, value) + tuple(kv_cache)
+        return any(t.requires_grad for t in tensors)
+
+    def _allocate(self, like: torch.Tensor, capacity: int) -> torch.Tensor:
+        shape = list(like.shape)
+        shape[self.seq_dim] = capacity
+        return torch.empty(shape, dtype=like.dtype, device=like.device)
+
+    def _capacity(self, needed: int, current: int) -> int:
+        block = self.block_size
+        return max((needed + block - 1) // block * block, current * 2)
+
+    def append(self, kv_cache, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+            kv_cache: None 或上一步的 (cache_k , cache_v) , 返回拼接后的 (key , value)
+        '''
+        seq_dim = self.seq_dim
+        if not self.enabled or self._requires_grad(kv_cache, key, value):
+            if kv_cache is None:
+                return key, value
+            cache_k, cache_v = kv_cache
+            return torch.cat((cache_k, key), dim=seq_dim), torch.cat((cache_v, value), dim=seq_dim)
+
+        buf_k, buf_v = self._buffers()
+        n = key.size(seq_dim)
+        if kv_cache is None:
+            past, prefix = 0, None
+        else:
+            cache_k, cache_v = kv_cache
+            past = cache_k.size(seq_dim)
+            prefix = None if self._owns(cache_k, cache_v, buf_k, buf_v) else (cache_k, cache_v)
+        end = past + n
+        if prefix is not None or buf_k is None or kv_cache is None or buf_k.size(seq_dim) < end \
+                or not _same_shape_except(buf_k, key, seq_dim) or buf_k.device != key.device or buf_k.dtype != key.dtype:
+            current = buf_k.size(seq_dim) if (buf_k is not None and prefix is None and kv_cache is not None) else 0
+            capacity = self._capacity(end, current)
+            new_k, new_v = self._allocate(key, capacity), self._allocate(value, capacity)
+            if past:
+                src_k, src_v = prefix if prefix is not None else (buf_k.narrow(seq_dim, 0, past),
+                                                                  buf_v.narrow(seq_dim, 0, past))
+                new_k.narrow(seq_dim, 0, past).copy_(src_k)
+                new_v.narrow(seq_dim, 0, past).copy_(src_v)
+            buf_k, buf_v = new_k, new_v
+            self._key_ref, self._value_ref = weakref.ref(buf_k), weakref.ref(buf_v)
+        buf_k.narrow(seq_dim, past, n).copy_(key)
+        buf_v.narrow(seq_dim, past, n).copy_(value)
+        self.length = end
+        return buf_k.narrow(seq_dim, 0, end), buf_v.narrow(seq_dim, 0, end)
+
+
+@torch.no_grad()
+def quantize_kv(x: torch.Tensor, bits=8) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+        沿最后一维 (head_dim) 非对称量化 , 返回 (uint8 数据 , [..., 2] 的 (scale , min) , dtype 与 x 相同)
+        bits=4 时相邻两个值打包为一个 uint8
+    '''
+    qmax = 2 ** bits - 1
+    xf = x.float()
+    x_min = xf.amin(-1, keepdim=True)
+    scale = (xf.amax(-1, keepdim=True) - x_min) / qmax
+    # 先按存储精度取整 , 量化与反量化使用同一组参数
+    scale = scale.clamp_min(torch.finfo(x.dtype).tiny).to(x.dtype)
+    x_min = x_min.to(x.dtype)
+    q = ((xf - x_min.float()) / scale.float()).round_().clamp_(0, qmax).to(torch.uint8)
+    if bits == 4:
+        q = q[..., 0::2] | (q[..., 1::2] << 4)
+    return q, torch.cat((scale, x_min), dim=-1)
+
+
+def dequantize_kv(q: torch.Tensor, meta: torch.Tensor, bits=8, dtype=None) -> torch.Tensor:
+    dtype = dtype or meta.dtype
+    if bits == 4:
+        q = torch.stack((q & 0x0F, q >> 4), dim=-1).flatten(-2)
+    meta = meta.to(dtype)
+    return torch.addcmul(meta[..., 1:], q.to(dtype), meta[..., :1])
+
+
+class QuantizedKVCache:
+    '''
+        bits: 8 或 4 , seq_dim: 与 KVCacheBuffer 相同 , block_size: 量化数据同样预分配原地追加
+        int8 约为 fp16 cache 的 (d + 4) / 2d , int4 约为 (d / 2 + 4) / 2d (d = head_dim , d=128 时分别约 0.52 , 0.27)
+    '''
+    def __init__(self, bits=8, seq_dim=2, block_size=256):
+        if bits not in (4, 8):
+            raise ValueError('kv cache bits must be 4 or 8, got {}'.format(bits))
+        self.bits = bits
+        self.seq_dim = seq_dim
+        self.data_buffer = KVCacheBuffer(seq_dim=seq_dim, block_size=block_size)
+        self.meta_buffer = KVCacheBuffer(seq_dim=seq_dim, block_size=block_size)
+
+    @staticmethod
+    def is_quantized(kv_cache) -> bool:
+        return kv_cache is not None and not isinstance(kv_cache, torch.Tensor) and len(kv_cache) == 4
+
+    def update(self, kv_cache, key: torch.Tensor, value: torch.Tensor):
+        '''
+            kv_cache: None , 全精度 (key , value) (例如 p-tuning 的 prefix) 或上一步返回的量化 cache
+            返回 (key , value , present) : 本步 attention 使用的全精度 key / value , 写回 past_key_values 的量化 cache
+        '''
+        seq_dim = self.seq_dim
+        if kv_cache is not None and not self.is_quantized(kv_cache):
+            # 全精度的历史与本步一起量化
+            key = torch.cat((kv_cache[0].to(key.dtype), key), dim=seq_dim)
+            value = torch.cat((kv_cache[1].to(value.dtype), value), dim=seq_dim)
+            kv_cache = None
+        key_q, key_meta = quantize_kv(key, self.bits)
+        value_q, value_meta = quantize_kv(value, self.bits)
+        if kv_cache is None:
+            data = self.data_buffer.append(None, key_q, value_q)
+            meta = self.meta_buffer.append(None, key_meta, value_meta)
+            return key, value, data + meta
+
+        past_key_q, past_value_q, past_key_meta, past_value_meta = kv_cache
+        past_key = dequantize_kv(past_key_q, past_key_meta, self.bits, key.dtype)
+        past_value = dequantize_kv(past_value_q, past_value_meta, self.bits, value.dtype)
+        data = self.data_buffer.append((past_key_q, past_value_q), key_q, value_q)
+        meta = self.meta_buffer.append((past_key_meta, past_value_meta), key_meta, value_meta)
+        key = torch.cat((past_key, key), dim=seq_dim)
+        value = torch.cat((past_value, value), dim=seq_dim)
+        return key, value, data + meta
+
+
+def build_kv_quantizer(config, seq_dim=2) -> Optional[QuantizedKVCache]:
+    '''
+        config.kv_cache_bits 为 8 / 4 时返回 QuantizedKVCache , 未设置 (None / 0 / 16) 返回 None
+    '''
+    bits = getattr(config, 'kv_cache_bits', None)
+    if not bits or bits >= 16:
+        return None
+    return QuantizedKVCache(bits, seq_dim=seq_dim, block_size=getattr(config, 'kv_cache_block_size', 256))
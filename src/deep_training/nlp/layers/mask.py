@@ -5,7 +5,11 @@ import torch
 
 __all__ = [
     'lm_mask',
-    'unilm_mask'
+    'unilm_mask',
+    'first_token_index',
+    'glm_mask_positions',
+    'glm_prefix_lm_mask',
+    'glm_position_ids',
 ]
 
 
@@ -20,3 +24,58 @@ def unilm_mask(s: torch.Tensor):
     mask = idxs[:, None, :] <= idxs[:, :, None]
     return mask.long()
 
+
+def first_token_index(input_ids: torch.Tensor, token_id: int, default=None) -> torch.Tensor:
+    '''
+        每行第一个 token_id 的位置 [b] , 不存在时为 default (默认 seq_len) , 全部在 device 上完成
+    '''
+    hit = input_ids == token_id
+    # argmax 遇到并列最大值时返回第一个
+    index = hit.int().argmax(-1)
+    if default is None:
+        default = input_ids.size(-1)
+    return torch.where(hit.any(-1), index, torch.full_like(index, default))
+
+
+def glm_mask_positions(input_ids: torch.Tensor, mask_token_id: int, gmask_token_id: int):
+    '''
+        有 gMASK 用 gMASK 否则用 MASK , 返回 (mask_positions [b] , use_gmasks [b] bool)
+    '''
+    gmask_positions = first_token_index(input_ids, gmask_token_id, default=-1)
+    use_gmasks = gmask_positions >= 0
+    mask_positions = torch.where(use_gmasks, gmask_positions, first_token_index(input_ids, mask_token_id, default=0))
+    return mask_positions, use_gmasks
+
+
+def glm_prefix_lm_mask(context_lengths: torch.Tensor, seq_length: int, padding_mask=None) -> torch.Tensor:
+    '''
+        prefix lm mask , context 内双向 , 之后因果
+        context_lengths: [b] , padding_mask: [b, s] 1 为有效 token
+        返回 [b, 1, s, s] bool , True 表示屏蔽
+    '''
+    idx = torch.arange(seq_length, device=context_lengths.device)
+    visible = (idx[None, :, None] >= idx[None, None, :]) | (idx[None, None, :] < context_lengths[:, None, None])
+    if padding_mask is not None:
+        padding_mask = padding_mask.bool()
+        visible = visible & padding_mask[:, None, :] & padding_mask[:, :, None]
+    return ~visible.unsqueeze(1)
+
+
+def glm_position_ids(context_lengths: torch.Tensor, mask_positions: torch.Tensor, seq_length: int,
+                     position_encoding_2d=True, use_gmasks=None) -> torch.Tensor:
+    '''
+        position_encoding_2d : [b, 2, s] , 第一行 context 之后取 mask 位置 , 第二行 context 内为 0 之后为 1, 2, ...
+        否则 [b, s] , 非 gMASK 的样本 context 之后取 mask 位置
+    '''
+    idx = torch.arange(seq_length, dtype=torch.long, device=context_lengths.device).unsqueeze(0)
+    context_lengths = context_lengths.unsqueeze(-1)
+    mask_positions = mask_positions.unsqueeze(-1)
+    in_context = idx < context_lengths
+    if position_encoding_2d:
+        position_ids = torch.where(in_context, idx, mask_positions)
+        block_position_ids = (idx - context_lengths + 1).clamp_min(0)
+        return torch.stack((position_ids, block_position_ids), dim=1)
+    replace = ~in_context
+    if use_gmasks is not None:
+        replace = replace & ~use_gmasks.unsqueeze(-1)
+    return torch.where(replace, mask_positions, idx)
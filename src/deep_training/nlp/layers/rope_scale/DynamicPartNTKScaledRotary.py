@@ -1,5 +1,6 @@
 import torch
 import math
+from .registry import CachedRotaryBase
 
 
 def find_correction_factor(num_rotations, dim, base=10000, max_position_embeddings=2048):
@@ -28,7 +29,9 @@ def find_newbase_ntk(dim, base=10000, scale=1):
     return base * scale ** (dim / (dim-2))
 
 
-class DynamicPartNTKScaledRotary(torch.nn.Module):
+class DynamicPartNTKScaledRotary(CachedRotaryBase):
+    growth = False
+
     def __init__(self, dim, max_position_embeddings=2048, original_max_position_embeddings=2048, base=10000, ntk_factor=1, extrapolation_factor=1, finetuned=False, device=None):
         super().__init__()
         self.dim = dim
@@ -43,40 +46,11 @@ class DynamicPartNTKScaledRotary(torch.nn.Module):
                 (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
             self.register_buffer("inv_freq", inv_freq)
 
-        # Build here to make `torch.jit.trace` work.
-        self.max_seq_len_cached = max_position_embeddings
-        t = torch.arange(self.max_seq_len_cached,
-                         device=self.inv_freq.device, dtype=self.inv_freq.dtype)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        dtype = torch.get_default_dtype()
-        self.register_buffer("cos_cached", emb.cos()[
-                             None, None, :, :].to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin()[
-                             None, None, :, :].to(dtype), persistent=False)
-
-    def forward(self, x, seq_len=None):
-        # x: [bs, num_attention_heads, seq_len, head_size]
-        # This `if` block is unlikely to be run after we build sin/cos in `__init__`. Keep the logic here just in case.
-        if seq_len > self.max_seq_len_cached:
-            self.max_seq_len_cached = seq_len
-
-            self.ntk(seq_len / self.max_position_embeddings, x.device)
-
-            t = torch.arange(self.max_seq_len_cached,
-                             device=x.device, dtype=self.inv_freq.dtype)
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            self.register_buffer("cos_cached", emb.cos()[
-                                 None, None, :, :].to(x.dtype), persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[
-                                 None, None, :, :].to(x.dtype), persistent=False)
-        return (
-            self.cos_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-            self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-        )
+        self.init_cache(max_position_embeddings)
+
+    def update_scaling(self, seq_len, device):
+        self.ntk(seq_len / self.max_position_embeddings, device)
+        self.refresh_key()
 
     def ntk(self, scale, device):
 
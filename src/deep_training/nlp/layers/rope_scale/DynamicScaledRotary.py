@@ -1,7 +1,11 @@
 import math
 import torch
+from .registry import CachedRotaryBase, CachedRotaryGLMBase
+
+class DynamicScaledRotary(CachedRotaryBase):
+    # 表内容依赖缓存长度 , 不能按倍数预留
+    growth = False
 
-class DynamicScaledRotary(torch.nn.Module):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, ntk=False, device=None):
         super().__init__()
         self.ntk = ntk
@@ -10,72 +14,38 @@ class DynamicScaledRotary(torch.nn.Module):
         self.max_position_embeddings = max_position_embeddings
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
         self.register_buffer("inv_freq", inv_freq)
+        self.init_cache(max_position_embeddings)
 
-        # Build here to make `torch.jit.trace` work.
-        self.max_seq_len_cached = max_position_embeddings
-        t = torch.arange(self.max_seq_len_cached, device=self.inv_freq.device, dtype=self.inv_freq.dtype)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        dtype = torch.get_default_dtype()
-        self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False)
-
-    def forward(self, x, seq_len=None):
-        # x: [bs, num_attention_heads, seq_len, head_size]
-        # This `if` block is unlikely to be run after we build sin/cos in `__init__`. Keep the logic here just in case.
-        if seq_len > self.max_seq_len_cached:
-            self.max_seq_len_cached = seq_len
-            if self.ntk:
-                base = self.base * ((self.ntk * seq_len / self.max_position_embeddings) - (self.ntk - 1)) ** (self.dim / (self.dim-2))
-                inv_freq = 1.0 / (base ** (torch.arange(0, self.dim, 2).float().to(x.device) / self.dim))
-                self.register_buffer("inv_freq", inv_freq)
-            t = torch.arange(self.max_seq_len_cached, device=x.device, dtype=self.inv_freq.dtype)
-            if not self.ntk:
-                t *= self.max_position_embeddings / seq_len
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(x.dtype), persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(x.dtype), persistent=False)
-        return (
-            self.cos_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-            self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-        )
+    def update_scaling(self, seq_len, device):
+        if self.ntk:
+            base = self.base * ((self.ntk * seq_len / self.max_position_embeddings) - (self.ntk - 1)) ** (self.dim / (self.dim-2))
+            self.inv_freq = 1.0 / (base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim))
+        else:
+            self.position_scale = self.max_position_embeddings / seq_len
+        self.refresh_key()
 
 
 
 
-class DynamicScaledRotaryGLM(torch.nn.Module):
+class DynamicScaledRotaryGLM(CachedRotaryGLMBase):
+    growth = False
+
     def __init__(self, dim,max_position_embeddings=2048, base=10000, ntk=False,device=None,learnable=False):
         super().__init__()
         self.ntk = ntk
+        self.base = base
+        self.dim = dim
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
         self.register_buffer("inv_freq", inv_freq)
-        self.max_seq_len_cached = None
         self.max_position_embeddings = max_position_embeddings
         self.learnable = learnable
+        self.init_cache(max_position_embeddings)
 
-
-    def forward(self, x, seq_dim=1, seq_len=None):
-        if seq_len is None:
-            seq_len = x.shape[seq_dim]
-        if self.max_seq_len_cached is None or (seq_len > self.max_seq_len_cached):
-            self.max_seq_len_cached = None if self.learnable else seq_len
-            if self.ntk:
-                base = self.base * ((self.ntk * seq_len / self.max_position_embeddings) - (self.ntk - 1)) ** (self.dim / (self.dim-2))
-                inv_freq = 1.0 / (base ** (torch.arange(0, self.dim, 2).float().to(x.device) / self.dim))
-                self.register_buffer("inv_freq", inv_freq)
-
-            t = torch.arange(self.max_seq_len_cached or seq_len, device=x.device, dtype=self.inv_freq.dtype)
-            freqs = torch.einsum('i,j->ij', t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            # [sx, 1 (b * np), hn]
-            self.register_buffer("cos_cached", emb.cos()[:, None, ...].to(x.dtype), persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[:, None, ...].to(x.dtype), persistent=False)
-
-        return self.cos_cached[:seq_len, ...], self.sin_cached[:seq_len, ...]
+    def update_scaling(self, seq_len, device):
+        if self.ntk:
+            base = self.base * ((self.ntk * seq_len / self.max_position_embeddings) - (self.ntk - 1)) ** (self.dim / (self.dim-2))
+            self.inv_freq = 1.0 / (base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim))
+        self.refresh_key()
 
 
 
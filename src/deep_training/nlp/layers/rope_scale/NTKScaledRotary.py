@@ -1,63 +1,24 @@
 import torch
+from .registry import ROPE_TABLE_REGISTRY, CachedRotaryBase, CachedRotaryGLMBase
 
-class NTKScaledRotary(torch.nn.Module):
+class NTKScaledRotary(CachedRotaryBase):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, alpha=1, device=None):
         super().__init__()
         base = base * alpha ** (dim / (dim-2))
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
         self.register_buffer("inv_freq", inv_freq)
+        self.init_cache(max_position_embeddings)
 
-        # Build here to make `torch.jit.trace` work.
-        self.max_seq_len_cached = max_position_embeddings
-        t = torch.arange(self.max_seq_len_cached, device=self.inv_freq.device, dtype=self.inv_freq.dtype)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        dtype = torch.get_default_dtype()
-        self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False)
-
-    def forward(self, x, seq_len=None):
-        # x: [bs, num_attention_heads, seq_len, head_size]
-        # This `if` block is unlikely to be run after we build sin/cos in `__init__`. Keep the logic here just in case.
-        if seq_len > self.max_seq_len_cached:
-            self.max_seq_len_cached = seq_len
-            t = torch.arange(self.max_seq_len_cached, device=x.device, dtype=self.inv_freq.dtype)
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(x.dtype), persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(x.dtype), persistent=False)
-        return (
-            self.cos_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-            self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
-        )
-
-
-class NTKScaledRotaryGLM(torch.nn.Module):
+
+class NTKScaledRotaryGLM(CachedRotaryGLMBase):
     def __init__(self, dim, max_position_embeddings=2048,base=10000, alpha=1, device=None,learnable=False):
         super().__init__()
         base = base * alpha ** (dim / (dim - 2))
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
         self.register_buffer('inv_freq', inv_freq)
-        self.max_seq_len_cached = None
         self.max_position_embeddings = max_position_embeddings
         self.learnable = learnable
-
-    def forward(self, x, seq_dim=1, seq_len=None):
-        if seq_len is None:
-            seq_len = x.shape[seq_dim]
-        if self.max_seq_len_cached is None or (seq_len > self.max_seq_len_cached):
-            self.max_seq_len_cached = None if self.learnable else max(seq_len,self.max_position_embeddings)
-            t = torch.arange(self.max_seq_len_cached or seq_len, device=x.device, dtype=self.inv_freq.dtype)
-            freqs = torch.einsum('i,j->ij', t, self.inv_freq)
-            # Different from paper, but it uses a different permutation in order to obtain the same calculation
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            # [sx, 1 (b * np), hn]
-            self.register_buffer("cos_cached", emb.cos()[:, None, ...].to(x.dtype), persistent=False)
-            self.register_buffer("sin_cached", emb.sin()[:, None, ...].to(x.dtype), persistent=False)
-
-        return self.cos_cached[:seq_len, ...], self.sin_cached[:seq_len, ...]
+        self.init_cache(max_position_embeddings)
 
 
 
@@ -98,9 +59,12 @@ class NTKScaledRotaryGLM2(torch.nn.Module):
         return cache
 
     def forward(self, max_seq_len, offset=0):
-        return self.forward_impl(
-            max_seq_len, self.dim, dtype=self.inv_freq.dtype, device=self.inv_freq.device
-        )
+        dtype, device = self.inv_freq.dtype, self.inv_freq.device
+        key = (self.__class__.__name__, self.dim, self.rope_ratio, dtype, device)
+        cache, = ROPE_TABLE_REGISTRY.get(key, max_seq_len, lambda length: (self.forward_impl(
+            length, self.dim, dtype=dtype, device=device
+        ),))
+        return cache[:max_seq_len]
 
 class NTKScaledRotaryMoss(torch.nn.Module):
     def __init__(self, dim,max_position_embeddings=2048,base=10000,rope_ratio=1.0, alpha=1, original_impl=False, device=None, dtype=None):
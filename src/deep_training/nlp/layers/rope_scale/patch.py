@@ -1,6 +1,7 @@
 from torch import nn
 from dataclasses import dataclass, field
 from typing import Optional, Union
+from .registry import ROPE_TABLE_REGISTRY
 
 __all__ = [
     'RotaryDynamicScaledArguments',
@@ -13,7 +14,8 @@ __all__ = [
     "patch_for_ntk_scaled_rotary_embeddings",
     "patch_for_linear_scaled_rotary_embeddings",
     "patch_for_part_ntk_scaled_rotary_embeddings",
-    "inject_rope_scale_layer"
+    "inject_rope_scale_layer",
+    "ROPE_TABLE_REGISTRY",
 ]
 
 def patch_for_dynamic_scaled_rotary_embeddings(model,name='rotary_emb',max_position_embeddings=None,
@@ -195,6 +197,7 @@ class RotaryPartNtkScaledArguments(RopeBaseArguments):
 def inject_rope_scale_layer(model,rope_args):
     if rope_args is None:
         return None
+    # 所有替换后的层共享 ROPE_TABLE_REGISTRY 中的 cos/sin 表
     if isinstance(rope_args,RotaryDynamicScaledArguments):
         rope_args: RotaryDynamicScaledArguments
         patch_for_dynamic_scaled_rotary_embeddings(model,name=rope_args.name,max_position_embeddings=rope_args.max_position_embeddings,
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/21 15:40
+# @FileName: registry.py
+"""
+    进程内共享的 rope cos/sin 表
+    同一模型所有层的 rotary 模块 (dim , base , scaling) 相同 , 只需要构建一份表
+    表按 (key , dtype , device) 缓存 , 返回的都是切片视图 , 调用时不再做 dtype 转换
+"""
+from collections import OrderedDict
+from typing import Callable, Tuple, Optional
+
+import torch
+
+__all__ = [
+    'RopeTableRegistry',
+    'ROPE_TABLE_REGISTRY',
+    'build_cos_sin_table',
+    'CachedRotaryBase',
+    'CachedRotaryGLMBase',
+]
+
+
+def build_cos_sin_table(inv_freq: torch.Tensor, length: int, dtype: torch.dtype,
+                        position_scale: float = 1.0) -> Tuple[torch.Tensor, torch.Tensor]:
+    t = torch.arange(length, device=inv_freq.device, dtype=torch.float32)
+    if position_scale != 1.0:
+        t *= position_scale
+    freqs = torch.outer(t, inv_freq.float())
+    # Different from paper, but it uses a different permutation in order to obtain the same calculation
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return emb.cos().to(dtype), emb.sin().to(dtype)
+
+
+class RopeTableRegistry:
+    '''
+        growth=True 时表长按 growth_factor 倍增长 , 避免逐 token 增长时反复重建
+        表内容依赖长度的 (dynamic scaling) 应传 growth=False , 并把缩放参数放进 key
+    '''
+    def __init__(self, max_entries=32, growth_factor=2.0):
+        self.max_entries = max_entries
+        self.growth_factor = growth_factor
+        self._tables = OrderedDict()
+        self._positions = {}
+
+    def clear(self):
+        self._tables.clear()
+        self._positions.clear()
+
+    def discard(self, prefix: tuple):
+        for key in [k for k in self._tables if k[:len(prefix)] == prefix]:
+            self._tables.pop(key)
+
+    def get(self, key: tuple, seq_len: int, build_fn: Callable[[int], Tuple[torch.Tensor, ...]],
+            growth=True) -> Tuple[torch.Tensor, ...]:
+        tables = self._tables.get(key, None)
+        if tables is not None and tables[0].size(0) >= seq_len:
+            self._tables.move_to_end(key)
+            return tables
+        length = seq_len
+        if growth and tables is not None:
+            length = max(seq_len, int(tables[0].size(0) * self.growth_factor))
+        tables = self._tables[key] = build_fn(length)
+        self._tables.move_to_end(key)
+        while len(self._tables) > self.max_entries:
+            self._tables.popitem(last=False)
+        return tables
+
+    def max_position(self, position_ids: torch.Tensor) -> int:
+        # 所有层共用同一个 position_ids 张量 , 每次 forward 只同步一次
+        last = self._positions.get(position_ids.device, None)
+        if last is not None and last[0] is position_ids:
+            return last[1]
+        value = int(position_ids.max()) + 1
+        self._positions[position_ids.device] = (position_ids, value)
+        return value
+
+
+ROPE_TABLE_REGISTRY = RopeTableRegistry()
+
+
+class CachedRotaryBase(torch.nn.Module):
+    '''
+        llama 风格 rotary , 子类在 __init__ 中注册 inv_freq 后调用 init_cache
+        forward(x, seq_len) 返回 [1, 1, seq_len, dim]
+        forward(x, position_ids) 按 position_ids 取表 , 返回 [bs, seq_len, dim] , 支持 packed / offset 序列
+    '''
+    registry = ROPE_TABLE_REGISTRY
+    position_scale = 1.0
+    growth = True
+
+    def init_cache(self, max_position_embeddings, dtype=None):
+        # Build here to make `torch.jit.trace` work.
+        self.max_seq_len_cached = max_position_embeddings
+        self.refresh_key()
+        self.get_table(max_position_embeddings, dtype or torch.get_default_dtype(), self.inv_freq.device)
+
+    def refresh_key(self):
+        # inv_freq 或 position_scale 变化后调用
+        self._table_key = (self.__class__.__name__, self.inv_freq.size(-1) * 2,
+                           hash(tuple(self.inv_freq.tolist())), self.position_scale)
+
+    def update_scaling(self, seq_len: int, device):
+        ...
+
+    def get_table(self, seq_len, dtype, device) -> Tuple[torch.Tensor, torch.Tensor]:
+        inv_freq = self.inv_freq
+        position_scale = self.position_scale
+        return self.registry.get(self._table_key + (dtype, device), seq_len,
+                                 lambda length: build_cos_sin_table(inv_freq.to(device), length, dtype, position_scale),
+                                 growth=self.growth)
+
+    def get_table_for(self, x, seq_len):
+        if seq_len > self.max_seq_len_cached:
+            self.max_seq_len_cached = seq_len
+            old_key = self._table_key
+            self.update_scaling(seq_len, x.device)
+            if self._table_key != old_key:
+                # dynamic scaling 的旧表不会再被用到
+                self.registry.discard(old_key)
+        return self.get_table(self.max_seq_len_cached, x.dtype, x.device)
+
+    @property
+    def cos_cached(self):
+        return self.get_table(self.max_seq_len_cached, torch.get_default_dtype(), self.inv_freq.device)[0][None, None]
+
+    @property
+    def sin_cached(self):
+        return self.get_table(self.max_seq_len_cached, torch.get_default_dtype(), self.inv_freq.device)[1][None, None]
+
+    def forward(self, x, seq_len=None, position_ids: Optional[torch.Tensor] = None):
+        # x: [bs, num_attention_heads, seq_len, head_size]
+        if torch.is_tensor(seq_len):
+            seq_len, position_ids = None, seq_len
+        if position_ids is not None:
+            seq_len = max(self.registry.max_position(position_ids), seq_len or 0)
+        elif seq_len is None:
+            seq_len = x.shape[-2]
+        cos, sin = self.get_table_for(x, seq_len)
+        if position_ids is not None:
+            return cos[position_ids], sin[position_ids]
+        return cos[None, None, :seq_len], sin[None, None, :seq_len]
+
+
+class CachedRotaryGLMBase(CachedRotaryBase):
+    '''
+        chatglm 风格 , 返回 [seq_len, 1, dim]
+    '''
+    learnable = False
+
+    def forward(self, x, seq_dim=1, seq_len=None):
+        if seq_len is None:
+            seq_len = x.shape[seq_dim]
+        if self.learnable:
+            cos, sin = build_cos_sin_table(self.inv_freq, seq_len, x.dtype, self.position_scale)
+        else:
+            cos, sin = self.get_table_for(x, seq_len)
+        return cos[:seq_len, None], sin[:seq_len, None]
@@ -2,6 +2,7 @@ import torch
 from torch import nn, Tensor
 from typing import Iterable, Dict
 from .utils import cos_sim
+from .distributed import DistributedSimilarity
 import numpy as np
 
 class ContrastiveTensionLoss(nn.Module):
@@ -32,12 +33,16 @@ class ContrastiveTensionLoss(nn.Module):
 
 
 class ContrastiveTensionLossInBatchNegatives(nn.Module):
-    def __init__(self,  scale: float = 20.0, similarity_fct = cos_sim):
+    def __init__(self,  scale: float = 20.0, similarity_fct = cos_sim, distributed=False, same_size=False):
         """
         :param model: SentenceTransformer model
+        :param distributed: all_gather both sides from all ranks to use them as in-batch negatives
+        :param same_size: every rank has the same batch size (e.g. drop_last), skips gathering the row counts
         """
         super(ContrastiveTensionLossInBatchNegatives, self).__init__()
         self.similarity_fct = similarity_fct
+        self.distributed = distributed
+        self.similarity = DistributedSimilarity(similarity_fct, enabled=distributed, same_size=same_size)
         self.cross_entropy_loss = nn.CrossEntropyLoss()
         #self.scale = scale
         self.logit_scale = nn.Parameter(torch.ones([]) * np.log(scale))
@@ -47,6 +52,14 @@ class ContrastiveTensionLossInBatchNegatives(nn.Module):
         # embeddings_a = self.model1(sentence_features1)['sentence_embedding']  # (bsz, hdim)
         # embeddings_b = self.model2(sentence_features2)['sentence_embedding']
 
+        if self.distributed:
+            # local features of one side against the gathered features of the other side
+            scores, labels = self.similarity(sentence_features1, sentence_features2)
+            scores_t, labels_t = self.similarity(sentence_features2, sentence_features1)
+            logit_scale = self.logit_scale.exp()
+            return (self.cross_entropy_loss(scores * logit_scale, labels) +
+                    self.cross_entropy_loss(scores_t * logit_scale, labels_t)) / 2
+
         scores = self.similarity_fct(sentence_features1, sentence_features2) * self.logit_scale.exp()  #self.scale
         labels = torch.tensor(range(len(scores)), dtype=torch.long, device=scores.device)
         return (self.cross_entropy_loss(scores, labels) + self.cross_entropy_loss(scores.t(), labels))/2
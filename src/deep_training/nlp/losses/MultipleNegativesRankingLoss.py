@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from .utils import cos_sim
+from .distributed import DistributedSimilarity
 
 
 class MultipleNegativesRankingLoss(nn.Module):
@@ -25,14 +26,18 @@ class MultipleNegativesRankingLoss(nn.Module):
         Here, n_1 is a hard negative for (a_1, p_1). The loss will use for the pair (a_i, p_i) all p_j (j!=i) and all n_j as negatives.
 
     """
-    def __init__(self, scale: float = 20.0, similarity_fct = cos_sim):
+    def __init__(self, scale: float = 20.0, similarity_fct = cos_sim, distributed=False, same_size=False):
         """
         :param scale: Output of similarity function is multiplied by scale value
         :param similarity_fct: similarity function between sentence embeddings. By default, cos_sim. Can also be set to dot product (and then set scale to 1)
+        :param distributed: all_gather candidates from all ranks, so every rank's positives and negatives are used as negatives
+        :param same_size: every rank has the same batch size (e.g. drop_last), skips gathering the row counts
         """
         super(MultipleNegativesRankingLoss, self).__init__()
         self.scale = scale
         self.similarity_fct = similarity_fct
+        self.distributed = distributed
+        self.similarity = DistributedSimilarity(similarity_fct, enabled=distributed, same_size=same_size)
         self.cross_entropy_loss = nn.CrossEntropyLoss()
 
 
@@ -40,9 +45,10 @@ class MultipleNegativesRankingLoss(nn.Module):
         # reps = [self.model(sentence_feature)['sentence_embedding'] for sentence_feature in sentence_features]
         embeddings_a = reps[0]
         embeddings_b = torch.cat(reps[1:])
-        scores = self.similarity_fct(embeddings_a, embeddings_b) * self.scale
-        labels = torch.arange(0,scores.size(0),dtype=torch.long,device=scores.device) # Example a[i] should match with b[i]
+        # Example a[i] should match with b[i]; if distributed, b is concatenated over ranks and labels are offset to this rank
+        scores, labels = self.similarity(embeddings_a, embeddings_b)
+        scores = scores * self.scale
         return self.cross_entropy_loss(scores, labels)
 
     def get_config_dict(self):
-        return {'scale': self.scale, 'similarity_fct': self.similarity_fct.__name__}
+        return {'scale': self.scale, 'similarity_fct': self.similarity_fct.__name__, 'distributed': self.distributed}
@@ -2,6 +2,7 @@ import torch
 from torch import nn, Tensor
 from typing import Iterable, Dict
 from .utils import cos_sim
+from .distributed import DistributedSimilarity
 
 class MultipleNegativesSymmetricRankingLoss(nn.Module):
     """
@@ -28,15 +29,19 @@ class MultipleNegativesSymmetricRankingLoss(nn.Module):
             train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=32)
             train_loss = losses.MultipleNegativesSymmetricRankingLoss(model=model)
     """
-    def __init__(self,scale: float = 20.0, similarity_fct = cos_sim):
+    def __init__(self,scale: float = 20.0, similarity_fct = cos_sim, distributed=False, same_size=False):
         """
         :param model: SentenceTransformer model
         :param scale: Output of similarity function is multiplied by scale value
         :param similarity_fct: similarity function between sentence embeddings. By default, cos_sim. Can also be set to dot product (and then set scale to 1)
+        :param distributed: all_gather candidates and anchors from all ranks to use them as negatives
+        :param same_size: every rank has the same batch size (e.g. drop_last), skips gathering the row counts
         """
         super(MultipleNegativesSymmetricRankingLoss, self).__init__()
         self.scale = scale
         self.similarity_fct = similarity_fct
+        self.distributed = distributed
+        self.similarity = DistributedSimilarity(similarity_fct, enabled=distributed, same_size=same_size)
         self.cross_entropy_loss = nn.CrossEntropyLoss()
 
 
@@ -45,16 +50,23 @@ class MultipleNegativesSymmetricRankingLoss(nn.Module):
         anchor = reps[0]
         candidates = torch.cat(reps[1:])
 
-        scores = self.similarity_fct(anchor, candidates) * self.scale
-        labels = torch.tensor(range(len(scores)), dtype=torch.long, device=scores.device)  # Example a[i] should match with b[i]
-
-        anchor_positive_scores = scores[:, 0:len(reps[1])]
-        forward_loss = self.cross_entropy_loss(scores, labels)
-        backward_loss = self.cross_entropy_loss(anchor_positive_scores.transpose(0, 1), labels)
+        if not self.distributed:
+            scores = self.similarity_fct(anchor, candidates) * self.scale
+            labels = torch.tensor(range(len(scores)), dtype=torch.long, device=scores.device)  # Example a[i] should match with b[i]
+
+            anchor_positive_scores = scores[:, 0:len(reps[1])]
+            forward_loss = self.cross_entropy_loss(scores, labels)
+            backward_loss = self.cross_entropy_loss(anchor_positive_scores.transpose(0, 1), labels)
+        else:
+            # local anchors against the candidates of all ranks, local positives against the anchors of all ranks
+            scores, labels = self.similarity(anchor, candidates)
+            forward_loss = self.cross_entropy_loss(scores * self.scale, labels)
+            scores, labels = self.similarity(reps[1], anchor)
+            backward_loss = self.cross_entropy_loss(scores * self.scale, labels)
         return (forward_loss + backward_loss) / 2
 
     def get_config_dict(self):
-        return {'scale': self.scale, 'similarity_fct': self.similarity_fct.__name__}
+        return {'scale': self.scale, 'similarity_fct': self.similarity_fct.__name__, 'distributed': self.distributed}
 
 
 
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/30 10:15
+# @FileName: distributed.py
+"""
+    in-batch 负例 loss 的跨卡版本
+    各 rank 的句向量 all_gather 后参与相似度计算 , 负例数随 world_size 线性增长
+    backward 时梯度 all_reduce 后只回传本 rank 的分片 , 与单卡大 batch 的梯度一致 (DDP 对各 rank 取均值)
+    未初始化分布式或 world_size == 1 时不做任何通信
+    各 rank 行数不同时先 all_gather 行数 , 已知行数相同 (same_size=True , 例如 drop_last) 时省掉这次通信
+"""
+from typing import Optional, Tuple, Callable
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch import Tensor
+
+__all__ = [
+    'is_distributed',
+    'all_gather_with_grad',
+    'DistributedSimilarity',
+]
+
+
+def is_distributed(group=None) -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size(group) > 1
+
+
+def _gather_sizes(tensor: Tensor, group=None):
+    size = torch.tensor([tensor.size(0)], dtype=torch.long, device=tensor.device)
+    sizes = [torch.zeros_like(size) for _ in range(dist.get_world_size(group))]
+    dist.all_gather(sizes, size, group=group)
+    return [int(s) for s in torch.cat(sizes).tolist()]
+
+
+class _AllGatherWithGrad(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, tensor: Tensor, group, sizes):
+        ctx.group = group
+        ctx.sizes = sizes
+        ctx.rank = dist.get_rank(group)
+        max_size = max(sizes)
+        if tensor.size(0) < max_size:
+            # 各 rank 行数不同时 (最后一个 batch) 补齐到最长
+            tensor = F.pad(tensor, [0, 0] * (tensor.dim() - 1) + [0, max_size - tensor.size(0)])
+        tensor = tensor.contiguous()
+        outputs = [torch.empty_like(tensor) for _ in sizes]
+        dist.all_gather(outputs, tensor, group=group)
+        return torch.cat([o[:n] for o, n in zip(outputs, sizes)], dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor):
+        # 每个 rank 的 loss 都用到了本 rank 的分片 , 梯度求和后取本 rank 的部分
+        grad = grad_output.contiguous().clone()
+        dist.all_reduce(grad, op=dist.ReduceOp.SUM, group=ctx.group)
+        start = sum(ctx.sizes[:ctx.rank])
+        return grad[start: start + ctx.sizes[ctx.rank]], None, None
+
+
+def all_gather_with_grad(tensor: Tensor, group=None, same_size=False) -> Tuple[Tensor, int]:
+    '''
+        tensor: [N_local, ...] -> ([sum(N_r), ...] , 本 rank 在结果中的起始行)
+        结果按 rank 顺序拼接 , 梯度只流回本 rank 的分片
+        same_size: 调用方保证各 rank 行数相同 , 不再收集各 rank 的行数
+    '''
+    if not is_distributed(group):
+        return tensor, 0
+    if same_size:
+        sizes = [tensor.size(0)] * dist.get_world_size(group)
+    else:
+        sizes = _gather_sizes(tensor, group)
+    offset = sum(sizes[:dist.get_rank(group)])
+    return _AllGatherWithGrad.apply(tensor, group, sizes), offset
+
+
+class DistributedSimilarity(torch.nn.Module):
+    '''
+        query 为本 rank 的向量 , keys 跨 rank 收集后计算 [N_local, sum(M_r)] 的相似度
+        labels[i] = 全局 keys 中与 query[i] 配对的行 , 即 keys 在每个 rank 上前 N_local 行是 query 的正例
+        enabled=False 或非分布式时等价于 similarity_fct(query, keys) , labels = arange(N_local)
+        same_size 见 all_gather_with_grad
+    '''
+    def __init__(self, similarity_fct: Callable[[Tensor, Tensor], Tensor], enabled=True, group=None, same_size=False):
+        super(DistributedSimilarity, self).__init__()
+        self.similarity_fct = similarity_fct
+        self.enabled = enabled
+        self.group = group
+        self.same_size = same_size
+
+    def gather(self, tensor: Tensor) -> Tuple[Tensor, int]:
+        if not self.enabled:
+            return tensor, 0
+        return all_gather_with_grad(tensor, self.group, same_size=self.same_size)
+
+    def forward(self, query: Tensor, keys: Tensor) -> Tuple[Tensor, Tensor]:
+        keys, offset = self.gather(keys)
+        scores = self.similarity_fct(query, keys)
+        labels = torch.arange(offset, offset + query.size(0), dtype=torch.long, device=scores.device)
+        return scores, labels
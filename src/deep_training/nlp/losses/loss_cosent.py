@@ -3,6 +3,7 @@
 import torch
 from torch import nn
 from torch.nn import  functional as F
+from .distributed import all_gather_with_grad
 
 
 def cat_even_odd_reorder(logits1,logits2):
@@ -17,13 +18,22 @@ def cat_even_odd_reorder(logits1,logits2):
     return mid_logits_state
 
 class CoSentLoss(nn.Module):
-    def __init__(self):
+    def __init__(self, distributed=False, same_size=False):
+        """
+        distributed: 各 rank 的句向量对 all_gather 后一起排序 , 每个 rank 的句向量对数需为偶数行 (成对排列)
+        same_size: 各 rank 行数相同 , 不再收集各 rank 的行数
+        """
         super(CoSentLoss, self).__init__()
+        self.distributed = distributed
+        self.same_size = same_size
 
     def forward(self,y_true, y_pred):
         """排序交叉熵
         y_true：标签/打分，y_pred：句向量
         """
+        if self.distributed:
+            y_true, _ = all_gather_with_grad(y_true, same_size=self.same_size)
+            y_pred, _ = all_gather_with_grad(y_pred, same_size=self.same_size)
         y_true = y_true[::2, 0]
         y_true = y_true[:, None] < y_true[None, :]
         y_true = y_true.float()
@@ -5,6 +5,7 @@
 import torch
 import torch.nn.functional as F
 from torch import nn
+from .distributed import all_gather_with_grad, is_distributed
 
 __all__ = ['InfoNCE', 'info_nce']
 
@@ -30,6 +31,10 @@ class InfoNCE(nn.Module):
             If 'paired', then each query sample is paired with a number of negative keys.
             Comparable to a triplet loss, but with multiple negatives per sample.
             If 'unpaired', then the set of negative keys are all unrelated to any positive key.
+        distributed: If True, the in-batch positive keys (or the unpaired negative keys) are all-gathered
+            from every rank, so negatives scale with the world size. Paired negatives are never gathered;
+            in paired mode the positive keys of the other ranks are added as extra unpaired negatives.
+        same_size: Every rank has the same batch size (e.g. drop_last), skips gathering the row counts.
 
     Input shape:
         query: (N, D) Tensor with query samples (e.g. embeddings of the input).
@@ -51,20 +56,26 @@ class InfoNCE(nn.Module):
         >>> output = loss(query, positive_key, negative_keys)
     """
 
-    def __init__(self, temperature=0.1, reduction='mean', negative_mode='unpaired'):
+    def __init__(self, temperature=0.1, reduction='mean', negative_mode='unpaired', distributed=False,
+                 same_size=False):
         super().__init__()
         self.temperature = temperature
         self.reduction = reduction
         self.negative_mode = negative_mode
+        self.distributed = distributed
+        self.same_size = same_size
 
     def forward(self, query, positive_key, negative_keys=None):
         return info_nce(query, positive_key, negative_keys,
                         temperature=self.temperature,
                         reduction=self.reduction,
-                        negative_mode=self.negative_mode)
+                        negative_mode=self.negative_mode,
+                        distributed=self.distributed,
+                        same_size=self.same_size)
 
 
-def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction='mean', negative_mode='unpaired'):
+def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction='mean', negative_mode='unpaired',
+             distributed=False, same_size=False):
     # Check input dimensionality.
     if query.dim() != 2:
         raise ValueError('<query> must have 2 dimensions.')
@@ -100,15 +111,22 @@ def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction
         positive_logit = torch.sum(query * positive_key, dim=1, keepdim=True)
 
         if negative_mode == 'unpaired':
+            if distributed:
+                negative_keys, _ = all_gather_with_grad(negative_keys, same_size=same_size)
             # Cosine between all query-negative combinations
             #b,h ; h,b
             negative_logits = query @ transpose(negative_keys)
 
         elif negative_mode == 'paired':
-            query = query.unsqueeze(1)
             #b,1,h;b,h,n
-            negative_logits = query @ transpose(negative_keys)
+            negative_logits = query.unsqueeze(1) @ transpose(negative_keys)
             negative_logits = negative_logits.squeeze(1)
+            if distributed and is_distributed():
+                # Positive keys of the other ranks as extra unpaired negatives
+                gathered, offset = all_gather_with_grad(positive_key, same_size=same_size)
+                other_keys = torch.cat([gathered[:offset], gathered[offset + len(query):]], dim=0)
+                #b,h ; h,(world-1)*b
+                negative_logits = torch.cat([negative_logits, query @ transpose(other_keys)], dim=1)
 
         # First index in last dimension are the positive samples
         #b,1+n
@@ -116,13 +134,16 @@ def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction
         labels = torch.zeros(len(logits), dtype=torch.long, device=query.device)
     else:
         # Negative keys are implicitly off-diagonal positive keys.
+        offset = 0
+        if distributed:
+            positive_key, offset = all_gather_with_grad(positive_key, same_size=same_size)
 
         # Cosine between all combinations
         #b,b
         logits = query @ transpose(positive_key)
 
         # Positive keys are the entries on the diagonal
-        labels = torch.arange(len(query), device=query.device)
+        labels = torch.arange(offset, offset + len(query), device=query.device)
 
     return F.cross_entropy(logits / temperature, labels, reduction=reduction)
 
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/31 14:10
+# @FileName: retrieval.py
+"""
+    检索评估 recall@k , MRR , 按 query 批次累加 , 不保留全部检索结果
+"""
+import numbers
+from typing import Sequence, Union, Iterable, Dict, Tuple
+
+import torch
+
+__all__ = [
+    'pad_positives',
+    'RetrievalMetrics',
+    'evaluate_retrieval',
+]
+
+
+def pad_positives(positives: Sequence[Union[int, Iterable[int]]], device=None) -> torch.Tensor:
+    '''
+        每个 query 的正例 id (int 或 id 列表) -> [q, P] , 不足补 -2 (不会与检索结果的 -1 相等)
+    '''
+    positives = [[p] if isinstance(p, numbers.Integral) else list(p) for p in positives]
+    width = max([len(p) for p in positives] + [1])
+    out = torch.full((len(positives), width), -2, dtype=torch.long)
+    for i, p in enumerate(positives):
+        if p:
+            out[i, :len(p)] = torch.as_tensor(p, dtype=torch.long)
+    return out.to(device) if device is not None else out
+
+
+class RetrievalMetrics:
+    '''
+        recall@k = top-k 中的正例数 / 正例数 , mrr@K 取第一个正例的倒数排名 , K = max(ks)
+    '''
+    def __init__(self, ks: Sequence[int] = (1, 5, 10, 100)):
+        self.ks = sorted(ks)
+        self.reset()
+
+    def reset(self):
+        self.num = 0
+        self._recall = {k: 0.0 for k in self.ks}
+        self._rr = 0.0
+
+    def update(self, indices: torch.Tensor, positives: Union[torch.Tensor, Sequence]):
+        '''
+            indices: [q, >= max(ks)] 检索结果 , positives: pad_positives 的结果或原始列表
+        '''
+        if not isinstance(positives, torch.Tensor):
+            positives = pad_positives(positives)
+        positives = positives.to(indices.device)
+        max_k = self.ks[-1]
+        indices = indices[:, :max_k]
+        hits = (indices.unsqueeze(-1) == positives.unsqueeze(1)).any(-1)  # [q, K]
+        num_pos = (positives >= 0).sum(-1).clamp_min(1).float()
+        cum_hits = hits.cumsum(-1).float()
+        for k in self.ks:
+            col = min(k, cum_hits.size(1)) - 1
+            self._recall[k] += float((cum_hits[:, col] / num_pos).sum())
+        found = hits.any(-1)
+        first = hits.float().argmax(-1).float() + 1
+        self._rr += float(torch.where(found, 1.0 / first, torch.zeros_like(first)).sum())
+        self.num += indices.size(0)
+
+    def compute(self) -> Dict[str, float]:
+        num = max(self.num, 1)
+        out = {'recall@{}'.format(k): v / num for k, v in self._recall.items()}
+        out['mrr@{}'.format(self.ks[-1])] = self._rr / num
+        return out
+
+
+def evaluate_retrieval(index, queries, positives: Sequence, ks: Sequence[int] = (1, 5, 10, 100),
+                       query_batch=4096, **search_kwargs) -> Dict[str, float]:
+    '''
+        index: ExactIndex / IVFPQIndex (iter_search 接口)
+        queries 与 positives 按行对应 , positives[i] 为第 i 个 query 的正例 id (int 或列表)
+    '''
+    metrics = RetrievalMetrics(ks)
+    for start, _, indices in index.iter_search(queries, k=max(ks), query_batch=query_batch, **search_kwargs):
+        metrics.update(indices, positives[start: start + indices.size(0)])
+    return metrics.compute()
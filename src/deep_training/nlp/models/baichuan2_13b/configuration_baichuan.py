@@ -27,6 +27,8 @@ class BaichuanConfig(PretrainedConfig):
         z_loss_weight=0,
         quantization_method="cpm",
         quantization_bit=0,
+        alibi_block_size=None,
+        kv_cache_bits=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -43,6 +45,10 @@ class BaichuanConfig(PretrainedConfig):
         self.gradient_checkpointing = gradient_checkpointing
         self.quantization_method = quantization_method
         self.quantization_bit = quantization_bit
+        # ALiBi bias 按 query 分块计算的块大小 , None 时按显存预算自动确定
+        self.alibi_block_size = alibi_block_size
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
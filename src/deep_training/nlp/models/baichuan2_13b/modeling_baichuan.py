@@ -4,8 +4,10 @@ import glob
 from transformers.deepspeed import is_deepspeed_zero3_enabled
 
 from ...utils.torch_utils import skip_init
+from ...layers.kv_cache import build_kv_quantizer
 from .configuration_baichuan import BaichuanConfig
 from .generation_utils import build_chat_input, TextIterStreamer
+from ...layers.alibi import alibi_slopes, alibi_attention
 
 import math
 from threading import Thread
@@ -37,56 +39,6 @@ def setup_model_profile(skip_init_flag=True):
     else:
         skip_init_function = default_init
 
-try:
-    from xformers import ops as xops
-except ImportError:
-    xops = None
-    logger.warning(
-        "Xformers is not installed correctly. If you want to use memory_efficient_attention to accelerate training use the following command to install Xformers\npip install xformers."
-    )
-
-
-def _get_interleave(n):
-    def _get_interleave_power_of_2(n):
-        start = 2 ** (-(2 ** -(math.log2(n) - 3)))
-        ratio = start
-        return [start * ratio**i for i in range(n)]
-
-    if math.log2(n).is_integer():
-        return _get_interleave_power_of_2(n)
-    else:
-        closest_power_of_2 = 2 ** math.floor(math.log2(n))
-        return (
-            _get_interleave_power_of_2(closest_power_of_2)
-            + _get_interleave(2 * closest_power_of_2)[0::2][: n - closest_power_of_2]
-        )
-
-
-def _fill_with_neg_inf(t):
-    """FP16-compatible function that fills a tensor with -inf."""
-    return t.float().fill_(float("-inf")).type_as(t)
-
-
-def _buffered_future_mask(tensor, maxpos, alibi, attn_heads):
-    _future_mask = torch.triu(_fill_with_neg_inf(torch.zeros([maxpos, maxpos])), 1)
-    _future_mask = _future_mask.unsqueeze(0) + alibi
-    new_future_mask = _future_mask.to(tensor)
-    return new_future_mask[: tensor.shape[0] * attn_heads, :maxpos, :maxpos]
-
-
-def _gen_alibi_mask(tensor, n_head, max_pos):
-    slopes = torch.Tensor(_get_interleave(n_head))
-    position_point = torch.arange(max_pos) - max_pos + 1
-    position_point = position_point.unsqueeze(0).unsqueeze(0).expand(n_head, -1, -1)
-    diag = torch.diag(position_point[0])
-    position_point = position_point - diag.unsqueeze(0).unsqueeze(0).transpose(-1, -2)
-    alibi = slopes.unsqueeze(1).unsqueeze(1) * position_point
-    alibi = alibi.view(n_head, 1, max_pos)
-    alibi_mask = torch.triu(_fill_with_neg_inf(torch.zeros([max_pos, max_pos])), 1)
-    alibi_mask = alibi_mask.unsqueeze(0) + alibi
-    return alibi_mask
-
-
 class RMSNorm(torch.nn.Module):
     def __init__(self, hidden_size, epsilon=1e-6,**kwargs):
         super().__init__()
@@ -125,6 +77,7 @@ class BaichuanAttention(torch.nn.Module):
     def __init__(self, config: BaichuanConfig,**kwargs):
         super().__init__()
         self.config = config
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=2)
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -142,6 +95,8 @@ class BaichuanAttention(torch.nn.Module):
         self.o_proj = init_method(torch.nn.Linear,
             self.num_heads * self.head_dim, self.hidden_size, bias=False,**kwargs
         )
+        # ALiBi bias 按 query 分块现算 , None 时按显存预算自动确定块大小
+        self.alibi_block_size = getattr(config, 'alibi_block_size', None)
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return (
@@ -181,43 +136,26 @@ class BaichuanAttention(torch.nn.Module):
         if past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
-
-        past_key_value = (key_states, value_states) if use_cache else None
-        if xops is not None and self.training:
-            attn_weights = None
-            # query_states = query_states.transpose(1, 2)
-            # key_states = key_states.transpose(1, 2)
-            # value_states = value_states.transpose(1, 2)
-            # attn_output = xops.memory_efficient_attention(
-            #     query_states, key_states, value_states, attn_bias=attention_mask
-            # )
-            with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=True, enable_mem_efficient=True):
-                attn_output = F.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask = attention_mask)
-            attn_output = attn_output.transpose(1, 2)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
         else:
-            attn_weights = torch.matmul(
-                query_states, key_states.transpose(2, 3)
-            ) / math.sqrt(self.head_dim)
-
-            if attention_mask is not None:
-                if q_len == 1:  # inference with cache
-                    if len(attention_mask.size()) == 4:
-                        attention_mask = attention_mask[:, :, -1:, :]
-                    else:
-                        attention_mask = attention_mask[:, -1:, :]
-                attn_weights = attn_weights + attention_mask
-                attn_weights = torch.max(
-                    attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min)
-                )
-
-            attn_weights = torch.nn.functional.softmax(attn_weights, dim=-1)
-            attn_output = torch.matmul(attn_weights, value_states)
-
-            attn_output = attn_output.transpose(1, 2)
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+            past_key_value = (key_states, value_states) if use_cache else None
+        attn_output, attn_weights = alibi_attention(
+            query_states, key_states, value_states,
+            alibi_slopes(self.num_heads, query_states.device),
+            attention_mask=attention_mask,
+            block_size=self.alibi_block_size,
+            output_attentions=output_attentions,
+        )
+        attn_output = attn_output.transpose(1, 2)
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
         attn_output = self.o_proj(attn_output)
 
@@ -418,9 +356,6 @@ class BaichuanModel(BaichuanPreTrainedModel):
 
         self.gradient_checkpointing = config.gradient_checkpointing
         self.post_init()
-        self.max_cache_pos = config.model_max_length
-        self.first_run = True
-        self.alibi_mask = None
 
     def get_input_embeddings(self):
         return self.embed_tokens
@@ -428,49 +363,6 @@ class BaichuanModel(BaichuanPreTrainedModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
-    def get_alibi_mask(self, tensor, seq_length_with_past):
-        if self.training:
-            slopes = torch.Tensor(_get_interleave(self.n_head))
-            position_point = (
-                torch.arange(seq_length_with_past) - seq_length_with_past + 1
-            )
-            position_point = (
-                position_point.unsqueeze(0)
-                .unsqueeze(0)
-                .expand(self.n_head, seq_length_with_past, -1)
-            )
-            diag = torch.diag(position_point[0])
-            position_point = position_point - diag.unsqueeze(0).unsqueeze(0).transpose(
-                -1, -2
-            )
-            alibi = slopes.unsqueeze(1).unsqueeze(1) * position_point
-            mask = _buffered_future_mask(
-                tensor, seq_length_with_past, alibi, self.n_head
-            )
-        else:
-            if self.first_run:
-                self.first_run = False
-                self.register_buffer(
-                    "future_mask",
-                    _gen_alibi_mask(tensor, self.n_head, self.max_cache_pos).to(
-                        tensor
-                    ),
-                    persistent=False,
-                )
-            if seq_length_with_past > self.max_cache_pos:
-                self.max_cache_pos = seq_length_with_past
-                self.register_buffer(
-                    "future_mask",
-                    _gen_alibi_mask(tensor, self.n_head, self.max_cache_pos).to(
-                        tensor
-                    ),
-                    persistent=False,
-                )
-            mask = self.future_mask[
-                : self.n_head, :seq_length_with_past, :seq_length_with_past
-            ]
-        return mask
-
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -506,44 +398,9 @@ class BaichuanModel(BaichuanPreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        if self.training:
-            if (
-                self.alibi_mask is None
-                or self.alibi_mask.shape[-1] != seq_length_with_past
-            ):
-                self.alibi_mask = self.get_alibi_mask(
-                    inputs_embeds, seq_length_with_past
-                )
-            alibi_mask = self.alibi_mask
-        else:
-            alibi_mask = self.get_alibi_mask(inputs_embeds, seq_length_with_past)
-
-
-        if attention_mask is not None:
-            if len(attention_mask.shape) == 2:
-                expanded_mask = attention_mask.to(alibi_mask.dtype)
-                expanded_mask = torch.tril(
-                    torch.gt(expanded_mask[:, :, None] * expanded_mask[:, None, :], 0)
-                ) * torch.eq(expanded_mask[:, :, None] - expanded_mask[:, None, :], 0)
-            else:
-                expanded_mask = attention_mask
-            bsz = inputs_embeds.size(0)
-            src_len, tgt_len = alibi_mask.size()[-2:]
-            expanded_mask = (
-                expanded_mask.unsqueeze(1)
-                .expand(bsz, 1, src_len, tgt_len)
-                .to(alibi_mask.dtype)
-            )
-            inverted_mask = 1.0 - expanded_mask
-            inverted_mask = inverted_mask.masked_fill(
-                inverted_mask.to(torch.bool), torch.finfo(alibi_mask.dtype).min
-            )
-            attention_mask = inverted_mask + alibi_mask.unsqueeze(0)
-        else:
-            attention_mask = alibi_mask
-
-        if attention_mask.size(-2) != seq_length:
-            attention_mask = attention_mask[...,-seq_length:,:]
+        # ALiBi 与因果 mask 在每层 attention 内按块生成 , attention_mask 保持 [b, s] ([b, s, s]) 原样传入
+        if attention_mask is not None and attention_mask.dim() not in (2, 3):
+            raise ValueError("attention_mask must be [batch, seq] or [batch, seq, seq]")
 
         hidden_states = inputs_embeds
 
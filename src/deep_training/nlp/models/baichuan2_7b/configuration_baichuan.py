@@ -49,6 +49,7 @@ class BaichuanConfig(PretrainedConfig):
         z_loss_weight=0,
         quantization_method = "cpm",
         quantization_bit=0,
+        kv_cache_bits=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -64,6 +65,8 @@ class BaichuanConfig(PretrainedConfig):
         self.z_loss_weight = z_loss_weight
         self.quantization_method = quantization_method
         self.quantization_bit = quantization_bit
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
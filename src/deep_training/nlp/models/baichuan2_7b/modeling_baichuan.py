@@ -21,6 +21,7 @@ from transformers.deepspeed import is_deepspeed_zero3_enabled
 # limitations under the License.
 
 from ...utils.torch_utils import skip_init
+from ...layers.kv_cache import build_kv_quantizer
 from .configuration_baichuan import BaichuanConfig
 from .generation_utils import build_chat_input, TextIterStreamer
 
@@ -186,6 +187,7 @@ class Attention(nn.Module):
     def __init__(self, config: BaichuanConfig,**kwargs):
         super().__init__()
         self.config = config
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=2)
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -231,12 +233,18 @@ class Attention(nn.Module):
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
         # [bsz, nh, t, hd]
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
         if xops is not None and self.training:
             attn_weights = None
             query_states = query_states.transpose(1, 2)
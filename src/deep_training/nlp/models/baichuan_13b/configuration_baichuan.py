@@ -24,7 +24,9 @@ class BaichuanConfig(PretrainedConfig):
             tie_word_embeddings=False,
             gradient_checkpointing=False,
             quantization_bit=0,
+            alibi_block_size=None,
             initializer_weight=False,
+            kv_cache_bits=None,
             **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -39,7 +41,11 @@ class BaichuanConfig(PretrainedConfig):
         self.use_cache = use_cache
         self.gradient_checkpointing = gradient_checkpointing
         self.quantization_bit = quantization_bit
+        # ALiBi bias 按 query 分块计算的块大小 , None 时按显存预算自动确定
+        self.alibi_block_size = alibi_block_size
         self.initializer_weight = initializer_weight
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
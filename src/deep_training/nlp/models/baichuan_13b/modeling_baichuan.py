@@ -12,7 +12,9 @@ from transformers.utils import logging
 from transformers.generation.utils import GenerationConfig
 from .configuration_baichuan import BaichuanConfig
 from ...utils.torch_utils import skip_init
+from ...layers.kv_cache import build_kv_quantizer
 from ..transformer_base import TransformerBase
+from ...layers.alibi import alibi_slopes, alibi_attention
 
 logger = logging.get_logger(__name__)
 
@@ -28,35 +30,6 @@ def setup_model_profile(skip_init_flag=True):
         skip_init_function = default_init
 
 
-def _get_interleave(n):
-    def _get_interleave_power_of_2(n):
-        start = (2 ** (-2 ** -(math.log2(n) - 3)))
-        ratio = start
-        return [start * ratio ** i for i in range(n)]
-
-    if math.log2(n).is_integer():
-        return _get_interleave_power_of_2(n)
-    else:
-        closest_power_of_2 = 2 ** math.floor(math.log2(n))
-        return _get_interleave_power_of_2(closest_power_of_2) + \
-               _get_interleave(2 * closest_power_of_2)[0::2][:n - closest_power_of_2]
-
-def _fill_with_neg_inf(t):
-    """FP16-compatible function that fills a tensor with -inf."""
-    return t.float().fill_(float("-inf")).type_as(t)
-
-def _gen_alibi_mask(n_head, max_pos):
-    slopes = torch.Tensor(_get_interleave(n_head))
-    alibi = slopes.unsqueeze(1).unsqueeze(1) * torch.arange(max_pos).unsqueeze(0).unsqueeze(0).expand(
-        n_head, -1, -1)
-    alibi = alibi.view(n_head, 1, max_pos)
-    alibi_mask = torch.triu(
-        _fill_with_neg_inf(torch.zeros([max_pos, max_pos])), 1
-    )
-    alibi_mask = alibi_mask.unsqueeze(0) + alibi
-    return alibi_mask
-
-
 class RMSNorm(torch.nn.Module):
     def __init__(self, hidden_size, epsilon=1e-6,**kwargs):
         super().__init__()
@@ -97,6 +70,7 @@ class BaichuanAttention(torch.nn.Module):
     def __init__(self, config: BaichuanConfig,**kwargs):
         super().__init__()
         self.config = config
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=2)
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -108,6 +82,8 @@ class BaichuanAttention(torch.nn.Module):
             )
         self.W_pack = torch.nn.Linear(self.hidden_size, 3 * self.hidden_size, bias=False,**kwargs)
         self.o_proj = torch.nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False,**kwargs)
+        # ALiBi bias 按 query 分块现算 , None 时按显存预算自动确定块大小
+        self.alibi_block_size = getattr(config, 'alibi_block_size', None)
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
@@ -133,23 +109,24 @@ class BaichuanAttention(torch.nn.Module):
         if past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
-
-        past_key_value = (key_states, value_states) if use_cache else None
-
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        if attention_mask is not None:
-            if attn_weights.size(-2) == 1:
-                attention_mask = attention_mask[:, -1:, :]
-            attn_weights = attn_weights + attention_mask.unsqueeze(0)
-            attn_weights = torch.max(attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min))
+            past_key_value = (key_states, value_states) if use_cache else None
 
-        attn_weights = torch.nn.functional.softmax(attn_weights, dim=-1)
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output, attn_weights = alibi_attention(query_states, key_states, value_states,
+                                                    alibi_slopes(self.num_heads, query_states.device),
+                                                    attention_mask=attention_mask,
+                                                    block_size=self.alibi_block_size,
+                                                    output_attentions=output_attentions)
 
         attn_output = attn_output.transpose(1, 2)
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
@@ -252,18 +229,6 @@ class BaichuanModel(BaichuanPreTrainedModel):
 
         self.gradient_checkpointing = config.gradient_checkpointing
         self.post_init()
-        self.max_cache_pos = config.model_max_length
-        self.first_run = True    
-    
-    def get_alibi_mask(self, tensor, seq_length_with_past):
-        if self.first_run:
-            self.first_run = False
-            self.register_buffer("future_mask", _gen_alibi_mask(self.n_head, self.max_cache_pos).to(tensor), persistent=False)
-        if seq_length_with_past > self.max_cache_pos:
-            self.max_cache_pos = seq_length_with_past
-            self.register_buffer("future_mask", _gen_alibi_mask(self.n_head, self.max_cache_pos).to(tensor), persistent=False)
-        mask = self.future_mask[:self.n_head, :seq_length_with_past, :seq_length_with_past] 
-        return mask
 
     def forward(
             self,
@@ -295,10 +260,8 @@ class BaichuanModel(BaichuanPreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        # embed positions
-        attention_mask = self.get_alibi_mask(inputs_embeds, seq_length_with_past)
-        if attention_mask.size(-2) != seq_length:
-            attention_mask = attention_mask[..., -seq_length:, :]
+        # ALiBi 与因果 mask 在每层 attention 内按块生成
+        attention_mask = None
 
         hidden_states = inputs_embeds
 
@@ -46,6 +46,7 @@ class BaiChuanConfig(PretrainedConfig):
         tie_word_embeddings=False,
         quantization_bit=0,
         initializer_weight=False,
+        kv_cache_bits=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -60,6 +61,8 @@ class BaiChuanConfig(PretrainedConfig):
         self.use_cache = use_cache
         self.quantization_bit = quantization_bit
         self.initializer_weight = initializer_weight
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
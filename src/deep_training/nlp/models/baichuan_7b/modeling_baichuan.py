@@ -32,6 +32,7 @@ from transformers.utils import logging
 from xformers import ops as xops
 from .configuration_baichuan import BaiChuanConfig
 from ...utils.torch_utils import skip_init
+from ...layers.kv_cache import build_kv_quantizer
 from ..transformer_base import TransformerBase
 
 logger = logging.get_logger(__name__)
@@ -173,6 +174,7 @@ class Attention(nn.Module):
     def __init__(self, config: BaiChuanConfig,**kwargs):
         super().__init__()
         self.config = config
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=2)
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -247,11 +249,17 @@ class Attention(nn.Module):
             cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-            if past_key_value is not None:
-                key_states = torch.cat([past_key_value[0], key_states], dim=2)
-                value_states = torch.cat([past_key_value[1], value_states], dim=2)
+            if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+                # int8 / int4 量化 kv cache , 历史部分读取时反量化
+                key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                    value_states)
+                past_key_value = past_key_value if use_cache else None
+            else:
+                if past_key_value is not None:
+                    key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                    value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-            past_key_value = (key_states, value_states) if use_cache else None
+                past_key_value = (key_states, value_states) if use_cache else None
             attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
 
             if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
@@ -111,6 +111,7 @@ class BlueLMConfig(PretrainedConfig):
         rope_theta=10000.0,
         rope_scaling=None,
         use_stable_embedding=True,
+        kv_cache_bits=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -134,6 +135,8 @@ class BlueLMConfig(PretrainedConfig):
         self.rope_scaling = rope_scaling
         self._rope_scaling_validation()
 
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
@@ -34,6 +34,7 @@ from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import add_start_docstrings, add_start_docstrings_to_model_forward, logging, replace_return_docstrings
 from .configuration_bluelm import BlueLMConfig
 from ...utils.torch_utils import skip_init
+from ...layers.kv_cache import build_kv_quantizer
 
 
 def default_init(cls, *args, **kwargs):
@@ -189,10 +190,12 @@ class BlueLMAttention(nn.Module):
         hidden_size: int,
         num_heads: int,
         dropout_prob: float,
+        kv_quantizer=None,
         **kwargs
     ):
         super().__init__()
         self.hidden_size = hidden_size
+        self.kv_quantizer = kv_quantizer
         self.num_heads = num_heads
         self.head_dim = hidden_size // num_heads
         self.dropout_prob = dropout_prob
@@ -256,12 +259,18 @@ class BlueLMAttention(nn.Module):
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, offset=offset)
         # [bsz, t, nh, hd]
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=1)
-            value_states = torch.cat([past_key_value[1], value_states], dim=1)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=1)
+                value_states = torch.cat([past_key_value[1], value_states], dim=1)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
         if xops is not None and self.training:
             attn_weights = None
@@ -315,6 +324,7 @@ class BlueLMDecoderLayer(nn.Module):
             hidden_size=self.hidden_size,
             num_heads=config.num_attention_heads,
             dropout_prob=0,
+            kv_quantizer=build_kv_quantizer(config, seq_dim=1),
             **kwargs
         )
         global skip_init_function
@@ -68,6 +68,8 @@ class ChatGLMConfig(PretrainedConfig):
             quantization_bit=0,
             pre_seq_len=None,
             prefix_projection=False,
+            attn_backend=None,
+            kv_cache_block_size=256,
             initializer_range=0.02,
             initializer_weight=False,
             #precision=16, # 16,32,64 or torch.half,torch.float,torch.float32
@@ -90,6 +92,10 @@ class ChatGLMConfig(PretrainedConfig):
         self.quantization_bit = quantization_bit
         self.pre_seq_len = pre_seq_len
         self.prefix_projection = prefix_projection
+        # eager / sdpa / mem_efficient , None 为模型默认
+        self.attn_backend = attn_backend
+        # kv cache 预分配粒度 , <= 0 时退化为 torch.cat
+        self.kv_cache_block_size = kv_cache_block_size
         self.initializer_range = initializer_range
         self.initializer_weight = initializer_weight
 
@@ -33,6 +33,9 @@ from transformers.generation.utils import LogitsProcessorList, StoppingCriteriaL
 
 from .configuration import ChatGLMConfig
 from ..transformer import TransformerBase
+from ...layers.attention_backend import resolve_attn_backend, sdpa_attention
+from ...layers.kv_cache import KVCacheBuffer
+from ...layers.mask import first_token_index, glm_mask_positions, glm_prefix_lm_mask, glm_position_ids
 from ...utils.torch_utils import skip_init
 
 logger = logging.get_logger(__name__)
@@ -271,11 +274,11 @@ def attention_fn(
         layer_past=None,
         scaling_attention_score=True,
         use_cache=False,
+        output_attentions=False,
 ):
-    if layer_past is not None:
-        past_key, past_value = layer_past[0], layer_past[1]
-        key_layer = torch.cat((past_key, key_layer), dim=0)
-        value_layer = torch.cat((past_value, value_layer), dim=0)
+    if layer_past is not None or use_cache:
+        # 预分配 buffer 原地追加 , 替代逐步 torch.cat
+        key_layer, value_layer = self.kv_buffer.append(layer_past, key_layer, value_layer)
 
     # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
     seq_len, b, nh, hidden_size = key_layer.shape
@@ -286,6 +289,23 @@ def attention_fn(
         present = None
 
     query_key_layer_scaling_coeff = float(layer_id + 1)
+    if self.attn_backend != 'eager' and not output_attentions:
+        # [sq, b, np, hn] -> [b, np, sq, hn]
+        query_layer, key_layer, value_layer = [t.permute(1, 2, 0, 3) for t in (query_layer, key_layer, value_layer)]
+        attn_mask = None
+        if attention_mask is not None:
+            # 不判断 mask 是否全 0 , (attention_mask == 0).all() 每层每步都会同步一次 host
+            attn_mask = torch.zeros(attention_mask.shape, dtype=query_layer.dtype, device=query_layer.device)
+            attn_mask.masked_fill_(attention_mask, -10000.0)
+        # eager 中 q 先除以 sqrt(hn) * coeff , softmax 前再乘 coeff
+        scale = None if scaling_attention_score else query_key_layer_scaling_coeff
+        context_layer = sdpa_attention(query_layer, key_layer, value_layer, attn_mask,
+                                       scale=scale, backend=self.attn_backend)
+        # [b, np, sq, hn] --> [sq, b, hp]
+        context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+        context_layer = context_layer.view(*context_layer.size()[:-2], hidden_size_per_partition)
+        return context_layer, present, None
+
     if scaling_attention_score:
         query_layer = query_layer / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
 
@@ -370,10 +390,12 @@ def attention_fn(
 class SelfAttention(torch.nn.Module):
     def __init__(self, hidden_size, num_attention_heads,
                  layer_id, hidden_size_per_attention_head=None, bias=True,
-                 params_dtype=torch.float, position_encoding_2d=True):
+                 params_dtype=torch.float, position_encoding_2d=True, attn_backend='eager', kv_cache_block_size=256):
         super(SelfAttention, self).__init__()
 
         self.layer_id = layer_id
+        self.attn_backend = attn_backend
+        self.kv_buffer = KVCacheBuffer(seq_dim=0, block_size=kv_cache_block_size)
         self.hidden_size = hidden_size
         self.hidden_size_per_partition = hidden_size
         self.num_attention_heads = num_attention_heads
@@ -492,7 +514,8 @@ class SelfAttention(torch.nn.Module):
             hidden_size_per_partition=self.hidden_size_per_partition,
             layer_id=layer_id,
             layer_past=layer_past,
-            use_cache=use_cache
+            use_cache=use_cache,
+            output_attentions=output_attentions,
         )
 
         output = self.dense(context_layer)
@@ -572,7 +595,9 @@ class GLMBlock(torch.nn.Module):
             use_bias=True,
             params_dtype=torch.float,
             num_layers=28,
-            position_encoding_2d=True
+            position_encoding_2d=True,
+            attn_backend='eager',
+            kv_cache_block_size=256,
     ):
         super(GLMBlock, self).__init__()
         # Set output layer initialization if not provided.
@@ -592,7 +617,9 @@ class GLMBlock(torch.nn.Module):
             hidden_size_per_attention_head=hidden_size_per_attention_head,
             bias=use_bias,
             params_dtype=params_dtype,
-            position_encoding_2d=self.position_encoding_2d
+            position_encoding_2d=self.position_encoding_2d,
+            attn_backend=attn_backend,
+            kv_cache_block_size=kv_cache_block_size,
         )
 
         # Layernorm on the input data.
@@ -700,40 +727,21 @@ class ChatGLMPreTrainedModel(PreTrainedModel):
             module.gradient_checkpointing = value
 
     def get_masks(self, input_ids, device):
-        batch_size, seq_length = input_ids.shape
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
-        attention_mask = torch.ones((batch_size, seq_length, seq_length), device=device)
-        attention_mask.tril_()
-        for i, context_length in enumerate(context_lengths):
-            attention_mask[i, :, :context_length] = 1
-        attention_mask.unsqueeze_(1)
-        attention_mask = (attention_mask < 0.5).bool()
+        seq_length = input_ids.size(1)
+        context_lengths = first_token_index(input_ids.to(device), self.config.bos_token_id)
+        return glm_prefix_lm_mask(context_lengths, seq_length)
 
-        return attention_mask
+    def get_mask_positions(self, input_ids):
+        return glm_mask_positions(input_ids, self.config.mask_token_id, self.config.gmask_token_id)
 
     def get_position_ids(self, input_ids, mask_positions, device, use_gmasks=None):
-        batch_size, seq_length = input_ids.shape
-        if use_gmasks is None:
-            use_gmasks = [False] * batch_size
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
-        if self.position_encoding_2d:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).repeat(batch_size, 1)
-            for i, context_length in enumerate(context_lengths):
-                position_ids[i, context_length:] = mask_positions[i]
-            block_position_ids = [torch.cat((
-                torch.zeros(context_length, dtype=torch.long, device=device),
-                torch.arange(seq_length - context_length, dtype=torch.long, device=device) + 1
-            )) for context_length in context_lengths]
-            block_position_ids = torch.stack(block_position_ids, dim=0)
-            position_ids = torch.stack((position_ids, block_position_ids), dim=1)
-        else:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).repeat(batch_size, 1)
-
-            for i, context_length in enumerate(context_lengths):
-                if not use_gmasks[i]:
-                    position_ids[i, context_length:] = mask_positions[i]
-
-        return position_ids
+        seq_length = input_ids.size(1)
+        context_lengths = first_token_index(input_ids.to(device), self.config.bos_token_id)
+        mask_positions = torch.as_tensor(mask_positions, dtype=torch.long, device=device)
+        if use_gmasks is not None:
+            use_gmasks = torch.as_tensor(use_gmasks, dtype=torch.bool, device=device)
+        return glm_position_ids(context_lengths, mask_positions, seq_length,
+                                position_encoding_2d=self.position_encoding_2d, use_gmasks=use_gmasks)
 
 
 CHATGLM_6B_START_DOCSTRING = r"""
@@ -862,6 +870,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 use_bias=True,
                 params_dtype=self.params_dtype,
                 position_encoding_2d=self.position_encoding_2d,
+                attn_backend=resolve_attn_backend(config, 'eager'),
+                kv_cache_block_size=getattr(config, 'kv_cache_block_size', 256),
             )
 
         self.layers = torch.nn.ModuleList(
@@ -964,16 +974,7 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 )
 
             if position_ids is None:
-                MASK, gMASK = self.config.mask_token_id, self.config.gmask_token_id
-                seqs = input_ids.tolist()
-
-                mask_positions, use_gmasks = [], []
-                for seq in seqs:
-                    mask_token = gMASK if gMASK in seq else MASK
-                    use_gmask = mask_token == gMASK
-                    mask_positions.append(seq.index(mask_token))
-                    use_gmasks.append(use_gmask)
-
+                mask_positions, use_gmasks = self.get_mask_positions(input_ids)
                 position_ids = self.get_position_ids(
                     input_ids,
                     mask_positions=mask_positions,
@@ -982,9 +983,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 )
 
         if self.pre_seq_len is not None and attention_mask is not None:
-            prefix_attention_mask = torch.ones(batch_size, 1, input_ids.size(-1), self.pre_seq_len).to(
-                attention_mask.device)
-            prefix_attention_mask = (prefix_attention_mask < 0.5).bool()
+            prefix_attention_mask = torch.zeros(batch_size, 1, input_ids.size(-1), self.pre_seq_len,
+                                                dtype=torch.bool, device=attention_mask.device)
             attention_mask = torch.cat((prefix_attention_mask, attention_mask), dim=3)
 
         # [seq_len, batch, hidden_size]
@@ -1127,15 +1127,8 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
     ) -> dict:
 
         batch_size, seq_length = input_ids.shape
-        MASK, gMASK = self.config.mask_token_id, self.config.gmask_token_id
-
-        seqs = input_ids.tolist()
-        mask_positions, use_gmasks = [], []
-        for seq in seqs:
-            mask_token = gMASK if gMASK in seq else MASK
-            use_gmask = mask_token == gMASK
-            mask_positions.append(seq.index(mask_token))
-            use_gmasks.append(use_gmask)
+        # 在 device 上计算 , 每步不再逐行回传 host
+        mask_positions, use_gmasks = self.get_mask_positions(input_ids)
 
         # only last token for input_ids if past is not None
         if past is not None or past_key_values is not None:
@@ -1148,14 +1141,11 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             if position_ids is not None:
                 position_ids = position_ids[..., -1:]
             else:
-                context_lengths = [seq.index(self.config.bos_token_id) for seq in seqs]
                 if self.position_encoding_2d:
-                    position_ids = torch.tensor(
-                        [[mask_position, seq_length - context_length] for mask_position, context_length in
-                         zip(mask_positions, context_lengths)], dtype=torch.long, device=input_ids.device).unsqueeze(-1)
+                    context_lengths = first_token_index(input_ids, self.config.bos_token_id)
+                    position_ids = torch.stack((mask_positions, seq_length - context_lengths), dim=1).unsqueeze(-1)
                 else:
-                    position_ids = torch.tensor([mask_position for mask_position in mask_positions], dtype=torch.long,
-                                                device=input_ids.device).unsqueeze(-1)
+                    position_ids = mask_positions.unsqueeze(-1)
 
             if past is None:
                 past = past_key_values
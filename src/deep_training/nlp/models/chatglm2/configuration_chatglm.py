@@ -32,6 +32,9 @@ class ChatGLMConfig(PretrainedConfig):
             quantization_bit=0,
             pre_seq_len=None,
             prefix_projection=False,
+            attn_backend=None,
+            kv_cache_block_size=256,
+            kv_cache_bits=None,
             initializer_weight=False,
             **kwargs
     ):
@@ -61,5 +64,11 @@ class ChatGLMConfig(PretrainedConfig):
         self.quantization_bit = quantization_bit
         self.pre_seq_len = pre_seq_len
         self.prefix_projection = prefix_projection
+        # eager / sdpa / mem_efficient , None 为模型默认
+        self.attn_backend = attn_backend
+        # kv cache 预分配粒度 , <= 0 时退化为 torch.cat
+        self.kv_cache_block_size = kv_cache_block_size
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         self.initializer_weight = initializer_weight
         super().__init__(**kwargs)
\ No newline at end of file
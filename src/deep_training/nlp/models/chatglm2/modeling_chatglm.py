@@ -23,6 +23,8 @@ from transformers.generation.logits_process import LogitsProcessor
 from transformers.generation.utils import LogitsProcessorList, StoppingCriteriaList, GenerationConfig, ModelOutput
 
 from .configuration_chatglm import ChatGLMConfig
+from ...layers.attention_backend import resolve_attn_backend, sdpa_attention
+from ...layers.kv_cache import KVCacheBuffer, build_kv_quantizer
 from ...utils.torch_utils import skip_init
 # flags required to enable jit fusion kernels
 
@@ -226,20 +228,21 @@ class CoreAttention(torch.nn.Module):
         self.coeff = coeff
 
         self.attention_dropout = torch.nn.Dropout(config.attention_dropout)
+        # eager / sdpa / mem_efficient
+        self.attn_backend = resolve_attn_backend(config, 'sdpa')
 
     def forward(self, query_layer, key_layer, value_layer, attention_mask):
-        pytorch_major_version = int(torch.__version__.split('.')[0])
-        if pytorch_major_version >= 2:
+        if self.attn_backend != 'eager':
             query_layer, key_layer, value_layer = [k.permute(1, 2, 0, 3) for k in [query_layer, key_layer, value_layer]]
             if attention_mask is None and query_layer.shape[2] == key_layer.shape[2]:
-                context_layer = torch.nn.functional.scaled_dot_product_attention(query_layer, key_layer, value_layer,
-                                                                                 is_causal=True)
+                context_layer = sdpa_attention(query_layer, key_layer, value_layer, is_causal=True,
+                                               backend=self.attn_backend)
             else:
                 if attention_mask is not None:
                     attention_mask = ~attention_mask
 
-                context_layer = torch.nn.functional.scaled_dot_product_attention(query_layer, key_layer, value_layer,
-                                                                                 attention_mask)
+                context_layer = sdpa_attention(query_layer, key_layer, value_layer, attention_mask,
+                                               backend=self.attn_backend)
             context_layer = context_layer.permute(2, 0, 1, 3)
             new_context_layer_shape = context_layer.size()[:-2] + (self.hidden_size_per_partition,)
             context_layer = context_layer.reshape(*new_context_layer_shape)
@@ -350,6 +353,10 @@ class SelfAttention(torch.nn.Module):
                                          )
 
         self.core_attention = CoreAttention(config, self.layer_number)
+        # 推理时预分配 , 原地追加的 kv cache
+        self.kv_buffer = KVCacheBuffer(seq_dim=0, block_size=getattr(config, 'kv_cache_block_size', 256))
+        # config.kv_cache_bits 为 8 / 4 时使用量化 cache
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=0)
 
         # Output.
         self.dense = nn.Linear(self.projection_size, config.hidden_size, bias=config.add_bias_linear,
@@ -419,13 +426,14 @@ class SelfAttention(torch.nn.Module):
             key_layer = apply_rotary_pos_emb(key_layer, rotary_pos_emb)
 
         # adjust key and value for inference
-        if kv_cache is not None:
-            cache_k, cache_v = kv_cache
-            key_layer = torch.cat((cache_k, key_layer), dim=0)
-            value_layer = torch.cat((cache_v, value_layer), dim=0)
-        if use_cache:
-            kv_cache = (key_layer, value_layer)
-        else:
+        if kv_cache is not None or use_cache:
+            if self.kv_quantizer is not None and not self.training:
+                # int8 / int4 量化 kv cache , 历史部分读取时反量化
+                key_layer, value_layer, kv_cache = self.kv_quantizer.update(kv_cache, key_layer, value_layer)
+            else:
+                key_layer, value_layer = self.kv_buffer.append(kv_cache, key_layer, value_layer)
+                kv_cache = (key_layer, value_layer)
+        if not use_cache:
             kv_cache = None
 
         if self.multi_query_attention:
@@ -1006,11 +1014,9 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         Output shares the same memory storage as `past`.
         """
+        # 量化 kv cache 每层为 (key_q , value_q , key_meta , value_meta) , 全部按 batch 重排
         return tuple(
-            (
-                layer_past[0].index_select(1, beam_idx.to(layer_past[0].device)),
-                layer_past[1].index_select(1, beam_idx.to(layer_past[1].device)),
-            )
+            tuple(past_state.index_select(1, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
         )
 
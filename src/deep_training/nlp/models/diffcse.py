@@ -7,6 +7,7 @@ from dataclasses import dataclass, field
 import torch
 from torch import nn
 from .transformer import TransformerModel
+from .embedding_utils import encode_views, MASK_INVARIANT_POOLINGS
 from transformers.activations import ACT2FN
 from transformers import AutoModelForMaskedLM
 from ..losses.MultipleNegativesRankingLoss import MultipleNegativesRankingLoss
@@ -292,13 +293,8 @@ class TransformerForDiffcse(TransformerModel):
         if self.training:
             input_ids = batch['input_ids']
             attention_mask = batch['attention_mask']
-            n = input_ids.size(1)
-            loss_logits = []
-            for i in range(n):
-                inputs = {}
-                inputs['input_ids'] = input_ids[:, i]
-                inputs['attention_mask'] = attention_mask[:, i]
-                loss_logits.append(self.forward_for_hidden(**inputs))
+            loss_logits = encode_views(self.forward_for_hidden, input_ids, attention_mask,
+                                       trim=self.diffcse_args.pooling in MASK_INVARIANT_POOLINGS)
 
             loss_cse = self.loss_fn_cse(loss_logits)
 
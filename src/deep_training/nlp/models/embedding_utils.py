@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/29 9:40
+# @FileName: embedding_utils.py
+"""
+    句向量模型 (simcse / esimcse / infonce / promptbert_cse / diffcse) 共用的编码工具
+    多视图输入 (B, n, L) 展平为一次 (n*B, L') 的 forward , 代替逐视图循环
+    grad cache : 分块无梯度编码 , 整个 batch 上算 loss 和向量梯度 , backward 时逐块重算并回传缓存的梯度 ,
+    激活显存只与块大小有关 , in-batch 负例数可以远大于单次 forward 能容纳的 batch
+    EmbeddingQueue : 动量编码器输出的负例队列 , 跨 step 复用
+"""
+from typing import Callable, List, Optional, Dict
+
+import torch
+import torch.nn.functional as F
+
+__all__ = [
+    'MASK_INVARIANT_POOLINGS',
+    'trim_padding',
+    'flatten_views',
+    'encode_views',
+    'pad_cat',
+    'grad_cache_encode',
+    'EmbeddingQueue',
+    'ema_update_',
+]
+
+# 去掉右侧 padding 不改变结果的 pooling , avg 类 pooling 没有按 mask 平均 , 不能裁剪
+MASK_INVARIANT_POOLINGS = ('cls', 'pooler', 'reduce')
+
+
+def trim_padding(attention_mask: torch.Tensor, *tensors: torch.Tensor):
+    '''
+        裁掉所有样本都是 padding 的尾部列 , 只有右 padding 时生效 , 左 padding 时不裁剪
+    '''
+    keep = attention_mask.reshape(-1, attention_mask.size(-1)).any(0)
+    length = int(keep.nonzero().max()) + 1 if keep.any() else 1
+    if length == attention_mask.size(-1):
+        return (attention_mask,) + tensors
+    return tuple(t[..., :length] for t in (attention_mask,) + tensors)
+
+
+def flatten_views(input_ids: torch.Tensor, attention_mask: torch.Tensor, trim=True, **extra: torch.Tensor) -> Dict:
+    '''
+        (B, n, L) -> (n*B, L') , 视图在前 (view-major) , 第 i 个视图为 [i*B: (i+1)*B]
+        extra 中同形状的张量 (token_type_ids 等) 同样处理
+    '''
+    names = ['attention_mask', 'input_ids'] + list(extra.keys())
+    tensors = [attention_mask, input_ids] + list(extra.values())
+    if trim:
+        tensors = trim_padding(*tensors)
+    return {name: t.transpose(0, 1).reshape(-1, t.size(-1)) for name, t in zip(names, tensors)}
+
+
+def encode_views(encode_fn: Callable[..., torch.Tensor], input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                 trim=True, chunk_size: Optional[int] = None, **extra: torch.Tensor) -> List[torch.Tensor]:
+    '''
+        encode_fn(input_ids=..., attention_mask=...) -> [n*B, H]
+        返回 n 个 [B, H] , 与逐视图调用 encode_fn 的结果一致
+        chunk_size > 0 时用 grad cache 分块编码 , 见 grad_cache_encode
+    '''
+    batch_size, n = input_ids.shape[:2]
+    inputs = flatten_views(input_ids, attention_mask, trim=trim, **extra)
+    if chunk_size:
+        embeddings = grad_cache_encode(encode_fn, inputs, chunk_size, trim=trim)
+    else:
+        embeddings = encode_fn(**inputs)
+    return list(embeddings.view(n, batch_size, *embeddings.shape[1:]).unbind(0))
+
+
+def pad_cat(tensors: List[torch.Tensor], pad_value=0) -> torch.Tensor:
+    '''
+        [B_i, L_i] 右补齐到最长后在 batch 维拼接
+    '''
+    length = max(t.size(-1) for t in tensors)
+    return torch.cat([F.pad(t, (0, length - t.size(-1)), value=pad_value) for t in tensors], dim=0)
+
+
+class _RngState:
+    '''
+        记录编码某一块之前的随机数状态 , 重算时 dropout 与无梯度编码时一致
+    '''
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_state = torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+
+    def restore(self):
+        torch.set_rng_state(self.cpu_state)
+        if self.cuda_state is not None:
+            torch.cuda.set_rng_state(self.cuda_state, self.device)
+
+
+class _GradCacheFunction(torch.autograd.Function):
+    '''
+        forward 逐块无梯度编码并拼接 , backward 逐块带梯度重算 , 把对应的向量梯度回传到模型参数
+        与 reentrant 的 checkpoint 相同 , backward 中再次调用 autograd.backward ,
+        因此 DDP 下需要 static_graph=True (同一参数每步会收到多次梯度)
+    '''
+    @staticmethod
+    def forward(ctx, encode_fn, chunks, dummy):
+        device = dummy.device
+        ctx.encode_fn = encode_fn
+        ctx.chunks = chunks
+        if device.type == 'cuda':
+            ctx.autocast = (torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype())
+        else:
+            ctx.autocast = (torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype())
+        ctx.rng_states = []
+        outputs = []
+        for chunk in chunks:
+            ctx.rng_states.append(_RngState(device))
+            outputs.append(encode_fn(**chunk))
+        ctx.sizes = [o.size(0) for o in outputs]
+        return torch.cat(outputs, dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        device = grad_output.device
+        enabled, dtype = ctx.autocast
+        grads = torch.split(grad_output, ctx.sizes, dim=0)
+        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+            for chunk, rng_state, grad in zip(ctx.chunks, ctx.rng_states, grads):
+                rng_state.restore()
+                with torch.enable_grad(), torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled):
+                    output = ctx.encode_fn(**chunk)
+                torch.autograd.backward(output, grad.to(output.dtype))
+        ctx.chunks = ctx.encode_fn = ctx.rng_states = None
+        return None, None, None
+
+
+def grad_cache_encode(encode_fn: Callable[..., torch.Tensor], inputs: Dict[str, torch.Tensor], chunk_size: int,
+                      trim=True) -> torch.Tensor:
+    '''
+        encode_fn(**inputs) -> [N, H] 的分块版本 , 结果与直接调用一致 (dropout 相同) ,
+        返回值可以直接参与 loss 计算 , loss.backward 时按块重算 encode_fn
+        trim=True 时每块单独裁剪尾部 padding , 需要 inputs 中有 attention_mask
+        不需要梯度或只有一块时直接调用 encode_fn
+    '''
+    names = list(inputs.keys())
+    first = inputs[names[0]]
+    if chunk_size is None or chunk_size <= 0 or first.size(0) <= chunk_size or not torch.is_grad_enabled():
+        return encode_fn(**inputs)
+    chunks = []
+    for tensors in zip(*(inputs[k].split(chunk_size, dim=0) for k in names)):
+        chunk = dict(zip(names, tensors))
+        if trim and 'attention_mask' in chunk:
+            others = [k for k in names if k != 'attention_mask']
+            trimmed = trim_padding(chunk['attention_mask'], *(chunk[k] for k in others))
+            chunk = dict(zip(['attention_mask'] + others, trimmed))
+        chunks.append(chunk)
+    # 只用于让输出带上 grad_fn , 参数的梯度在 backward 中直接累加
+    dummy = torch.empty(0, device=first.device, requires_grad=True)
+    return _GradCacheFunction.apply(encode_fn, chunks, dummy)
+
+
+@torch.no_grad()
+def ema_update_(ema_params: List[torch.Tensor], params: List[torch.Tensor], decay: float):
+    '''
+        原地 ema_params = decay * ema_params + (1 - decay) * params , foreach 一次处理所有参数
+    '''
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(ema_params, params, 1. - decay)
+    else:
+        torch._foreach_mul_(ema_params, decay)
+        torch._foreach_add_(ema_params, params, alpha=1. - decay)
+
+
+class EmbeddingQueue(torch.nn.Module):
+    '''
+        固定大小的环形队列 [max_size, H] , enqueue 覆盖最旧的向量 , 首次 enqueue 时按向量维度分配
+        不保存到 state_dict
+    '''
+    def __init__(self, max_size: int):
+        super(EmbeddingQueue, self).__init__()
+        assert max_size > 0
+        self.max_size = max_size
+        self.register_buffer('queue', torch.zeros(0), persistent=False)
+        self.ptr = 0
+        self.num = 0
+
+    def __len__(self):
+        return self.num
+
+    def clear(self):
+        self.ptr = 0
+        self.num = 0
+
+    @torch.no_grad()
+    def enqueue(self, embeddings: torch.Tensor):
+        embeddings = embeddings.detach()
+        if embeddings.size(0) > self.max_size:
+            embeddings = embeddings[-self.max_size:]
+        n = embeddings.size(0)
+        if self.queue.dim() != 2 or self.queue.shape[1:] != embeddings.shape[1:] \
+                or self.queue.device != embeddings.device:
+            self.queue = embeddings.new_zeros((self.max_size, *embeddings.shape[1:]))
+            self.clear()
+        end = self.ptr + n
+        if end <= self.max_size:
+            self.queue[self.ptr: end].copy_(embeddings)
+        else:
+            first = self.max_size - self.ptr
+            self.queue[self.ptr:].copy_(embeddings[:first])
+            self.queue[:n - first].copy_(embeddings[first:])
+        self.ptr = end % self.max_size
+        self.num = min(self.num + n, self.max_size)
+
+    @torch.no_grad()
+    def dequeue(self, n: int):
+        '''
+            丢弃最旧的 n 个向量
+        '''
+        self.num = max(self.num - n, 0)
+
+    def embeddings(self, dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+        '''
+            队列中的有效向量 , 未写满时只返回已写入的部分 (顺序与写入顺序无关)
+        '''
+        if self.num == 0:
+            return self.queue.new_zeros((0, *self.queue.shape[1:]), dtype=dtype)
+        if self.num == self.max_size:
+            out = self.queue
+        else:
+            start = (self.ptr - self.num) % self.max_size
+            if start < self.ptr:
+                out = self.queue[start: self.ptr]
+            else:
+                out = torch.cat([self.queue[start:], self.queue[:self.ptr]], dim=0)
+        return out if dtype is None else out.to(dtype)
@@ -8,6 +8,8 @@ from lightning.core.optimizer import LightningOptimizer
 from torch.optim.optimizer import Optimizer
 
 from .transformer import TransformerModel
+from .embedding_utils import encode_views, pad_cat, trim_padding, grad_cache_encode, MASK_INVARIANT_POOLINGS, \
+    EmbeddingQueue, ema_update_
 from ..losses.MultipleNegativesRankingLoss import MultipleNegativesRankingLoss
 
 __all__ = [
@@ -18,13 +20,28 @@ class TransformerForESimcse(TransformerModel):
     def __init__(self, *args,**kwargs):
         pooling = kwargs.pop('pooling','cls')
         gamma = kwargs.pop('gamma', 0.95)
+        # > 0 时训练用 grad cache 分块编码 , 显存只与块大小有关
+        grad_cache_chunk_size = kwargs.pop('grad_cache_chunk_size', 0)
+        # 数据并行时 all_gather 各 rank 的句向量作为 in-batch 负例
+        gather_negatives = kwargs.pop('gather_negatives', False)
+        # 各 rank batch 大小相同时 (drop_last) 不再每步收集各 rank 的行数
+        gather_same_size = kwargs.pop('gather_same_size', False)
+        # > 0 时动量编码器输出的负例放入固定大小的队列 , 跨 step 复用 (动量编码器不再接收梯度)
+        neg_queue_size = kwargs.pop('neg_queue_size', 0)
         super(TransformerForESimcse, self).__init__(*args,**kwargs)
         self.pooling = pooling
         self.gamma = gamma
+        self.grad_cache_chunk_size = grad_cache_chunk_size
         # config = self.config
         # self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.momentum_encoder = TransformerModel(*args,**kwargs)
-        self.loss_fn = MultipleNegativesRankingLoss()
+        self.loss_fn = MultipleNegativesRankingLoss(distributed=gather_negatives, same_size=gather_same_size)
+        if neg_queue_size > 0:
+            self.neg_queue = EmbeddingQueue(neg_queue_size)
+            self.momentum_encoder.requires_grad_(False)
+        else:
+            self.neg_queue = None
+        self._ema_params = None
 
     def get_model_lr(self,*args,**kwargs):
         return super(TransformerForESimcse, self).get_model_lr()
@@ -71,38 +88,51 @@ class TransformerForESimcse(TransformerModel):
     ) -> None:
         # update params
         optimizer.step(closure=optimizer_closure)
-        model = self.model
-        momentum_encoder = self.momentum_encoder
+        self.momentum_update()
+
+    def momentum_update(self):
+        #  Momentum Contrast Encoder Update , 原地 foreach lerp , 不为每个参数分配新张量
+        if self._ema_params is None:
+            pairs = [(moco_encoder_param, encoder_param) for encoder_param, moco_encoder_param in
+                     zip(self.model.parameters(), self.momentum_encoder.parameters())]
+            self._ema_params = ([p for p, _ in pairs], [p for _, p in pairs])
+        moco_params, params = self._ema_params
+        ema_update_(moco_params, params, self.gamma)
 
-        #  Momentum Contrast Encoder Update
-        for encoder_param, moco_encoder_param in zip(model.parameters(), momentum_encoder.parameters()):
-            # print("--", moco_encoder_param.data.shape, encoder_param.data.shape)
-            moco_encoder_param.data = self.gamma \
-                                      * moco_encoder_param.data \
-                                      + (1. - self.gamma) * encoder_param.data
+    def encode_negatives(self, neg_inputs, trim, chunk_size):
+        if neg_inputs and trim:
+            # 各负例 batch 补齐后一次 forward
+            attention_mask, input_ids = trim_padding(pad_cat([mask for _, mask in neg_inputs]),
+                                                     pad_cat([ids for ids, _ in neg_inputs]))
+            neg_logits = grad_cache_encode(self.forward_for_neg_hidden,
+                                           dict(input_ids=input_ids, attention_mask=attention_mask), chunk_size)
+            return list(torch.split(neg_logits, [ids.size(0) for ids, _ in neg_inputs], dim=0))
+        return [grad_cache_encode(self.forward_for_neg_hidden, dict(input_ids=input_ids, attention_mask=attention_mask),
+                                  chunk_size, trim=False)
+                for input_ids, attention_mask in neg_inputs]
 
 
     def compute_loss(self, *args,**batch) -> tuple:
         labels: torch.Tensor = batch.pop('labels',None)
         if self.model.training:
             neg_num = batch.pop('neg_num').cpu().numpy().tolist()
-            input_ids = batch['input_ids']
-            attention_mask = batch['attention_mask']
-            n = input_ids.size(1)
-            loss_logits = []
-            for i in range(n):
-                inputs = {}
-                inputs['input_ids'] = input_ids[:, i]
-                inputs['attention_mask'] = attention_mask[:, i]
-                loss_logits.append(self.forward_for_pos_hidden(**inputs))
-            for i in range(neg_num):
-                input_ids = batch['input_ids' + str(i)]
-                attention_mask = batch['attention_mask' + str(i)]
-                inputs = {}
-                inputs['input_ids'] = input_ids
-                inputs['attention_mask'] = attention_mask
-                loss_logits.append(self.forward_for_neg_hidden(**inputs))
-            loss = self.loss_fn(loss_logits)
+            trim = self.pooling in MASK_INVARIANT_POOLINGS
+            chunk_size = self.grad_cache_chunk_size
+            loss_logits = encode_views(self.forward_for_pos_hidden, batch['input_ids'], batch['attention_mask'],
+                                       trim=trim, chunk_size=chunk_size)
+            neg_inputs = [(batch['input_ids' + str(i)], batch['attention_mask' + str(i)]) for i in range(neg_num)]
+            if self.neg_queue is None:
+                loss_logits.extend(self.encode_negatives(neg_inputs, trim, chunk_size))
+                loss = self.loss_fn(loss_logits)
+            else:
+                # 本 step 的动量负例与队列中之前 step 的负例一起参与 loss , 之后入队
+                with torch.no_grad():
+                    neg_logits = self.encode_negatives(neg_inputs, trim, 0)
+                if len(self.neg_queue):
+                    neg_logits = neg_logits + [self.neg_queue.embeddings(dtype=loss_logits[0].dtype)]
+                loss = self.loss_fn(loss_logits + neg_logits)
+                for logits in neg_logits[:len(neg_inputs)]:
+                    self.neg_queue.enqueue(logits)
             outputs = (loss,)
         elif labels is not None:
             inputs = {}
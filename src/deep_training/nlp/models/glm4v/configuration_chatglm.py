@@ -31,6 +31,9 @@ class ChatGLMConfig(PretrainedConfig):
             fp32_residual_connection=False,
             pre_seq_len=None,
             prefix_projection=False,
+            attn_backend=None,
+            kv_cache_block_size=256,
+            kv_cache_bits=None,
             boi_token_id=None,
             eoi_token_id=None,
             quantization_bit=0,
@@ -62,6 +65,12 @@ class ChatGLMConfig(PretrainedConfig):
         self.fp32_residual_connection = fp32_residual_connection
         self.pre_seq_len = pre_seq_len
         self.prefix_projection = prefix_projection
+        # eager / sdpa / mem_efficient , None 为模型默认
+        self.attn_backend = attn_backend
+        # kv cache 预分配粒度 , <= 0 时退化为 torch.cat
+        self.kv_cache_block_size = kv_cache_block_size
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         self.boi_token_id = boi_token_id
         self.eoi_token_id = eoi_token_id
         self.quantization_bit = quantization_bit
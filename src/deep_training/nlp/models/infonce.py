@@ -4,6 +4,7 @@
 import torch
 from torch import nn
 from .transformer import TransformerModel
+from .embedding_utils import encode_views, MASK_INVARIANT_POOLINGS
 from ..losses.loss_infonce import InfoNCE
 
 __all__ = [
@@ -16,11 +17,19 @@ class TransformerForInfoNce(TransformerModel):
         pooling = kwargs.pop('pooling', 'cls')
         temperature = kwargs.pop('temperature', 0.1)
         vector_size = kwargs.pop('vector_size', 512)
+        # > 0 时训练用 grad cache 分块编码 , 显存只与块大小有关
+        grad_cache_chunk_size = kwargs.pop('grad_cache_chunk_size', 0)
+        # 数据并行时 all_gather 各 rank 的句向量作为 in-batch 负例
+        gather_negatives = kwargs.pop('gather_negatives', False)
+        # 各 rank batch 大小相同时 (drop_last) 不再每步收集各 rank 的行数
+        gather_same_size = kwargs.pop('gather_same_size', False)
         super(TransformerForInfoNce, self).__init__(*args, **kwargs)
         config = self.config
         self.pooling = pooling
+        self.grad_cache_chunk_size = grad_cache_chunk_size
         self.feat_head = nn.Linear(config.hidden_size, vector_size, bias=False)
-        self.loss_fn = InfoNCE(temperature=temperature,negative_mode='paired', reduction='sum')
+        self.loss_fn = InfoNCE(temperature=temperature,negative_mode='paired', reduction='sum', distributed=gather_negatives,
+                              same_size=gather_same_size)
 
     def get_model_lr(self,*args,**kwargs):
         return super(TransformerForInfoNce, self).get_model_lr() + [
@@ -53,21 +62,16 @@ class TransformerForInfoNce(TransformerModel):
     def compute_loss(self, *args, **batch) -> tuple:
         labels: torch.Tensor = batch.pop('labels', None)
         if self.model.training:
-            input_ids = batch['input_ids']
-            attention_mask = batch['attention_mask']
-            n = input_ids.size(1)
-            pos, neg = [], []
-            for i in range(n):
-                inputs = {}
-                inputs['input_ids'] = input_ids[:, i]
-                inputs['attention_mask'] = attention_mask[:, i]
-                obj = pos if i < 2 else neg
-                obj.append(self.forward_for_hidden(**inputs))
+            # 所有视图一次 forward , 前两个视图为 query / pos , 其余为 neg
+            embeddings = encode_views(self.forward_for_hidden, batch['input_ids'], batch['attention_mask'],
+                                      trim=self.pooling in MASK_INVARIANT_POOLINGS,
+                                      chunk_size=self.grad_cache_chunk_size)
+            query, pos_key = embeddings[:2]
+            neg = embeddings[2:]
             if neg:
                 neg_key = torch.stack(neg, dim=1)
             else:
                 neg_key = None
-            query, pos_key = pos
             loss = self.loss_fn(query, pos_key, neg_key)
             outputs = (loss,)
         elif labels is not None:
@@ -98,6 +98,7 @@ class InternLM2Config(PretrainedConfig):
         attn_implementation="eager",
         quantization_bit=0,
         initializer_weight=False,
+        kv_cache_bits=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -126,6 +127,8 @@ class InternLM2Config(PretrainedConfig):
 
         self.quantization_bit = quantization_bit
         self.initializer_weight = initializer_weight
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
@@ -58,6 +58,7 @@ except:  # noqa # pylint: disable=bare-except
     BaseStreamer = None
 
 from .configuration_internlm2 import InternLM2Config
+from ...layers.kv_cache import build_kv_quantizer
 
 logger = logging.get_logger(__name__)
 
@@ -281,6 +282,7 @@ class InternLM2Attention(nn.Module):
     def __init__(self, config: InternLM2Config,**kwargs):
         super().__init__()
         self.config = config
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=2)
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -381,12 +383,18 @@ class InternLM2Attention(nn.Module):
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -485,12 +493,18 @@ class InternLM2FlashAttention2(InternLM2Attention):
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
         query_states = query_states.transpose(1, 2)
         key_states = key_states.transpose(1, 2)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/27 14:05
+# @FileName: adapter_registry.py
+"""
+    大量磁盘 adapter 的注册与热切换
+    safetensors 文件通过 safe_open 内存映射 , 加载时按 key 直接拷贝到已注入的 adapter 参数 , 不构建完整 state_dict
+    key 映射按 (模型 , lora_type , key 集合) 只解析一次 , 解析结果与 adapter 名无关
+    同时驻留在模型(显存)中的 adapter 数量受 max_resident 限制 , 超出时按 LRU 淘汰 ,
+    配置一致时直接复用被淘汰 adapter 的层 (只改名 + 拷贝权重) , 不需要重新注入
+"""
+import dataclasses
+import warnings
+from collections import OrderedDict
+from typing import Dict, List
+
+import torch
+from safetensors import safe_open
+from torch.nn.modules.module import _IncompatibleKeys
+
+from ...layers.petl.petl_layer import PetlLayerBase
+from ...layers.petl.utils import ModulesToSaveWrapper
+from .save_and_load import map_petl_state_dict_keys, get_petl_weights_file
+
+__all__ = [
+    'AdapterRegistry',
+]
+
+# 与权重无关的配置字段 , 比较两个 adapter 能否复用同一组层时忽略
+_CONFIG_IGNORE_FIELDS = ('base_model_name_or_path', 'revision', 'inference_mode', 'with_lora', 'enable')
+
+
+def _config_signature(config):
+    d = dataclasses.asdict(config)
+    for k in _CONFIG_IGNORE_FIELDS:
+        d.pop(k, None)
+    return repr(sorted(d.items(), key=lambda x: x[0]))
+
+
+class _AdapterEntry:
+    def __init__(self, model_id, config, subfolder=None):
+        self.model_id = model_id
+        self.config = config
+        self.subfolder = subfolder
+        self.filename, self.use_safetensors = get_petl_weights_file(model_id, subfolder=subfolder)
+        self._handle = None
+
+    @property
+    def handle(self):
+        # safe_open 只映射文件 , get_tensor 时才读取对应的页
+        if self._handle is None and self.use_safetensors:
+            self._handle = safe_open(self.filename, framework="pt", device="cpu")
+        return self._handle
+
+    def keys(self) -> List[str]:
+        return list(self.handle.keys())
+
+    def get_tensor(self, key):
+        return self.handle.get_tensor(key)
+
+    def close(self):
+        self._handle = None
+
+
+class AdapterRegistry:
+    '''
+        register 只记录路径和配置 , activate 时才加载到模型
+        由 PetlModel.register_adapter / set_adapter 使用
+    '''
+    def __init__(self, max_resident=8):
+        assert max_resident >= 1
+        self.max_resident = max_resident
+        self._entries: Dict[str, _AdapterEntry] = {}
+        # 由 registry 加载到模型中的 adapter , LRU 顺序
+        self._resident: OrderedDict = OrderedDict()
+        self._key_mapping_cache: Dict[tuple, list] = {}
+        self._layers_cache: Dict[int, list] = {}
+
+    def __contains__(self, adapter_name):
+        return adapter_name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def resident_adapters(self) -> List[str]:
+        return list(self._resident.keys())
+
+    def register(self, adapter_name, model_id, config, subfolder=None):
+        if adapter_name in self._resident:
+            raise ValueError(f"Adapter {adapter_name} is resident, deactivate it before registering again.")
+        self._entries[adapter_name] = _AdapterEntry(model_id, config, subfolder=subfolder)
+
+    def unregister(self, model, adapter_name):
+        if adapter_name in self._resident:
+            self._evict(model, adapter_name)
+        entry = self._entries.pop(adapter_name, None)
+        if entry is not None:
+            entry.close()
+
+    def get_layers(self, model):
+        key = id(model)
+        layers = self._layers_cache.get(key, None)
+        if layers is None:
+            layers = self._layers_cache[key] = [m for m in model.modules()
+                                                if isinstance(m, (PetlLayerBase, ModulesToSaveWrapper))]
+        return layers
+
+    def get_key_mapping(self, model, keys, adapter_name):
+        '''
+            返回 [(文件 key , 模块 , 容器属性名 , 容器内路径)] , 容器属性名为 None 时是普通参数(如 bias)
+        '''
+        config = model.petl_config[adapter_name]
+        cache_key = (id(model), config.lora_type, tuple(sorted(model.modules_to_save or ())), tuple(sorted(keys)))
+        mapping = self._key_mapping_cache.get(cache_key, None)
+        if mapping is not None:
+            return mapping
+
+        mapping = []
+        for src, dst in map_petl_state_dict_keys(model, keys, adapter_name=adapter_name).items():
+            parts = dst.split('.')
+            target = None
+            for i in range(len(parts) - 1, 0, -1):
+                if parts[i] != adapter_name:
+                    continue
+                try:
+                    owner = model.get_submodule('.'.join(parts[:i - 1]))
+                except AttributeError:
+                    continue
+                container = getattr(owner, parts[i - 1], None)
+                if hasattr(container, 'keys') and adapter_name in container.keys():
+                    target = (src, owner, parts[i - 1], tuple(parts[i + 1:]))
+                    break
+            if target is None:
+                try:
+                    owner = model.get_submodule('.'.join(parts[:-1]))
+                    getattr(owner, parts[-1])
+                    target = (src, owner, None, (parts[-1],))
+                except AttributeError:
+                    target = (src, None, None, (dst,))
+            mapping.append(target)
+        self._key_mapping_cache[cache_key] = mapping
+        return mapping
+
+    @staticmethod
+    def _resolve(owner, attr, path, adapter_name):
+        obj = getattr(owner, attr)[adapter_name] if attr is not None else owner
+        for p in path:
+            obj = getattr(obj, p)
+        return obj
+
+    def load_from_file(self, model, model_id, adapter_name, subfolder=None, strict=False):
+        '''
+            不注册 , 直接把 model_id 的 safetensors 权重拷贝到已注入的 adapter_name
+        '''
+        entry = _AdapterEntry(model_id, model.petl_config[adapter_name], subfolder=subfolder)
+        try:
+            return self.load_weights(model, entry, adapter_name, strict=strict)
+        finally:
+            entry.close()
+
+    def get_adapter_parameters(self, model, adapter_name) -> Dict[int, torch.nn.Parameter]:
+        '''
+            model 中 adapter_name 的全部参数 , 按 id 索引
+        '''
+        params = {}
+        for layer in self.get_layers(model):
+            if isinstance(layer, ModulesToSaveWrapper):
+                names = ('modules_to_save',)
+            else:
+                names = layer.adapter_layer_names
+            for attr in names:
+                container = getattr(layer, attr, None)
+                if container is None or adapter_name not in container:
+                    continue
+                obj = container[adapter_name]
+                if isinstance(obj, torch.nn.Parameter):
+                    params[id(obj)] = obj
+                elif isinstance(obj, torch.nn.Module):
+                    params.update((id(p), p) for p in obj.parameters())
+        return params
+
+    @torch.no_grad()
+    def load_weights(self, model, entry: _AdapterEntry, adapter_name, strict=False):
+        '''
+            内存映射读取 entry 的权重并逐个拷贝到 model 中 adapter_name 的参数
+            先检查全部形状再拷贝 , 形状不一致时抛出异常且不修改模型
+        '''
+        unexpected_keys = []
+        error_msgs = []
+        targets = []
+        for src, owner, attr, path in self.get_key_mapping(model, entry.keys(), adapter_name):
+            if owner is None:
+                unexpected_keys.append(path[0])
+                continue
+            param = self._resolve(owner, attr, path, adapter_name)
+            # get_slice 只读取文件头中的形状
+            shape = tuple(entry.handle.get_slice(src).get_shape())
+            if shape != tuple(param.shape):
+                error_msgs.append(f"size mismatch for {src}: copying a param with shape {shape} from checkpoint, "
+                                  f"the shape in current model is {tuple(param.shape)}.")
+                continue
+            targets.append((src, param))
+        if error_msgs:
+            raise RuntimeError(f"Error(s) in loading adapter {entry.model_id}:\n\t" + "\n\t".join(error_msgs))
+
+        loaded = set()
+        for src, param in targets:
+            param.data.copy_(entry.get_tensor(src))
+            loaded.add(id(param))
+
+        expected = self.get_adapter_parameters(model, adapter_name)
+        missing_keys = [name for name, p in model.named_parameters()
+                        if id(p) in expected and id(p) not in loaded]
+        if strict and (missing_keys or unexpected_keys):
+            raise RuntimeError(f"Error(s) in loading adapter {entry.model_id}: "
+                               f"missing key(s) {missing_keys}, unexpected key(s) {unexpected_keys}")
+        return _IncompatibleKeys(missing_keys, unexpected_keys)
+
+    def _rename(self, model, old_name, new_name):
+        for layer in self.get_layers(model):
+            if isinstance(layer, ModulesToSaveWrapper):
+                names = ('modules_to_save',)
+            else:
+                names = layer.adapter_layer_names + layer.other_param_names
+            for attr in names:
+                container = getattr(layer, attr, None)
+                if container is not None and old_name in container:
+                    container[new_name] = container.pop(old_name)
+        model.petl_config[new_name] = model.petl_config.pop(old_name)
+
+    def _evict(self, model, adapter_name):
+        delete_adapter = getattr(model.base_model, 'delete_adapter', None)
+        if delete_adapter is None:
+            raise ValueError(f"{model.base_model.__class__.__name__} does not support deleting adapters, "
+                             f"increase max_resident.")
+        self._resident.pop(adapter_name, None)
+        delete_adapter(adapter_name)
+        model.petl_config.pop(adapter_name, None)
+        self._layers_cache.pop(id(model), None)
+
+    def activate(self, model, adapter_name):
+        '''
+            确保 adapter_name 驻留在模型中
+        '''
+        if adapter_name in self._resident:
+            self._resident.move_to_end(adapter_name)
+            return
+        entry = self._entries[adapter_name]
+        if adapter_name in model.petl_config:
+            # 用户直接加载的同名 adapter 不归 registry 管理
+            return
+        if not entry.use_safetensors:
+            model.load_adapter(entry.model_id, adapter_name, config=entry.config, subfolder=entry.subfolder)
+            self._resident[adapter_name] = True
+            self._shrink(model, keep=adapter_name)
+            return
+
+        reuse = None
+        if len(self._resident) >= self.max_resident:
+            signature = _config_signature(entry.config)
+            active = set(model.base_model.active_adapters) if hasattr(model.base_model, 'active_adapters') else set()
+            for name in self._resident:
+                if name not in active and _config_signature(model.petl_config[name]) == signature:
+                    reuse = name
+                    break
+        if reuse is not None:
+            # 复用层 , 只改名并覆盖权重
+            self._resident.pop(reuse)
+            self._rename(model, reuse, adapter_name)
+            model.petl_config[adapter_name] = entry.config
+        else:
+            self._shrink(model, keep=None, reserve=1)
+            model.add_adapter(adapter_name, entry.config)
+            self._layers_cache.pop(id(model), None)
+        self.load_weights(model, entry, adapter_name)
+        self._resident[adapter_name] = True
+
+    def _shrink(self, model, keep=None, reserve=0):
+        active = set(model.base_model.active_adapters) if hasattr(model.base_model, 'active_adapters') else set()
+        for name in list(self._resident.keys()):
+            if len(self._resident) + reserve <= self.max_resident:
+                break
+            if name == keep or name in active:
+                continue
+            self._evict(model, name)
+        if len(self._resident) + reserve > self.max_resident:
+            warnings.warn(f"All {len(self._resident)} resident adapters are active, max_resident={self.max_resident} exceeded.")
@@ -261,6 +261,28 @@ class IA3Module(PetlModelBase):
                     module.unmerge()
                 module.set_adapter(adapter_name)
 
+    def delete_adapter(self, adapter_name: str):
+        """
+        Deletes an existing adapter.
+
+        Args:
+            adapter_name (str): Name of the adapter to be deleted.
+        """
+        if adapter_name not in list(self.petl_config.keys()):
+            raise ValueError(f"Adapter {adapter_name} does not exist")
+        del self.petl_config[adapter_name]
+
+        key_list = [key for key, _ in self.model.named_modules() if "ia3_l" not in key]
+        new_adapter = None
+        for key in key_list:
+            _, target, _ = _get_submodules(self.model, key)
+            if isinstance(target, IA3Layer):
+                target.delete_adapter(adapter_name)
+                if new_adapter is None:
+                    new_adapter = target.active_adapters[:]
+
+        self.active_adapter = new_adapter or []
+
     def _prepare_adapter_config(self, petl_config, model_config):
         if petl_config.target_modules is None:
             if model_config[ "model_type" ] not in TRANSFORMERS_MODELS_TO_IA3_TARGET_MODULES_MAPPING:
@@ -2,9 +2,13 @@
 # @Time:  10:44
 # @Author: tk
 # @File：lora_model
+import math
 import operator
+import os
 import re
 import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, replace
 from enum import Enum
 from functools import reduce
@@ -37,6 +41,48 @@ if is_bnb_4bit_available():
 
 from ....layers.petl.lora.gptq import QuantLinear
 
+
+def _stack_weighted_factors(adapters, weights, target):
+    '''
+        ΔW = Σ w_i * s_i * B_i @ A_i = [B_1 .. B_k] @ [w_1 s_1 A_1 ; .. ; w_k s_k A_k]
+        返回 fp32 (B_cat [out, R] , A_cat [R, in]) , conv 的 kernel 维展平到 A_cat
+    '''
+    loras_A, loras_B = [], []
+    for adapter, weight in zip(adapters, weights):
+        if adapter in target.lora_A:
+            lora_A = target.lora_A[adapter].weight
+            lora_B = target.lora_B[adapter].weight
+        elif adapter in target.lora_embedding_A:
+            lora_A = target.lora_embedding_A[adapter]
+            lora_B = target.lora_embedding_B[adapter]
+        else:
+            continue
+        loras_A.append(lora_A.detach().float().flatten(start_dim=1) * (weight * target.scaling[adapter]))
+        loras_B.append(lora_B.detach().float().flatten(start_dim=1).to(loras_A[-1].device))
+    if len(loras_A) == 0:
+        raise ValueError("No matching LoRAs found. Please raise an issue on Github.")
+    return torch.cat(loras_B, dim=1), torch.cat(loras_A, dim=0)
+
+
+def _lowrank_svd(B, A, new_rank, driver=None):
+    '''
+        B: [..., m, R] , A: [..., R, n] , 返回 B @ A 的 new_rank 截断 (U * S [..., m, new_rank] , Vh [..., new_rank, n])
+        B @ A = Q_B (R_B R_A^T) Q_A^T , 只对 R x R 的核做 svd , 不构造 m x n 的 ΔW
+        R < new_rank 时补零 , 与稠密 svd 截断结果一致
+    '''
+    Q_B, R_B = torch.linalg.qr(B)
+    Q_A, R_A = torch.linalg.qr(A.transpose(-1, -2))
+    core = R_B @ R_A.transpose(-1, -2)
+    U, S, Vh = torch.linalg.svd(core, full_matrices=False, driver=driver if core.is_cuda else None)
+    k = min(new_rank, S.size(-1))
+    U = Q_B @ (U[..., :k] * S[..., None, :k])
+    Vh = Vh[..., :k, :] @ Q_A.transpose(-1, -2)
+    if k < new_rank:
+        U = torch.nn.functional.pad(U, (0, new_rank - k))
+        Vh = torch.nn.functional.pad(Vh, (0, 0, 0, new_rank - k))
+    return U, Vh
+
+
 class LoraModule(PetlModelBase):
     """
     Creates Low Rank Adapter (Lora) model from a pretrained transformers model.
@@ -408,8 +454,9 @@ class LoraModule(PetlModelBase):
             combination_type="svd",
             svd_rank=None,
             svd_clamp=None,
-            svd_full_matrices=True,
+            svd_full_matrices=None,
             svd_driver=None,
+            svd_num_workers=None,
     ):
         """
         This method adds a new adapter by merging the given adapters with the given weights.
@@ -435,14 +482,23 @@ class LoraModule(PetlModelBase):
                 A quantile threshold for clamping SVD decomposition output. If None is provided, do not perform
                 clamping. Defaults to None.
             svd_full_matrices (`bool`, *optional*):
-                Controls whether to compute the full or reduced SVD, and consequently, the shape of the returned
-                tensors U and Vh. Defaults to True.
+                Deprecated and ignored. The svd runs on the small core of the stacked low-rank factors, whose
+                truncation does not depend on full or reduced matrices.
             svd_driver (`str`, *optional*):
                 Name of the cuSOLVER method to be used. This keyword argument only works when merging on CUDA. Can be
                 one of [None, `gesvd`, `gesvdj`, `gesvda`]. For more info please refer to `torch.linalg.svd`
                 documentation. Defaults to None.
+            svd_num_workers (`int`, *optional*):
+                Number of CPU threads used by the `svd` combination when the adapters live on CPU. Defaults to
+                `min(8, os.cpu_count())`.
         """
 
+        if svd_full_matrices is not None:
+            warnings.warn(
+                "`svd_full_matrices` is deprecated and has no effect, the svd combination is computed from the "
+                "stacked low-rank factors and gives the same truncation either way.",
+                FutureWarning,
+            )
         if adapter_name in list(self.petl_config.keys()):
             return
         for adapter in adapters:
@@ -497,6 +553,7 @@ class LoraModule(PetlModelBase):
         # Do we really need that?
         _freeze_adapter(self.model, adapter_name)
 
+        svd_jobs = []
         key_list = [key for key, _ in self.model.named_modules() if "lora" not in key]
         for key in key_list:
             _, target, _ = _get_submodules(self.model, key)
@@ -545,70 +602,73 @@ class LoraModule(PetlModelBase):
                     target_lora_A.data[: loras_A.shape[0], :] = loras_A
                     target_lora_B.data[:, : loras_B.shape[1]] = loras_B
                 elif combination_type == "svd":
-                    target_lora_A.data, target_lora_B.data = self._svd_weighted_adapter(
-                        adapters,
-                        weights,
-                        new_rank,
-                        target,
-                        target_lora_A,
-                        target_lora_B,
-                        svd_clamp,
-                        full_matrices=svd_full_matrices,
-                        driver=svd_driver,
-                    )
+                    svd_jobs.append((target, target_lora_A, target_lora_B))
+
+        if svd_jobs:
+            self._svd_weighted_adapter(
+                adapters,
+                weights,
+                new_rank,
+                svd_jobs,
+                svd_clamp,
+                driver=svd_driver,
+                num_workers=svd_num_workers,
+            )
 
+    @staticmethod
+    @torch.no_grad()
     def _svd_weighted_adapter(
-            self,
             adapters,
             weights,
             new_rank,
-            target,
-            target_lora_A,
-            target_lora_B,
+            svd_jobs,
             clamp=None,
-            full_matrices=True,
             driver=None,
+            num_workers=None,
     ):
-        valid_adapters = []
-        valid_weights = []
-        for adapter, weight in zip(adapters, weights):
-            if adapter in target.lora_A or adapter in target.lora_embedding_A:
-                valid_adapters.append(adapter)
-                valid_weights.append(weight)
-
-        # if no valid adapter, nothing to do
-        if len(valid_adapters) == 0:
-            raise ValueError("No matching LoRAs found. Please raise an issue on Github.")
-
-        delta_weight = valid_weights[0] * target.get_delta_weight(valid_adapters[0])
-        for adapter, weight in zip(valid_adapters[1:], valid_weights[1:]):
-            delta_weight += weight * target.get_delta_weight(adapter)
-        conv2d = isinstance(target, Conv2d)
-        if conv2d:
-            conv2d_1x1 = target.weight.size()[2:4] == (1, 1)
-            if not conv2d_1x1:
-                delta_weight = delta_weight.flatten(start_dim=1)
-            else:
-                delta_weight = delta_weight.squeeze()
-        if hasattr(target, "fan_in_fan_out") and target.fan_in_fan_out:
-            delta_weight = delta_weight.T
-
-        # based on https://github.com/kohya-ss/sd-scripts/blob/main/networks/svd_merge_lora.py#L114-L131
-        U, S, Vh = torch.linalg.svd(delta_weight, full_matrices=full_matrices, driver=driver)
-        U = U[:, :new_rank]
-        S = S[:new_rank]
-        U = U @ torch.diag(S)
-        Vh = Vh[:new_rank, :]
-        if clamp is not None:
-            dist = torch.cat([U.flatten(), Vh.flatten()])
-            hi_val = torch.quantile(dist, clamp)
-            low_val = -hi_val
-            U = U.clamp(low_val, hi_val)
-            Vh = Vh.clamp(low_val, hi_val)
-        if conv2d:
-            U = U.reshape(target_lora_B.data.shape)
-            Vh = Vh.reshape(target_lora_A.data.shape)
-        return Vh, U
+        '''
+            svd_jobs: [(target , target_lora_A , target_lora_B)]
+            ΔW 的秩不超过各 adapter 秩之和 , 在堆叠后的因子上做 qr + 小核 svd , 结果与稠密 svd 截断一致
+            形状相同的模块堆成一个 batch , cpu 上按 num_workers 分块并行
+        '''
+        groups = defaultdict(list)
+        factors = []
+        for idx, (target, _, _) in enumerate(svd_jobs):
+            B, A = _stack_weighted_factors(adapters, weights, target)
+            factors.append((B, A))
+            groups[(tuple(B.shape), tuple(A.shape), B.device)].append(idx)
+
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        chunks = []
+        for (_, _, device), indices in groups.items():
+            step = len(indices) if device.type != "cpu" else max(1, math.ceil(len(indices) / num_workers))
+            chunks.extend(indices[i: i + step] for i in range(0, len(indices), step))
+
+        def run(indices):
+            U, Vh = _lowrank_svd(torch.stack([factors[i][0] for i in indices]),
+                                 torch.stack([factors[i][1] for i in indices]),
+                                 new_rank, driver=driver)
+            return indices, U, Vh
+
+        if num_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(run, chunks))
+        else:
+            results = [run(indices) for indices in chunks]
+
+        for indices, U, Vh in results:
+            for i, u, vh in zip(indices, U, Vh):
+                _, target_lora_A, target_lora_B = svd_jobs[i]
+                # based on https://github.com/kohya-ss/sd-scripts/blob/main/networks/svd_merge_lora.py#L114-L131
+                if clamp is not None:
+                    dist = torch.cat([u.flatten(), vh.flatten()])
+                    hi_val = torch.quantile(dist, clamp)
+                    low_val = -hi_val
+                    u = u.clamp(low_val, hi_val)
+                    vh = vh.clamp(low_val, hi_val)
+                target_lora_A.data = vh.reshape(target_lora_A.shape).to(target_lora_A.device, target_lora_A.dtype)
+                target_lora_B.data = u.reshape(target_lora_B.shape).to(target_lora_B.device, target_lora_B.dtype)
 
     def delete_adapter(self, adapter_name: str):
         """
@@ -22,7 +22,8 @@ from .adalora.model import AdaLoraModule
 from .ia3.model import IA3Module
 from .loha.model import LoHaModule
 from .lokr.model import LoKrModule
-from .save_and_load import get_petl_model_state_dict, set_petl_model_state_dict, load_petl_weights
+from .save_and_load import get_petl_model_state_dict, set_petl_model_state_dict, load_petl_weights, get_petl_weights_file
+from .adapter_registry import AdapterRegistry
 
 PETL_TYPE_TO_MODEL_MAPPING = {
     "ia3": IA3Module,
@@ -45,7 +46,8 @@ __all__ = [
     "LoKrModule",
     "get_petl_model_state_dict",
     "set_petl_model_state_dict",
-    "load_petl_weights"
+    "load_petl_weights",
+    "AdapterRegistry",
 ]
 class PetlModel(PushToHubMixin, torch.nn.Module):
     """
@@ -88,6 +90,7 @@ class PetlModel(PushToHubMixin, torch.nn.Module):
         self.lora_type = petl_config.lora_type
         self.base_model_torch_dtype = getattr(model, "dtype", None)
         self.petl_config[adapter_name] = petl_config
+        self.adapter_registry: Optional[AdapterRegistry] = None
         self.base_model: LoraModule = PETL_TYPE_TO_MODEL_MAPPING[petl_config.lora_type](
             self.base_model, self.petl_config, adapter_name,
             gradient_checkpointing=gradient_checkpointing,
@@ -353,6 +356,31 @@ class PetlModel(PushToHubMixin, torch.nn.Module):
                 self.modules_to_save = self.modules_to_save.update(lora_config.modules_to_save)
             _set_trainable(self, adapter_name)
 
+    def get_adapter_registry(self, max_resident=None) -> AdapterRegistry:
+        if self.adapter_registry is None:
+            self.adapter_registry = AdapterRegistry(max_resident=max_resident or 8)
+        elif max_resident is not None:
+            self.adapter_registry.max_resident = max_resident
+        return self.adapter_registry
+
+    def register_adapter(self, model_id, adapter_name, config=None, max_resident=None, **kwargs):
+        """
+        Registers an on-disk adapter without loading it. It is loaded into the model by `set_adapter`, at most
+        `max_resident` registered adapters stay in the model (least recently used ones are evicted).
+        """
+        if config is None:
+            config = PETL_TYPE_TO_CONFIG_MAPPING[
+                LoraConfig.from_pretrained(model_id, subfolder=kwargs.get("subfolder", None)).lora_type
+            ].from_pretrained(model_id, subfolder=kwargs.get("subfolder", None))
+        if config.lora_type != self.lora_type:
+            raise ValueError(
+                f"Cannot combine adapters with different peft types. "
+                f"Found {self.lora_type} and {config.lora_type}."
+            )
+        config.inference_mode = True
+        self.get_adapter_registry(max_resident).register(adapter_name, model_id, config,
+                                                         subfolder=kwargs.get("subfolder", None))
+
     def load_adapter(self, model_id, adapter_name,
                      config=None,
                      is_trainable=False, strict=False,
@@ -371,7 +399,14 @@ class PetlModel(PushToHubMixin, torch.nn.Module):
             self.add_adapter(adapter_name, lora_config)
 
 
-        adapters_weights = load_petl_weights(model_id,device=torch_device)
+        _, use_safetensors = get_petl_weights_file(model_id, **kwargs)
+        if use_safetensors and map_preprocess is None and self.lora_type != "adalora":
+            # 内存映射 , 按缓存的 key 映射逐个拷贝 , 不构建完整 state_dict
+            return self.get_adapter_registry().load_from_file(self, model_id, adapter_name,
+                                                              subfolder=kwargs.get("subfolder", None),
+                                                              strict=strict)
+
+        adapters_weights = load_petl_weights(model_id,device=torch_device, **kwargs)
 
         if 'state_dict' in adapters_weights:
             adapters_weights = adapters_weights['state_dict']
@@ -386,6 +421,8 @@ class PetlModel(PushToHubMixin, torch.nn.Module):
         """
         Sets the active adapter.
         """
+        if self.adapter_registry is not None and adapter_name in self.adapter_registry:
+            self.adapter_registry.activate(self, adapter_name)
         if adapter_name not in self.petl_config:
             raise ValueError(f"Adapter {adapter_name} not found.")
         self.active_adapter = adapter_name
@@ -79,6 +79,46 @@ def get_petl_model_state_dict(model, state_dict=None, adapter_name="default"):
     return to_return
 
 
+def map_petl_state_dict_keys(model, keys, adapter_name="default"):
+    """
+    Map the keys of a saved Peft state dict to the keys of the Peft model.
+
+    Args:
+        model ([`PeftModel`]): The Peft model.
+        keys (`Iterable[str]`): The keys of the saved state dict.
+
+    Returns:
+        `dict`: saved key -> model key
+    """
+    config = model.petl_config[adapter_name]
+    if config.lora_type not in ('lora', 'adalora', 'ia3', "loha", "lokr"):
+        raise NotImplementedError
+    parameter_prefix = {
+        "ia3": "ia3_",
+        "lora": "lora_",
+        "adalora": "lora_",
+        "loha": "hada_",
+        "lokr": "lokr_",
+    }[config.lora_type]
+    mapping = {}
+    for src in keys:
+        k = src
+        if getattr(model, "modules_to_save", None) is not None:
+            for module_name in model.modules_to_save:
+                if module_name in k:
+                    k = k.replace(module_name, f"{module_name}.modules_to_save.{adapter_name}")
+                    break
+        if parameter_prefix in k:
+            suffix = k.split(parameter_prefix)[1]
+            if "." in suffix:
+                suffix_to_replace = ".".join(suffix.split(".")[1:])
+                k = k.replace(suffix_to_replace, f"{adapter_name}.{suffix_to_replace}")
+            else:
+                k = f"{k}.{adapter_name}"
+        mapping[src] = k
+    return mapping
+
+
 def set_petl_model_state_dict(model, petl_model_state_dict, adapter_name="default", strict=False):
     """
     Set the state dict of the Peft model.
@@ -88,44 +128,12 @@ def set_petl_model_state_dict(model, petl_model_state_dict, adapter_name="defaul
         petl_model_state_dict (`dict`): The state dict of the Peft model.
     """
     config = model.petl_config[adapter_name]
-    state_dict = {}
-    if getattr(model, "modules_to_save", None) is not None:
-        for key, value in petl_model_state_dict.items():
-            if any(module_name in key for module_name in model.modules_to_save):
-                for module_name in model.modules_to_save:
-                    if module_name in key:
-                        key = key.replace(module_name, f"{module_name}.modules_to_save.{adapter_name}")
-                        break
-            state_dict[key] = value
-    else:
-        state_dict = petl_model_state_dict
-
-    if config.lora_type in ('lora', 'adalora', 'ia3',"loha","lokr"):
-        petl_model_state_dict = {}
-        parameter_prefix = {
-            "ia3": "ia3_",
-            "lora": "lora_",
-            "adalora": "lora_",
-            "loha": "hada_",
-            "lokr": "lokr_",
-        }[config.lora_type]
-        for k, v in state_dict.items():
-            if parameter_prefix in k:
-                suffix = k.split(parameter_prefix)[1]
-                if "." in suffix:
-                    suffix_to_replace = ".".join(suffix.split(".")[1:])
-                    k = k.replace(suffix_to_replace, f"{adapter_name}.{suffix_to_replace}")
-                else:
-                    k = f"{k}.{adapter_name}"
-                petl_model_state_dict[k] = v
-            else:
-                petl_model_state_dict[k] = v
-        if config.lora_type == "adalora":
-            rank_pattern = config.rank_pattern
-            if rank_pattern is not None:
-                model.resize_modules_by_rank_pattern(rank_pattern, adapter_name)
-    else:
-        raise NotImplementedError
+    mapping = map_petl_state_dict_keys(model, petl_model_state_dict.keys(), adapter_name=adapter_name)
+    petl_model_state_dict = {mapping[k]: v for k, v in petl_model_state_dict.items()}
+    if config.lora_type == "adalora":
+        rank_pattern = config.rank_pattern
+        if rank_pattern is not None:
+            model.resize_modules_by_rank_pattern(rank_pattern, adapter_name)
 
     load_result = model.load_state_dict(petl_model_state_dict, strict=strict)
     return load_result
@@ -135,6 +143,29 @@ def set_petl_model_state_dict(model, petl_model_state_dict, adapter_name="defaul
 
 
 
+def get_petl_weights_file(model_id: str, **kwargs):
+    r"""
+    Locate the adapter weights file.
+
+    Returns:
+        (`str`, `bool`): the filename and whether it is a safetensors file
+    """
+    path = (
+        os.path.join(model_id, kwargs["subfolder"])
+        if kwargs.get("subfolder", None) is not None
+        else model_id
+    )
+
+    if os.path.exists(os.path.join(path, SAFETENSORS_WEIGHTS_NAME)):
+        return os.path.join(path, SAFETENSORS_WEIGHTS_NAME), True
+    if os.path.exists(os.path.join(path, WEIGHTS_NAME)):
+        return os.path.join(path, WEIGHTS_NAME), False
+    raise ValueError(
+        f"Can't find weights for {model_id} in {model_id} or in the Hugging Face Hub. "
+        f"Please check that the file {WEIGHTS_NAME} or {SAFETENSORS_WEIGHTS_NAME} is present at {model_id}."
+    )
+
+
 def load_petl_weights(model_id: str, device: Optional[str] = None, **kwargs) -> dict:
     r"""
     A helper method to load the effi weights from the HuggingFace Hub or locally
@@ -147,27 +178,11 @@ def load_petl_weights(model_id: str, device: Optional[str] = None, **kwargs) ->
         hf_hub_download_kwargs (`dict`):
             Additional arguments to pass to the `hf_hub_download` method when loading from the HuggingFace Hub.
     """
-    path = (
-        os.path.join(model_id, kwargs["subfolder"])
-        if kwargs.get("subfolder", None) is not None
-        else model_id
-    )
+    filename, use_safetensors = get_petl_weights_file(model_id, **kwargs)
 
     if device is None:
         device = infer_device()
 
-    if os.path.exists(os.path.join(path, SAFETENSORS_WEIGHTS_NAME)):
-        filename = os.path.join(path, SAFETENSORS_WEIGHTS_NAME)
-        use_safetensors = True
-    elif os.path.exists(os.path.join(path, WEIGHTS_NAME)):
-        filename = os.path.join(path, WEIGHTS_NAME)
-        use_safetensors = False
-    else:
-        raise ValueError(
-            f"Can't find weights for {model_id} in {model_id} or in the Hugging Face Hub. "
-            f"Please check that the file {WEIGHTS_NAME} or {SAFETENSORS_WEIGHTS_NAME} is present at {model_id}."
-        )
-
     if use_safetensors:
         adapters_weights = safe_load_file(filename, device=device)
     else:
@@ -4,11 +4,13 @@
 
 import typing
 from dataclasses import field, dataclass
+from functools import partial
 
 import numpy as np
 import torch
 from torch import nn
 from .transformer import TransformerModel
+from .embedding_utils import flatten_views, grad_cache_encode
 from ..losses.MultipleNegativesRankingLoss import MultipleNegativesRankingLoss
 
 __all__ = [
@@ -123,11 +125,18 @@ class TransformerForPromptbertcse(TransformerModel):
     def __init__(self, *args, **kwargs):
         promptbertcse_args: PromptBertcseArguments = kwargs.pop('promptbertcse_args')
         tokenizer = kwargs.pop('tokenizer')
+        # > 0 时训练用 grad cache 分块编码 , 显存只与块大小有关
+        grad_cache_chunk_size = kwargs.pop('grad_cache_chunk_size', 0)
+        # 数据并行时 all_gather 各 rank 的句向量作为 in-batch 负例
+        gather_negatives = kwargs.pop('gather_negatives', False)
+        # 各 rank batch 大小相同时 (drop_last) 不再每步收集各 rank 的行数
+        gather_same_size = kwargs.pop('gather_same_size', False)
         super(TransformerForPromptbertcse, self).__init__(*args, **kwargs)
         self.promptbertcse_args = promptbertcse_args
+        self.grad_cache_chunk_size = grad_cache_chunk_size
         config = self.config
         self.mlp = MLPLayer(config)
-        self.loss_fn = MultipleNegativesRankingLoss()
+        self.loss_fn = MultipleNegativesRankingLoss(distributed=gather_negatives, same_size=gather_same_size)
         self.config.mask_token_id = self.config.task_specific_params['mask_token_id']
 
         bs = tokenizer.encode(promptbertcse_args.mask_embedding_sentence_bs, add_special_tokens=False)
@@ -316,14 +325,9 @@ class TransformerForPromptbertcse(TransformerModel):
                     delta1, template_len1 = self.get_delta([self.model_extra['mask_embedding_template2']], device,
                                                            length=N)
             attention_mask = batch['attention_mask']
-            logits_list = []
-            for i in range(n):
-                inputs = {
-                    'input_ids': input_ids[:, i],
-                    'attention_mask': attention_mask[:, i]
-                }
-                logits_list.append(self.forward_for_hidden(*args, **inputs))
-            pooler_output = torch.cat(logits_list, dim=0)
+            # 所有视图一次 forward , 按 [mask] 位置取向量 , 结果按视图顺序排列
+            pooler_output = grad_cache_encode(partial(self.forward_for_hidden, *args),
+                                              flatten_views(input_ids, attention_mask), self.grad_cache_chunk_size)
 
             if self.promptbertcse_args.mask_embedding_sentence_delta:
                 if len(self.promptbertcse_args.mask_embedding_sentence_different_template) > 0:
@@ -41,6 +41,149 @@ def batched_index_select(
     idxs = idxs.unsqueeze(-1).expand(idxs.shape[0], idxs.shape[1], x.shape[-1])
     return x.gather(dim=dim, index=idxs)
 
+def ilql_sample(
+    logits: torch.Tensor,
+    qs: torch.Tensor,
+    vs: torch.Tensor,
+    beta=1,
+    top_k=20,
+    temperature=1,
+    logit_mask: Optional[torch.Tensor] = None,
+    prev_tokens: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Advantage-weighted top-k sampling of one token per row.
+    softmax / multinomial run on the k candidates instead of the full vocab.
+    logits, qs: (batch, vocab); vs: (batch, 1); returns (batch, 1)
+    """
+    if logit_mask is not None:
+        mask = logit_mask[prev_tokens.to(logit_mask.device)].to(logits.device)
+        logits = logits.masked_fill(mask, -np.inf)
+    scores = F.log_softmax(logits, -1).add_(qs - vs, alpha=beta)
+    indices = None
+    if top_k and top_k < scores.shape[-1]:
+        scores, indices = torch.topk(scores, top_k, dim=-1)
+    pi = F.softmax(scores / temperature, -1)
+    next_tokens = torch.multinomial(pi, num_samples=1)
+    if indices is not None:
+        next_tokens = indices.gather(-1, next_tokens)
+    return next_tokens
+
+
+def reorder_past_key_values(model, past_key_values, index: torch.Tensor):
+    """
+    Keep only the rows in index of the kv cache, using the model family's own
+    _reorder_cache (the one beam search uses). Returns None if not supported.
+    """
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(index)
+        return past_key_values
+    fn = getattr(model, "_reorder_cache", None)
+    if fn is None:
+        return None
+    try:
+        return fn(past_key_values, index)
+    except NotImplementedError:
+        return None
+
+
+class ILQLCausalGenerateMixin:
+    """
+    Decoding loop shared by the decoder-only ILQL wrappers:
+        - output ids and attention mask are preallocated and written in place
+        - ilql heads only run on the last hidden state
+        - finished rows are dropped from the batch (and the kv cache) instead of
+          being decoded until every row hits eos
+    """
+    def generate_ilql(
+        self,
+        input_ids,
+        attention_mask=None,
+        position_ids=None,
+        past_key_values=None,
+        beta=1,
+        max_new_tokens=32,
+        max_length=1024,
+        temperature=1,
+        top_k=20,
+        logit_mask=None,
+        pad_token_id=None,
+        eos_token_id=None,
+    ):
+        """
+        Generates samples akin to hf's `.generate` but with custom logp prepossessing:
+        changing token probabilities as to how advantageous they would be
+        according to value functions estimations.
+        """
+        pad_token_id = pad_token_id if pad_token_id is not None else self.model.config.pad_token_id
+        eos_token_id = eos_token_id if eos_token_id is not None else self.model.config.eos_token_id
+
+        if attention_mask is None:
+            attention_mask = input_ids.not_equal(pad_token_id).long()
+
+        if position_ids is None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask.eq(0), 0)
+
+        batch_size, prompt_length = input_ids.shape
+        max_new_tokens = max(0, min(max_new_tokens, max_length - prompt_length))
+        samples = input_ids.new_full((batch_size, prompt_length + max_new_tokens), eos_token_id)
+        samples[:, :prompt_length] = input_ids
+        attention_buffer = attention_mask.new_zeros((batch_size, prompt_length + max_new_tokens))
+        attention_buffer[:, :prompt_length] = attention_mask
+
+        # zero3 下所有 rank 必须执行相同次数的 forward
+        sync_steps = os.environ.get("ACCELERATE_DEEPSPEED_ZERO_STAGE", "0") == "3"
+        can_compact = not sync_steps
+        rows = torch.arange(batch_size, device=input_ids.device)
+        finished = torch.zeros(batch_size, 1, dtype=torch.bool, device=input_ids.device)
+        cur_length = prompt_length
+        for _ in range(max_new_tokens):
+            last_ixs = input_ids.new_full((input_ids.shape[0], 1), input_ids.shape[1] - 1)
+            out = self.forward(
+                input_ids=input_ids,
+                attention_mask=attention_buffer[:, :cur_length],
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                states_ixs=last_ixs,
+                actions_ixs=last_ixs,
+            )
+
+            logits, _, target_qs, vs, past_key_values = out
+            if self.two_qs:
+                qs = torch.minimum(target_qs[0][:, -1, :], target_qs[1][:, -1, :])
+            else:
+                qs = target_qs[0][:, -1, :]
+
+            next_tokens = ilql_sample(logits[:, -1, :], qs, vs[:, -1, :],
+                                      beta=beta, top_k=top_k, temperature=temperature,
+                                      logit_mask=logit_mask, prev_tokens=input_ids[:, -1])
+            next_tokens.masked_fill_(finished, eos_token_id)
+            finished |= next_tokens == eos_token_id
+
+            samples[rows, cur_length] = next_tokens.squeeze(-1)
+            attention_buffer[:, cur_length] = (~finished.squeeze(-1)).to(attention_buffer.dtype)
+            cur_length += 1
+            input_ids = next_tokens
+            position_ids = position_ids[:, -1:] + 1
+
+            if sync_steps:
+                continue
+            num_active = int((~finished).sum())
+            if num_active == 0:
+                break
+            if can_compact and num_active < finished.shape[0]:
+                keep = (~finished).squeeze(-1).nonzero().squeeze(-1)
+                reordered = reorder_past_key_values(self.model, past_key_values, keep)
+                if reordered is None:
+                    can_compact = False
+                    continue
+                past_key_values = reordered
+                rows, input_ids, position_ids = rows[keep], input_ids[keep], position_ids[keep]
+                attention_buffer, finished = attention_buffer[keep], finished[keep]
+
+        return samples[:, :cur_length]
+
 class ILQLHeads(nn.Module):
     def __init__(
             self,
@@ -118,7 +261,7 @@ class ILQLHeads(nn.Module):
     def sync_target_q_heads(self):
         self._sync_target_q_heads(self.alpha)
 
-class AutoModelForCausalLMWithILQLHeads(TransformerForCausalLM):
+class AutoModelForCausalLMWithILQLHeads(ILQLCausalGenerateMixin, TransformerForCausalLM):
     """An `AutoModel` class wrapper for `transformers` causal models wtih a language
     modeling head and ILQL heads.
 
@@ -160,79 +303,6 @@ class AutoModelForCausalLMWithILQLHeads(TransformerForCausalLM):
         qs, target_qs, vs = self.ilql_heads(outputs.hidden_states[-1], states_ixs=states_ixs, actions_ixs=actions_ixs)
         return outputs.logits, qs, target_qs, vs, outputs.past_key_values
 
-    def generate_ilql(
-        self,
-        input_ids,
-        attention_mask=None,
-        position_ids=None,
-        past_key_values=None,
-        beta=1,
-        max_new_tokens=32,
-        max_length=1024,
-        temperature=1,
-        top_k=20,
-        logit_mask=None,
-        pad_token_id=None,
-        eos_token_id=None,
-    ):
-        """
-        Generates samples akin to hf's `.generate` but with custom logp prepossessing:
-        changing token probabilities as to how advantageous they would be
-        according to value functions estimations.
-        """
-        pad_token_id = pad_token_id if pad_token_id is not None else self.model.config.pad_token_id
-        eos_token_id = eos_token_id if eos_token_id is not None else self.model.config.eos_token_id
-
-        if attention_mask is None:
-            attention_mask = input_ids.not_equal(pad_token_id)
-
-        if position_ids is None:
-            position_ids = attention_mask.cumsum(-1) - 1
-            position_ids.masked_fill_(attention_mask.eq(0), 0)
-
-        samples = input_ids.clone()
-        max_new_tokens = min(max_new_tokens, max_length - input_ids.shape[1])
-
-        finished = torch.zeros(input_ids.shape[0], 1, dtype=torch.long, device=input_ids.device)
-        for _ in range(max_new_tokens):
-            out = self.forward(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                position_ids=position_ids,
-                past_key_values=past_key_values,
-            )
-
-            logits, _, target_qs, vs, past_key_values = out
-            if self.two_qs:
-                qs = torch.minimum(target_qs[0][:, -1, :], target_qs[1][:, -1, :])
-            else:
-                qs = target_qs[:, -1, :]
-
-            logits = logits[:, -1, :]
-            vs = vs[:, -1, :]
-
-            if logit_mask is not None:
-                mask = logit_mask[input_ids[:, -1].squeeze().to(logit_mask.device)]
-                logits[torch.where(mask)] = -np.inf
-
-            adv = qs - vs
-            pi_beta = F.log_softmax(logits, -1)
-            pi_top_k = topk_mask(pi_beta + beta * adv, top_k)
-            pi = F.softmax(pi_top_k / temperature, -1)
-
-            input_ids = torch.multinomial(pi, num_samples=1)
-            input_ids = (1 - finished) * input_ids + finished * eos_token_id
-            finished = (input_ids == eos_token_id).long()
-
-            samples = torch.hstack((samples, input_ids))
-            attention_mask = torch.hstack((attention_mask, (input_ids != eos_token_id).long()))
-            position_ids = (position_ids[:, -1] + 1).view(-1, 1)
-
-            if os.environ.get("ACCELERATE_DEEPSPEED_ZERO_STAGE", "0") != "3" and torch.all(finished):
-                break
-
-        return samples
-
     def sync_target_q_heads(self):
         self.ilql_heads.sync_target_q_heads()
 
@@ -359,47 +429,49 @@ class AutoModelForSeq2SeqLMWithILQLHeads(TransformerForSeq2SeqLM):
         if attention_mask is None:
             attention_mask = input_ids.not_equal(pad_token_id)
 
-        samples = input_ids.clone()
-        max_new_tokens = min(max_new_tokens, max_length - input_ids.shape[1])
+        max_new_tokens = max(0, min(max_new_tokens, max_length - input_ids.shape[1]))
         if decoder_input_ids is None:
             decoder_input_ids = input_ids.new_zeros(input_ids.shape[0], 1)
 
-        finished = torch.zeros(input_ids.shape[0], 1, dtype=torch.long, device=input_ids.device)
+        start = decoder_input_ids.shape[1]
+        samples = decoder_input_ids.new_full((decoder_input_ids.shape[0], start + max_new_tokens), eos_token_id)
+        samples[:, :start] = decoder_input_ids
+        cur_length = start
+        finished = torch.zeros(input_ids.shape[0], 1, dtype=torch.bool, device=input_ids.device)
         for _ in range(max_new_tokens):
+            last_ixs = decoder_input_ids.new_zeros((decoder_input_ids.shape[0], 1))
             out = self.forward(
                 input_ids=input_ids,
                 attention_mask=attention_mask,
-                decoder_input_ids=decoder_input_ids[:, -1].unsqueeze(-1),
+                decoder_input_ids=samples[:, cur_length - 1: cur_length],
                 past_key_values=past_key_values,
                 encoder_outputs=encoder_outputs,
+                states_ixs=last_ixs,
+                actions_ixs=last_ixs,
             )
             logits, _, target_qs, vs, past_key_values, encoder_outputs = out
             if self.two_qs:
                 qs = torch.minimum(target_qs[0][:, -1, :], target_qs[1][:, -1, :])
             else:
-                qs = target_qs[:, -1, :]
-
-            logits = logits[:, -1, :]
-            vs = vs[:, -1, :]
-            adv = qs - vs
-            pi_beta = F.log_softmax(logits, -1)
-            pi_top_k = topk_mask(pi_beta + beta * adv, top_k)
-            pi = F.softmax(pi_top_k / temperature, -1)
-            next_tokens = torch.multinomial(pi, num_samples=1)
-            next_tokens = (1 - finished) * next_tokens + finished * eos_token_id
-            finished = (next_tokens == eos_token_id).long() | (next_tokens == pad_token_id).long()
-            decoder_input_ids = torch.cat([decoder_input_ids, next_tokens], dim=-1)
-            samples = decoder_input_ids
+                qs = target_qs[0][:, -1, :]
+
+            next_tokens = ilql_sample(logits[:, -1, :], qs, vs[:, -1, :],
+                                      beta=beta, top_k=top_k, temperature=temperature,
+                                      logit_mask=logit_mask, prev_tokens=samples[:, cur_length - 1])
+            next_tokens.masked_fill_(finished, eos_token_id)
+            finished |= (next_tokens == eos_token_id) | (next_tokens == pad_token_id)
+            samples[:, cur_length] = next_tokens.squeeze(-1)
+            cur_length += 1
             if os.environ.get("ACCELERATE_DEEPSPEED_ZERO_STAGE", "0") != "3" and torch.all(finished):
                 break
 
-        return samples
+        return samples[:, :cur_length]
 
 
 
 
 
-class ChatglmModelForCausalLMWithILQLHeads(TransformerChatGlmLMHeadModel):
+class ChatglmModelForCausalLMWithILQLHeads(ILQLCausalGenerateMixin, TransformerChatGlmLMHeadModel):
     """An `AutoModel` class wrapper for `transformers` causal models wtih a language
     modeling head and ILQL heads.
 
@@ -441,79 +513,6 @@ class ChatglmModelForCausalLMWithILQLHeads(TransformerChatGlmLMHeadModel):
         qs, target_qs, vs = self.ilql_heads(outputs.hidden_states[-1], states_ixs=states_ixs, actions_ixs=actions_ixs)
         return outputs.logits, qs, target_qs, vs, outputs.past_key_values
 
-    def generate_ilql(
-        self,
-        input_ids,
-        attention_mask=None,
-        position_ids=None,
-        past_key_values=None,
-        beta=1,
-        max_new_tokens=32,
-        max_length=1024,
-        temperature=1,
-        top_k=20,
-        logit_mask=None,
-        pad_token_id=None,
-        eos_token_id=None,
-    ):
-        """
-        Generates samples akin to hf's `.generate` but with custom logp prepossessing:
-        changing token probabilities as to how advantageous they would be
-        according to value functions estimations.
-        """
-        pad_token_id = pad_token_id if pad_token_id is not None else self.model.config.pad_token_id
-        eos_token_id = eos_token_id if eos_token_id is not None else self.model.config.eos_token_id
-
-        if attention_mask is None:
-            attention_mask = input_ids.not_equal(pad_token_id)
-
-        if position_ids is None:
-            position_ids = attention_mask.cumsum(-1) - 1
-            position_ids.masked_fill_(attention_mask.eq(0), 0)
-
-        samples = input_ids.clone()
-        max_new_tokens = min(max_new_tokens, max_length - input_ids.shape[1])
-
-        finished = torch.zeros(input_ids.shape[0], 1, dtype=torch.long, device=input_ids.device)
-        for _ in range(max_new_tokens):
-            out = self.forward(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                position_ids=position_ids,
-                past_key_values=past_key_values,
-            )
-
-            logits, _, target_qs, vs, past_key_values = out
-            if self.two_qs:
-                qs = torch.minimum(target_qs[0][:, -1, :], target_qs[1][:, -1, :])
-            else:
-                qs = target_qs[:, -1, :]
-
-            logits = logits[:, -1, :]
-            vs = vs[:, -1, :]
-
-            if logit_mask is not None:
-                mask = logit_mask[input_ids[:, -1].squeeze().to(logit_mask.device)]
-                logits[torch.where(mask)] = -np.inf
-
-            adv = qs - vs
-            pi_beta = F.log_softmax(logits, -1)
-            pi_top_k = topk_mask(pi_beta + beta * adv, top_k)
-            pi = F.softmax(pi_top_k / temperature, -1)
-
-            input_ids = torch.multinomial(pi, num_samples=1)
-            input_ids = (1 - finished) * input_ids + finished * eos_token_id
-            finished = (input_ids == eos_token_id).long()
-
-            samples = torch.hstack((samples, input_ids))
-            attention_mask = torch.hstack((attention_mask, (input_ids != eos_token_id).long()))
-            position_ids = (position_ids[:, -1] + 1).view(-1, 1)
-
-            if os.environ.get("ACCELERATE_DEEPSPEED_ZERO_STAGE", "0") != "3" and torch.all(finished):
-                break
-
-        return samples
-
     def sync_target_q_heads(self):
         self.ilql_heads.sync_target_q_heads()
 
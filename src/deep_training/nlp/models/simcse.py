@@ -8,7 +8,9 @@
 
 import torch
 from torch import nn
+from functools import partial
 from .transformer import TransformerModel
+from .embedding_utils import encode_views, MASK_INVARIANT_POOLINGS
 from ..losses.MultipleNegativesRankingLoss import MultipleNegativesRankingLoss
 __all__ = [
     'TransformerForSimcse'
@@ -20,11 +22,18 @@ __all__ = [
 class TransformerForSimcse(TransformerModel):
     def __init__(self, *args,**kwargs):
         pooling = kwargs.pop('pooling')
+        # > 0 时训练用 grad cache 分块编码 , 显存只与块大小有关
+        grad_cache_chunk_size = kwargs.pop('grad_cache_chunk_size', 0)
+        # 数据并行时 all_gather 各 rank 的句向量作为 in-batch 负例
+        gather_negatives = kwargs.pop('gather_negatives', False)
+        # 各 rank batch 大小相同时 (drop_last) 不再每步收集各 rank 的行数
+        gather_same_size = kwargs.pop('gather_same_size', False)
         super(TransformerForSimcse, self).__init__(*args,**kwargs)
         self.pooling = pooling
+        self.grad_cache_chunk_size = grad_cache_chunk_size
         config = self.config
         self.sim_head = nn.Linear(config.hidden_size, 512, bias=False)
-        self.loss_fn = MultipleNegativesRankingLoss()
+        self.loss_fn = MultipleNegativesRankingLoss(distributed=gather_negatives, same_size=gather_same_size)
 
     def get_model_lr(self,*args,**kwargs):
         return super(TransformerForSimcse, self).get_model_lr() + [
@@ -57,16 +66,9 @@ class TransformerForSimcse(TransformerModel):
     def compute_loss(self, *args, **batch) -> tuple:
         labels: torch.Tensor = batch.pop('labels', None)
         if self.training:
-            input_ids = batch['input_ids']
-            attention_mask = batch['attention_mask']
-            n = input_ids.size(1)
-            loss_logits = []
-            for i in range(n):
-                inputs = {
-                    'input_ids': input_ids[:, i],
-                    'attention_mask': attention_mask[:, i]
-                }
-                loss_logits.append(self.forward_for_hidden(*args, **inputs))
+            loss_logits = encode_views(partial(self.forward_for_hidden, *args), batch['input_ids'], batch['attention_mask'],
+                                       trim=self.pooling in MASK_INVARIANT_POOLINGS,
+                                       chunk_size=self.grad_cache_chunk_size)
             loss = self.loss_fn(loss_logits)
             outputs = (loss,)
         elif labels is not None:
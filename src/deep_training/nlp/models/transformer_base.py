@@ -18,10 +18,21 @@ from transformers.trainer_pt_utils import get_parameter_names
 
 from ..utils import configure_optimizers, get_value_from_args_assert, get_value_from_args
 from ..utils.adversarial import AdversarialMethods
+from ..utils.lazy_loading import resolve_checkpoint_files, lazy_load_pretrained
+from ..layers.hierarchical_position import HierarchicalPositionEmbedding
 from ...data_helper import TrainingArguments, ModelArguments, PrefixModelArguments, DataArguments, TrainingArgumentsHF, \
     TrainingArgumentsCL, TrainingArgumentsAC
 
 
+# CLS.from_pretrained 的加载参数 , lazy_load 时不传给模型构造函数
+_PRETRAINED_LOAD_KWARGS = (
+    'cache_dir', 'revision', 'use_auth_token', 'token', 'torch_dtype', 'device_map', 'dtype_map', 'max_memory',
+    'low_cpu_mem_usage', 'trust_remote_code', 'use_safetensors', 'local_files_only', 'force_download',
+    'resume_download', 'proxies', 'offload_folder', 'offload_state_dict', 'variant', 'subfolder', 'from_tf',
+    'from_flax', 'output_loading_info', 'mirror', '_fast_init',
+)
+
+
 def verify_manual_optimization_support(trainer: "pl.Trainer", model: "pl.LightningModule") -> None:
     if model.automatic_optimization:
         return
@@ -179,6 +190,24 @@ class TransformerBase(MyLightningModule, metaclass=TransformerFakeMeta):
                 "use_auth_token": True if model_args.use_auth_token else None,
                 **kwargs_new,
             }
+            # 按模块名前缀指定 dtype , 只有 lazy_load 支持
+            dtype_map = model_kwargs.pop('dtype_map', None)
+            checkpoint_files = self._lazy_load_files(config, model_args, model_kwargs)
+            if checkpoint_files:
+                init_kwargs = {k: v for k, v in kwargs_new.items() if k not in _PRETRAINED_LOAD_KWARGS}
+                cls_ = lazy_load_pretrained(
+                    CLS,
+                    model_args.model_name_or_path,
+                    *args_new,
+                    config=config,
+                    checkpoint_files=checkpoint_files,
+                    torch_dtype=kwargs_new.get('torch_dtype', None),
+                    device_map=kwargs_new.get('device_map', None),
+                    dtype_map=dtype_map,
+                    num_workers=getattr(model_args, 'load_workers', None),
+                    **init_kwargs
+                )
+                return cls_
             cls_ = CLS.from_pretrained(
                 model_args.model_name_or_path,
                 *args_new,
@@ -197,6 +226,23 @@ class TransformerBase(MyLightningModule, metaclass=TransformerFakeMeta):
             cls_.post_init()
         return cls_
 
+    @staticmethod
+    def _lazy_load_files(config, model_args: ModelArguments, model_kwargs: dict) -> Optional[List[str]]:
+        '''
+            满足 lazy_load 条件时返回本地 checkpoint 文件 , 否则返回 None 走 CLS.from_pretrained
+        '''
+        if not getattr(model_args, 'lazy_load', False) or ".ckpt" in model_args.model_name_or_path:
+            return None
+        if any(model_kwargs.get(k, None) for k in ('load_in_8bit', 'load_in_4bit', 'quantization_config')):
+            return None
+        # 构造时即量化的模型 (config.quantization_bit) 由各自的 from_pretrained 处理
+        if getattr(config, 'quantization_bit', 0):
+            return None
+        device_map = model_kwargs.get('device_map', None)
+        if isinstance(device_map, str) and device_map in ('auto', 'balanced', 'balanced_low_0', 'sequential'):
+            return None
+        return resolve_checkpoint_files(model_args.model_name_or_path)
+
     @property
     def model(self):
         if not self.base_model_prefix:
@@ -309,24 +355,17 @@ class TransformerLightningModule(MyLightningModule):
         if training_args.hierarchical_position is not None and (
                 training_args.hierarchical_position > 0 and training_args.hierarchical_position < 1):
             # 绝对位置编码 分层位置编码
-            def forward(cls, input: Tensor) -> Tensor:
-                # return F.embedding(
-                #     input, self.weight, self.padding_idx, self.max_norm,
-                #     self.norm_type, self.scale_grad_by_freq, self.sparse)
-                position_ids = input
-                alpha = training_args.hierarchical_position
-                embeddings = cls.weight - alpha * cls.weight[:1]
-                embeddings = embeddings / (1 - alpha)
-                x_idx = position_ids // cls.num_embeddings
-                y_idx = position_ids % cls.num_embeddings
-
-                embeddings_x = torch.index_select(embeddings, dim=0, index=x_idx.view(-1))
-                embeddings_y = torch.index_select(embeddings, dim=0, index=y_idx.view(-1))
-                embeddings = alpha * embeddings_x + (1 - alpha) * embeddings_y
-                return embeddings
-
-            position_embeddings = self.get_embeddings_module().embeddings.position_embeddings
-            position_embeddings.forward = partial(forward, position_embeddings)
+            embeddings = self.get_embeddings_module().embeddings
+            embeddings.position_embeddings = HierarchicalPositionEmbedding.from_embedding(
+                embeddings.position_embeddings, alpha=training_args.hierarchical_position)
+            # 可表示的最大长度为 n * n , 扩展 bert 类 embeddings 中预先生成的 buffer
+            max_length = embeddings.position_embeddings.num_embeddings ** 2
+            for k in ['position_ids', 'token_type_ids']:
+                buffer = getattr(embeddings, k, None)
+                if isinstance(buffer, Tensor) and buffer.size(-1) < max_length:
+                    value = torch.arange(max_length, device=buffer.device) if k == 'position_ids' \
+                        else torch.zeros(max_length, dtype=buffer.dtype, device=buffer.device)
+                    embeddings.register_buffer(k, value.expand((1, -1)), persistent=False)
 
     def get_embeddings_module(self):
         base_model_prefix = self.backbone.base_model_prefix
@@ -478,11 +517,13 @@ class TransformerLightningModule(MyLightningModule):
         scheduler = self.lr_schedulers()
         gradient_clip_val = self.gradient_clip_val
         epsilon = self.training_args.adv['epsilon']
+        # 默认只扰动 batch 中出现的 token 对应的 embedding 行 (restore 也只恢复这些行 , 见 EmbeddingAttackBase)
+        input_ids = batch.get('input_ids', None) if self.training_args.adv.get('sparse', True) else None
         if mode == 'fgm':
             opt.zero_grad()
             loss = self.training_step_fn(batch)
             self.manual_backward(loss)
-            self.adversarial.attack(epsilon=epsilon)
+            self.adversarial.attack(epsilon=epsilon,input_ids=input_ids)
             loss = self.training_step_fn(batch)
             opt.zero_grad()
             self.manual_backward(loss)
@@ -519,7 +560,7 @@ class TransformerLightningModule(MyLightningModule):
             setattr(self.get_embeddings_module().embeddings, 'forward', self.embeddings_forward_fn)
         elif mode == 'fgsm':
             alpha = self.training_args.adv['alpha']
-            self.adversarial.attack(is_first_attack=True,alpha=alpha,epsilon=epsilon)
+            self.adversarial.attack(is_first_attack=True,alpha=alpha,epsilon=epsilon,input_ids=input_ids)
             loss = self.training_step_fn(batch)
             self.manual_backward(loss)
 
@@ -542,7 +583,7 @@ class TransformerLightningModule(MyLightningModule):
             self.adversarial.backup_grad()
             attack_iters = self.training_args.adv['attack_iters']
             for t in range(attack_iters):
-                self.adversarial.attack(is_first_attack=(t == 0),alpha=alpha,epsilon=epsilon)
+                self.adversarial.attack(is_first_attack=(t == 0),alpha=alpha,epsilon=epsilon,input_ids=input_ids)
                 if t != attack_iters - 1:
                     opt.zero_grad()
                 else:
@@ -587,7 +628,7 @@ class TransformerLightningModule(MyLightningModule):
                 if gradient_clip_val is not None:
                     self.clip_gradients(opt, gradient_clip_val=gradient_clip_val)
                 opt.step()
-                self.adversarial.attack(epsilon=epsilon)
+                self.adversarial.attack(epsilon=epsilon,input_ids=input_ids)
                 scheduler and scheduler.step()
                 self.model.zero_grad()
         else:
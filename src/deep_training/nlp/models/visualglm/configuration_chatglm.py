@@ -75,6 +75,8 @@ class ChatGLMConfig(PretrainedConfig):
             quantization_bit=0,
             pre_seq_len=None,
             prefix_projection=False,
+            attn_backend=None,
+            kv_cache_block_size=256,
             image_length=32,
             eva_config=None,
             qformer_config=None,
@@ -97,6 +99,10 @@ class ChatGLMConfig(PretrainedConfig):
         self.quantization_bit = quantization_bit
         self.pre_seq_len = pre_seq_len
         self.prefix_projection = prefix_projection
+        # eager / sdpa / mem_efficient , None 为模型默认
+        self.attn_backend = attn_backend
+        # kv cache 预分配粒度 , <= 0 时退化为 torch.cat
+        self.kv_cache_block_size = kv_cache_block_size
         self.image_length = image_length
         self.eva_config = eva_config
         self.qformer_config = qformer_config
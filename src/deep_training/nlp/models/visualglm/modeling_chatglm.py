@@ -31,6 +31,9 @@ from transformers.generation.logits_process import LogitsProcessor
 from transformers.generation.utils import LogitsProcessorList, StoppingCriteriaList, GenerationConfig, ModelOutput
 
 from .configuration_chatglm import ChatGLMConfig
+from ...layers.attention_backend import resolve_attn_backend, sdpa_attention
+from ...layers.kv_cache import KVCacheBuffer
+from ...layers.mask import first_token_index, glm_mask_positions, glm_prefix_lm_mask, glm_position_ids
 
 # flags required to enable jit fusion kernels
 
@@ -197,11 +200,11 @@ def attention_fn(
         layer_past=None,
         scaling_attention_score=True,
         use_cache=False,
+        output_attentions=False,
 ):
-    if layer_past is not None:
-        past_key, past_value = layer_past[0], layer_past[1]
-        key_layer = torch.cat((past_key, key_layer), dim=0)
-        value_layer = torch.cat((past_value, value_layer), dim=0)
+    if layer_past is not None or use_cache:
+        # 预分配 buffer 原地追加 , 替代逐步 torch.cat
+        key_layer, value_layer = self.kv_buffer.append(layer_past, key_layer, value_layer)
 
     # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
     seq_len, b, nh, hidden_size = key_layer.shape
@@ -212,6 +215,22 @@ def attention_fn(
         present = None
 
     query_key_layer_scaling_coeff = float(layer_id + 1)
+    if self.attn_backend != 'eager' and not output_attentions:
+        # [sq, b, np, hn] -> [b, np, sq, hn]
+        query_layer, key_layer, value_layer = [t.permute(1, 2, 0, 3) for t in (query_layer, key_layer, value_layer)]
+        attn_mask = None
+        if attention_mask is not None and not (attention_mask == 0).all():
+            attn_mask = torch.zeros(attention_mask.shape, dtype=query_layer.dtype, device=query_layer.device)
+            attn_mask.masked_fill_(attention_mask, -10000.0)
+        # eager 中 q 先除以 sqrt(hn) * coeff , softmax 前再乘 coeff
+        scale = None if scaling_attention_score else query_key_layer_scaling_coeff
+        context_layer = sdpa_attention(query_layer, key_layer, value_layer, attn_mask,
+                                       scale=scale, backend=self.attn_backend)
+        # [b, np, sq, hn] --> [sq, b, hp]
+        context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+        context_layer = context_layer.view(*context_layer.size()[:-2], hidden_size_per_partition)
+        return context_layer, present, None
+
     if scaling_attention_score:
         query_layer = query_layer / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
 
@@ -300,7 +319,8 @@ def default_init(cls, *args, **kwargs):
 class SelfAttention(torch.nn.Module):
     def __init__(self, hidden_size, num_attention_heads,
                  layer_id, hidden_size_per_attention_head=None, bias=True,
-                 params_dtype=torch.float, position_encoding_2d=True, empty_init=True):
+                 params_dtype=torch.float, position_encoding_2d=True, empty_init=True,
+                 attn_backend='eager', kv_cache_block_size=256):
         if empty_init:
             init_method = skip_init
         else:
@@ -308,6 +328,8 @@ class SelfAttention(torch.nn.Module):
         super(SelfAttention, self).__init__()
 
         self.layer_id = layer_id
+        self.attn_backend = attn_backend
+        self.kv_buffer = KVCacheBuffer(seq_dim=0, block_size=kv_cache_block_size)
         self.hidden_size = hidden_size
         self.hidden_size_per_partition = hidden_size
         self.num_attention_heads = num_attention_heads
@@ -427,7 +449,8 @@ class SelfAttention(torch.nn.Module):
             hidden_size_per_partition=self.hidden_size_per_partition,
             layer_id=layer_id,
             layer_past=layer_past,
-            use_cache=use_cache
+            use_cache=use_cache,
+            output_attentions=output_attentions,
         )
 
         output = self.dense(context_layer)
@@ -512,7 +535,9 @@ class GLMBlock(torch.nn.Module):
             params_dtype=torch.float,
             num_layers=28,
             position_encoding_2d=True,
-            empty_init=True
+            empty_init=True,
+            attn_backend='eager',
+            kv_cache_block_size=256,
     ):
         super(GLMBlock, self).__init__()
         # Set output layer initialization if not provided.
@@ -533,7 +558,9 @@ class GLMBlock(torch.nn.Module):
             bias=use_bias,
             params_dtype=params_dtype,
             position_encoding_2d=self.position_encoding_2d,
-            empty_init=empty_init
+            empty_init=empty_init,
+            attn_backend=attn_backend,
+            kv_cache_block_size=kv_cache_block_size,
         )
 
         # Layernorm on the input data.
@@ -625,49 +652,20 @@ class ChatGLMPreTrainedModel(PreTrainedModel):
         return
 
     def get_masks(self, input_ids, device, padding_mask=None):
-        batch_size, seq_length = input_ids.shape
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
-        attention_mask = torch.ones((batch_size, seq_length, seq_length), device=device)
-        attention_mask.tril_()
-        for i, context_length in enumerate(context_lengths):
-            attention_mask[i, :, :context_length] = 1
+        seq_length = input_ids.size(1)
+        context_lengths = first_token_index(input_ids.to(device), self.config.bos_token_id)
         if padding_mask is not None:
-            attention_mask = attention_mask * padding_mask.unsqueeze(1) * padding_mask.unsqueeze(2)
-        attention_mask.unsqueeze_(1)
-        attention_mask = (attention_mask < 0.5).bool()
-
-        return attention_mask
+            padding_mask = padding_mask.to(device)
+        return glm_prefix_lm_mask(context_lengths, seq_length, padding_mask=padding_mask)
 
     def get_position_ids(self, input_ids, device):
-        MASK, gMASK = self.config.mask_token_id, self.config.gmask_token_id
-        seqs = input_ids.tolist()
-        mask_positions, use_gmasks = [], []
-        for seq in seqs:
-            mask_token = gMASK if gMASK in seq else MASK
-            use_gmask = mask_token == gMASK
-            mask_positions.append(seq.index(mask_token))
-            use_gmasks.append(use_gmask)
-        batch_size, seq_length = input_ids.shape
-        if use_gmasks is None:
-            use_gmasks = [False] * batch_size
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
-        if self.position_encoding_2d:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).repeat(batch_size, 1)
-            for i, context_length in enumerate(context_lengths):
-                position_ids[i, context_length:] = mask_positions[i]
-            block_position_ids = [torch.cat((
-                torch.zeros(context_length, dtype=torch.long, device=device),
-                torch.arange(seq_length - context_length, dtype=torch.long, device=device) + 1
-            )) for context_length in context_lengths]
-            block_position_ids = torch.stack(block_position_ids, dim=0)
-            position_ids = torch.stack((position_ids, block_position_ids), dim=1)
-        else:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).repeat(batch_size, 1)
-            for i, context_length in enumerate(context_lengths):
-                if not use_gmasks[i]:
-                    position_ids[i, context_length:] = mask_positions[i]
-
-        return position_ids
+        input_ids = input_ids.to(device)
+        seq_length = input_ids.size(1)
+        mask_positions, use_gmasks = glm_mask_positions(input_ids, self.config.mask_token_id,
+                                                        self.config.gmask_token_id)
+        context_lengths = first_token_index(input_ids, self.config.bos_token_id)
+        return glm_position_ids(context_lengths, mask_positions, seq_length,
+                                position_encoding_2d=self.position_encoding_2d, use_gmasks=use_gmasks)
 
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, ChatGLMModel):
@@ -794,7 +792,9 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 use_bias=True,
                 params_dtype=self.params_dtype,
                 position_encoding_2d=self.position_encoding_2d,
-                empty_init=empty_init
+                empty_init=empty_init,
+                attn_backend=resolve_attn_backend(config, 'eager'),
+                kv_cache_block_size=getattr(config, 'kv_cache_block_size', 256),
             )
 
         self.layers = torch.nn.ModuleList(
@@ -908,9 +908,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 full_attention_mask = full_attention_mask.unsqueeze(1).unsqueeze(1)
 
         if self.pre_seq_len is not None and full_attention_mask is not None:
-            prefix_attention_mask = torch.ones(batch_size, 1, input_ids.size(-1), self.pre_seq_len).to(
-                full_attention_mask.device)
-            prefix_attention_mask = (prefix_attention_mask < 0.5).bool()
+            prefix_attention_mask = torch.zeros(batch_size, 1, input_ids.size(-1), self.pre_seq_len,
+                                                dtype=torch.bool, device=full_attention_mask.device)
             full_attention_mask = torch.cat((prefix_attention_mask, full_attention_mask), dim=3)
 
         # [seq_len, batch, hidden_size]
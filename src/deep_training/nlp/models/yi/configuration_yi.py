@@ -91,6 +91,7 @@ class YiConfig(PretrainedConfig):
         tie_word_embeddings=False,
         output_attentions=False,
         rope_theta=5000000.0,
+        kv_cache_bits=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -112,6 +113,8 @@ class YiConfig(PretrainedConfig):
         self.output_attentions = output_attentions
         self.rope_theta = rope_theta
 
+        # kv cache 量化位数 8 / 4 , None 为不量化
+        self.kv_cache_bits = kv_cache_bits
         super().__init__(
             pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
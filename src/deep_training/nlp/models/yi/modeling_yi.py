@@ -23,6 +23,7 @@ from transformers.utils import (
 
 from .configuration_yi import YiConfig
 from ...utils.torch_utils import skip_init
+from ...layers.kv_cache import build_kv_quantizer
 
 is_flash_attn_available = True
 try:
@@ -193,6 +194,7 @@ class YiAttention(nn.Module):
     def __init__(self, config: YiConfig,**kwargs):
         super().__init__()
         self.config = config
+        self.kv_quantizer = build_kv_quantizer(config, seq_dim=1 if is_flash_attn_available else 2)
         self.hidden_size = config.hidden_size
         self.num_heads = config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -271,12 +273,18 @@ class YiAttention(nn.Module):
             query_states, key_states, cos, sin, position_ids, is_flash_attn_available
         )
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=seq_dim)
-            value_states = torch.cat([past_key_value[1], value_states], dim=seq_dim)
+        if self.kv_quantizer is not None and not self.training and (past_key_value is not None or use_cache):
+            # int8 / int4 量化 kv cache , 历史部分读取时反量化
+            key_states, value_states, past_key_value = self.kv_quantizer.update(past_key_value, key_states,
+                                                                                value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=seq_dim)
+                value_states = torch.cat([past_key_value[1], value_states], dim=seq_dim)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
         if is_flash_attn_available:
             attn_output = flash_attn_func(
@@ -7,6 +7,7 @@ import collections
 import math
 import torch
 from torch.optim import Optimizer
+from .lion.lion import group_tensors_by_device_and_dtype
 
 
 # from tensorboardX import SummaryWriter
@@ -37,12 +38,14 @@ class Lamb(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         adam (bool, optional): always use trust ratio = 1, which turns this into
             Adam. Useful for comparison purposes.
+        foreach (bool, optional): update all parameters of a group with
+            multi-tensor (torch._foreach_*) kernels (default: False)
     .. _Large Batch Optimization for Deep Learning: Training BERT in 76 minutes:
         https://arxiv.org/abs/1904.00962
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6,
-                 weight_decay=0, adam=False):
+                 weight_decay=0, adam=False, foreach=False):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -54,6 +57,7 @@ class Lamb(Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps,
                         weight_decay=weight_decay)
         self.adam = adam
+        self.foreach = foreach
         super(Lamb, self).__init__(params, defaults)
 
     def step(self, closure=None):
@@ -67,6 +71,9 @@ class Lamb(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if self.foreach:
+                self._foreach_step(group)
+                continue
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -120,4 +127,56 @@ class Lamb(Optimizer):
 
                 p.data.add_(adam_step, alpha=-step_size * trust_ratio)
 
-        return loss
\ No newline at end of file
+        return loss
+
+    @torch.no_grad()
+    def _foreach_step(self, group):
+        params, grads, exp_avgs, exp_avg_sqs = [], [], [], []
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('Lamb does not support sparse gradients, consider SparseAdam instad.')
+            state = self.state[p]
+            if len(state) == 0:
+                state['step'] = 0
+                state['exp_avg'] = torch.zeros_like(p.data)
+                state['exp_avg_sq'] = torch.zeros_like(p.data)
+            state['step'] += 1
+            params.append(p)
+            grads.append(p.grad)
+            exp_avgs.append(state['exp_avg'])
+            exp_avg_sqs.append(state['exp_avg_sq'])
+
+        beta1, beta2 = group['betas']
+        step_size = group['lr']
+        for device_params, device_grads, device_exp_avgs, device_exp_avg_sqs in group_tensors_by_device_and_dtype(
+                params, grads, exp_avgs, exp_avg_sqs):
+            torch._foreach_mul_(device_exp_avgs, beta1)
+            torch._foreach_add_(device_exp_avgs, device_grads, alpha=1 - beta1)
+            torch._foreach_mul_(device_exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(device_exp_avg_sqs, device_grads, device_grads, value=1 - beta2)
+
+            # adam_step = exp_avg / (sqrt(exp_avg_sq) + eps) , 复用同一组临时张量
+            adam_steps = torch._foreach_sqrt(device_exp_avg_sqs)
+            torch._foreach_add_(adam_steps, group['eps'])
+            torch._foreach_reciprocal_(adam_steps)
+            torch._foreach_mul_(adam_steps, device_exp_avgs)
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(adam_steps, device_params, alpha=group['weight_decay'])
+
+            weight_norms = torch.stack(torch._foreach_norm(device_params)).clamp(0, 10)
+            adam_norms = torch.stack(torch._foreach_norm(adam_steps))
+            trust_ratios = torch.where((weight_norms == 0) | (adam_norms == 0),
+                                       torch.ones_like(weight_norms), weight_norms / adam_norms)
+            for p, weight_norm, adam_norm, trust_ratio in zip(device_params, weight_norms, adam_norms, trust_ratios):
+                state = self.state[p]
+                state['weight_norm'] = weight_norm
+                state['adam_norm'] = adam_norm
+                state['trust_ratio'] = trust_ratio
+            if self.adam:
+                trust_ratios = torch.ones_like(trust_ratios)
+
+            # 每组只同步一次 , 而不是每个参数一次
+            torch._foreach_mul_(adam_steps, [-step_size * r for r in trust_ratios.tolist()])
+            torch._foreach_add_(device_params, adam_steps)
@@ -1,8 +1,9 @@
 # @Time    : 2023/3/1 22:37
 # @Author  : tk
 # @FileName: lion.py
+from collections import defaultdict
 from functools import partial
-from typing import Tuple, Optional, Callable
+from typing import Tuple, Optional, Callable, List
 
 import torch
 from torch.optim.optimizer import Optimizer
@@ -25,13 +26,35 @@ def update_fn(p, grad, exp_avg, lr, wd, beta1, beta2):
 
     # weight update
 
-    update = exp_avg.clone().mul_(beta1).add(grad, alpha = 1 - beta1).sign_()
+    update = exp_avg.mul(beta1).add_(grad, alpha = 1 - beta1).sign_()
     p.add_(update, alpha = -lr)
 
     # decay the momentum running average coefficient
 
     exp_avg.mul_(beta2).add_(grad, alpha = 1 - beta2)
 
+def foreach_update_fn(params: List, grads: List, exp_avgs: List, lr, wd, beta1, beta2):
+    # multi-tensor 版本 , 同一 device/dtype 的参数合并为一组 kernel 调用
+
+    if wd != 0:
+        torch._foreach_mul_(params, 1 - lr * wd)
+
+    updates = torch._foreach_mul(exp_avgs, beta1)
+    torch._foreach_add_(updates, grads, alpha = 1 - beta1)
+    torch._foreach_sign_(updates)
+    torch._foreach_add_(params, updates, alpha = -lr)
+
+    torch._foreach_mul_(exp_avgs, beta2)
+    torch._foreach_add_(exp_avgs, grads, alpha = 1 - beta2)
+
+def group_tensors_by_device_and_dtype(*tensor_lists: List):
+    grouped = defaultdict(lambda: tuple([] for _ in tensor_lists))
+    for tensors in zip(*tensor_lists):
+        key = (tensors[0].device, tensors[0].dtype)
+        for bucket, t in zip(grouped[key], tensors):
+            bucket.append(t)
+    return grouped.values()
+
 # class
 
 class Lion(Optimizer):
@@ -43,6 +66,7 @@ class Lion(Optimizer):
         weight_decay: float = 0.0,
         use_triton: bool = False,
         triton_block_size: int = 1024,
+        foreach: bool = False,
         **kwargs
     ):
         assert lr > 0.
@@ -58,6 +82,7 @@ class Lion(Optimizer):
 
         self.update_fn = update_fn
         self.use_triton = use_triton
+        self.foreach = foreach and not use_triton
         self.took_first_step = False
 
         if use_triton:
@@ -78,6 +103,9 @@ class Lion(Optimizer):
         # update all parameters
 
         for group in self.param_groups:
+            if self.foreach:
+                self._foreach_step(group)
+                continue
             for p in filter(lambda p: exists(p.grad), group['params']):
 
                 grad, lr, wd, beta1, beta2, state = p.grad, group['lr'], group['weight_decay'], *group['betas'], self.state[p]
@@ -99,4 +127,18 @@ class Lion(Optimizer):
                     beta2
                 )
 
-        return loss
\ No newline at end of file
+        return loss
+
+    def _foreach_step(self, group):
+        params, grads, exp_avgs = [], [], []
+        for p in filter(lambda p: exists(p.grad), group['params']):
+            state = self.state[p]
+            if len(state) == 0:
+                state['exp_avg'] = torch.zeros_like(p)
+            params.append(p)
+            grads.append(p.grad)
+            exp_avgs.append(state['exp_avg'])
+
+        lr, wd, (beta1, beta2) = group['lr'], group['weight_decay'], group['betas']
+        for device_params, device_grads, device_exp_avgs in group_tensors_by_device_and_dtype(params, grads, exp_avgs):
+            foreach_update_fn(device_params, device_grads, device_exp_avgs, lr, wd, beta1, beta2)
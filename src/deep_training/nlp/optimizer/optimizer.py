@@ -8,7 +8,7 @@ import torch
 from torch import optim
 from transformers.utils import ExplicitEnum, strtobool
 from ..scheduler import WarmupCosineSchedule
-from ..optimizer import lion,lamb
+from ..optimizer import lion,lamb,quant_8bit
 try:
     from transformers import AdamW as AdamWHF, Adafactor
 except:
@@ -35,12 +35,16 @@ class OptimizerNames(ExplicitEnum):
     ADAMW_8BIT = "adamw_8bit"  # just an alias for adamw_bnb_8bit
     LION_8BIT = "lion_8bit"
     LION_CUSTOM = "lion"
+    LION_FOREACH = "lion_foreach"
     LION = "lion_32bit"
     PAGED_ADAMW = "paged_adamw_32bit"
     PAGED_ADAMW_8BIT = "paged_adamw_8bit"
     PAGED_LION = "paged_lion_32bit"
     PAGED_LION_8BIT = "paged_lion_8bit"
     LAMB = "lamb"
+    LAMB_FOREACH = "lamb_foreach"
+    ADAMW_8BIT_BLOCKWISE = "adamw_8bit_blockwise"
+    LION_8BIT_BLOCKWISE = "lion_8bit_blockwise"
     LAMB_FUSED_DP = 'lamb_fused_dp'
     ADAGRAD_CPU_DP = 'adagrad_cpu_dp'
     ADAM_CPU_DP = 'adam_cpu_dp'
@@ -125,12 +129,24 @@ def get_optimizer_cls_and_kwargs(optimizer_name,args) -> typing.Tuple[typing.Any
         else:
             raise ValueError('invalid optimizer_name ',optimizer_name)
 
-    elif optimizer_name == OptimizerNames.LION_CUSTOM:
+    elif optimizer_name in [OptimizerNames.LION_CUSTOM,OptimizerNames.LION_FOREACH]:
         optimizer_cls = lion.Lion
         optimizer_kwargs.update(adam_kwargs)
-    elif optimizer_name == OptimizerNames.LAMB:
+        if optimizer_name == OptimizerNames.LION_FOREACH:
+            optimizer_kwargs.update({"foreach": True})
+    elif optimizer_name in [OptimizerNames.LAMB,OptimizerNames.LAMB_FOREACH]:
         optimizer_cls = lamb.Lamb
         optimizer_kwargs.update(adam_kwargs)
+        if optimizer_name == OptimizerNames.LAMB_FOREACH:
+            optimizer_kwargs.update({"foreach": True})
+    elif optimizer_name == OptimizerNames.ADAMW_8BIT_BLOCKWISE:
+        optimizer_cls = quant_8bit.AdamW8bit
+        optimizer_kwargs.update(adam_kwargs)
+        optimizer_kwargs.update({k: int(optim_args[k]) for k in ("blocksize","min_8bit_size") if k in optim_args})
+    elif optimizer_name == OptimizerNames.LION_8BIT_BLOCKWISE:
+        optimizer_cls = quant_8bit.Lion8bit
+        optimizer_kwargs.update({"betas": tuple(args.optimizer_betas)})
+        optimizer_kwargs.update({k: int(optim_args[k]) for k in ("blocksize","min_8bit_size") if k in optim_args})
     elif optimizer_name in [
         OptimizerNames.ADAMW_BNB,
         OptimizerNames.ADAMW_8BIT,
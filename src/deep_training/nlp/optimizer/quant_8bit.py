@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/20 10:12
+# @FileName: quant_8bit.py
+"""
+    不依赖 bitsandbytes 的 8bit 优化器 , cpu / gpu 均可运行
+    优化器状态按 blocksize 分块做 dynamic int8 量化 , 每块保存一个 fp32 absmax
+    更新按块分片进行 , 任意时刻只反量化一个分片 , 峰值显存与参数大小无关
+    是否量化由 state['quantized'] 记录 , load_state_dict 按 checkpoint 原样恢复 uint8 码与 fp32 absmax
+"""
+import math
+from itertools import chain
+from typing import Tuple, Optional, Callable, Dict
+
+import torch
+import torch.nn.functional as F
+from torch.optim.optimizer import Optimizer
+
+__all__ = [
+    'create_dynamic_map',
+    'quantize_blockwise',
+    'dequantize_blockwise',
+    'AdamW8bit',
+    'Lion8bit',
+]
+
+
+def create_dynamic_map(signed=True, max_exponent_bits=7, total_bits=8):
+    '''
+        dynamic tree 量化码表 , 参考 https://arxiv.org/abs/2110.02861
+        unsigned 时不需要符号位 , 每个指数段的小数部分多一位精度
+    '''
+    data = []
+    non_sign_bits = total_bits - 1
+    for i in range(max_exponent_bits):
+        fraction_items = 2 ** (i + non_sign_bits - max_exponent_bits + (0 if signed else 1)) + 1
+        boundaries = torch.linspace(0.1, 1, fraction_items)
+        means = ((boundaries[:-1] + boundaries[1:]) / 2.0) * (10 ** (-(max_exponent_bits - 1) + i))
+        data += means.tolist()
+        if signed:
+            data += (-means).tolist()
+    data.append(0)
+    data.append(1.0)
+    data += [0] * (2 ** total_bits - len(data))
+    data.sort()
+    return torch.tensor(data, dtype=torch.float32)
+
+
+def quantize_blockwise(x: torch.Tensor, code: torch.Tensor, blocksize: int, out: Optional[torch.Tensor] = None):
+    '''
+        x 展平后按 blocksize 分块 , 不足一块补零
+        返回 (uint8 码 , 每块 fp32 absmax)
+    '''
+    flat = x.reshape(-1).float()
+    pad = (-flat.numel()) % blocksize
+    if pad:
+        flat = F.pad(flat, (0, pad))
+    blocks = flat.view(-1, blocksize)
+    absmax = blocks.abs().amax(dim=1)
+    normed = blocks / absmax.clamp_min(torch.finfo(torch.float32).tiny).unsqueeze(1)
+    # 取最近的码值
+    idx = torch.searchsorted(code, normed).clamp_(1, code.numel() - 1)
+    idx -= (normed - code[idx - 1] < code[idx] - normed).long()
+    if out is None:
+        out = torch.empty(blocks.numel(), dtype=torch.uint8, device=x.device)
+    out.copy_(idx.view(-1))
+    return out, absmax
+
+
+def dequantize_blockwise(codes: torch.Tensor, absmax: torch.Tensor, code: torch.Tensor, blocksize: int, numel: int):
+    x = code[codes.long()].view(-1, blocksize) * absmax.float().unsqueeze(1)
+    return x.view(-1)[:numel]
+
+
+class _Blockwise8bitOptimizer(Optimizer):
+    '''
+        numel < min_8bit_size 的参数(bias , LayerNorm 等)状态保持 fp32
+    '''
+    state_keys: Dict[str, bool] = {}
+
+    def __init__(self, params, defaults, blocksize=2048, min_8bit_size=4096, chunk_blocks=1024):
+        super().__init__(params, defaults)
+        self.blocksize = blocksize
+        self.min_8bit_size = min_8bit_size
+        self.chunk_size = blocksize * chunk_blocks
+        self._code_cache = {}
+
+    def get_code(self, signed, device):
+        key = (signed, device)
+        code = self._code_cache.get(key, None)
+        if code is None:
+            code = self._code_cache[key] = create_dynamic_map(signed=signed).to(device)
+        return code
+
+    def init_state(self, p, state):
+        state['step'] = 0
+        state['quantized'] = p.numel() >= self.min_8bit_size
+        if not state['quantized']:
+            for name in self.state_keys:
+                state[name] = torch.zeros_like(p, dtype=torch.float32, memory_format=torch.preserve_format)
+            return
+        nblocks = math.ceil(p.numel() / self.blocksize)
+        for name, signed in self.state_keys.items():
+            zero = int(torch.argmin(self.get_code(signed, p.device).abs()))
+            state[name] = torch.full((nblocks * self.blocksize,), zero, dtype=torch.uint8, device=p.device)
+            state[name + '_absmax'] = torch.zeros((nblocks,), dtype=torch.float32, device=p.device)
+
+    def update_chunk(self, group, state, p, grad, states: Dict[str, torch.Tensor]):
+        raise NotImplementedError
+
+    def load_state_dict(self, state_dict):
+        '''
+            Optimizer.load_state_dict 会把浮点状态转换为参数的 dtype (absmax / 未量化的 fp32 状态精度丢失) ,
+            这里按 checkpoint 中的 dtype 原样恢复全部状态张量 , 只移动到参数所在 device
+        '''
+        saved_state = state_dict['state']
+        super().load_state_dict(state_dict)
+        saved_ids = chain.from_iterable(g['params'] for g in state_dict['param_groups'])
+        params = chain.from_iterable(g['params'] for g in self.param_groups)
+        for saved_id, p in zip(saved_ids, params):
+            if saved_id not in saved_state:
+                continue
+            state = self.state[p]
+            for name, value in saved_state[saved_id].items():
+                if torch.is_tensor(value) and name != 'step':
+                    state[name] = value.to(device=p.device, copy=True)
+            if 'quantized' not in state:
+                # 旧 checkpoint 没有该标记
+                state['quantized'] = state[next(iter(self.state_keys))].dtype == torch.uint8
+
+    @torch.no_grad()
+    def step(self, closure: Optional[Callable] = None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError('{} does not support sparse gradients'.format(self.__class__.__name__))
+                state = self.state[p]
+                if len(state) == 0:
+                    self.init_state(p, state)
+                state['step'] += 1
+
+                if not state['quantized']:
+                    self.update_chunk(group, state, p, p.grad.float(),
+                                      {name: state[name] for name in self.state_keys})
+                    continue
+
+                p_flat = p.data.view(-1)
+                g_flat = p.grad.reshape(-1)
+                blocksize = self.blocksize
+                for start in range(0, p.numel(), self.chunk_size):
+                    end = min(start + self.chunk_size, p.numel())
+                    b_start, b_end = start // blocksize, math.ceil(end / blocksize)
+                    states = {}
+                    for name, signed in self.state_keys.items():
+                        states[name] = dequantize_blockwise(state[name][b_start * blocksize: b_end * blocksize],
+                                                            state[name + '_absmax'][b_start: b_end],
+                                                            self.get_code(signed, p.device),
+                                                            blocksize, end - start)
+                    self.update_chunk(group, state, p_flat[start: end], g_flat[start: end].float(), states)
+                    for name, signed in self.state_keys.items():
+                        _, absmax = quantize_blockwise(states[name], self.get_code(signed, p.device), blocksize,
+                                                       out=state[name][b_start * blocksize: b_end * blocksize])
+                        state[name + '_absmax'][b_start: b_end] = absmax
+        return loss
+
+
+class AdamW8bit(_Blockwise8bitOptimizer):
+    state_keys = {'exp_avg': True, 'exp_avg_sq': False}
+
+    def __init__(self, params, lr=1e-3, betas: Tuple[float, float] = (0.9, 0.999), eps=1e-8, weight_decay=1e-2,
+                 blocksize=2048, min_8bit_size=4096, **kwargs):
+        if not 0.0 <= lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        if not 0.0 <= eps:
+            raise ValueError("Invalid epsilon value: {}".format(eps))
+        if not 0.0 <= betas[0] < 1.0:
+            raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
+        if not 0.0 <= betas[1] < 1.0:
+            raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults, blocksize=blocksize, min_8bit_size=min_8bit_size)
+
+    def update_chunk(self, group, state, p, grad, states):
+        exp_avg, exp_avg_sq = states['exp_avg'], states['exp_avg_sq']
+        lr, eps, wd, (beta1, beta2) = group['lr'], group['eps'], group['weight_decay'], group['betas']
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2 = 1 - beta2 ** state['step']
+
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+        update = exp_avg.div(denom).mul_(lr / bias_correction1)
+        if wd != 0:
+            update.add_(p, alpha=lr * wd)
+        p.sub_(update.to(p.dtype))
+
+
+class Lion8bit(_Blockwise8bitOptimizer):
+    state_keys = {'exp_avg': True}
+
+    def __init__(self, params, lr=1e-4, betas: Tuple[float, float] = (0.9, 0.99), weight_decay=0.0,
+                 blocksize=2048, min_8bit_size=4096, **kwargs):
+        assert lr > 0.
+        assert all([0. <= beta <= 1. for beta in betas])
+        defaults = dict(lr=lr, betas=betas, weight_decay=weight_decay)
+        super().__init__(params, defaults, blocksize=blocksize, min_8bit_size=min_8bit_size)
+
+    def update_chunk(self, group, state, p, grad, states):
+        exp_avg = states['exp_avg']
+        lr, wd, (beta1, beta2) = group['lr'], group['weight_decay'], group['betas']
+
+        p.mul_(1 - lr * wd)
+        update = exp_avg.mul(beta1).add_(grad, alpha=1 - beta1).sign_()
+        p.add_(update.to(p.dtype), alpha=-lr)
+        exp_avg.mul_(beta2).add_(grad, alpha=1 - beta2)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/31 10:00
+# @FileName: __init__.py
+from .embedding_store import EmbeddingWriter, EmbeddingStore, encode_corpus, iter_embedding_blocks
+from .search import merge_topk, blocked_topk, iter_blocked_topk, ExactIndex
+from .ivfpq import kmeans, IVFPQIndex
+from .hard_negative import mine_hard_negatives, write_triples
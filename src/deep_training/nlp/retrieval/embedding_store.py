@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/31 10:05
+# @FileName: embedding_store.py
+"""
+    语料向量的磁盘存储
+    向量按 float16 逐 batch 追加写入一个裸文件 , 写完后以 np.memmap 只读打开 ,
+    检索 / 评估按块读取 , 内存占用只与块大小有关
+    meta (行数 , 维度 , dtype , 是否归一化) 写在同名 .json
+"""
+import json
+import os
+from typing import Callable, Iterable, Optional, Union, Iterator, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers.utils import logging
+
+__all__ = [
+    'EmbeddingWriter',
+    'EmbeddingStore',
+    'encode_corpus',
+    'iter_embedding_blocks',
+]
+
+logger = logging.get_logger(__name__)
+
+
+def _meta_file(path):
+    return path + '.json'
+
+
+class EmbeddingWriter:
+    '''
+        追加写入 [n, D] 向量 , 不需要预先知道行数
+        normalize=True 时在 float32 下做 L2 归一化后再转 float16 , 之后内积即 cosine
+    '''
+    def __init__(self, path, normalize=True, dtype='float16'):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.normalize = normalize
+        self.dtype = np.dtype(dtype)
+        self.num = 0
+        self.dim = None
+        self._fp = open(path, mode='wb')
+
+    def write(self, embeddings: Union[torch.Tensor, np.ndarray]):
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().float()
+            if self.normalize:
+                embeddings = F.normalize(embeddings, p=2, dim=-1)
+            embeddings = embeddings.cpu().numpy()
+        else:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if self.normalize:
+                embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-8, np.inf)
+        if embeddings.ndim != 2:
+            raise ValueError('embeddings must have 2 dimensions, got {}'.format(embeddings.shape))
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif self.dim != embeddings.shape[1]:
+            raise ValueError('embedding dim mismatch {} != {}'.format(embeddings.shape[1], self.dim))
+        self._fp.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        self.num += embeddings.shape[0]
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        with open(_meta_file(self.path), mode='w', encoding='utf-8') as f:
+            json.dump({'num': self.num, 'dim': self.dim or 0, 'dtype': self.dtype.name,
+                       'normalized': self.normalize}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class EmbeddingStore:
+    '''
+        只读的 [N, D] 向量矩阵 , 数据通过 np.memmap 按需分页读取
+    '''
+    def __init__(self, path, mode='r'):
+        with open(_meta_file(path), mode='r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.path = path
+        self.meta = meta
+        self.normalized = meta.get('normalized', False)
+        shape = (meta['num'], meta['dim'])
+        self.data = np.memmap(path, dtype=np.dtype(meta['dtype']), mode=mode, shape=shape) \
+            if meta['num'] > 0 else np.zeros(shape, dtype=np.dtype(meta['dtype']))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def dim(self):
+        return self.data.shape[1]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self, item) -> np.ndarray:
+        return self.data[item]
+
+    def get(self, start, end, device=None, dtype=None) -> torch.Tensor:
+        block = torch.from_numpy(np.ascontiguousarray(self.data[start: end]))
+        if device is not None or dtype is not None:
+            block = block.to(device=device, dtype=dtype, non_blocking=True)
+        return block
+
+    def take(self, indices: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+        '''
+            按行号读取 , 行号先排序以顺序访问磁盘
+        '''
+        indices = np.asarray(indices.cpu() if isinstance(indices, torch.Tensor) else indices).reshape(-1)
+        order = np.argsort(indices, kind='stable')
+        out = np.empty((len(indices), self.dim), dtype=self.data.dtype)
+        out[order] = self.data[indices[order]]
+        return out
+
+    def iter_blocks(self, block_size=65536, device=None, dtype=None) -> Iterator[Tuple[int, torch.Tensor]]:
+        for start in range(0, len(self), block_size):
+            yield start, self.get(start, min(start + block_size, len(self)), device=device, dtype=dtype)
+
+
+def iter_embedding_blocks(embeddings: Union[torch.Tensor, np.ndarray, EmbeddingStore], block_size,
+                          device=None, dtype=None) -> Iterator[Tuple[int, torch.Tensor]]:
+    '''
+        Tensor / ndarray / EmbeddingStore 统一按块迭代 , 返回 (起始行 , [n, D] Tensor)
+    '''
+    if isinstance(embeddings, EmbeddingStore):
+        yield from embeddings.iter_blocks(block_size, device=device, dtype=dtype)
+        return
+    if isinstance(embeddings, np.ndarray):
+        embeddings = torch.from_numpy(embeddings)
+    for start in range(0, embeddings.size(0), block_size):
+        yield start, embeddings[start: start + block_size].to(device=device, dtype=dtype)
+
+
+@torch.inference_mode()
+def encode_corpus(encode_fn: Callable[..., torch.Tensor], batches: Iterable, path: str, normalize=True,
+                  device=None, log_every: Optional[int] = None) -> EmbeddingStore:
+    '''
+        encode_fn(**batch) -> [B, D] , 例如 model.forward_for_hidden
+        batches 为 dataloader 等 , batch 为 dict , 张量移动到 device 后调用 encode_fn
+        返回只读打开的 EmbeddingStore
+    '''
+    with EmbeddingWriter(path, normalize=normalize) as writer:
+        for i, batch in enumerate(batches):
+            if device is not None:
+                batch = {k: v.to(device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+                         for k, v in batch.items()}
+            writer.write(encode_fn(**batch))
+            if log_every and (i + 1) % log_every == 0:
+                logger.info('encode_corpus {} batches , {} rows'.format(i + 1, writer.num))
+    return EmbeddingStore(path)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/31 15:00
+# @FileName: hard_negative.py
+"""
+    难负例挖掘
+    用当前模型的向量检索 top-k , 去掉正例和疑似漏标的正例后取若干条作为负例 ,
+    结果按 {query , pos , neg} 写回 jsonl , 与训练数据格式一致
+"""
+import json
+import numbers
+import os
+import random
+from typing import Sequence, List, Optional, Union, Iterable, Callable
+
+__all__ = [
+    'mine_hard_negatives',
+    'write_triples',
+]
+
+
+def mine_hard_negatives(index, queries, positives: Sequence[Union[int, Iterable[int]]], num_negatives=4,
+                        top_k=100, skip_top=0, max_score: Optional[float] = None, sample=False,
+                        query_batch=4096, seed=42, **search_kwargs) -> List[List[int]]:
+    '''
+        index: ExactIndex / IVFPQIndex , queries 与 positives 按行对应
+        skip_top: 丢弃排名最前的若干结果 , 减少把漏标正例当作负例
+        max_score: 分数高于该值的结果视为疑似正例丢弃 (向量已归一化时为 cosine)
+        sample=True 时从剩余候选中随机取 num_negatives 个 , 否则取最难的
+        返回每个 query 的负例 id 列表 (可能少于 num_negatives)
+    '''
+    rng = random.Random(seed)
+    out = []
+    for start, scores, indices in index.iter_search(queries, k=top_k, query_batch=query_batch, **search_kwargs):
+        scores, indices = scores.tolist(), indices.tolist()
+        for i, (row_scores, row_ids) in enumerate(zip(scores, indices)):
+            pos = positives[start + i]
+            pos = {pos} if isinstance(pos, numbers.Integral) else set(pos)
+            candidates = []
+            for rank, (score, idx) in enumerate(zip(row_scores, row_ids)):
+                if rank < skip_top or idx < 0 or idx in pos:
+                    continue
+                if max_score is not None and score > max_score:
+                    continue
+                candidates.append(idx)
+            if sample and len(candidates) > num_negatives:
+                candidates = rng.sample(candidates, num_negatives)
+            out.append(candidates[:num_negatives])
+    return out
+
+
+def write_triples(path, queries: Sequence, corpus: Union[Sequence, Callable[[int], str]],
+                  positives: Sequence[Union[int, Iterable[int]]], negatives: Sequence[Sequence[int]],
+                  keys=('query', 'pos', 'neg'), min_negatives=1):
+    '''
+        queries 为文本 , corpus 为文本列表或 id -> 文本 的函数
+        每行 {"query": str , "pos": [str] , "neg": [str]} , 负例少于 min_negatives 的 query 跳过
+        返回写入的行数
+    '''
+    get_text = corpus if callable(corpus) else corpus.__getitem__
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    num = 0
+    with open(path, mode='w', encoding='utf-8') as f:
+        for query, pos, neg in zip(queries, positives, negatives):
+            if len(neg) < min_negatives:
+                continue
+            pos = [pos] if isinstance(pos, numbers.Integral) else list(pos)
+            f.write(json.dumps({keys[0]: query,
+                                keys[1]: [get_text(i) for i in pos],
+                                keys[2]: [get_text(i) for i in neg]}, ensure_ascii=False) + '\n')
+            num += 1
+    return num
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/31 11:20
+# @FileName: ivfpq.py
+"""
+    IVF + PQ 近似内积检索 , 纯 torch 实现 , 不依赖 faiss
+    粗聚类 nlist 个中心 , 残差按 m 段做乘积量化 (每段 2**nbits 个中心 , 每个向量 m 字节)
+    检索时每个 query 探测 nprobe 个簇 , 分数 = q·c + sum_j T[j, code_j] (ADC 查表)
+    簇内按 block_size 行分块 , 逐段查表累加 , 中间结果为 [r, block_size] , 不生成 [r, n_l, m]
+    向量应先归一化 , 内积即 cosine
+"""
+from typing import Optional, Tuple, Iterator
+
+import numpy as np
+import torch
+
+from .embedding_store import iter_embedding_blocks, EmbeddingStore
+from .search import merge_topk, EmbeddingsType
+
+__all__ = [
+    'kmeans',
+    'IVFPQIndex',
+]
+
+
+def _assign(x: torch.Tensor, centroids: torch.Tensor, batch_size=65536) -> torch.Tensor:
+    # argmin ||x - c||^2 = argmax (2 x·c - ||c||^2)
+    c_norm = (centroids * centroids).sum(-1)
+    out = []
+    for start in range(0, x.size(0), batch_size):
+        out.append((2 * x[start: start + batch_size] @ centroids.T - c_norm).argmax(-1))
+    return torch.cat(out) if out else torch.zeros(0, dtype=torch.long, device=x.device)
+
+
+def kmeans(x: torch.Tensor, num_clusters: int, niter=20, seed=42) -> torch.Tensor:
+    '''
+        x: [N, D] float32 , 返回 [num_clusters, D] , 空簇重新取随机样本
+    '''
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    n = x.size(0)
+    if n < num_clusters:
+        raise ValueError('kmeans needs at least {} training vectors, got {}'.format(num_clusters, n))
+    centroids = x[torch.randperm(n, generator=generator)[:num_clusters].to(x.device)].clone()
+    for _ in range(niter):
+        assign = _assign(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=num_clusters).to(x.dtype)
+        empty = counts == 0
+        centroids = sums / counts.clamp_min(1).unsqueeze(-1)
+        if empty.any():
+            refill = torch.randint(0, n, (int(empty.sum()),), generator=generator).to(x.device)
+            centroids[empty] = x[refill]
+    return centroids
+
+
+class IVFPQIndex:
+    '''
+        train(样本) -> add(语料 , 可多次) -> search(queries)
+        倒排表按簇排序后以 CSR 形式存储 : codes [N, m] uint8 , ids [N] int64 , offsets [nlist + 1]
+    '''
+    def __init__(self, dim: int, nlist=1024, m=16, nbits=8, device=None):
+        if dim % m != 0:
+            raise ValueError('dim {} must be divisible by m {}'.format(dim, m))
+        if nbits > 8:
+            raise ValueError('nbits must be <= 8')
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.ksub = 2 ** nbits
+        self.dsub = dim // m
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.coarse: Optional[torch.Tensor] = None
+        self.codebooks: Optional[torch.Tensor] = None
+        self._pending = []
+        self.codes = torch.zeros((0, m), dtype=torch.uint8)
+        self.ids = torch.zeros(0, dtype=torch.long)
+        self.offsets = torch.zeros(nlist + 1, dtype=torch.long)
+        self.ntotal = 0
+
+    @property
+    def is_trained(self):
+        return self.coarse is not None
+
+    def __len__(self):
+        return self.ntotal
+
+    @torch.no_grad()
+    def train(self, x: EmbeddingsType, max_samples=262144, niter=20, seed=42):
+        '''
+            x 超过 max_samples 行时均匀采样
+        '''
+        n = len(x)
+        if n > max_samples:
+            rows = np.sort(np.random.default_rng(seed).choice(n, max_samples, replace=False))
+            sample = x.take(rows) if isinstance(x, EmbeddingStore) else x[rows]
+        else:
+            sample = x[:]
+        sample = torch.as_tensor(np.asarray(sample) if not isinstance(sample, torch.Tensor) else sample)
+        sample = sample.to(self.device, torch.float32)
+        self.coarse = kmeans(sample, self.nlist, niter=niter, seed=seed)
+        residual = sample - self.coarse[_assign(sample, self.coarse)]
+        residual = residual.view(-1, self.m, self.dsub)
+        self.codebooks = torch.stack([kmeans(residual[:, j].contiguous(), self.ksub, niter=niter, seed=seed + j)
+                                      for j in range(self.m)])
+
+    def _encode(self, residual: torch.Tensor) -> torch.Tensor:
+        residual = residual.view(-1, self.m, self.dsub)
+        codes = [_assign(residual[:, j].contiguous(), self.codebooks[j]) for j in range(self.m)]
+        return torch.stack(codes, dim=1).to(torch.uint8)
+
+    @torch.no_grad()
+    def add(self, x: EmbeddingsType, start_id=None, block_size=65536):
+        '''
+            按块编码 , ids 默认接在已有向量之后 ; 调用 search 前自动整理倒排表
+        '''
+        if not self.is_trained:
+            raise RuntimeError('IVFPQIndex must be trained before add')
+        base = self.ntotal if start_id is None else start_id
+        for start, block in iter_embedding_blocks(x, block_size, device=self.device, dtype=torch.float32):
+            lists = _assign(block, self.coarse)
+            codes = self._encode(block - self.coarse[lists])
+            ids = torch.arange(base + start, base + start + block.size(0), dtype=torch.long)
+            self._pending.append((lists.cpu(), codes.cpu(), ids))
+            self.ntotal += block.size(0)
+
+    def _build(self):
+        if not self._pending:
+            return
+        lists = torch.cat([p[0] for p in self._pending])
+        codes = torch.cat([p[1] for p in self._pending])
+        ids = torch.cat([p[2] for p in self._pending])
+        self._pending = []
+        if self.ids.numel():
+            # 已有倒排表展开回 (list , code , id) 后重新排序
+            old_lists = torch.repeat_interleave(torch.arange(self.nlist), self.offsets.diff())
+            lists, codes, ids = torch.cat([old_lists, lists]), torch.cat([self.codes, codes]), torch.cat([self.ids, ids])
+        order = torch.argsort(lists, stable=True)
+        self.codes, self.ids = codes[order], ids[order]
+        self.offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        self.offsets[1:] = torch.bincount(lists, minlength=self.nlist).cumsum(0)
+
+    def _adc(self, tables: torch.Tensor, codes: torch.Tensor) -> torch.Tensor:
+        # tables [r, m, ksub] , codes [n_l, m] -> [r, n_l] , 每段 gather 一次后原地累加
+        scores = tables[:, 0].index_select(1, codes[:, 0])
+        for j in range(1, self.m):
+            scores.add_(tables[:, j].index_select(1, codes[:, j]))
+        return scores
+
+    def _search_batch(self, q: torch.Tensor, k: int, nprobe: int, block_size: int
+                      ) -> Tuple[torch.Tensor, torch.Tensor]:
+        n = q.size(0)
+        coarse_scores = q @ self.coarse.T
+        probe_scores, probes = coarse_scores.topk(min(nprobe, self.nlist), dim=1)
+        # ADC 表 [n, m, ksub]
+        tables = torch.einsum('nmd,mkd->nmk', q.view(n, self.m, self.dsub), self.codebooks)
+        best_scores = torch.full((n, k), -float('inf'), device=q.device)
+        best_ids = torch.full((n, k), -1, dtype=torch.long, device=q.device)
+        offsets = self.offsets.tolist()
+        # 按簇遍历 , 每个簇只读取一次 , 与探测该簇的 query 一起计算
+        for lst in torch.unique(probes).tolist():
+            lo, hi = offsets[lst], offsets[lst + 1]
+            if hi == lo:
+                continue
+            rows, cols = (probes == lst).nonzero(as_tuple=True)
+            list_tables = tables[rows]
+            list_scores = probe_scores[rows, cols].unsqueeze(-1)
+            # 每个 query 对同一簇只探测一次 , rows 不重复
+            row_scores, row_ids = best_scores[rows], best_ids[rows]
+            for start in range(lo, hi, block_size):
+                end = min(start + block_size, hi)
+                codes = self.codes[start: end].to(q.device, torch.long)
+                scores = self._adc(list_tables, codes).add_(list_scores)
+                scores, idx = scores.topk(min(k, scores.size(1)), dim=1)
+                ids = self.ids[start: end].to(q.device)[idx]
+                row_scores, row_ids = merge_topk(row_scores, row_ids, scores, ids, k)
+            best_scores[rows], best_ids[rows] = row_scores, row_ids
+        return best_scores, best_ids
+
+    @torch.no_grad()
+    def iter_search(self, queries: EmbeddingsType, k=10, nprobe=16, query_batch=1024, block_size=65536
+                    ) -> Iterator[Tuple[int, torch.Tensor, torch.Tensor]]:
+        '''
+            与 ExactIndex.iter_search 相同 , 不足 k 个结果时 id 为 -1
+            分数矩阵最大为 query_batch * block_size
+        '''
+        self._build()
+        for start, q in iter_embedding_blocks(queries, query_batch, device=self.device, dtype=torch.float32):
+            scores, ids = self._search_batch(q, k, nprobe, block_size)
+            yield start, scores.cpu(), ids.cpu()
+
+    def search(self, queries: EmbeddingsType, k=10, nprobe=16, query_batch=1024, block_size=65536):
+        results = list(self.iter_search(queries, k=k, nprobe=nprobe, query_batch=query_batch,
+                                        block_size=block_size))
+        if not results:
+            return torch.zeros((0, k)), torch.zeros((0, k), dtype=torch.long)
+        return torch.cat([r[1] for r in results], dim=0), torch.cat([r[2] for r in results], dim=0)
+
+    def state_dict(self):
+        self._build()
+        return {
+            'dim': self.dim, 'nlist': self.nlist, 'm': self.m, 'nbits': self.nbits,
+            'coarse': None if self.coarse is None else self.coarse.cpu(),
+            'codebooks': None if self.codebooks is None else self.codebooks.cpu(),
+            'codes': self.codes, 'ids': self.ids, 'offsets': self.offsets, 'ntotal': self.ntotal,
+        }
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path, device=None) -> 'IVFPQIndex':
+        # state_dict 只有张量和基础类型
+        state = torch.load(path, map_location='cpu', weights_only=True)
+        index = cls(state['dim'], nlist=state['nlist'], m=state['m'], nbits=state['nbits'], device=device)
+        if state['coarse'] is not None:
+            index.coarse = state['coarse'].to(index.device)
+            index.codebooks = state['codebooks'].to(index.device)
+        index.codes, index.ids, index.offsets = state['codes'], state['ids'], state['offsets']
+        index.ntotal = state['ntotal']
+        return index
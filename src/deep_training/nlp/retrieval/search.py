@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/31 10:40
+# @FileName: search.py
+"""
+    精确 top-k 内积检索
+    query 按批 , 语料按块 , 每块 matmul 后取块内 top-k 再与当前结果合并 ,
+    显存 / 内存占用为 query_batch * block_size 的分数矩阵 , 与语料大小无关
+"""
+from typing import Union, Optional, Tuple, Iterator
+
+import numpy as np
+import torch
+
+from .embedding_store import EmbeddingStore, iter_embedding_blocks
+
+__all__ = [
+    'merge_topk',
+    'blocked_topk',
+    'iter_blocked_topk',
+    'ExactIndex',
+]
+
+EmbeddingsType = Union[torch.Tensor, np.ndarray, EmbeddingStore]
+
+
+def _compute_dtype(device):
+    # cpu 上 float16 matmul 很慢
+    return torch.float16 if torch.device(device).type == 'cuda' else torch.float32
+
+
+def merge_topk(scores: torch.Tensor, indices: torch.Tensor, new_scores: torch.Tensor, new_indices: torch.Tensor,
+               k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    scores = torch.cat([scores, new_scores], dim=1)
+    indices = torch.cat([indices, new_indices], dim=1)
+    scores, order = scores.topk(min(k, scores.size(1)), dim=1)
+    return scores, indices.gather(1, order)
+
+
+def _search_batch(queries: torch.Tensor, corpus: EmbeddingsType, k: int, block_size: int,
+                  device, dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+    n = queries.size(0)
+    best_scores = torch.full((n, 0), -float('inf'), device=device)
+    best_indices = torch.zeros((n, 0), dtype=torch.long, device=device)
+    for start, block in iter_embedding_blocks(corpus, block_size, device=device, dtype=dtype):
+        scores = (queries @ block.T).float()
+        kk = min(k, scores.size(1))
+        scores, indices = scores.topk(kk, dim=1)
+        best_scores, best_indices = merge_topk(best_scores, best_indices, scores, indices + start, k)
+    return best_scores, best_indices
+
+
+@torch.inference_mode()
+def iter_blocked_topk(queries: EmbeddingsType, corpus: EmbeddingsType, k=10, query_batch=4096, block_size=65536,
+                      device=None) -> Iterator[Tuple[int, torch.Tensor, torch.Tensor]]:
+    '''
+        按 query 批次返回 (起始行 , scores [q, k] float32 , indices [q, k] int64) , 结果在 cpu
+        评估 / 挖掘时逐批处理 , 不需要保留全部结果
+    '''
+    device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    dtype = _compute_dtype(device)
+    for start, q in iter_embedding_blocks(queries, query_batch, device=device, dtype=dtype):
+        scores, indices = _search_batch(q, corpus, k, block_size, device, dtype)
+        yield start, scores.cpu(), indices.cpu()
+
+
+def blocked_topk(queries: EmbeddingsType, corpus: EmbeddingsType, k=10, query_batch=4096, block_size=65536,
+                 device=None) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+        返回全部 query 的 (scores [Q, k] , indices [Q, k])
+    '''
+    results = list(iter_blocked_topk(queries, corpus, k=k, query_batch=query_batch, block_size=block_size,
+                                     device=device))
+    if not results:
+        return torch.zeros((0, k)), torch.zeros((0, k), dtype=torch.long)
+    return torch.cat([r[1] for r in results], dim=0), torch.cat([r[2] for r in results], dim=0)
+
+
+class ExactIndex:
+    '''
+        与 IVFPQIndex 相同的 search 接口 , 语料不载入内存
+    '''
+    def __init__(self, corpus: EmbeddingsType, block_size=65536, device=None):
+        self.corpus = corpus
+        self.block_size = block_size
+        self.device = device
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def iter_search(self, queries: EmbeddingsType, k=10, query_batch=4096):
+        return iter_blocked_topk(queries, self.corpus, k=k, query_batch=query_batch,
+                                 block_size=self.block_size, device=self.device)
+
+    def search(self, queries: EmbeddingsType, k=10, query_batch=4096):
+        return blocked_topk(queries, self.corpus, k=k, query_batch=query_batch,
+                            block_size=self.block_size, device=self.device)
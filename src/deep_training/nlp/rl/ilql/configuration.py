@@ -21,6 +21,9 @@ class ILQLConfig(RLConfigMixin):
     gen_kwargs: dict = field(default=None,
                              metadata={"help": "Additioanl kwargs for the generation"})
     minibatch_size: Optional[int] = field(default=None, metadata={"help": "minibatch_size"})
+    minibatch_max_tokens: Optional[int] = field(default=None, metadata={"help": "minibatch 的 token 预算 (行数 * pad 后长度) , 超出时自动切分并梯度累积 , 只用于 store planner"})
+    minibatch_memory_budget: Optional[float] = field(default=None, metadata={"help": "minibatch 激活显存预算 (GB) , 未设置 minibatch_max_tokens 时据此按模型结构估算 token 预算 , 只用于 store planner"})
+    minibatch_loss_reduction: str = field(default='sum', metadata={"help": "sum: 每个 minibatch 的 loss 按 行数 / minibatch_size 缩放后累加 (原梯度尺度) , mean: 按行数占比加权 , 整步为均值"})
 
     def __post_init__(self):
         if self.gen_kwargs is None:
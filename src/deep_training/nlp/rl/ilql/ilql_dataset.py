@@ -28,6 +28,7 @@ class ILQLRolloutStorage(BaseRolloutStore):
     """
     Rollout storage for training ILQL
     """
+    length_fields = ('input_ids',)
 
     def __init__(self, input_ids, attention_mask, rewards, states_ixs, actions_ixs, dones):
         super().__init__()
@@ -78,6 +79,7 @@ class ILQLSeq2SeqRolloutStorage(BaseRolloutStore):
     """
     Rollout storage for training ILQL
     """
+    length_fields = ('input_ids', 'decoder_input_ids')
 
     def __init__(self, input_ids, attention_mask, decoder_input_ids, rewards, states_ixs, actions_ixs, dones):
         super().__init__()
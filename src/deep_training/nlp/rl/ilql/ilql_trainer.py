@@ -8,7 +8,6 @@ import os
 import lightning
 import numpy as np
 from tqdm import tqdm
-from time import time
 from collections.abc import Mapping
 from functools import partial
 from typing import Any, cast, Iterable, List, Literal, Optional, Tuple, Union, Callable
@@ -23,8 +22,9 @@ from lightning.fabric.strategies import Strategy, DeepSpeedStrategy
 from lightning.fabric.wrappers import _unwrap_objects, _FabricModule
 
 from ....trainer.pl.fabric.fabric import FabricEx
+from ....trainer.telemetry import StepTelemetry
 from .ilql_dataset import ILQLSeq2SeqRolloutStorage, ILQLRolloutStorage, tokenize_dialogue
-from ..rl_base.rl_dataset import MiniBatchIterator, logger
+from ..rl_base.rl_dataset import RolloutBatchPlanner, resolve_minibatch_max_tokens, logger
 from ..utils import RunningMoments
 from .configuration import ILQLConfig
 
@@ -51,6 +51,7 @@ class ILQLTrainer:
         checkpoint_dir: str = "./checkpoints",
         checkpoint_frequency: int = 1,
         max_grad_norm=None,
+        telemetry: Optional[StepTelemetry] = None,
     ) -> None:
         """Exemplary Trainer with Fabric. This is a very simple trainer focused on readablity but with reduced
         featureset. As a trainer with more included features, we recommend using the
@@ -142,6 +143,7 @@ class ILQLTrainer:
         self.checkpoint_dir = checkpoint_dir
         self.checkpoint_frequency = checkpoint_frequency
         self.max_grad_norm = max_grad_norm
+        self.telemetry = telemetry if telemetry is not None else StepTelemetry(enabled=False)
         self.train_mb_count = 0
         self.train_item_count = 0
 
@@ -195,7 +197,7 @@ class ILQLTrainer:
     def fit(
         self,
         model: L.LightningModule,
-        train_loader: DataLoader,
+        train_loader: Optional[DataLoader],
         tokenizer,
         ilql_config,
         reward_fn = None,
@@ -209,6 +211,8 @@ class ILQLTrainer:
             model: the LightningModule to train.
                 Can have the same hooks as :attr:`callbacks` (see :meth:`PPPTrainer.__init__`).
             train_loader: the training dataloader. Has to be an iterable returning batches.
+                If None, batches are planned directly from ``self.store`` (call :meth:`make_experience` first),
+                split under ``minibatch_max_tokens`` / ``minibatch_memory_budget``.
             val_loader: the validation dataloader. Has to be an iterable returning batches.
                 If not specified, no validation will run.
             ckpt_path: Path to previous checkpoints to resume training from.
@@ -219,9 +223,20 @@ class ILQLTrainer:
         self.stop_sequences = stop_sequences
 
         # setup dataloaders
-        train_loader = self.fabric.setup_dataloaders(train_loader,
-                                                     use_distributed_sampler=self.use_distributed_sampler,
-                                                     move_to_device=False)
+        if train_loader is None:
+            assert getattr(self, 'store', None) is not None, ValueError('train_loader is None , call make_experience first')
+            train_loader = self.store.create_planner(model.training_args.train_batch_size,
+                                                     mb_size=self.mb_size,
+                                                     max_tokens=resolve_minibatch_max_tokens(self.ilql_config, getattr(model, 'config', None)),
+                                                     shuffle=True,
+                                                     device=self.fabric.device,
+                                                     num_replicas=self.fabric.world_size,
+                                                     rank=self.fabric.global_rank,
+                                                     loss_reduction=self.ilql_config.minibatch_loss_reduction)
+        else:
+            train_loader = self.fabric.setup_dataloaders(train_loader,
+                                                         use_distributed_sampler=self.use_distributed_sampler,
+                                                         move_to_device=False)
         if val_loader is not None:
             val_loader = self.fabric.setup_dataloaders(val_loader, use_distributed_sampler=self.use_distributed_sampler,
                                                        move_to_device=False)
@@ -289,7 +304,7 @@ class ILQLTrainer:
         self,
         model: _FabricModule,
         optimizer: torch.optim.Optimizer,
-        train_loader: DataLoader,
+        train_loader: Union[DataLoader, RolloutBatchPlanner],
         limit_batches: Union[int, float] = float("inf"),
         scheduler_cfg: Optional[Mapping[str, Union[L.fabric.utilities.types.LRScheduler, bool, str, int]]] = None,
     ):
@@ -304,6 +319,9 @@ class ILQLTrainer:
             scheduler_cfg: The learning rate scheduler configuration.
                 Have a look at :meth:`lightning.pytorch.LightninModule.configure_optimizers` for supported values.
         """
+        is_planner = isinstance(train_loader, RolloutBatchPlanner)
+        if is_planner:
+            train_loader.set_epoch(self.current_epoch)
         self.fabric.call("on_train_epoch_start",self,model)
         iterable = self.progbar_wrapper(
             train_loader, total=len(train_loader), desc=f"Epoch {self.current_epoch}"
@@ -316,49 +334,33 @@ class ILQLTrainer:
                 return
 
             self.fabric.call("on_train_batch_start",self,model,batch, batch_idx)
-            # Note that whereas standard policy gradient methods perform one
-            # gradient update per batch, PPO for example commonly performs
-            # multiple gradient updates on the same batch of data.
-            # https://arxiv.org/pdf/1707.06347.pdf
             stats_accum = []
             loss_accum = []
 
-            bs = batch['input_ids'].size(0)
-            num_mb = bs // self.mb_size
-            if num_mb == 0:
-                num_mb = 1
-                mbs = [batch]
-            else:
-                batch_keys = batch.keys()
-                mbs = []
-                for i in range(num_mb):
-                    mb = {k: None for k in batch_keys}
-                    for k in batch_keys:
-                        mb[k] = batch[k][i * self.mb_size: (i + 1) * self.mb_size]
-                    mbs.append(mb)
-
-            for mb in mbs:
+            # planner 直接产出 [(minibatch, loss_weight, share) , ...] , 普通 dataloader 的 batch 按 mb_size 切分 ,
+            # share 只用于汇总
+            mbs = batch if is_planner else self.split_minibatches(batch)
+            for mb_idx, (mb, weight, share) in enumerate(mbs):
                 self.train_mb_count += 1
                 for k in mb:
                     mb[k] = mb[k].to(self.fabric.device)
-                should_sync = self.train_mb_count % self.accumulate_grad_batches == 0
+                should_sync = mb_idx == len(mbs) - 1
                 with self.fabric.no_backward_sync(model,enabled=not should_sync):
-                    outputs = self.training_step(model=model, batch=mb, batch_idx = batch_idx)
+                    outputs = self.training_step(model=model, batch=mb, batch_idx = batch_idx, loss_weight=weight)
                     loss, stats = outputs['loss'], outputs['stats']
-                loss_accum.append(loss)
-                stats_accum.append(stats)
+                loss_accum.append(loss * share)
+                stats_accum.append((stats, share))
+                self.telemetry.add_batch(mb)
 
-            # TODO(Dahoas): Best way to combine stats between mbs?
-            # How does accelerate do it?
-            # currently only supports a single optimizer
             self.fabric.call("on_before_optimizer_step" ,self,model,optimizer, 0)
 
-            if self.max_grad_norm is not None:
-                self.fabric.clip_gradients(model, optimizer, max_norm=self.max_grad_norm)
-            # optimizer step runs train step internally through closure
-            optimizer.step()
-            self.fabric.call("on_before_zero_grad",self,model, optimizer)
-            optimizer.zero_grad()
+            with self.telemetry.phase("optimizer"):
+                if self.max_grad_norm is not None:
+                    self.fabric.clip_gradients(model, optimizer, max_norm=self.max_grad_norm)
+                # optimizer step runs train step internally through closure
+                optimizer.step()
+                self.fabric.call("on_before_zero_grad",self,model, optimizer)
+                optimizer.zero_grad()
 
             self.step_scheduler(model, scheduler_cfg, level="step", current_value=self.global_step)
 
@@ -366,11 +368,13 @@ class ILQLTrainer:
             self.global_step += 1
 
             self.train_item_count += 1
-            stats = {key: sum([stats[key] for stats in stats_accum]) / num_mb for key in stats_accum[0]}
+            stats = {key: sum([stats[key] * weight for stats, weight in stats_accum]) for key in stats_accum[0][0]}
             metrics = {
-                "loss": torch.mean(torch.stack(loss_accum)),
+                "loss": torch.sum(torch.stack(loss_accum)),
             }
             metrics.update(stats)
+            for k, v in self.telemetry.step_end(self.global_step).items():
+                metrics.setdefault(k, v)
             self.fabric.logger.log_metrics(metrics, step=self.global_step)
             self._callback_metrics.update(metrics)
 
@@ -443,7 +447,22 @@ class ILQLTrainer:
         self.fabric.call("on_validation_model_train",self,model)
         torch.set_grad_enabled(True)
 
-    def training_step(self, model: L.LightningModule, batch: Any, batch_idx: int) -> torch.Tensor:
+    def split_minibatches(self, batch):
+        '''
+            返回 [(minibatch , loss_weight , share) , ...] , loss_weight 的含义见 RolloutBatchPlanner
+        '''
+        bs = batch['input_ids'].size(0)
+        if bs <= self.mb_size:
+            return [(batch, 1.0, 1.0)]
+        mean = self.ilql_config.minibatch_loss_reduction == 'mean'
+        mbs = []
+        for i in range(0, bs, self.mb_size):
+            mb = {k: v[i: i + self.mb_size] for k, v in batch.items()}
+            rows = mb['input_ids'].size(0)
+            mbs.append((mb, rows / bs if mean else rows / self.mb_size, rows / bs))
+        return mbs
+
+    def training_step(self, model: L.LightningModule, batch: Any, batch_idx: int, loss_weight: float = 1.0) -> torch.Tensor:
         """A single training step, running forward and backward. The optimizer step is called separately, as this
         is given as a closure to the optimizer step.
 
@@ -451,24 +470,22 @@ class ILQLTrainer:
             model: the lightning module to train
             batch: the batch to run the forward on
             batch_idx: index of the current batch w.r.t the current epoch
+            loss_weight: scale of the loss before backward, see ``minibatch_loss_reduction``
         """
-        forward_time,backward_time = 0,0
-        forward_time -= time()
-        outputs: Union[torch.Tensor, Mapping[str, Any]] = model.training_step(batch)
-        loss = outputs if isinstance(outputs, torch.Tensor) else outputs["loss"]
-        forward_time += time()
+        with self.telemetry.phase("forward") as forward_timer:
+            outputs: Union[torch.Tensor, Mapping[str, Any]] = model.training_step(batch)
+            loss = outputs if isinstance(outputs, torch.Tensor) else outputs["loss"]
 
         self.fabric.call("on_before_backward",self,model, loss)
-        backward_time -= time()
-        self.fabric.backward(loss)
-        backward_time += time()
+        with self.telemetry.phase("backward") as backward_timer:
+            self.fabric.backward(loss * loss_weight if loss_weight != 1.0 else loss)
         self.fabric.call("on_after_backward",self,model)
 
         # avoid gradients in stored/accumulated values -> prevents potential OOM
         self._current_train_return = apply_to_collection(outputs, dtype=torch.Tensor, function=lambda x: x.detach())
         stats = self._current_train_return['stats']
-        stats['time/forward'] = forward_time
-        stats['time/backward'] = backward_time
+        stats['time/forward'] = forward_timer.elapsed
+        stats['time/backward'] = backward_timer.elapsed
         return self._current_train_return
 
     def step_scheduler(
@@ -569,7 +586,8 @@ class ILQLTrainer:
                 "state_dict": state['state_dict'],
                 "pytorch-lightning_version": state['pytorch-lightning_version'],
             }
-        self.fabric.save(filepath, state)
+        with self.telemetry.phase("checkpoint"):
+            self.fabric.save(filepath, state)
 
     @staticmethod
     def get_latest_checkpoint(checkpoint_dir: str) -> Optional[str]:
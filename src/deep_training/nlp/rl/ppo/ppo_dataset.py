@@ -29,11 +29,19 @@ class PPORolloutStore(BaseRolloutStore):
         self.padding_side = padding_side
         self.history: Iterable[PPORLElement] = [None]
 
+        # create_planner , 与 create_loader 的 collate_fn 一致
+        self.padding_values = dict(query_tensor=pad_token_id, response_tensor=pad_token_id)
+        self.left_padding_fields = ('query_tensor',) if padding_side != "right" else ()
+        self.length_fields = ('query_tensor', 'response_tensor')
+        self.batch_cls = PPORLBatch
+
     def push(self, exps: Iterable[PPORLElement]):
         self.history += exps
+        self.invalidate_planner()
 
     def clear_history(self):
         self.history = []
+        self.invalidate_planner()
 
     def export_history(self, location: str):
         assert os.path.exists(location)
@@ -7,7 +7,7 @@ from torch import nn
 from transformers import PretrainedConfig
 from transformers.utils import ModelOutput
 from .configuration import PPOConfig
-from ..utils import logprobs_of_labels, get_tensor_stats, flatten_dict, whiten
+from ..utils import logprobs_of_labels, get_tensor_stats, flatten_dict, whiten, discounted_cumsum
 from .data_define import PPORLBatch
 from ...models.rl.utils import CausalLMOutputWithValue
 
@@ -55,7 +55,6 @@ class PPOModelLoss(nn.Module, PPOLLMAbstract, PPOSEQ2SEQAbstract,PPOPrefixLMAbst
         old_rewards = batch.rewards.to(device)
         response_length = old_rewards.shape[1]
 
-        advantages, returns = self.get_advantages_and_returns(old_values, old_rewards, response_length)
         if self.ppo_config.model_arch_type == "seq2seq":
             input_ids = query_tensors
             decoder_input_ids = response_tensors
@@ -114,6 +113,8 @@ class PPOModelLoss(nn.Module, PPOLLMAbstract, PPOSEQ2SEQAbstract,PPOPrefixLMAbst
                 attention_mask[:, start:end],
             )
 
+        # 与 loss 使用同一个 mask , 每行在自己的长度处截断 , padding 上 advantage 为 0
+        advantages, returns = self.get_advantages_and_returns(old_values, old_rewards, response_length, mask=mask)
         loss, stats = self.loss_fn(
             logprobs=logprobs,
             values=values_pred,
@@ -134,6 +135,7 @@ class PPOModelLoss(nn.Module, PPOLLMAbstract, PPOSEQ2SEQAbstract,PPOPrefixLMAbst
             rewards, #: TensorType["batch_size", "response_size"]
             response_length: int,
             use_whitening: Optional[bool] = True,
+            mask: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Function that computes advantages and returns from rewards and values.
         Calculated as in the original PPO paper: https://arxiv.org/abs/1707.06347
@@ -152,15 +154,20 @@ class PPOModelLoss(nn.Module, PPOLLMAbstract, PPOSEQ2SEQAbstract,PPOPrefixLMAbst
             rewards: Tensor of shape (batch_size, response_size)
             response_length: Length of the response sequence
             use_whitening: Whether to use whitening (ie. normalize advantages) or not
+            mask: Optional tensor of shape (batch_size, response_size), 1 for valid steps.
+                Each row is cut at its own length: no bootstrap past the last valid step
+                and zero advantage on padding.
         """
-        lastgaelam = 0
-        advantages_reversed = []
-        for t in reversed(range(response_length)):
-            nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
-            delta = rewards[:, t] + self.ppo_config.gamma * nextvalues - values[:, t]
-            lastgaelam = delta + self.ppo_config.gamma * self.ppo_config.lam * lastgaelam
-            advantages_reversed.append(lastgaelam)
-        advantages = torch.stack(advantages_reversed[::-1], dim=1)
+        values = values[:, :response_length]
+        rewards = rewards[:, :response_length]
+        nextvalues = torch.nn.functional.pad(values[:, 1:], (0, 1))
+        if mask is not None:
+            mask = mask[:, :response_length].to(values.dtype)
+            nextvalues = nextvalues * torch.nn.functional.pad(mask[:, 1:], (0, 1))
+        delta = rewards + self.ppo_config.gamma * nextvalues - values
+        if mask is not None:
+            delta = delta * mask
+        advantages = discounted_cumsum(delta, self.ppo_config.gamma * self.ppo_config.lam)
         returns = advantages + values
         if use_whitening:
             advantages = whiten(advantages)
@@ -8,7 +8,6 @@ import os
 import lightning
 import numpy as np
 from tqdm import tqdm
-from time import time
 from collections.abc import Mapping
 from functools import partial
 from typing import Any, cast, Iterable, List, Literal, Optional, Tuple, Union, Callable
@@ -25,13 +24,14 @@ from lightning.fabric.strategies import Strategy,DeepSpeedStrategy
 from lightning.fabric.wrappers import _unwrap_objects, _FabricModule
 from .ppo_dataset import PPORolloutStore
 from .data_define import PPORLElement,logger,logging
-from ..rl_base.rl_dataset import MiniBatchIterator
+from ..rl_base.rl_dataset import resolve_minibatch_max_tokens
 from ..utils import logprobs_of_labels, Clock, gather_dict, RunningMoments, pad_across_processes, _gpu_gather, infinite_dataloader
 from ...layers.ppo import AdaptiveKLController, FixedKLController
 from .configuration import PPOConfig
 
 from lightning.fabric.loggers.tensorboard import TensorBoardLogger
 from ....trainer.pl.fabric.fabric import FabricEx
+from ....trainer.telemetry import StepTelemetry
 
 class PPOTrainer:
     def __init__(
@@ -53,6 +53,7 @@ class PPOTrainer:
         checkpoint_dir: str = "./checkpoints",
         checkpoint_frequency: int = 1,
         max_grad_norm=None,
+        telemetry: Optional[StepTelemetry] = None,
     ) -> None:
         """Exemplary Trainer with Fabric. This is a very simple trainer focused on readablity but with reduced
         featureset. As a trainer with more included features, we recommend using the
@@ -144,6 +145,7 @@ class PPOTrainer:
         self.checkpoint_dir = checkpoint_dir
         self.checkpoint_frequency = checkpoint_frequency
         self.max_grad_norm = max_grad_norm
+        self.telemetry = telemetry if telemetry is not None else StepTelemetry(enabled=False)
         self.train_mb_count = 0
         self.train_item_count = 0
 
@@ -364,13 +366,18 @@ class PPOTrainer:
         """
 
 
-        num_mb = model.training_args.train_batch_size // self.mb_size
-        train_loader = self.fabric.setup_dataloaders(self.store.create_loader(model.training_args.train_batch_size,shuffle=True),
-                                                     use_distributed_sampler=False)
-        mbs = MiniBatchIterator(train_loader, self.mb_size, num_mb)
+        planner = self.store.create_planner(model.training_args.train_batch_size,
+                                            mb_size=self.mb_size,
+                                            max_tokens=resolve_minibatch_max_tokens(self.ppo_config, getattr(model, 'config', None)),
+                                            shuffle=True,
+                                            device=self.fabric.device,
+                                            seed=self.fabric.global_rank,
+                                            loss_reduction=self.ppo_config.minibatch_loss_reduction)
+        # store 不变时复用同一个 planner (只 pad 一次) , 用 current_epoch 区分每个 epoch 的步顺序
+        planner.set_epoch(self.current_epoch)
         self.fabric.call("on_train_epoch_start",self,model)
         iterable = self.progbar_wrapper(
-            mbs, total=len(train_loader) * num_mb , desc=f"Epoch {self.current_epoch}"
+            planner, total=len(planner), desc=f"Epoch {self.current_epoch}"
         )
         for batch_idx, batch in enumerate(iterable):
             # end epoch if stopping training completely or max batches for this epoch reached
@@ -378,7 +385,7 @@ class PPOTrainer:
                 self.fabric.call("on_train_epoch_end",self,model)
                 return
 
-            self.fabric.call("on_train_batch_start",self,model,mbs, batch_idx)
+            self.fabric.call("on_train_batch_start",self,model,planner, batch_idx)
             # For each update per batch
             for _ in range(self.n_updates_per_batch):
                 # Note that whereas standard policy gradient methods perform one
@@ -387,26 +394,27 @@ class PPOTrainer:
                 # https://arxiv.org/pdf/1707.06347.pdf
                 stats_accum = []
                 loss_accum = []
-                for mb in batch:
+                # minibatch 为 planner 切分的梯度累积步 , 只在最后一个同步梯度 , share 只用于汇总
+                for mb_idx, (mb, weight, share) in enumerate(batch):
                     self.train_mb_count += 1
-                    should_sync = self.train_mb_count % self.accumulate_grad_batches == 0
+                    should_sync = mb_idx == len(batch) - 1
                     with self.fabric.no_backward_sync(model,enabled=not should_sync):
-                        outputs = self.training_step(model=model, batch = mb, batch_idx = batch_idx)
+                        outputs = self.training_step(model=model, batch = mb, batch_idx = batch_idx, loss_weight=weight)
                         loss, stats = outputs['loss'], outputs['stats']
-                    loss_accum.append(loss)
-                    stats_accum.append(stats)
+                    loss_accum.append(loss * share)
+                    stats_accum.append((stats, share))
+                    self.telemetry.add(tokens=mb.query_tensors.numel() + mb.response_tensors.numel(),
+                                       samples=mb.query_tensors.size(0))
 
-                # TODO(Dahoas): Best way to combine stats between mbs?
-                # How does accelerate do it?
-                # currently only supports a single optimizer
                 self.fabric.call("on_before_optimizer_step" ,self,model,optimizer, 0)
 
-                if self.max_grad_norm is not None:
-                    self.fabric.clip_gradients(model, optimizer, max_norm=self.max_grad_norm)
-                # optimizer step runs train step internally through closure
-                optimizer.step()
-                self.fabric.call("on_before_zero_grad",self,model, optimizer)
-                optimizer.zero_grad()
+                with self.telemetry.phase("optimizer"):
+                    if self.max_grad_norm is not None:
+                        self.fabric.clip_gradients(model, optimizer, max_norm=self.max_grad_norm)
+                    # optimizer step runs train step internally through closure
+                    optimizer.step()
+                    self.fabric.call("on_before_zero_grad",self,model, optimizer)
+                    optimizer.zero_grad()
 
                 self.step_scheduler(model, scheduler_cfg, level="step", current_value=self.global_step)
 
@@ -415,11 +423,13 @@ class PPOTrainer:
                 self.global_step += 1
 
                 self.train_item_count += 1
-                stats = {key: sum([stats[key] for stats in stats_accum]) / num_mb for key in stats_accum[0]}
+                stats = {key: sum([stats[key] * weight for stats, weight in stats_accum]) for key in stats_accum[0][0]}
                 metrics = {
-                    "loss": torch.mean(torch.stack(loss_accum)),
+                    "loss": torch.sum(torch.stack(loss_accum)),
                 }
                 metrics.update(stats)
+                for k, v in self.telemetry.step_end(self.global_step).items():
+                    metrics.setdefault(k, v)
                 self.fabric.logger.log_metrics(metrics, step=self.global_step)
                 self._callback_metrics.update(metrics)
 
@@ -494,7 +504,7 @@ class PPOTrainer:
         self.fabric.call("on_validation_model_train",self,model)
         torch.set_grad_enabled(True)
 
-    def training_step(self, model: L.LightningModule, batch: Any, batch_idx: int) -> torch.Tensor:
+    def training_step(self, model: L.LightningModule, batch: Any, batch_idx: int, loss_weight: float = 1.0) -> torch.Tensor:
         """A single training step, running forward and backward. The optimizer step is called separately, as this
         is given as a closure to the optimizer step.
 
@@ -502,25 +512,23 @@ class PPOTrainer:
             model: the lightning module to train
             batch: the batch to run the forward on
             batch_idx: index of the current batch w.r.t the current epoch
+            loss_weight: scale of the loss before backward, see ``minibatch_loss_reduction``
         """
-        forward_time,backward_time = 0,0
-        forward_time -= time()
-        outputs: Union[torch.Tensor, Mapping[str, Any]] = model.training_step(batch,device=self.fabric.device)
-        loss = outputs if isinstance(outputs, torch.Tensor) else outputs["loss"]
-        forward_time += time()
+        with self.telemetry.phase("forward") as forward_timer:
+            outputs: Union[torch.Tensor, Mapping[str, Any]] = model.training_step(batch,device=self.fabric.device)
+            loss = outputs if isinstance(outputs, torch.Tensor) else outputs["loss"]
 
         self.fabric.call("on_before_backward",self,model, loss)
-        backward_time -= time()
-        self.fabric.backward(loss)
-        backward_time += time()
+        with self.telemetry.phase("backward") as backward_timer:
+            self.fabric.backward(loss * loss_weight if loss_weight != 1.0 else loss)
         self.fabric.call("on_after_backward",self,model)
 
         # avoid gradients in stored/accumulated values -> prevents potential OOM
         self._current_train_return = apply_to_collection(outputs, dtype=torch.Tensor, function=lambda x: x.detach())
 
         stats = self._current_train_return['stats']
-        stats['time/forward'] = forward_time
-        stats['time/backward'] = backward_time
+        stats['time/forward'] = forward_timer.elapsed
+        stats['time/backward'] = backward_timer.elapsed
         return self._current_train_return
 
     def step_scheduler(
@@ -621,7 +629,8 @@ class PPOTrainer:
                 "state_dict": state['state_dict'],
                 "pytorch-lightning_version": state['pytorch-lightning_version'],
             }
-        self.fabric.save(filepath, state)
+        with self.telemetry.phase("checkpoint"):
+            self.fabric.save(filepath, state)
 
     @staticmethod
     def get_latest_checkpoint(checkpoint_dir: str) -> Optional[str]:
@@ -831,15 +840,14 @@ class PPOTrainer:
             # Get next batch in prompt dataset
             batch: dict = next(prompt_iterator)
 
-            rollout_generate_time = time()
-
-            if self.ppo_config.model_arch_type == "prefixlm":
-                attention_mask = None
-            else:
-                attention_mask = batch.get('attention_mask', None)
-            # Generate samples from the language model (similar to using HuggingFace `generate` method)
-            samples = self.generate(model , batch["input_ids"], attention_mask , **kwargs)
-            stats["rollout/time/generate"] = time() - rollout_generate_time
+            with self.telemetry.phase("rollout/generate") as generate_timer:
+                if self.ppo_config.model_arch_type == "prefixlm":
+                    attention_mask = None
+                else:
+                    attention_mask = batch.get('attention_mask', None)
+                # Generate samples from the language model (similar to using HuggingFace `generate` method)
+                samples = self.generate(model , batch["input_ids"], attention_mask , **kwargs)
+            stats["rollout/time/generate"] = generate_timer.elapsed
             prompt_tensors = batch['input_ids']
             device = samples.device
 
@@ -861,12 +869,12 @@ class PPOTrainer:
                     gathered_prompts, gathered_samples, gathered_prompt_sizes, append_eos_token=True
                 )
 
-                rollout_score_time = time()
-                all_scores = self.reward_fn(
-                    samples=all_str_samples, prompts=all_str_prompts, outputs=all_str_outputs, **metadata
-                )
-                all_scores = all_scores.clone().detach().float().to(device)
-                stats["rollout/time/score"] = time() - rollout_score_time
+                with self.telemetry.phase("rollout/score") as score_timer:
+                    all_scores = self.reward_fn(
+                        samples=all_str_samples, prompts=all_str_prompts, outputs=all_str_outputs, **metadata
+                    )
+                    all_scores = all_scores.clone().detach().float().to(device)
+                stats["rollout/time/score"] = score_timer.elapsed
                 all_scores = list(all_scores.reshape(world_size, -1).unbind())
             else:
                 all_scores = None
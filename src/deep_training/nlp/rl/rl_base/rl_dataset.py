@@ -2,9 +2,12 @@
 # @Time    : 2023/5/14 23:14
 # @Author  : tk
 # @FileName: rl_dataset
+import random
 from abc import abstractmethod
-from dataclasses import is_dataclass
-from typing import Any, Callable, Dict, Iterable
+from dataclasses import is_dataclass, fields
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import torch
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset
 from transformers import BatchEncoding
 
@@ -46,6 +49,232 @@ class BaseRolloutStore(Dataset):
         """
         pass
 
+    # create_planner 使用 , 子类按字段覆盖
+    # padding_values: 字段 -> pad 值 , 未列出的字段 pad 0
+    # left_padding_fields: 左 pad 的字段
+    # length_fields: 计入 token 数的字段
+    # batch_cls: minibatch 类型 , 按 element 字段顺序位置传参 , None 时返回 dict
+    padding_values: Dict[str, Any] = {}
+    left_padding_fields: Tuple[str, ...] = ()
+    length_fields: Optional[Tuple[str, ...]] = None
+    batch_cls: Optional[type] = None
+
+    def create_planner(self,
+                       batch_size: int,
+                       mb_size: Optional[int] = None,
+                       max_tokens: Optional[int] = None,
+                       shuffle: bool = True,
+                       device: Optional[torch.device] = None,
+                       num_replicas: int = 1,
+                       rank: int = 0,
+                       seed: int = 0,
+                       loss_reduction: str = 'sum') -> "RolloutBatchPlanner":
+        '''
+            同一份 rollout 只 pad 一次 , 参数相同时返回缓存的 planner , 内容变化后调用 invalidate_planner
+        '''
+        key = (batch_size, mb_size, max_tokens, shuffle, str(device), num_replicas, rank, seed, loss_reduction)
+        planner = getattr(self, '_planner', None)
+        if planner is not None and self._planner_key == key:
+            return planner
+        planner = RolloutBatchPlanner([self[i] for i in range(len(self))],
+                                      batch_size=batch_size,
+                                      mb_size=mb_size,
+                                      max_tokens=max_tokens,
+                                      padding_values=self.padding_values,
+                                      left_padding_fields=self.left_padding_fields,
+                                      length_fields=self.length_fields,
+                                      batch_cls=self.batch_cls,
+                                      shuffle=shuffle,
+                                      device=device,
+                                      num_replicas=num_replicas,
+                                      rank=rank,
+                                      seed=seed,
+                                      loss_reduction=loss_reduction)
+        self._planner, self._planner_key = planner, key
+        return planner
+
+    def invalidate_planner(self):
+        self._planner = None
+
+
+def estimate_token_bytes(config, dtype_bytes=2) -> int:
+    """
+    粗估训练时每个 token 的激活显存 (不含权重 / 优化器状态)
+    每层约 34 * hidden_size * dtype_bytes / 2 , 参考 https://arxiv.org/abs/2205.05198 (flash / sdpa 下忽略 attention score 项)
+    logits 及其 float32 的 log_softmax 与梯度 , 约 vocab_size * (dtype_bytes + 8)
+    """
+    hidden_size = getattr(config, 'hidden_size', None) or getattr(config, 'd_model', None) or getattr(config, 'n_embd')
+    num_layers = getattr(config, 'num_hidden_layers', None) or getattr(config, 'num_layers', None) or getattr(config, 'n_layer')
+    vocab_size = getattr(config, 'vocab_size', None) or getattr(config, 'padded_vocab_size')
+    return int(num_layers * hidden_size * 17 * dtype_bytes + vocab_size * (dtype_bytes + 8))
+
+
+def resolve_minibatch_max_tokens(rl_config, model_config=None) -> Optional[int]:
+    """
+    rl_config.minibatch_max_tokens 优先 , 否则由 rl_config.minibatch_memory_budget (GB) 和模型结构估算
+    """
+    max_tokens = getattr(rl_config, 'minibatch_max_tokens', None)
+    if max_tokens:
+        return max_tokens
+    budget = getattr(rl_config, 'minibatch_memory_budget', None)
+    if not budget:
+        return None
+    if model_config is None:
+        logger.warning('minibatch_memory_budget is set but the model config is not available, ignored')
+        return None
+    return max(int(budget * 1024 ** 3) // estimate_token_bytes(model_config), 1)
+
+
+class RolloutBatchPlanner:
+    """
+    rollout 只在构建时按长度降序排好并 pad 成连续张量 , 之后不再 collate
+    构建时按长度顺序每 batch_size 行划为一个优化步 , 步内在 token 预算 max_tokens (行数 * 各 length_fields 的最大长度之和)
+    和 mb_size 内切成若干 minibatch , minibatch 是连续行区间且按本区间最大长度裁剪列后的切片视图 , 没有拷贝
+    minibatch 个数即该步的梯度累积次数 , 由 token 预算自动决定 , 步内的切分不影响该步的梯度
+    划分只做一次 , 每个 epoch 只打乱优化步的顺序 (seed + epoch) , 同一步内的样本长度相近 (与按长度分组的 sampler 相同的取舍)
+
+    迭代一次为一个 epoch , 产出每个优化步的 [(minibatch, loss_weight, share) , ...]
+    share 为该 minibatch 行数占该步的比例 , 用于汇总 loss / stats
+    loss_weight 为 backward 前 loss 的缩放 :
+        loss_reduction='sum' (默认 , 与 MiniBatchIterator 相同的梯度尺度) : 行数 / mb_size , 满 mb_size 的 minibatch 为 1
+        loss_reduction='mean' : 等于 share , 整步为全部行的均值 , 与 minibatch 个数无关
+    shuffle=False 时按长度顺序迭代
+    """
+    def __init__(self,
+                 elements: Sequence[Any],
+                 batch_size: int,
+                 mb_size: Optional[int] = None,
+                 max_tokens: Optional[int] = None,
+                 padding_values: Optional[Dict[str, Any]] = None,
+                 left_padding_fields: Iterable[str] = (),
+                 length_fields: Optional[Iterable[str]] = None,
+                 batch_cls: Optional[type] = None,
+                 shuffle: bool = True,
+                 device: Optional[torch.device] = None,
+                 num_replicas: int = 1,
+                 rank: int = 0,
+                 seed: int = 0,
+                 loss_reduction: str = 'sum'):
+        assert len(elements) > 0, ValueError('RolloutBatchPlanner got an empty rollout store')
+        assert batch_size > 0
+        if loss_reduction not in ('sum', 'mean'):
+            raise ValueError('loss_reduction must be sum or mean, got {}'.format(loss_reduction))
+        self.batch_size = batch_size
+        self.mb_size = mb_size
+        self.max_tokens = max_tokens
+        self.batch_cls = batch_cls
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.loss_reduction = loss_reduction
+        self.epoch = 0
+
+        first = elements[0]
+        if is_dataclass(first):
+            self.keys = [f.name for f in fields(first)]
+            rows = [[getattr(e, k) for k in self.keys] for e in elements]
+        else:
+            self.keys = list(first.keys())
+            rows = [[e[k] for k in self.keys] for e in elements]
+
+        length_fields = list(length_fields or self.keys)
+        lengths = [[len(v) for v in row] for row in rows]
+        self.length_ids = [self.keys.index(k) for k in length_fields]
+        order = sorted(range(len(rows)), key=lambda i: -sum(lengths[i][j] for j in self.length_ids))
+        lengths = [lengths[i] for i in order]
+
+        padding_values = padding_values or {}
+        left_padding_fields = set(left_padding_fields)
+        self.left_padding = [k in left_padding_fields for k in self.keys]
+        self.data: List[torch.Tensor] = []
+        for j, k in enumerate(self.keys):
+            seqs = [rows[i][j] for i in order]
+            padding_value = padding_values.get(k, 0)
+            if self.left_padding[j]:
+                t = pad_sequence([x.flip(0) for x in seqs], batch_first=True, padding_value=padding_value).flip(1)
+            else:
+                t = pad_sequence(seqs, batch_first=True, padding_value=padding_value)
+            if device is not None:
+                t = t.to(device)
+            self.data.append(t.contiguous())
+
+        self.steps = self._plan(lengths)
+
+    def _plan(self, lengths: List[List[int]]):
+        '''
+            每步为 [(start , end , 各字段列数) , ...] , 行号为排序后的位置
+        '''
+        steps = []
+        n = len(lengths)
+        for start in range(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            mbs = []
+            i = start
+            while i < end:
+                j = i
+                cols = [0] * len(self.keys)
+                while j < end:
+                    new_cols = [max(c, l) for c, l in zip(cols, lengths[j])]
+                    if j > i:
+                        if self.mb_size and j - i >= self.mb_size:
+                            break
+                        if self.max_tokens and (j + 1 - i) * sum(new_cols[c] for c in self.length_ids) > self.max_tokens:
+                            break
+                    cols = new_cols
+                    j += 1
+                mbs.append((i, j, cols))
+                i = j
+            steps.append(mbs)
+        return steps
+
+    def plan(self, epoch: int):
+        '''
+            本进程在第 epoch 个 epoch 的优化步顺序
+            各进程使用相同的 seed , 顺序一致 , 按 rank 取步
+        '''
+        order = list(range(len(self.steps)))
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(order)
+        if self.num_replicas > 1:
+            # 每个进程的优化步数相同 , 多余的步丢弃
+            order = order[: len(order) // self.num_replicas * self.num_replicas][self.rank::self.num_replicas]
+        return [self.steps[i] for i in order]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.steps) // self.num_replicas
+
+    @property
+    def num_minibatches(self):
+        return sum(len(mbs) for mbs in self.steps)
+
+    def view(self, start, end, cols):
+        values = []
+        for t, left, c in zip(self.data, self.left_padding, cols):
+            t = t[start: end]
+            values.append(t[:, t.size(1) - c:] if left else t[:, :c])
+        if self.batch_cls is not None:
+            return self.batch_cls(*values)
+        return dict(zip(self.keys, values))
+
+    def __iter__(self):
+        steps = self.plan(self.epoch)
+        self.epoch += 1
+        for mbs in steps:
+            total = mbs[-1][1] - mbs[0][0]
+            out = []
+            for start, end, cols in mbs:
+                share = (end - start) / total
+                if self.loss_reduction == 'mean':
+                    loss_weight = share
+                else:
+                    loss_weight = (end - start) / (self.mb_size or total)
+                out.append((self.view(start, end, cols), loss_weight, share))
+            yield out
+
 
 
 
@@ -41,6 +41,34 @@ def whiten(xs: torch.Tensor, shift_mean=True, distributed=True) -> torch.Tensor:
     return whitened
 
 
+def discounted_cumsum(xs: torch.Tensor, discount: float, chunk_size: int = 256) -> torch.Tensor:
+    """Reverse discounted cumulative sum along the last dim
+
+    ys[..., t] = sum_{k >= t} discount^(k - t) * xs[..., k]
+
+    Each chunk is a single matmul with a (chunk_size, chunk_size) discount matrix and
+    chunks are chained from the end with a carry, so discount powers never go past
+    chunk_size and the python loop runs len / chunk_size times instead of len times."""
+    length = xs.size(-1)
+    chunk_size = max(1, min(chunk_size, length))
+    idx = torch.arange(chunk_size, device=xs.device)
+    exponent = (idx[:, None] - idx[None, :]).to(xs.dtype)
+    # weights[k, t] = discount^(k - t) for k >= t
+    weights = torch.where(exponent >= 0, discount ** exponent.clamp(min=0), torch.zeros_like(exponent))
+    carry_weights = discount ** (chunk_size - idx).to(xs.dtype)
+
+    ys = torch.empty_like(xs)
+    carry = None
+    for start in reversed(range(0, length, chunk_size)):
+        n = min(chunk_size, length - start)
+        ys_chunk = torch.matmul(xs[..., start: start + n], weights[:n, :n])
+        if carry is not None:
+            ys_chunk += carry.unsqueeze(-1) * carry_weights[chunk_size - n:]
+        ys[..., start: start + n] = ys_chunk
+        carry = ys_chunk[..., 0]
+    return ys
+
+
 def logprobs_of_labels(logits, labels):
     """Log probabilities of the labels
 
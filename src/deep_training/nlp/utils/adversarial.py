@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2023/1/3 9:51
+import typing
 import torch
+from torch import nn
 
 __all__ = [
+    'EmbeddingAttackBase',
     'FGM',
     'FGSM_Local',
     'FGSM',
@@ -13,74 +16,150 @@ __all__ = [
 
 
 
-
-
-class FGM():
+def _get_input_embedding_weight(model: nn.Module):
+    for module in model.modules():
+        fn = getattr(module, 'get_input_embeddings', None)
+        if not callable(fn):
+            continue
+        try:
+            emb = fn()
+        except NotImplementedError:
+            continue
+        if not isinstance(emb, nn.Embedding):
+            continue
+        # 词表与输出层共享权重时梯度是稠密的 , 不能按行扰动
+        fn = getattr(module, 'get_output_embeddings', None)
+        output_emb = fn() if callable(fn) else None
+        if output_emb is not None and getattr(output_emb, 'weight', None) is emb.weight:
+            return None
+        return emb.weight
+    return None
+
+
+class EmbeddingAttackBase():
+    '''
+        扰动引擎基类
+        目标 embedding 参数只在第一次使用时解析一次 , 不再每步遍历 named_parameters
+        传入 input_ids 时 , 词表 embedding 只扰动 batch 中出现的行 , 备份也只保存这些行
+        其余匹配到的参数(position embedding , LayerNorm 等)体积小 , 仍然整体备份
+        fgm / fgsm 在 opt.step() 之后 restore , 两种路径对词表的结果不同 :
+            按行路径 (默认) 只把 batch 中出现的行恢复到攻击前 , 其余行的梯度为 0 , 保留本步 optimizer 的更新 (weight decay / 动量)
+            稠密路径 (adv['sparse'] = False) 每步 clone 整个词表 , 把所有行都恢复到攻击前 , 与旧版本行为一致
+    '''
     def __init__(self, model, emb_name='embedding'):
         self.model = model
-        self.backup = {}
         self.emb_name = emb_name
-
-    def attack(self, epsilon=1.):
-        # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
+        self.backup = {}
+        self._params: typing.Optional[typing.List] = None
+        self._sparse_weight = None
+        self._rows = None
+
+    @property
+    def params(self) -> typing.List:
+        if self._params is None:
+            self._params = [(name, param) for name, param in self.model.named_parameters()
+                            if param.requires_grad and self.emb_name in name]
+            self._sparse_weight = _get_input_embedding_weight(self.model)
+        return self._params
+
+    def set_rows(self, input_ids: typing.Optional[torch.Tensor]):
+        # 同一 batch 多次攻击共用同一组行
+        self._rows = torch.unique(input_ids) if input_ids is not None else None
+
+    def _is_sparse(self, param):
+        return self._rows is not None and param is self._sparse_weight
+
+    def save(self):
+        for name, param in self.params:
+            if self._is_sparse(param):
+                self.backup[name] = param.data.index_select(0, self._rows)
+            else:
                 self.backup[name] = param.data.clone()
-                norm = torch.norm(param.grad)
-                if norm != 0 and not torch.isnan(norm):
-                    r_at = epsilon * param.grad / norm
-                    param.data.add_(r_at)
 
     def restore(self):
-        # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
-                assert name in self.backup
-                param.data = self.backup[name]
+        for name, param in self.params:
+            assert name in self.backup
+            if self._is_sparse(param):
+                param.data.index_copy_(0, self._rows, self.backup[name])
+            else:
+                param.data.copy_(self.backup[name])
         self.backup = {}
+        self._rows = None
 
-class PGD():
-    def __init__(self, model, emb_name='embedding'):
-        self.emb_name = emb_name
-        self.model = model
-        self.emb_backup = {}
-        self.grad_backup = {}
+    def grad_of(self, param):
+        if self._is_sparse(param):
+            # embedding 的梯度只在 batch 出现的行上非零 , 行范数即全量范数
+            return param.grad.index_select(0, self._rows)
+        return param.grad
 
-    def attack(self, epsilon=1., alpha=0.3, is_first_attack=False):
+    def add_(self, param, delta):
+        if self._is_sparse(param):
+            param.data.index_add_(0, self._rows, delta.to(param.dtype))
+        else:
+            param.data.add_(delta)
+
+    def delta_of(self, name, param):
+        if self._is_sparse(param):
+            return param.data.index_select(0, self._rows) - self.backup[name]
+        return param.data - self.backup[name]
+
+
+
+class FGM(EmbeddingAttackBase):
+    def attack(self, epsilon=1., input_ids=None):
         # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
-                if is_first_attack:
-                    self.emb_backup[name] = param.data.clone()
-                norm = torch.norm(param.grad)
-                if norm != 0 and not torch.isnan(norm):
-                    r_at = alpha * param.grad / norm
-                    param.data.add_(r_at)
-                    param.data = self.project(name, param.data, epsilon)
+        self.set_rows(input_ids)
+        self.save()
+        for name, param in self.params:
+            if param.grad is None:
+                continue
+            grad = self.grad_of(param)
+            norm = torch.norm(grad)
+            if norm != 0 and not torch.isnan(norm):
+                self.add_(param, epsilon * grad / norm)
 
-    def restore(self):
+
+class PGD(EmbeddingAttackBase):
+    def __init__(self, model, emb_name='embedding'):
+        super(PGD, self).__init__(model, emb_name=emb_name)
+        self._grad_params: typing.Optional[typing.List] = None
+        self.grad_backup = []
+
+    @property
+    def emb_backup(self):
+        return self.backup
+
+    def attack(self, epsilon=1., alpha=0.3, is_first_attack=False, input_ids=None):
         # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
-                assert name in self.emb_backup
-                param.data = self.emb_backup[name]
-        self.emb_backup = {}
-
-    def project(self, param_name, param_data, epsilon):
-        r = param_data - self.emb_backup[param_name]
-        if torch.norm(r) > epsilon:
-            r = epsilon * r / torch.norm(r)
-        return param_data + r
+        if is_first_attack:
+            self.set_rows(input_ids)
+            self.save()
+        for name, param in self.params:
+            if param.grad is None:
+                continue
+            grad = self.grad_of(param)
+            norm = torch.norm(grad)
+            if norm != 0 and not torch.isnan(norm):
+                self.add_(param, alpha * grad / norm)
+                self.project(name, param, epsilon)
+
+    def project(self, param_name, param, epsilon):
+        # 将累计扰动投影回半径为 epsilon 的球内
+        r = self.delta_of(param_name, param)
+        norm = torch.norm(r)
+        if norm > epsilon:
+            self.add_(param, (epsilon / norm - 1) * r)
 
     def backup_grad(self):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad:
-                self.grad_backup[name] = param.grad
+        # 只保存梯度引用 , zero_grad(set_to_none=True) 后原张量不会被改写
+        if self._grad_params is None:
+            self._grad_params = [param for param in self.model.parameters() if param.requires_grad]
+        self.grad_backup = [param.grad for param in self._grad_params]
 
     def restore_grad(self):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad:
-                param.grad = self.grad_backup[name]
+        for param, grad in zip(self._grad_params, self.grad_backup):
+            param.grad = grad
+        self.grad_backup = []
 
 class FGSM_Local(): #局部Embedding
     def __init__(self, model):
@@ -95,52 +174,38 @@ class FGSM_Local(): #局部Embedding
             grad = delta.grad.detach()
             norm = torch.norm(grad)
             if norm != 0 and not torch.isnan(norm):
-                delta.data = torch.clamp(delta + alpha * grad / norm, torch.tensor((-epsilon)).cuda(), torch.tensor((epsilon)).cuda())
+                delta.data = torch.clamp(delta + alpha * grad / norm, -epsilon, epsilon)
                 delta = delta.detach()
         return delta 
     
-class FGSM(): #全局Embedding
-    def __init__(self, model, emb_name='embedding'):
-        self.emb_name = emb_name
-        self.model = model
-        self.backup = {}
-
-    def attack(self, epsilon=1., alpha = 0.3, is_first_attack=False):
+class FGSM(EmbeddingAttackBase): #全局Embedding
+    def attack(self, epsilon=1., alpha = 0.3, is_first_attack=False, input_ids=None):
         # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
-                if is_first_attack:
-                    self.backup[name] = param.data.clone()
-                    delta = torch.zeros_like(param.data).cuda()
-                    delta.uniform_(-epsilon, epsilon)
-                    param.data.add_(delta)
-                else:
-                    norm = torch.norm(param.grad)
-                    if norm != 0 and not torch.isnan(norm):
-                        delta = torch.clamp(alpha * param.grad / norm, torch.tensor(-epsilon).cuda(), torch.tensor(epsilon).cuda())
-                        param.data.add_(delta)
-
-    def restore(self):
-        # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
-                assert name in self.backup
-                param.data = self.backup[name]
-        self.backup = {}
-
-class FreeAT(): #全局Embedding
-    def __init__(self, model, emb_name='embedding'):
-        self.emb_name = emb_name
-        self.model = model
+        if is_first_attack:
+            self.set_rows(input_ids)
+            self.save()
+        for name, param in self.params:
+            if is_first_attack:
+                delta = torch.empty_like(self.backup[name]).uniform_(-epsilon, epsilon)
+                self.add_(param, delta)
+            elif param.grad is not None:
+                grad = self.grad_of(param)
+                norm = torch.norm(grad)
+                if norm != 0 and not torch.isnan(norm):
+                    self.add_(param, torch.clamp(alpha * grad / norm, -epsilon, epsilon))
 
-    def attack(self, epsilon=1.):
+class FreeAT(EmbeddingAttackBase): #全局Embedding
+    def attack(self, epsilon=1., input_ids=None):
         # emb_name这个参数要换成你模型中embedding的参数名
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and self.emb_name in name:
-                norm = torch.norm(param.grad)
-                if norm != 0 and not torch.isnan(norm):
-                    r_at = torch.clamp(epsilon * param.grad / norm, torch.tensor((-epsilon)).cuda(), torch.tensor((epsilon)).cuda())
-                    param.data.add_(r_at)
+        self.set_rows(input_ids)
+        for name, param in self.params:
+            if param.grad is None:
+                continue
+            grad = self.grad_of(param)
+            norm = torch.norm(grad)
+            if norm != 0 and not torch.isnan(norm):
+                self.add_(param, torch.clamp(epsilon * grad / norm, -epsilon, epsilon))
+        self._rows = None
 
 class FreeAT_Local(): #局部Embedding
     def __init__(self, model):
@@ -150,7 +215,7 @@ class FreeAT_Local(): #局部Embedding
         grad = delta.grad.detach()
         norm = torch.norm(grad)
         if norm != 0 and not torch.isnan(norm):
-            delta.data = torch.clamp(delta + epsilon * grad / norm, torch.tensor((-epsilon)).cuda(), torch.tensor((epsilon)).cuda())
+            delta.data = torch.clamp(delta + epsilon * grad / norm, -epsilon, epsilon)
         return delta
 
 
@@ -162,4 +227,4 @@ AdversarialMethods = {
     "fgsm_local": FGSM_Local,  # 扰动计算方式不一样
     "free": FreeAT,
     "free_local": FreeAT_Local,
-}
\ No newline at end of file
+}
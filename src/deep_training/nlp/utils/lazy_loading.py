@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/5 10:20
+# @FileName: lazy_loading.py
+"""
+    meta device 构造 + 多线程按 shard 加载
+    模型在 init_empty_weights 下构造 , 参数不分配内存也不做随机初始化
+    safetensors shard 以 mmap 方式打开 , 每个 shard 一个线程 , 读出的张量直接转换到目标 dtype / device 后替换 meta 参数
+    device_map / dtype_map 按模块名前缀指定 (最长前缀优先 , '' 为默认) , 例如 {'lm_head': torch.float32}
+    checkpoint 中缺失的参数在目标 device 上以 0 分配后调用 _init_weights 初始化 , 同一模块中已加载的参数不受影响
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Union, Iterator, Tuple
+
+import torch
+from torch import nn
+from transformers.utils import logging
+
+from .torch_utils import init_empty_weights
+
+__all__ = [
+    'resolve_checkpoint_files',
+    'lazy_load_pretrained',
+]
+
+logger = logging.get_logger(__name__)
+
+_CHECKPOINT_NAMES = (
+    ('model.safetensors.index.json', 'model.safetensors'),
+    ('pytorch_model.bin.index.json', 'pytorch_model.bin'),
+)
+
+
+def resolve_checkpoint_files(path) -> Optional[List[str]]:
+    '''
+        本地目录中的权重文件 , 优先 safetensors , 找不到时返回 None
+    '''
+    if not path or not os.path.isdir(path):
+        return None
+    for index_name, weights_name in _CHECKPOINT_NAMES:
+        index_file = os.path.join(path, index_name)
+        if os.path.isfile(index_file):
+            with open(index_file, mode='r', encoding='utf-8') as f:
+                weight_map = json.load(f)['weight_map']
+            return [os.path.join(path, name) for name in sorted(set(weight_map.values()))]
+        weights_file = os.path.join(path, weights_name)
+        if os.path.isfile(weights_file):
+            return [weights_file]
+    return None
+
+
+def _iter_shard(file) -> Iterator[Tuple[str, torch.Tensor]]:
+    if file.endswith('.safetensors'):
+        from safetensors import safe_open
+        with safe_open(file, framework='pt', device='cpu') as f:
+            for name in f.keys():
+                yield name, f.get_tensor(name)
+        return
+    try:
+        state_dict = torch.load(file, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError):
+        # 旧版本 torch 不支持 mmap , 或为不能 mmap 的旧格式 checkpoint , 只去掉 mmap
+        state_dict = torch.load(file, map_location='cpu', weights_only=True)
+    for name in list(state_dict.keys()):
+        yield name, state_dict.pop(name)
+
+
+def _match(mapping: Optional[Dict], name: str, default=None):
+    '''
+        按模块名最长前缀匹配 , '' 匹配全部
+    '''
+    if not mapping:
+        return default
+    best, best_len = default, -1
+    for prefix, value in mapping.items():
+        if prefix == '' or name == prefix or name.startswith(prefix + '.'):
+            if len(prefix) > best_len:
+                best, best_len = value, len(prefix)
+    return best
+
+
+class _Loader:
+    def __init__(self, model: nn.Module, device_map: Optional[Dict] = None, dtype_map: Optional[Dict] = None,
+                 torch_dtype: Union[torch.dtype, str, None] = None):
+        self.model = model
+        self.device_map = device_map
+        self.dtype_map = dtype_map
+        self.torch_dtype = torch_dtype
+        self.keep_in_fp32 = list(getattr(model, '_keep_in_fp32_modules', None) or [])
+        self.prefix = getattr(model, 'base_model_prefix', '') or ''
+        self.targets = {}
+        for name, _ in model.named_parameters(remove_duplicate=False):
+            self.targets[name] = True
+        for name, _ in model.named_buffers(remove_duplicate=False):
+            self.targets[name] = False
+        self.loaded = set()
+        self.unexpected = []
+        self.mismatched = []
+        self._lock = threading.Lock()
+
+    def device_of(self, name: str) -> torch.device:
+        return torch.device(_match(self.device_map, name, 'cpu'))
+
+    def dtype_of(self, name: str, tensor: torch.Tensor, current: Optional[torch.Tensor]) -> Optional[torch.dtype]:
+        if not tensor.is_floating_point():
+            return None
+        dtype = _match(self.dtype_map, name)
+        if dtype is not None:
+            return dtype
+        if any('.{}.'.format(m) in '.{}.'.format(name) for m in self.keep_in_fp32):
+            return torch.float32
+        if isinstance(self.torch_dtype, torch.dtype):
+            return self.torch_dtype
+        if self.torch_dtype == 'auto' or current is None or not current.is_floating_point():
+            return tensor.dtype
+        return current.dtype
+
+    def resolve(self, name: str) -> Optional[str]:
+        # 兼容 checkpoint 带 / 不带 base_model_prefix
+        if name in self.targets:
+            return name
+        prefix = self.prefix
+        if prefix:
+            if prefix + '.' + name in self.targets:
+                return prefix + '.' + name
+            if name.startswith(prefix + '.') and name[len(prefix) + 1:] in self.targets:
+                return name[len(prefix) + 1:]
+        return None
+
+    def set_tensor(self, name: str, tensor: torch.Tensor):
+        module_name, _, attr = name.rpartition('.')
+        module = self.model.get_submodule(module_name)
+        is_param = self.targets[name]
+        current = module._parameters.get(attr) if is_param else module._buffers.get(attr)
+        if current is not None and current.shape != tensor.shape:
+            with self._lock:
+                self.mismatched.append((name, tuple(tensor.shape), tuple(current.shape)))
+            return
+        value = tensor.to(device=self.device_of(name), dtype=self.dtype_of(name, tensor, current))
+        if is_param:
+            requires_grad = current.requires_grad if current is not None else value.is_floating_point()
+            module._parameters[attr] = nn.Parameter(value, requires_grad=requires_grad)
+        else:
+            module._buffers[attr] = value
+        with self._lock:
+            self.loaded.add(name)
+
+    def load_shard(self, file):
+        for name, tensor in _iter_shard(file):
+            target = self.resolve(name)
+            if target is None:
+                with self._lock:
+                    self.unexpected.append(name)
+                continue
+            self.set_tensor(target, tensor)
+
+    def finalize(self) -> List[str]:
+        '''
+            checkpoint 中没有 (或形状不一致) 的参数仍在 meta 上 , 在目标 device 上以 0 分配并初始化 ,
+            未加载的 buffer 移到目标 device
+            _init_weights / reset_parameters 以模块为单位 , 调用期间把模块中其他张量换成临时张量 , 只初始化缺失的部分 ;
+            _init_weights 为空操作的模型 (chatglm2 / chatglm3 / glm4 等) 缺失的参数保持为 0
+            返回缺失的参数名
+        '''
+        model = self.model
+        missing = []
+        init_fn = getattr(model, '_init_weights', None)
+        for module_name, module in model.named_modules():
+            need_init = False
+            allocated = set()
+            for attr, param in list(module._parameters.items()):
+                if param is None or param.device.type != 'meta':
+                    continue
+                name = module_name + '.' + attr if module_name else attr
+                dtype = _match(self.dtype_map, name) or \
+                        (self.torch_dtype if isinstance(self.torch_dtype, torch.dtype) else param.dtype)
+                module._parameters[attr] = nn.Parameter(
+                    torch.zeros(param.shape, dtype=dtype, device=self.device_of(name)),
+                    requires_grad=param.requires_grad)
+                missing.append(name)
+                allocated.add(attr)
+                need_init = True
+            for attr, buf in list(module._buffers.items()):
+                if buf is None:
+                    continue
+                name = module_name + '.' + attr if module_name else attr
+                if name in self.loaded:
+                    continue
+                device = self.device_of(name)
+                if buf.device.type == 'meta':
+                    module._buffers[attr] = torch.zeros(buf.shape, dtype=buf.dtype, device=device)
+                    missing.append(name)
+                    allocated.add(attr)
+                    need_init = True
+                elif buf.device != device:
+                    module._buffers[attr] = buf.to(device)
+            if need_init:
+                self._init_missing(module, allocated, init_fn)
+        return missing
+
+    @staticmethod
+    @torch.no_grad()
+    def _init_missing(module: nn.Module, allocated: set, init_fn):
+        if init_fn is None and not hasattr(module, 'reset_parameters'):
+            return
+        # 已有的张量 (已加载 / 共享 / 构造时创建的 buffer) 临时换成 empty_like , 初始化后放回
+        kept = {}
+        for tensors in (module._parameters, module._buffers):
+            for attr, t in list(tensors.items()):
+                if t is None or attr in allocated:
+                    continue
+                kept[attr] = (tensors, t)
+                scratch = torch.empty_like(t)
+                tensors[attr] = nn.Parameter(scratch, requires_grad=t.requires_grad) \
+                    if isinstance(t, nn.Parameter) else scratch
+        try:
+            if init_fn is not None:
+                init_fn(module)
+            else:
+                module.reset_parameters()
+        finally:
+            for attr, (tensors, t) in kept.items():
+                tensors[attr] = t
+
+
+def lazy_load_pretrained(CLS, pretrained_model_name_or_path: str, *model_args, config=None,
+                         checkpoint_files: Optional[List[str]] = None,
+                         torch_dtype: Union[torch.dtype, str, None] = None,
+                         device_map: Union[Dict, str, torch.device, None] = None,
+                         dtype_map: Optional[Dict] = None,
+                         num_workers: Optional[int] = None, **kwargs):
+    '''
+        CLS: PreTrainedModel 子类 , config 为已构造好的配置
+        torch_dtype: 浮点参数的默认 dtype , 'auto' 使用 checkpoint 中的 dtype , None 使用构造时的 dtype
+        device_map: 单个 device 或 {模块名前缀: device} , 跨多个 device 时需要 accelerate (dispatch_model)
+        dtype_map: {模块名前缀: dtype} , 优先于 torch_dtype 和 _keep_in_fp32_modules
+        num_workers: 加载线程数 , 默认 min(shard 数 , 8)
+        kwargs 传给模型构造函数
+    '''
+    if checkpoint_files is None:
+        checkpoint_files = resolve_checkpoint_files(pretrained_model_name_or_path)
+    if not checkpoint_files:
+        raise ValueError('no checkpoint found in {}'.format(pretrained_model_name_or_path))
+    if device_map is not None and not isinstance(device_map, dict):
+        device_map = {'': device_map}
+
+    start = time.time()
+    init_kwargs = dict(kwargs)
+    with init_empty_weights():
+        if hasattr(CLS, '_from_config') and not model_args:
+            # _from_config 处理 torch_dtype (构造时的默认 dtype) 与 attn_implementation
+            if isinstance(torch_dtype, torch.dtype):
+                init_kwargs['torch_dtype'] = torch_dtype
+            model = CLS._from_config(config, **init_kwargs)
+        else:
+            model = CLS(config, *model_args, **init_kwargs)
+
+    loader = _Loader(model, device_map=device_map, dtype_map=dtype_map, torch_dtype=torch_dtype)
+    num_workers = num_workers or min(len(checkpoint_files), 8)
+    if num_workers <= 1 or len(checkpoint_files) == 1:
+        for file in checkpoint_files:
+            loader.load_shard(file)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # 逐个取 result , 子线程中的异常在这里抛出
+            for _ in executor.map(loader.load_shard, checkpoint_files):
+                pass
+
+    if hasattr(model, 'tie_weights'):
+        model.tie_weights()
+    missing = loader.finalize()
+    if missing:
+        logger.warning('Some weights of {} were not initialized from the checkpoint {} and are newly initialized: {}'
+                       .format(CLS.__name__, pretrained_model_name_or_path, missing))
+    if loader.unexpected:
+        logger.warning('Some weights of the checkpoint {} were not used when initializing {}: {}'
+                       .format(pretrained_model_name_or_path, CLS.__name__, loader.unexpected))
+    if loader.mismatched:
+        logger.warning('Some weights of {} have mismatched shapes (checkpoint , model) and are newly initialized: {}'
+                       .format(CLS.__name__, loader.mismatched))
+
+    if device_map is not None and len({str(torch.device(d)) for d in device_map.values()}) > 1:
+        try:
+            from accelerate import dispatch_model
+        except ImportError:
+            logger.warning('accelerate is not installed , modules are placed on multiple devices without dispatch hooks')
+        else:
+            model = dispatch_model(model, device_map=device_map)
+
+    if getattr(model, 'can_generate', None) is not None and model.can_generate():
+        try:
+            from transformers import GenerationConfig
+            model.generation_config = GenerationConfig.from_pretrained(pretrained_model_name_or_path)
+        except (OSError, TypeError, ValueError):
+            pass
+    model.eval()
+    logger.info('loaded {} from {} shard(s) in {:.1f}s'.format(CLS.__name__, len(checkpoint_files), time.time() - start))
+    return model
@@ -3,7 +3,6 @@
 import numpy as np
 import scipy
 from scipy.stats import stats
-from sklearn.metrics.pairwise import paired_distances
 
 
 def transform_and_normalize(vecs, kernel=None, bias=None):
@@ -21,7 +20,21 @@ def compute_corrcoef(x, y):
     return scipy.stats.spearmanr(x, y).correlation
 
 
-def evaluate_spearman(a_vecs,b_vecs,labels):
-    sims = 1 - paired_distances(a_vecs,b_vecs,metric='cosine')
-    correlation,_  = stats.spearmanr(labels,sims)
+def paired_cosine_similarity(a_vecs, b_vecs, block_size=65536):
+    """逐行 cosine , 按块计算 , a_vecs / b_vecs 可以是 np.memmap 或 EmbeddingStore
+    """
+    n = len(a_vecs)
+    assert n == len(b_vecs)
+    sims = np.empty(n, dtype=np.float32)
+    for start in range(0, n, block_size):
+        a = np.asarray(a_vecs[start: start + block_size], dtype=np.float32)
+        b = np.asarray(b_vecs[start: start + block_size], dtype=np.float32)
+        norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+        sims[start: start + len(a)] = np.einsum('ij,ij->i', a, b) / np.clip(norms, 1e-8, np.inf)
+    return sims
+
+
+def evaluate_spearman(a_vecs,b_vecs,labels,block_size=65536):
+    sims = paired_cosine_similarity(a_vecs,b_vecs,block_size=block_size)
+    correlation,_  = stats.spearmanr(np.asarray(labels),sims)
     return correlation
@@ -2,8 +2,65 @@
 # @Author  : ssbuild
 # @Time    : 2023/8/2 15:57
 import inspect
+import threading
+from contextlib import contextmanager
+
 import torch
 
+__all__ = [
+    'skip_init',
+    'init_empty_weights',
+    'is_empty_init',
+]
+
+# register_parameter 的补丁是进程级的 (patch 在 nn.Module 类上) , 用引用计数在第一个进入时安装 , 最后一个退出时恢复
+# 嵌套深度按线程记录 , 只有处于 init_empty_weights 内的线程新建的参数放到 meta 上 , 其他线程并发构造模块不受影响
+_empty_init_lock = threading.Lock()
+_empty_init_local = threading.local()
+_empty_init_users = 0
+_old_register_parameter = None
+
+
+def is_empty_init() -> bool:
+    return getattr(_empty_init_local, 'depth', 0) > 0
+
+
+def _register_empty_parameter(module, name, param):
+    _old_register_parameter(module, name, param)
+    if is_empty_init() and param is not None and param.device.type != 'meta':
+        param = module._parameters[name]
+        kwargs = dict(param.__dict__)
+        kwargs['requires_grad'] = param.requires_grad
+        module._parameters[name] = type(param)(param.to('meta'), **kwargs)
+
+
+@contextmanager
+def init_empty_weights():
+    '''
+        上下文内新建的 parameter 全部放到 meta device , 不分配内存 , 随后的初始化 (reset_parameters / _init_weights) 也是空操作
+        buffer 保持原样创建 (rotary inv_freq 等不在 checkpoint 中的 buffer 仍然有效)
+        skip_init 在上下文内不再 to_empty , 参数留在 meta 上 , 由加载时直接替换
+        注意 : 上下文期间 nn.Module.register_parameter 在整个进程内被替换 , 只对当前线程生效 ;
+        其他同样替换 register_parameter 的代码 (如 accelerate.init_empty_weights) 不要与之在不同线程中交错使用
+    '''
+    global _empty_init_users, _old_register_parameter
+    with _empty_init_lock:
+        if _empty_init_users == 0:
+            _old_register_parameter = torch.nn.Module.register_parameter
+            torch.nn.Module.register_parameter = _register_empty_parameter
+        _empty_init_users += 1
+    _empty_init_local.depth = getattr(_empty_init_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _empty_init_local.depth -= 1
+        with _empty_init_lock:
+            _empty_init_users -= 1
+            if _empty_init_users == 0:
+                torch.nn.Module.register_parameter = _old_register_parameter
+                _old_register_parameter = None
+
+
 
 def skip_init(module_cls, *args, **kwargs):
     r"""
@@ -52,6 +109,9 @@ def skip_init(module_cls, *args, **kwargs):
 
     final_device = kwargs.pop('device', 'cpu')
     kwargs['device'] = 'meta'
-    return module_cls(*args, **kwargs).to_empty(device=final_device)
+    module = module_cls(*args, **kwargs)
+    if is_empty_init():
+        return module
+    return module.to_empty(device=final_device)
 
 
@@ -2,91 +2,166 @@
 # @Time:  23:07
 # @Author: tk
 # @File：export_transformers
-import gc
+"""
+    导出训练权重为 transformers 格式
+    逐个 tensor 读取源权重 (safetensors 内存映射 , bin 使用 mmap) , 按改名规则处理 key 后累积到当前分片 ,
+    超过 max_shard_size 时立即写出 , 内存中最多一个分片
+    python -m deep_training.tools.export_transformers --src ./best_ckpt/last.ckpt --dst ./export --mode safetensors
+"""
+import argparse
 import json
 import os
+import re
 from collections import OrderedDict
-import torch
-import safetensors.torch as st
-from safetensors import safe_open
-import argparse
-
-from transformers.modeling_utils import shard_checkpoint
-from transformers.utils import WEIGHTS_INDEX_NAME
-
-parser = argparse.ArgumentParser(description='convert to huggingface.')
-parser.add_argument('--src',  type=str,help='src model file or path')
-parser.add_argument('--dst',  type=str,help='dst model path')
-parser.add_argument('--mode',  choices=['hf', 'safetensors'], default="hf", help='dst model file')
-parser.add_argument('--max_shard_size',default="10GB", help='max size per block')
+from typing import List, Tuple, Optional, Dict, Iterator
 
-args = parser.parse_args()
+import torch
+from safetensors.torch import save_file as safe_save_file
+from transformers.utils import SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_NAME, WEIGHTS_INDEX_NAME
+from transformers.utils import logging
+from transformers.utils.hub import convert_file_size_to_int
 
+from .merge_lora import _BaseShards, _detach_storage
 
-model_file: str = args.src
-dest_path: str = args.dst
-mode: str = args.mode
-max_shard_size = args.max_shard_size
+__all__ = [
+    'DEFAULT_RENAME_RULES',
+    'convert2hf',
+    'export',
+]
 
-if mode == "hf":
-    file_save_fn = torch.save
-else:
-    file_save_fn = st.save_file
+logger = logging.get_logger(__name__)
 
-def convert2hf(weight):
-    w = OrderedDict()
-    for k,v in weight.items():
-        if k.startswith('base_model.model'):
-            w['.'.join(k.split('.')[3:])] = v
-        else:
-            w[k] = v
-    return w
+# (正则 , 替换) , 按顺序应用
+DEFAULT_RENAME_RULES: List[Tuple[str, str]] = [
+    (r'^base_model\.model\.[^.]+\.', ''),
+    (r'_TransformerLightningModule__backbone\.', 'transformer_base.'),
+]
 
-def export():
-    if model_file.endswith('.safetensors'):
-        tensors = {}
-        with safe_open(model_file, framework="pt", device='cpu') as f:
-            for k in f.keys():
-                tensors[k] = f.get_tensor(k)
-    else:
-        tensors = torch.load(model_file)
 
-    state_dict = convert2hf(tensors)
+def _compile_rules(rules):
+    return [(re.compile(pattern), repl) for pattern, repl in rules]
 
-    shards, index = shard_checkpoint(state_dict, max_shard_size=max_shard_size)
-    for shard_file, shard in shards.items():
-        file_save_fn(shard, os.path.join(dest_path, shard_file))
 
-    if index is not None:
-        save_index_file = os.path.join(dest_path, WEIGHTS_INDEX_NAME)
-        # Save the index as well
-        with open(save_index_file, "w", encoding="utf-8") as f:
-            content = json.dumps(index, indent=2, sort_keys=True) + "\n"
-            f.write(content)
+def rename_key(k: str, rules) -> str:
+    for pattern, repl in rules:
+        k = pattern.sub(repl, k)
+    return k
 
-        # 5. Clean up shards (for some reason the file PyTorch saves take the same space as the whole state_dict
-        print(
-            "Cleaning up shards. This may error with an OOM error, it this is the case don't worry you still have converted the model."
-        )
-        shard_files = list(shards.keys())
 
-        del state_dict
-        del shards
-        gc.collect()
+def convert2hf(weight, rename_rules=None):
+    rules = _compile_rules(DEFAULT_RENAME_RULES if rename_rules is None else rename_rules)
+    w = OrderedDict()
+    for k,v in weight.items():
+        w[rename_key(k, rules)] = v
+    return w
 
-        for shard_file in shard_files:
-            state_dict = torch.load(os.path.join(dest_path, shard_file))
-            file_save_fn({k: v.cpu().clone() for k, v in state_dict.items()}, os.path.join(dest_path, shard_file))
-    del state_dict
-    gc.collect()
 
+class _ShardWriter:
+    '''
+        按字节预算打包 , 分片先以临时名写出 , 结束时分片总数确定后再改名
+    '''
+    def __init__(self, dest_path, max_shard_size, safe_serialization):
+        self.dest_path = dest_path
+        self.max_size = convert_file_size_to_int(max_shard_size)
+        self.safe_serialization = safe_serialization
+        self.weights_name = SAFE_WEIGHTS_NAME if safe_serialization else WEIGHTS_NAME
+        self.buffer = OrderedDict()
+        self.buffer_size = 0
+        self.seen = set()
+        self.shard_keys: List[List[str]] = []
+        self.total_size = 0
+
+    def _tmp_name(self, i):
+        return os.path.join(self.dest_path, f".{self.weights_name}.tmp{i}")
+
+    def add(self, k, v: torch.Tensor):
+        size = v.numel() * v.element_size()
+        if self.buffer and self.buffer_size + size > self.max_size:
+            self.flush()
+        self.buffer[k] = _detach_storage(v, self.seen)
+        self.buffer_size += size
+        self.total_size += size
+
+    def flush(self):
+        if not self.buffer:
+            return
+        filename = self._tmp_name(len(self.shard_keys))
+        if self.safe_serialization:
+            safe_save_file(self.buffer, filename, metadata={"format": "pt"})
+        else:
+            torch.save(self.buffer, filename)
+        self.shard_keys.append(list(self.buffer.keys()))
+        self.buffer = OrderedDict()
+        self.buffer_size = 0
+        self.seen = set()
+
+    def close(self) -> Dict[str, str]:
+        self.flush()
+        num_shards = len(self.shard_keys)
+        weight_map = {}
+        for i, keys in enumerate(self.shard_keys):
+            if num_shards == 1:
+                name = self.weights_name
+            else:
+                suffix = ".safetensors" if self.safe_serialization else ".bin"
+                name = self.weights_name.replace(suffix, f"-{i + 1:05d}-of-{num_shards:05d}{suffix}")
+            os.replace(self._tmp_name(i), os.path.join(self.dest_path, name))
+            for k in keys:
+                weight_map[k] = name
+
+        if num_shards > 1:
+            index_name = SAFE_WEIGHTS_INDEX_NAME if self.safe_serialization else WEIGHTS_INDEX_NAME
+            with open(os.path.join(self.dest_path, index_name), "w", encoding="utf-8") as f:
+                content = json.dumps({"metadata": {"total_size": self.total_size}, "weight_map": weight_map},
+                                     indent=2, sort_keys=True) + "\n"
+                f.write(content)
+        return weight_map
+
+
+def export(model_file: str, dest_path: str, mode="hf", max_shard_size="10GB",
+           rename_rules: Optional[List[Tuple[str, str]]] = None, unsafe_pickle=False) -> Dict[str, str]:
+    '''
+        model_file: 权重文件或目录 (单文件 / index 分片 , safetensors 或 bin , 支持 lightning ckpt 的 state_dict)
+        mode: hf 输出 pytorch_model*.bin , safetensors 输出 model*.safetensors
+        unsafe_pickle: bin / ckpt 不以 weights_only 加载 , 只用于可信的旧格式文件
+        返回 weight_map
+    '''
+    rules = _compile_rules(DEFAULT_RENAME_RULES if rename_rules is None else rename_rules)
+    os.makedirs(dest_path, exist_ok=True)
+    writer = _ShardWriter(dest_path, max_shard_size, safe_serialization=mode == "safetensors")
+    source: Iterator = _BaseShards(model_file, unsafe_pickle=unsafe_pickle).iter_tensors()
+    for k, v in source:
+        if not isinstance(v, torch.Tensor):
+            continue
+        writer.add(rename_key(k, rules), v)
+    return writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='convert to huggingface.')
+    parser.add_argument('--src',  type=str,help='src model file or path')
+    parser.add_argument('--dst',  type=str,help='dst model path')
+    parser.add_argument('--mode',  choices=['hf', 'safetensors'], default="hf", help='dst model file')
+    parser.add_argument('--max_shard_size',default="10GB", help='max size per block')
+    parser.add_argument('--rename', action='append', default=None,
+                        help='extra key rename rule "regex=replacement" , applied after the default rules')
+    parser.add_argument('--unsafe-pickle', dest='unsafe_pickle', action='store_true',
+                        help='load trusted legacy .bin / .ckpt files without weights_only')
+    args = parser.parse_args()
+
+    rules = list(DEFAULT_RENAME_RULES)
+    for rule in args.rename or []:
+        pattern, _, repl = rule.partition('=')
+        rules.append((pattern, repl))
+    logging.set_verbosity_info()
+    weight_map = export(args.src, args.dst, mode=args.mode, max_shard_size=args.max_shard_size, rename_rules=rules,
+                        unsafe_pickle=args.unsafe_pickle)
+    logger.info(f"exported {len(weight_map)} tensors to {args.dst}")
 
 
 def __main__():
-    export()
-
-
-
-
+    main()
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/28 10:21
+# @FileName: merge_lora.py
+"""
+    离线合并 adapter 到基础模型 , 只需要 cpu
+    逐个读取基础模型的分片 (safetensors 内存映射 , bin 使用 mmap) , 逐个 tensor 加上 delta 后写出新的 safetensors 分片
+    任意时刻内存中最多一个输出分片 , 不需要加载完整模型
+    支持 lora / adalora / loha / lokr / ia3 , 以及 bias 和 modules_to_save 的权重替换
+    deep_merge_lora --base_model ./llama --adapter ./lora_weight --output ./merged --max_shard_size 5GB
+"""
+import argparse
+import json
+import os
+import pickle
+import re
+import shutil
+from collections import OrderedDict
+from typing import Dict, Optional, List
+
+import torch
+import torch.nn.functional as F
+from safetensors import safe_open
+from safetensors.torch import save_file as safe_save_file
+from transformers.utils import SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_NAME, WEIGHTS_INDEX_NAME
+from transformers.utils import logging
+from transformers.utils.hub import convert_file_size_to_int
+
+__all__ = [
+    'merge_adapter_offline',
+]
+
+logger = logging.get_logger(__name__)
+
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+ADAPTER_WEIGHTS_NAMES = ("adapter_model.safetensors", "adapter_model.bin")
+
+_DTYPE_BYTES = {
+    'F64': 8, 'F32': 4, 'F16': 2, 'BF16': 2, 'I64': 8, 'I32': 4, 'I16': 2, 'I8': 1, 'U8': 1, 'BOOL': 1,
+    'F8_E4M3': 1, 'F8_E5M2': 1,
+}
+
+# adapter 权重名 -> (模块内的参数名)
+_ADAPTER_PARAM_NAMES = {
+    "lora": ("lora_A", "lora_B", "lora_E", "ranknum", "lora_embedding_A", "lora_embedding_B"),
+    "adalora": ("lora_A", "lora_B", "lora_E", "ranknum"),
+    "loha": ("hada_w1_a", "hada_w1_b", "hada_w2_a", "hada_w2_b", "hada_t1", "hada_t2"),
+    "lokr": ("lokr_w1", "lokr_w1_a", "lokr_w1_b", "lokr_w2", "lokr_w2_a", "lokr_w2_b", "lokr_t2"),
+    "ia3": ("ia3_l",),
+}
+
+
+def _detach_storage(v: torch.Tensor, seen: set) -> torch.Tensor:
+    '''
+        视图或与同分片其他 tensor 共享存储时复制 , torch.save 不会写出整块存储 , safetensors 也不支持共享
+    '''
+    v = v.contiguous()
+    storage = v.untyped_storage()
+    ptr = storage.data_ptr()
+    if ptr in seen or storage.nbytes() != v.numel() * v.element_size():
+        v = v.clone()
+        ptr = v.untyped_storage().data_ptr()
+    seen.add(ptr)
+    return v
+
+
+class _BaseShards:
+    '''
+        基础模型的分片 , safetensors 或 bin , 支持单文件和 index
+    '''
+    def __init__(self, path, unsafe_pickle=False):
+        self.path = path
+        self.unsafe_pickle = unsafe_pickle
+        if os.path.isfile(path):
+            files = [path]
+        elif os.path.exists(os.path.join(path, SAFE_WEIGHTS_INDEX_NAME)):
+            files = self._files_from_index(os.path.join(path, SAFE_WEIGHTS_INDEX_NAME))
+        elif os.path.exists(os.path.join(path, SAFE_WEIGHTS_NAME)):
+            files = [os.path.join(path, SAFE_WEIGHTS_NAME)]
+        elif os.path.exists(os.path.join(path, WEIGHTS_INDEX_NAME)):
+            files = self._files_from_index(os.path.join(path, WEIGHTS_INDEX_NAME))
+        elif os.path.exists(os.path.join(path, WEIGHTS_NAME)):
+            files = [os.path.join(path, WEIGHTS_NAME)]
+        else:
+            raise ValueError(f"Can't find model weights in {path}")
+        self.files = files
+
+    @staticmethod
+    def _files_from_index(index_file):
+        with open(index_file, mode='r', encoding='utf-8') as f:
+            weight_map = json.load(f)["weight_map"]
+        dirname = os.path.dirname(index_file)
+        return [os.path.join(dirname, name) for name in OrderedDict.fromkeys(weight_map.values())]
+
+    def _load_bin(self, filename):
+        return _torch_load(filename, unsafe_pickle=self.unsafe_pickle, mmap=True)
+
+    def iter_meta(self):
+        '''
+            (key , shape , 每元素字节数 , 是否浮点) , 不读取数据
+        '''
+        for filename in self.files:
+            if filename.endswith(".safetensors"):
+                with safe_open(filename, framework="pt", device="cpu") as f:
+                    for k in f.keys():
+                        s = f.get_slice(k)
+                        dtype = s.get_dtype()
+                        yield k, tuple(s.get_shape()), _DTYPE_BYTES[dtype], dtype.startswith(('F', 'BF'))
+            else:
+                state_dict = self._load_bin(filename)
+                for k, v in state_dict.items():
+                    yield k, tuple(v.shape), v.element_size(), v.is_floating_point()
+                del state_dict
+
+    def iter_tensors(self):
+        for filename in self.files:
+            if filename.endswith(".safetensors"):
+                with safe_open(filename, framework="pt", device="cpu") as f:
+                    for k in f.keys():
+                        yield k, f.get_tensor(k)
+            else:
+                state_dict = self._load_bin(filename)
+                for k in list(state_dict.keys()):
+                    yield k, state_dict.pop(k)
+                del state_dict
+
+
+def _torch_load(filename, unsafe_pickle=False, mmap=False):
+    '''
+        默认 weights_only=True , 只反序列化张量和基础类型 , lightning ckpt 取其中的 state_dict
+        unsafe_pickle=True 时按任意 pickle 加载 , 只用于可信的旧格式文件
+    '''
+    kwargs = {"mmap": True} if mmap else {}
+    try:
+        try:
+            state_dict = torch.load(filename, map_location="cpu", weights_only=not unsafe_pickle, **kwargs)
+        except TypeError:
+            # 旧版本 torch 不支持 mmap
+            state_dict = torch.load(filename, map_location="cpu", weights_only=not unsafe_pickle)
+    except pickle.UnpicklingError as e:
+        raise ValueError(f"{filename} contains objects that weights_only loading refuses. "
+                         f"If the file is trusted, pass --unsafe-pickle (unsafe_pickle=True).") from e
+    # lightning ckpt
+    if isinstance(state_dict.get("state_dict", None), dict):
+        state_dict = state_dict["state_dict"]
+    return state_dict
+
+
+def _load_adapter(adapter_path, unsafe_pickle=False):
+    with open(os.path.join(adapter_path, ADAPTER_CONFIG_NAME), mode='r', encoding='utf-8') as f:
+        config = json.load(f)
+    for name in ADAPTER_WEIGHTS_NAMES:
+        filename = os.path.join(adapter_path, name)
+        if not os.path.exists(filename):
+            continue
+        if filename.endswith(".safetensors"):
+            with safe_open(filename, framework="pt", device="cpu") as f:
+                weights = {k: f.get_tensor(k) for k in f.keys()}
+        else:
+            weights = _torch_load(filename, unsafe_pickle=unsafe_pickle)
+        return config, weights
+    raise ValueError(f"Can't find adapter weights in {adapter_path}")
+
+
+def _match_module(prefix: str, base_modules: Dict[str, str]) -> Optional[str]:
+    '''
+        adapter 的模块名带有 PetlModel / TransformerBase 的前缀 , 逐级去掉前缀直到与基础模型的模块名一致
+    '''
+    parts = prefix.split('.')
+    for i in range(len(parts)):
+        name = '.'.join(parts[i:])
+        if name in base_modules:
+            return name
+    return None
+
+
+def _pattern_value(pattern: Optional[dict], module_name: str, default, lycoris=False):
+    if not pattern:
+        return default
+    for key, value in pattern.items():
+        if re.match(f"(.*\\.)?{key}$" if lycoris else f".*\\.{key}$", module_name):
+            return value
+    return default
+
+
+class _ModuleDelta:
+    def __init__(self, lora_type, config, module_name, params: Dict[str, torch.Tensor]):
+        self.lora_type = lora_type
+        self.config = config
+        self.module_name = module_name
+        self.params = {k: v.float() for k, v in params.items()}
+
+    def apply(self, weight: torch.Tensor) -> torch.Tensor:
+        p = self.params
+        config = self.config
+        fan_in_fan_out = config.get("fan_in_fan_out", False)
+        w = weight.float()
+        if self.lora_type == "ia3":
+            ia3_l = p["ia3_l"]
+            if fan_in_fan_out:
+                return (w.T * ia3_l).T
+            return w * ia3_l
+        if self.lora_type in ("lora", "adalora"):
+            if "lora_E" in p:
+                r = float(p["lora_A"].shape[0])
+                scaling = config.get("lora_alpha") or r
+                # ranknum 不在保存的权重中 , 加载时等于 r
+                ranknum = p["ranknum"] if "ranknum" in p else r
+                delta = p["lora_B"] @ (p["lora_A"] * p["lora_E"]) * scaling / (ranknum + 1e-5)
+                return w + (delta.T if fan_in_fan_out else delta)
+            if "lora_embedding_A" in p:
+                r = p["lora_embedding_A"].shape[0]
+                alpha = _pattern_value(config.get("alpha_pattern"), self.module_name, config["lora_alpha"])
+                return w + (p["lora_embedding_B"] @ p["lora_embedding_A"]).T * (alpha / r)
+            A, B = p["lora_A"], p["lora_B"]
+            r = A.shape[0]
+            alpha = _pattern_value(config.get("alpha_pattern"), self.module_name, config["lora_alpha"])
+            scaling = alpha / r
+            if w.dim() == 4:
+                if w.shape[2:4] == (1, 1):
+                    delta = (B.squeeze(3).squeeze(2) @ A.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
+                else:
+                    delta = F.conv2d(A.permute(1, 0, 2, 3), B).permute(1, 0, 2, 3)
+                return w + delta * scaling
+            delta = B @ A
+            return w + (delta.T if fan_in_fan_out else delta) * scaling
+        if self.lora_type == "loha":
+            r = p["hada_w1_b"].shape[0]
+            alpha = _pattern_value(config.get("alpha_pattern"), self.module_name, config["alpha"], lycoris=True)
+            scale = alpha / r
+            if "hada_t1" in p:
+                rebuild1 = torch.einsum("i j k l, j r, i p -> p r k l", p["hada_t1"], p["hada_w1_b"], p["hada_w1_a"])
+                rebuild2 = torch.einsum("i j k l, j r, i p -> p r k l", p["hada_t2"], p["hada_w2_b"], p["hada_w2_a"])
+                delta = rebuild1 * rebuild2 * scale
+            else:
+                delta = (p["hada_w1_a"] @ p["hada_w1_b"]) * (p["hada_w2_a"] @ p["hada_w2_b"]) * scale
+            return w + delta.reshape(w.shape)
+        if self.lora_type == "lokr":
+            # 与 LoKrLayer.get_delta_weight 一致 , 不乘 scaling
+            w1 = p["lokr_w1"] if "lokr_w1" in p else p["lokr_w1_a"] @ p["lokr_w1_b"]
+            if "lokr_w2" in p:
+                w2 = p["lokr_w2"]
+            elif "lokr_t2" in p:
+                w2 = torch.einsum("i j k l, i p, j r -> p r k l", p["lokr_t2"], p["lokr_w2_a"], p["lokr_w2_b"])
+            else:
+                w2 = p["lokr_w2_a"] @ p["lokr_w2_b"]
+            if w2.dim() == 4:
+                w1 = w1.unsqueeze(2).unsqueeze(2)
+            return w + torch.kron(w1, w2.contiguous()).reshape(w.shape)
+        raise NotImplementedError(self.lora_type)
+
+    def apply_bias(self, bias: torch.Tensor) -> torch.Tensor:
+        # ia3 非 feedforward 模块的 bias 同样缩放
+        ia3_l = self.params["ia3_l"]
+        return bias.float() * ia3_l.reshape(bias.shape)
+
+
+def _build_plan(lora_type, config, adapter_weights, base_keys: List[str]):
+    '''
+        返回 (基础权重名 -> _ModuleDelta , 基础权重名 -> 替换的 tensor)
+    '''
+    base_modules = {k[: -len(".weight")]: k for k in base_keys if k.endswith(".weight")}
+    base_key_set = set(base_keys)
+    param_names = _ADAPTER_PARAM_NAMES[lora_type]
+    grouped: Dict[str, Dict[str, torch.Tensor]] = OrderedDict()
+    replaced: Dict[str, torch.Tensor] = {}
+    for k, v in adapter_weights.items():
+        parts = k.split('.')
+        # xxx.lora_A.weight / xxx.ia3_l / xxx.hada_w1_a
+        idx = next((i for i in range(len(parts) - 1, -1, -1) if parts[i] in param_names), None)
+        if idx is None:
+            # bias 或 modules_to_save , 直接替换
+            for i in range(len(parts)):
+                name = '.'.join(parts[i:])
+                if name in base_key_set:
+                    replaced[name] = v
+                    break
+            else:
+                raise ValueError(f"Can't match adapter weight {k} to the base model")
+            continue
+        module = _match_module('.'.join(parts[:idx]), base_modules)
+        if module is None:
+            raise ValueError(f"Can't match adapter weight {k} to the base model")
+        grouped.setdefault(module, {})[parts[idx]] = v
+
+    deltas = {}
+    for module, params in grouped.items():
+        delta = _ModuleDelta(lora_type, config, module, params)
+        deltas[base_modules[module]] = delta
+        if lora_type == "ia3" and params["ia3_l"].shape[-1] == 1 and module + ".bias" in base_key_set:
+            deltas[module + ".bias"] = delta
+    return deltas, replaced
+
+
+def merge_adapter_offline(base_model_path: str,
+                          adapter_path: str,
+                          output_path: str,
+                          max_shard_size="10GB",
+                          dtype: Optional[torch.dtype] = None,
+                          copy_extra_files=True,
+                          verbose=True,
+                          unsafe_pickle=False) -> Dict[str, str]:
+    '''
+        合并 adapter_path 到 base_model_path , 结果以 safetensors 分片写入 output_path
+        unsafe_pickle: bin 文件不以 weights_only 加载 , 只用于可信的旧格式文件
+        返回 weight_map
+    '''
+    config, adapter_weights = _load_adapter(adapter_path, unsafe_pickle=unsafe_pickle)
+    lora_type = config.get("lora_type", "lora")
+    if lora_type not in _ADAPTER_PARAM_NAMES:
+        raise ValueError(f"lora_type {lora_type} is not supported")
+
+    base = _BaseShards(base_model_path, unsafe_pickle=unsafe_pickle)
+    meta = list(base.iter_meta())
+    deltas, replaced = _build_plan(lora_type, config, adapter_weights, [m[0] for m in meta])
+
+    # 先按 header 规划分片 , 输出文件名中的分片总数需要提前确定
+    max_size = convert_file_size_to_int(max_shard_size)
+    out_bytes = torch.tensor([], dtype=dtype).element_size() if dtype is not None else None
+    shard_of = {}
+    shard_id, shard_size, total_size = 0, 0, 0
+    for k, shape, nbytes, is_float in meta:
+        numel = 1
+        for s in shape:
+            numel *= s
+        size = numel * (out_bytes if (out_bytes is not None and is_float) else nbytes)
+        if shard_size > 0 and shard_size + size > max_size:
+            shard_id += 1
+            shard_size = 0
+        shard_of[k] = shard_id
+        shard_size += size
+        total_size += size
+    num_shards = shard_id + 1
+
+    def shard_name(i):
+        if num_shards == 1:
+            return SAFE_WEIGHTS_NAME
+        return SAFE_WEIGHTS_NAME.replace(".safetensors", f"-{i + 1:05d}-of-{num_shards:05d}.safetensors")
+
+    os.makedirs(output_path, exist_ok=True)
+    weight_map = {}
+    buffer, current = OrderedDict(), 0
+    seen = set()
+    merged_count = 0
+    for k, tensor in base.iter_tensors():
+        out_dtype = dtype if (dtype is not None and tensor.is_floating_point()) else tensor.dtype
+        if k in deltas:
+            delta = deltas[k]
+            tensor = delta.apply_bias(tensor) if k.endswith(".bias") else delta.apply(tensor)
+            merged_count += 1
+        elif k in replaced:
+            tensor = replaced[k]
+        tensor = tensor.to(out_dtype)
+
+        if shard_of[k] != current:
+            safe_save_file(buffer, os.path.join(output_path, shard_name(current)), metadata={"format": "pt"})
+            buffer = OrderedDict()
+            seen = set()
+            current = shard_of[k]
+        # 绑定的 embed / lm_head , 或 modules_to_save 替换进来的同一 tensor , safetensors 不允许共享存储
+        buffer[k] = _detach_storage(tensor, seen)
+        weight_map[k] = shard_name(current)
+    if buffer:
+        safe_save_file(buffer, os.path.join(output_path, shard_name(current)), metadata={"format": "pt"})
+    del buffer
+
+    if num_shards > 1:
+        with open(os.path.join(output_path, SAFE_WEIGHTS_INDEX_NAME), mode='w', encoding='utf-8') as f:
+            f.write(json.dumps({"metadata": {"total_size": total_size}, "weight_map": weight_map},
+                               indent=2, sort_keys=True) + "\n")
+
+    if copy_extra_files and os.path.isdir(base_model_path):
+        # config / tokenizer 等
+        for name in os.listdir(base_model_path):
+            src = os.path.join(base_model_path, name)
+            if not os.path.isfile(src) or name.endswith((".safetensors", ".bin", ".pt", ".pth")) \
+                    or name in (SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_INDEX_NAME):
+                continue
+            shutil.copy(src, os.path.join(output_path, name))
+
+    if verbose:
+        logger.info(f"merged {merged_count} tensors ({lora_type}) , replaced {len(replaced)} tensors , "
+                    f"{num_shards} shards written to {output_path}")
+    return weight_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description='merge adapter weights into the base model offline.')
+    parser.add_argument('--base_model', type=str, required=True, help='base model path or weight file')
+    parser.add_argument('--adapter', type=str, required=True, help='adapter path')
+    parser.add_argument('--output', type=str, required=True, help='output path')
+    parser.add_argument('--max_shard_size', default="10GB", help='max size per shard')
+    parser.add_argument('--dtype', choices=['float16', 'bfloat16', 'float32'], default=None, help='output dtype')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch cpu threads')
+    parser.add_argument('--unsafe-pickle', dest='unsafe_pickle', action='store_true',
+                        help='load trusted legacy .bin / .ckpt files without weights_only')
+    args = parser.parse_args()
+    logging.set_verbosity_info()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    merge_adapter_offline(args.base_model, args.adapter, args.output,
+                          max_shard_size=args.max_shard_size,
+                          dtype=getattr(torch, args.dtype) if args.dtype else None,
+                          unsafe_pickle=args.unsafe_pickle)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ import resource
 import shutil
 import sys
 import warnings
+from collections.abc import Mapping
 from contextlib import nullcontext
 from pathlib import Path
 from typing import Union, Optional, Callable, List, Tuple, Dict, Any
@@ -44,6 +45,7 @@ from ...nlp.optimizer.optimizer import OptimizerNames
 from transformers.utils import strtobool, logging, is_accelerate_available, is_peft_available, is_sagemaker_mp_enabled
 from torch.optim.optimizer import Optimizer
 from ...data_helper import TrainingArgumentsAC
+from ..telemetry import StepTelemetry
 
 
 if is_peft_available():
@@ -82,6 +84,46 @@ DEFAULT_PROGRESS_CALLBACK = ProgressCallback
 
 
 
+class _DevicePrefetcher:
+    '''
+        在独立 cuda stream 上提前把下一个 batch 拷贝到 device , 与当前 step 的计算重叠
+    '''
+    def __init__(self, iterable, device):
+        self.iterable = iterable
+        self.device = torch.device("cuda", device) if isinstance(device, int) else torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def _to_device(self, batch):
+        if not isinstance(batch, Mapping):
+            return batch
+        with torch.cuda.stream(self.stream):
+            return {k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+                    for k, v in batch.items()}
+
+    def __iter__(self):
+        it = iter(self.iterable)
+        try:
+            next_batch = self._to_device(next(it))
+        except StopIteration:
+            return
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            if isinstance(batch, Mapping):
+                for v in batch.values():
+                    if isinstance(v, torch.Tensor) and v.is_cuda:
+                        v.record_stream(current_stream)
+            try:
+                next_batch = self._to_device(next(it))
+            except StopIteration:
+                next_batch = None
+            yield batch
+
+
 def get_model_numel(model: torch.nn.Module) -> int:
     return sum(p.numel() for p in model.parameters())
 
@@ -113,6 +155,7 @@ class TrainerAC:
                  callbacks: Optional[ List[ TrainerCallback ] ] = None,
                  optimizers: Tuple[ torch.optim.Optimizer, torch.optim.lr_scheduler.LambdaLR ] = (None, None),
                  accelerator_kwargs = None,
+                 telemetry: Optional[StepTelemetry] = None,
                  **kwargs):
 
         if accelerator_kwargs is None:
@@ -145,6 +188,10 @@ class TrainerAC:
 
         self.current_flos = 0
         self.use_cpu_amp = False
+        self._flos_per_token = None
+        self._cuda_total_memory = None
+        self._last_logged_loss = None
+        self.telemetry = telemetry if telemetry is not None else StepTelemetry(enabled=False)
 
         # Activate gradient checkpointing if needed
         if args.gradient_checkpointing:
@@ -285,8 +332,10 @@ class TrainerAC:
         eval_dataloader = self.eval_dataset
 
 
+        # 由 _DevicePrefetcher 在 side stream 上拷贝训练 batch 时 , accelerate 不再对训练 batch 做 device placement
+        device_placement = [None, None, False if self._use_prefetcher() else None, None, None]
         model, optimizer, train_dataloader, eval_dataloader, lr_scheduler = self.accelerator.prepare(
-            model, optimizer, train_dataloader, eval_dataloader, lr_scheduler
+            model, optimizer, train_dataloader, eval_dataloader, lr_scheduler, device_placement=device_placement
         )
 
         self.model = model
@@ -590,7 +639,7 @@ class TrainerAC:
     def training_step(self, model: nn.Module, inputs: Dict[ str, Union[ torch.Tensor, Any ] ]) -> torch.Tensor:
         device = torch.cuda.current_device()
         batch = {k: v.to(device) for k, v in inputs.items() if isinstance(v, torch.Tensor)}
-        with self.compute_loss_context_manager():
+        with self.telemetry.phase("forward"), self.compute_loss_context_manager():
             loss_obj = model(**batch)
 
         if dataclasses.is_dataclass(loss_obj):
@@ -606,7 +655,8 @@ class TrainerAC:
         if self.args.n_gpu > 1:
             tr_loss_step = tr_loss_step.mean()  # mean() to average on multi-gpu parallel training
 
-        self.accelerator.backward(loss=tr_loss_step)
+        with self.telemetry.phase("backward"):
+            self.accelerator.backward(loss=tr_loss_step)
         return tr_loss_step.detach() / self.args.gradient_accumulation_steps
 
     def floating_point_ops(self, inputs: Dict[str, Union[torch.Tensor, Any]]):
@@ -627,6 +677,34 @@ class TrainerAC:
         else:
             return 0
 
+    def _estimate_flos(self, inputs: Dict[str, Union[torch.Tensor, Any]]):
+        '''
+            PreTrainedModel.floating_point_ops 与 token 数成正比 , 但每次调用都要遍历参数统计参数量
+            只对第一个 batch 调用一次 , 之后按 input_ids 的 token 数外推
+        '''
+        input_ids = inputs.get("input_ids", None) if isinstance(inputs, Mapping) else None
+        if input_ids is None:
+            return float(self.floating_point_ops(inputs))
+        if self._flos_per_token is None:
+            self._flos_per_token = float(self.floating_point_ops(inputs)) / max(input_ids.numel(), 1)
+        return self._flos_per_token * input_ids.numel()
+
+    def _maybe_empty_cache(self):
+        # 只在显存压力大时清理缓存 , empty_cache 会同步并使后续分配变慢
+        threshold = getattr(self.args, "empty_cache_threshold", None)
+        if not threshold or threshold <= 0 or not torch.cuda.is_available():
+            return
+        device = torch.cuda.current_device()
+        if self._cuda_total_memory is None:
+            self._cuda_total_memory = torch.cuda.get_device_properties(device).total_memory
+        if torch.cuda.memory_reserved(device) > threshold * self._cuda_total_memory:
+            torch.cuda.empty_cache()
+
+    def _use_prefetcher(self):
+        args = self.args
+        return getattr(args, "low_overhead_loop", False) and getattr(args, "prefetch_to_device", False) \
+            and torch.cuda.is_available()
+
     def store_flos(self):
         # Storing the number of floating-point operations that went into the model
         if self.args.parallel_mode == ParallelMode.DISTRIBUTED:
@@ -740,6 +818,7 @@ class TrainerAC:
         self.state.is_world_process_zero = self.is_world_process_zero
 
         self.control = self.callback_handler.on_train_begin(args, self.state, self.control)
+        self.telemetry.reset_step()
 
         # tr_loss is a tensor to avoid synchronization of TPUs through .item()
         tr_loss = torch.tensor(0.0).to(args.device)
@@ -753,6 +832,8 @@ class TrainerAC:
         steps_trained_in_current_epoch = 0
         steps_skipped = 0
         total_batched_samples = 0
+        low_overhead = getattr(args, "low_overhead_loop", False)
+        prefetch = self._use_prefetcher()
         for epoch in range(start_epoch, num_train_epochs):
             # train_dataloader.sampler.set_epoch(epoch=epoch)
             num_steps_per_epoch = len(train_dataloader)
@@ -766,7 +847,9 @@ class TrainerAC:
             step = -1
             model.train()
             with tqdm(
-                    iterable=enumerate(train_dataloader, start=start_step),
+                    iterable=enumerate(self.telemetry.wrap_data(
+                        _DevicePrefetcher(train_dataloader, self.accelerator.device)
+                        if prefetch else train_dataloader), start=start_step),
                     desc=f"Epoch {epoch}",
                     disable=not self.is_world_process_zero,
                     total=num_steps_per_epoch,
@@ -779,19 +862,30 @@ class TrainerAC:
                     with self.accelerator.accumulate(model):
                         tr_loss_step = self.training_step(model, batch)
 
-                    if (
-                            args.logging_nan_inf_filter
-                            and not is_torch_tpu_available()
-                            and (torch.isnan(tr_loss_step) or torch.isinf(tr_loss_step))
-                    ):
-                        # if loss is nan or inf simply add the average of previous logged losses
-                        tr_loss += tr_loss / (1 + self.state.global_step - self._globalstep_last_logged)
-                    else:
+                    if low_overhead:
+                        # nan / inf 过滤在 device 上完成 , 不在每个 micro step 同步
+                        if args.logging_nan_inf_filter and not is_torch_tpu_available():
+                            tr_loss_step = torch.where(
+                                torch.isfinite(tr_loss_step), tr_loss_step,
+                                tr_loss / (1 + self.state.global_step - self._globalstep_last_logged))
                         tr_loss += tr_loss_step
+                        flos = self._estimate_flos(batch)
+                    else:
+                        if (
+                                args.logging_nan_inf_filter
+                                and not is_torch_tpu_available()
+                                and (torch.isnan(tr_loss_step) or torch.isinf(tr_loss_step))
+                        ):
+                            # if loss is nan or inf simply add the average of previous logged losses
+                            tr_loss += tr_loss / (1 + self.state.global_step - self._globalstep_last_logged)
+                        else:
+                            tr_loss += tr_loss_step
 
-                    self.current_flos += float(self.floating_point_ops(batch))
+                        flos = float(self.floating_point_ops(batch))
 
-                    pbar.set_postfix({"Loss": f"{tr_loss_step.item():.4f}"})
+                        pbar.set_postfix({"Loss": f"{tr_loss_step.item():.4f}"})
+                    self.current_flos += flos
+                    self.telemetry.add_batch(batch, flops=flos)
 
 
                     is_last_step_and_steps_less_than_grad_acc = (
@@ -805,35 +899,43 @@ class TrainerAC:
                             is_last_step_and_steps_less_than_grad_acc
                     ):
 
-                        # Gradient clipping
-                        if args.max_grad_norm is not None and args.max_grad_norm > 0:
-                            # deepspeed does its own clipping
-
-                            if hasattr(self.optimizer, "clip_grad_norm"):
-                                # Some optimizers (like the sharded optimizer) have a specific way to do gradient clipping
-                                self.optimizer.clip_grad_norm(args.max_grad_norm)
-                            elif hasattr(model, "clip_grad_norm_"):
-                                # Some models (like FullyShardedDDP) have a specific way to do gradient clipping
-                                model.clip_grad_norm_(args.max_grad_norm)
-                            else:
-                                self.accelerator.clip_grad_norm_(
-                                    model.parameters(),
-                                    args.max_grad_norm,
-                                )
-                        optimizer.step()
-                        lr_scheduler.step()
-                        optimizer.zero_grad()
+                        with self.telemetry.phase("optimizer"):
+                            # Gradient clipping
+                            if args.max_grad_norm is not None and args.max_grad_norm > 0:
+                                # deepspeed does its own clipping
+
+                                if hasattr(self.optimizer, "clip_grad_norm"):
+                                    # Some optimizers (like the sharded optimizer) have a specific way to do gradient clipping
+                                    self.optimizer.clip_grad_norm(args.max_grad_norm)
+                                elif hasattr(model, "clip_grad_norm_"):
+                                    # Some models (like FullyShardedDDP) have a specific way to do gradient clipping
+                                    model.clip_grad_norm_(args.max_grad_norm)
+                                else:
+                                    self.accelerator.clip_grad_norm_(
+                                        model.parameters(),
+                                        args.max_grad_norm,
+                                    )
+                            optimizer.step()
+                            lr_scheduler.step()
+                            optimizer.zero_grad()
 
                         self.state.global_step += 1
                         self.state.epoch = epoch + (step + 1 + steps_skipped) / steps_in_epoch
+                        self.telemetry.step_end(self.state.global_step)
                         self.control = self.callback_handler.on_step_end(args, self.state, self.control)
                         self._maybe_log_save_evaluate(tr_loss, model, trial, epoch, step , ignore_keys_for_eval)
+                        if low_overhead:
+                            # 只在 logging_steps 取到 host 的 loss 刷新进度条
+                            if self._globalstep_last_logged == self.state.global_step and self._last_logged_loss is not None:
+                                pbar.set_postfix({"Loss": f"{self._last_logged_loss:.4f}"})
+                            self._maybe_empty_cache()
 
                     else:
                         self.control = self.callback_handler.on_substep_end(args, self.state, self.control)
-                    # Delete CUDA cache.
-                    # del batch, batch_labels, batch_output, loss
-                    torch.cuda.empty_cache()
+                    if not low_overhead:
+                        # Delete CUDA cache.
+                        # del batch, batch_labels, batch_output, loss
+                        torch.cuda.empty_cache()
                     if self.control.should_epoch_stop or self.control.should_training_stop:
                         break
 
@@ -848,6 +950,7 @@ class TrainerAC:
 
                 self.control = self.callback_handler.on_epoch_end(args, self.state, self.control)
                 self._maybe_log_save_evaluate(tr_loss, model, trial, epoch,step, ignore_keys_for_eval)
+        self.telemetry.close()
         self.control = self.callback_handler.on_train_end(args, self.state, self.control)
     def _get_output_dir(self, trial):
         run_dir = self.args.output_dir
@@ -1012,24 +1115,27 @@ class TrainerAC:
             tr_loss -= tr_loss
 
             logs[ "loss" ] = round(tr_loss_scalar / (self.state.global_step - self._globalstep_last_logged), 4)
+            self._last_logged_loss = logs[ "loss" ]
             logs[ "learning_rate" ] = self._get_learning_rate()
 
             self._total_loss_scalar += tr_loss_scalar
             self._globalstep_last_logged = self.state.global_step
             self.store_flos()
+            logs.update(self.telemetry.pop_window())
 
             self.log(logs)
 
         metrics = None
         if self.control.should_save:
             self.accelerator.print("\nStart saving model checkpoint with running states")
-            self._save_checkpoint(
-                model=model,
-                epoch=epoch,
-                step=step + 1,
-                batch_size=self.args.per_device_train_batch_size,
-                trial=trial,
-            )
+            with self.telemetry.phase("checkpoint"):
+                self._save_checkpoint(
+                    model=model,
+                    epoch=epoch,
+                    step=step + 1,
+                    batch_size=self.args.per_device_train_batch_size,
+                    trial=trial,
+                )
             self.accelerator.print(
                 f"Saved checkpoint at epoch {epoch} step {step + 1} at folder {self.args.output_dir}"
             )
@@ -45,6 +45,7 @@ from transformers.utils import strtobool, logging
 from torch.optim.optimizer import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
 from ...data_helper import TrainingArgumentsCL
+from ..telemetry import StepTelemetry
 
 import colossalai
 from colossalai.booster import Booster
@@ -123,6 +124,7 @@ class TrainerCL:
                  model_init: Optional[Callable[[], PreTrainedModel]] = None,
                  callbacks: Optional[ List[ TrainerCallback ] ] = None,
                  optimizers: Tuple[ torch.optim.Optimizer, torch.optim.lr_scheduler.LambdaLR ] = (None, None),
+                 telemetry: Optional[StepTelemetry] = None,
                  **kwargs):
 
 
@@ -150,6 +152,7 @@ class TrainerCL:
         self.tokenizer = tokenizer
         self.callbacks = callbacks
         self.optimizer, self.lr_scheduler = optimizers
+        self.telemetry = telemetry if telemetry is not None else StepTelemetry(enabled=False)
 
         # Activate gradient checkpointing if needed
         if args.gradient_checkpointing:
@@ -612,10 +615,17 @@ class TrainerCL:
     def training_step(self, model: nn.Module, inputs: Dict[ str, Union[ torch.Tensor, Any ] ]) -> Union[torch.Tensor,Dict,Any]:
         device = get_current_device()
         batch = {k: v.to(device) for k, v in inputs.items() if isinstance(v, torch.Tensor)}
-        loss = model(**batch)
+        with self.telemetry.phase("forward"):
+            loss = model(**batch)
         return loss
 
 
+    def floating_point_ops(self, inputs: Dict[str, Union[torch.Tensor, Any]]):
+        model = self.model.unwrap() if isinstance(self.model, ModelWrapper) else self.model
+        if hasattr(model, "floating_point_ops"):
+            return float(model.floating_point_ops(inputs))
+        return 0.0
+
     def _train_loop(self,start_epoch=0,start_step=0,
                     trial: Union["optuna.Trial", Dict[str, Any]] = None,
                     ignore_keys_for_eval: Optional[List[str]] = None,
@@ -719,6 +729,7 @@ class TrainerCL:
         self.state.is_world_process_zero = self.is_world_process_zero
 
         self.control = self.callback_handler.on_train_begin(args, self.state, self.control)
+        self.telemetry.reset_step()
 
         epochs_trained = 0
         steps_trained_in_current_epoch = 0
@@ -736,7 +747,7 @@ class TrainerCL:
             self.control = self.callback_handler.on_epoch_begin(args, self.state, self.control)
             step = -1
             with tqdm(
-                    iterable=enumerate(train_dataloader, start=start_step),
+                    iterable=enumerate(self.telemetry.wrap_data(train_dataloader), start=start_step),
                     desc=f"Epoch {epoch}",
                     disable=not coordinator.is_master(),
                     total=num_steps_per_epoch,
@@ -759,7 +770,10 @@ class TrainerCL:
                     else:
                         loss = loss_obj
 
-                    booster.backward(loss=loss, optimizer=optimizer)
+                    with self.telemetry.phase("backward"):
+                        booster.backward(loss=loss, optimizer=optimizer)
+                    if self.telemetry.enabled:
+                        self.telemetry.add_batch(batch, flops=self.floating_point_ops(batch))
 
                     all_reduce_mean(tensor=loss)
 
@@ -789,12 +803,17 @@ class TrainerCL:
                             # last step in epoch but step is always smaller than gradient_accumulation_steps
                             is_last_step_and_steps_less_than_grad_acc
                     ):
-                        optimizer.step()
-                        lr_scheduler.step()
-                        optimizer.zero_grad()
+                        with self.telemetry.phase("optimizer"):
+                            optimizer.step()
+                            lr_scheduler.step()
+                            optimizer.zero_grad()
 
                         self.state.global_step += 1
                         self.state.epoch = epoch + (step + 1 + steps_skipped) / steps_in_epoch
+                        telemetry_metrics = self.telemetry.step_end(self.state.global_step)
+                        if coordinator.is_master():
+                            for k, v in telemetry_metrics.items():
+                                writer.add_scalar(tag=k, scalar_value=v, global_step=self.state.global_step)
                         self.control = self.callback_handler.on_step_end(args, self.state, self.control)
                         self._maybe_log_save_evaluate(loss, model, trial, epoch, step , ignore_keys_for_eval)
 
@@ -817,6 +836,7 @@ class TrainerCL:
 
                 self.control = self.callback_handler.on_epoch_end(args, self.state, self.control)
                 self._maybe_log_save_evaluate(loss, model, trial, epoch,step, ignore_keys_for_eval)
+        self.telemetry.close()
         self.control = self.callback_handler.on_train_end(args, self.state, self.control)
     def _get_output_dir(self, trial):
         run_dir = self.args.output_dir
@@ -941,16 +961,17 @@ class TrainerCL:
 
         if self.control.should_save:
             self.coordinator.print_on_master("\nStart saving model checkpoint with running states")
-            self._save_checkpoint(
-                model=model,
-                optimizer=self.optimizer,
-                lr_scheduler=self.lr_scheduler,
-                epoch=epoch,
-                step=step + 1,
-                batch_size=self.args.per_device_train_batch_size,
-                coordinator=self.coordinator,
-                trial=trial,
-            )
+            with self.telemetry.phase("checkpoint"):
+                self._save_checkpoint(
+                    model=model,
+                    optimizer=self.optimizer,
+                    lr_scheduler=self.lr_scheduler,
+                    epoch=epoch,
+                    step=step + 1,
+                    batch_size=self.args.per_device_train_batch_size,
+                    coordinator=self.coordinator,
+                    trial=trial,
+                )
             self.coordinator.print_on_master(
                 f"Saved checkpoint at epoch {epoch} step {step + 1} at folder {self.args.output_dir}"
             )
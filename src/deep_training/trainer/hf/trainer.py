@@ -2,9 +2,10 @@
 # Copyright 2020-present the HuggingFace Inc. team.
 import dataclasses
 import os
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Union, Iterable, List, Optional, Dict, Callable, Tuple
+from typing import Union, Iterable, List, Optional, Dict, Callable, Tuple, Any
 
 import safetensors
 import torch
@@ -28,6 +29,7 @@ from ...data_helper.training_args import TrainingArguments, DataArguments, \
 from ...nlp.models.petl import PetlModel
 from ...nlp.models.petl.prompt import PromptModel
 from transformers.trainer import logger
+from ..telemetry import StepTelemetry, TelemetryCallback
 
 if is_peft_available:
     from peft import PeftModel
@@ -64,6 +66,7 @@ class TrainerHF(Trainer):
         callbacks: Optional[List[TrainerCallback]] = None,
         optimizers: Tuple[torch.optim.Optimizer, torch.optim.lr_scheduler.LambdaLR] = (None, None),
         preprocess_logits_for_metrics: Optional[Callable[[torch.Tensor, torch.Tensor], torch.Tensor]] = None,
+        telemetry: Optional[StepTelemetry] = None,
         **kwargs):
         super().__init__(model=model,
                          args = args,
@@ -77,6 +80,9 @@ class TrainerHF(Trainer):
                          optimizers=optimizers,
                          preprocess_logits_for_metrics=preprocess_logits_for_metrics,
                          )
+        self.telemetry = telemetry if telemetry is not None else StepTelemetry(enabled=False)
+        if self.telemetry.enabled:
+            self.add_callback(TelemetryCallback(self.telemetry))
         # _is_peft_model = is_peft_available() and isinstance(model, (PeftModel,PetlModel,PromptModel))
 
     def get_train_dataloader(self) -> DataLoader:
@@ -105,7 +111,8 @@ class TrainerHF(Trainer):
             labels = inputs.pop("labels")
         else:
             labels = None
-        outputs = model(**inputs)
+        with self.telemetry.phase("forward") if model.training else nullcontext():
+            outputs = model(**inputs)
         # Save past state if it exists
         # TODO: this needs to be fixed and made cleaner later.
         if self.args.past_index >= 0:
@@ -142,6 +149,25 @@ class TrainerHF(Trainer):
                 loss = loss["loss"]
         return (loss, outputs) if return_outputs else loss
 
+    def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]], *args, **kwargs) -> torch.Tensor:
+        # forward + backward , backward 耗时为 train_step - forward
+        with self.telemetry.phase("train_step"):
+            return super().training_step(model, inputs, *args, **kwargs)
+
+    def floating_point_ops(self, inputs: Dict[str, Union[torch.Tensor, Any]]):
+        flos = super().floating_point_ops(inputs)
+        self.telemetry.add_batch(inputs, flops=float(flos))
+        return flos
+
+    def _save_checkpoint(self, *args, **kwargs):
+        with self.telemetry.phase("checkpoint"):
+            return super()._save_checkpoint(*args, **kwargs)
+
+    def log(self, logs: Dict[str, float], *args, **kwargs) -> None:
+        if "loss" in logs:
+            logs.update(self.telemetry.pop_window())
+        super().log(logs, *args, **kwargs)
+
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         # If we are executing this function, we are the process zero, so we don't check for that.
         output_dir = output_dir if output_dir is not None else self.args.output_dir
@@ -3,8 +3,13 @@
 # @Time    : 2023/6/1 9:10
 import copy
 import os.path
+import time
 import typing
 import torch
+from safetensors.torch import save_file as safe_save_file
+from transformers.utils import logging
+from ....nlp.layers.petl.constants import WEIGHTS_NAME, SAFETENSORS_WEIGHTS_NAME
+from ....nlp.layers.petl.utils import id_tensor_storage
 
 try:
     import deepspeed
@@ -14,6 +19,8 @@ except:
     deepspeed = None
     ZeroParamStatus = None
 
+logger = logging.get_logger(__name__)
+
 def _z3_params_to_fetch(param_list):
     return [
         p for p in param_list
@@ -21,37 +28,99 @@ def _z3_params_to_fetch(param_list):
     ]
 
 
-def gather_ds_state_dict(checkpoints: typing.Dict,output_filename,zero_stage_3,is_global_zero,config):
+def _iter_z3_buckets(state_dict: typing.Dict, bucket_size: int):
+    '''
+        按 ds_tensor 完整大小 (ds_numel) 把 zero3 参数分桶 , 非 zero3 张量单独返回
+    '''
+    bucket, size = [], 0
+    for k, v in state_dict.items():
+        if not hasattr(v, 'ds_id'):
+            yield None, [(k, v)]
+            continue
+        numel = getattr(v, 'ds_numel', v.numel())
+        bucket.append((k, v))
+        size += numel * v.element_size()
+        if size >= bucket_size:
+            yield True, bucket
+            bucket, size = [], 0
+    if bucket:
+        yield True, bucket
+
+
+def _gather_z3_state_dict(state_dict: typing.Dict, is_global_zero, bucket_size_mb=256):
+    '''
+        每个桶只做一次 GatheredParameters (一次合并的 all_gather)
+        只有 rank0 拷贝到 cpu , 直接拷贝到普通内存 ,
+        每次保存都为每个张量分配 pinned 内存 (cudaHostAlloc) 的开销远大于 adapter 权重本身的拷贝
+    '''
+    output_state_dict = {}
+    bucket_size = int(bucket_size_mb * 1024 * 1024)
+    for is_z3, items in _iter_z3_buckets(state_dict, bucket_size):
+        if not is_z3:
+            k, v = items[0]
+            if is_global_zero:
+                output_state_dict[k] = v.detach().cpu()
+            continue
+        with deepspeed.zero.GatheredParameters(_z3_params_to_fetch([v for _, v in items]), enabled=True):
+            if not is_global_zero:
+                continue
+            for k, v in items:
+                data = v.data
+                # 同步拷贝 , 退出上下文释放完整参数前已完成
+                output_state_dict[k] = data.cpu() if data.is_cuda else data.clone()
+    return output_state_dict
+
+
+def _save_adapter_state_dict(output_state_dict: typing.Dict, save_dir, safe_serialization=True):
+    if not safe_serialization:
+        torch.save(output_state_dict, os.path.join(save_dir, WEIGHTS_NAME))
+        return
+    output_state_dict = {k: v.detach().cpu().contiguous() for k, v in output_state_dict.items()}
+    # safetensors 不支持共享存储的张量
+    ptrs = {}
+    for k in list(output_state_dict.keys()):
+        ptr = id_tensor_storage(output_state_dict[k])
+        if ptr in ptrs:
+            output_state_dict[k] = output_state_dict[k].clone()
+        else:
+            ptrs[ptr] = k
+    safe_save_file(output_state_dict, os.path.join(save_dir, SAFETENSORS_WEIGHTS_NAME), metadata={"format": "pt"})
+
+
+def gather_ds_state_dict(checkpoints: typing.Dict,output_filename,zero_stage_3,is_global_zero,config,
+                         bucket_size_mb=256,safe_serialization=True):
+    '''
+        zero3 下按 bucket_size_mb 分桶收集 adapter 参数 , 只有 rank0 保留完整权重并写盘
+        safe_serialization 为 True 时保存 adapter_model.safetensors , 否则 adapter_model.bin
+        返回每个 adapter 的 (gather 耗时 , 保存耗时) 秒
+    '''
     dirname = os.path.dirname(output_filename)
     basename = os.path.basename(output_filename)
+    timings = {}
     for adapter_name, state in checkpoints.items():
         lora_or_prompt_config = state['config']
         state_dict = state['state_dict']
+        t0 = time.perf_counter()
         if zero_stage_3:
-            output_state_dict = {}
-            for k,v in state_dict.items():
-                if hasattr(v, 'ds_id'):
-                    with deepspeed.zero.GatheredParameters(_z3_params_to_fetch([v]),
-                                                           enabled=zero_stage_3):
-                        v_p = v.data.cpu()
-                else:
-                    v_p = v.cpu()
-                output_state_dict[k] = v_p
+            output_state_dict = _gather_z3_state_dict(state_dict, is_global_zero, bucket_size_mb=bucket_size_mb)
         else:
             output_state_dict = copy.copy(state_dict)
+        t1 = time.perf_counter()
 
         if is_global_zero:
-            if adapter_name != 'default':
-                basename = adapter_name + '-' + basename
-            pathfile = os.path.join(dirname,basename)
-            if not os.path.exists(pathfile):
-                os.mkdir(pathfile)
-            filepath_new = os.path.join(dirname, basename)
-            torch.save(output_state_dict, os.path.join(filepath_new,'adapter_model.bin'))
+            save_name = basename if adapter_name == 'default' else adapter_name + '-' + basename
+            filepath_new = os.path.join(dirname, save_name)
+            if not os.path.exists(filepath_new):
+                os.mkdir(filepath_new)
+            _save_adapter_state_dict(output_state_dict, filepath_new, safe_serialization=safe_serialization)
             lora_or_prompt_config.save_pretrained(filepath_new)
 
             config_path = os.path.join(filepath_new, 'config.json')
             if not os.path.exists(config_path):
                 config.save_pretrained(filepath_new)
+            t2 = time.perf_counter()
+            timings[adapter_name] = (t1 - t0, t2 - t1)
+            logger.info('save adapter {} to {} , gather {:.3f}s , write {:.3f}s\n'.format(
+                adapter_name, filepath_new, t1 - t0, t2 - t1))
         del output_state_dict
-
+    return timings
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/5/28 10:20
+# @FileName: telemetry.py
+"""
+    各 trainer 共用的性能遥测
+    按阶段 (data / forward / backward / optimizer / checkpoint / rollout/generate ...) 统计 wall time ,
+    每个 optimizer step 汇总 tokens/s , samples/s , MFU , 峰值显存 (及本步新增的峰值) , 写入本地 jsonl ,
+    pop_window 返回上次调用以来的均值 , 由各 trainer 合并到已有 logger
+    可按需包一段 torch.profiler
+"""
+import json
+import os
+import time
+from typing import Dict, Optional, Iterable
+
+import torch
+import torch.distributed as dist
+from transformers import TrainerCallback
+
+__all__ = [
+    'StepTelemetry',
+    'TelemetryCallback',
+    'estimate_peak_flops',
+]
+
+# 常见 GPU 的 bf16/fp16 dense 峰值 TFLOPS , 按设备名子串顺序匹配
+_PEAK_TFLOPS = (
+    ('H100', 989.0),
+    ('H800', 989.0),
+    ('A100', 312.0),
+    ('A800', 312.0),
+    ('L40S', 362.0),
+    ('L40', 181.0),
+    ('4090', 165.2),
+    ('A6000', 154.8),
+    ('A10', 125.0),
+    ('V100', 125.0),
+    ('3090', 71.0),
+    ('T4', 65.0),
+)
+
+
+def estimate_peak_flops(device=None) -> Optional[float]:
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name(device)
+    for key, tflops in _PEAK_TFLOPS:
+        if key in name:
+            return tflops * 1e12
+    return None
+
+
+class _Phase:
+    __slots__ = ('telemetry', 'name', 'elapsed', '_start', '_record')
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+        self.elapsed = 0.0
+        self._record = None
+
+    def __enter__(self):
+        telemetry = self.telemetry
+        if telemetry.enabled:
+            if telemetry.sync_cuda and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if telemetry._profiler is not None:
+                self._record = torch.profiler.record_function(self.name)
+                self._record.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        telemetry = self.telemetry
+        if telemetry.enabled and telemetry.sync_cuda and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.elapsed = time.perf_counter() - self._start
+        if self._record is not None:
+            self._record.__exit__(exc_type, exc_val, exc_tb)
+            self._record = None
+        if telemetry.enabled:
+            phases = telemetry._phases
+            phases[self.name] = phases.get(self.name, 0.0) + self.elapsed
+        return False
+
+
+class StepTelemetry:
+    '''
+        enabled=False 时只计时不记录 , trainer 可以无条件调用
+        sync_cuda=True 时在阶段边界同步 cuda , 阶段耗时准确但会打断异步执行 , 默认只统计 host 时间
+        peak_flops 为单卡峰值 , None 时按设备名估计 , 无法估计时不输出 mfu
+        profile_trigger_file 存在时 (每个 step 检查一次) 开始 profile_steps 步的 torch.profiler , 并删除该文件
+    '''
+    def __init__(self, enabled=True, log_file: Optional[str] = None, peak_flops: Optional[float] = None,
+                 sync_cuda=False, profile_dir: Optional[str] = None, profile_steps=5,
+                 profile_trigger_file: Optional[str] = None):
+        self.enabled = enabled
+        self.log_file = log_file
+        self.sync_cuda = sync_cuda
+        self.peak_flops = peak_flops if peak_flops is not None or not enabled else estimate_peak_flops()
+        self.profile_dir = profile_dir
+        self.profile_steps = profile_steps
+        self.profile_trigger_file = profile_trigger_file
+
+        self._phases: Dict[str, float] = {}
+        self._tokens = 0
+        self._samples = 0
+        self._flops = 0.0
+        self._step_start = None
+        self._window = []
+        self._fp = None
+        self._profiler = None
+        self._profile_remaining = 0
+        # 上一个 step 结束时的峰值显存 , 不每步 reset_peak_memory_stats , 以免影响其他读取峰值的代码
+        self._peak_allocated = None
+
+    @staticmethod
+    def is_global_zero():
+        return not dist.is_available() or not dist.is_initialized() or dist.get_rank() == 0
+
+    def phase(self, name) -> _Phase:
+        if self._step_start is None:
+            self._step_start = time.perf_counter()
+        return _Phase(self, name)
+
+    def wrap_data(self, iterable: Iterable):
+        '''
+            统计取下一个 batch 的等待时间
+        '''
+        it = iter(iterable)
+        while True:
+            with self.phase('data'):
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    return
+            yield batch
+
+    def add(self, tokens=0, samples=0, flops=0.0):
+        if self.enabled:
+            self._tokens += tokens
+            self._samples += samples
+            self._flops += flops
+
+    def add_batch(self, batch, flops=0.0):
+        '''
+            按 input_ids 统计 token 数和样本数
+        '''
+        if not self.enabled:
+            return
+        input_ids = batch.get('input_ids', None) if hasattr(batch, 'get') else None
+        if isinstance(input_ids, torch.Tensor):
+            self.add(tokens=input_ids.numel(), samples=input_ids.size(0) if input_ids.dim() > 1 else 1, flops=flops)
+        else:
+            self.add(flops=flops)
+
+    def reset_step(self):
+        self._phases = {}
+        self._tokens = 0
+        self._samples = 0
+        self._flops = 0.0
+        self._step_start = time.perf_counter()
+
+    def step_end(self, step, **extra) -> Dict[str, float]:
+        '''
+            一个 optimizer step 结束 , 返回本步指标
+        '''
+        if not self.enabled:
+            return {}
+        now = time.perf_counter()
+        step_time = now - (self._step_start if self._step_start is not None else now)
+        record = {'step': step, 'time/step': step_time}
+        for name, value in self._phases.items():
+            record['time/' + name] = value
+        if step_time > 0:
+            if self._tokens:
+                record['throughput/tokens_per_sec'] = self._tokens / step_time
+            if self._samples:
+                record['throughput/samples_per_sec'] = self._samples / step_time
+            if self._flops:
+                record['perf/tflops'] = self._flops / step_time / 1e12
+                if self.peak_flops:
+                    record['perf/mfu'] = self._flops / step_time / self.peak_flops
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            peak_allocated = torch.cuda.max_memory_allocated()
+            record['memory/peak_allocated_gb'] = peak_allocated / 2 ** 30
+            record['memory/peak_reserved_gb'] = torch.cuda.max_memory_reserved() / 2 ** 30
+            # 峰值只增不减 , 与上一步的差值即本步抬高的峰值 , 为 0 说明本步没有超过之前的峰值
+            if self._peak_allocated is not None:
+                record['memory/peak_allocated_delta_gb'] = (peak_allocated - self._peak_allocated) / 2 ** 30
+            self._peak_allocated = peak_allocated
+        record.update(extra)
+        record['_tokens'], record['_samples'], record['_flops'] = self._tokens, self._samples, self._flops
+
+        self._window.append(record)
+        self._write(record)
+        self._profile_step()
+        self.reset_step()
+        return {k: v for k, v in record.items() if not k.startswith('_') and k != 'step'}
+
+    def pop_window(self) -> Dict[str, float]:
+        '''
+            上次 pop_window 以来各 step 的汇总 , 时间取均值 , 吞吐按总量计算 , 显存取最大值 , 峰值增量求和
+        '''
+        window, self._window = self._window, []
+        if not window:
+            return {}
+        out = {}
+        total_time = sum(r['time/step'] for r in window)
+        for r in window:
+            for k, v in r.items():
+                if k.startswith('time/'):
+                    out[k] = out.get(k, 0.0) + v / len(window)
+                elif k.endswith('_delta_gb'):
+                    out[k] = out.get(k, 0.0) + v
+                elif k.startswith('memory/'):
+                    out[k] = max(out.get(k, 0.0), v)
+        if total_time > 0:
+            tokens = sum(r['_tokens'] for r in window)
+            samples = sum(r['_samples'] for r in window)
+            flops = sum(r['_flops'] for r in window)
+            if tokens:
+                out['throughput/tokens_per_sec'] = tokens / total_time
+            if samples:
+                out['throughput/samples_per_sec'] = samples / total_time
+            if flops:
+                out['perf/tflops'] = flops / total_time / 1e12
+                if self.peak_flops:
+                    out['perf/mfu'] = flops / total_time / self.peak_flops
+        return out
+
+    def _write(self, record):
+        if not self.log_file or not self.is_global_zero():
+            return
+        if self._fp is None:
+            dirname = os.path.dirname(self.log_file)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._fp = open(self.log_file, mode='a', encoding='utf-8')
+        self._fp.write(json.dumps({k: v for k, v in record.items() if not k.startswith('_')}, ensure_ascii=False) + '\n')
+        self._fp.flush()
+
+    def start_profile(self, num_steps=None, output_dir=None):
+        '''
+            从下一个 step 开始 profile num_steps 步 , trace 写到 output_dir (tensorboard 格式)
+        '''
+        if self._profiler is not None:
+            return
+        num_steps = num_steps or self.profile_steps
+        output_dir = output_dir or self.profile_dir or './profile'
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=0, warmup=1, active=num_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(output_dir),
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self._profiler.start()
+        self._profile_remaining = num_steps + 1
+
+    def _profile_step(self):
+        if self._profiler is None:
+            trigger = self.profile_trigger_file
+            if trigger and os.path.exists(trigger):
+                try:
+                    os.remove(trigger)
+                except OSError:
+                    pass
+                self.start_profile()
+            return
+        self._profiler.step()
+        self._profile_remaining -= 1
+        if self._profile_remaining <= 0:
+            self._profiler.stop()
+            self._profiler = None
+
+    def close(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class TelemetryCallback(TrainerCallback):
+    '''
+        transformers.Trainer 的 step 计时 , 阶段计时由 trainer 自己调用 telemetry.phase
+    '''
+    def __init__(self, telemetry: StepTelemetry):
+        self.telemetry = telemetry
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.telemetry.reset_step()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.telemetry.step_end(state.global_step)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.telemetry.close()
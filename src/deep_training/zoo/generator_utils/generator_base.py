@@ -70,6 +70,29 @@ class GeneratorBase:
         response = self.post_process(outputs, prompt_length,output_scores)
         return response,history
 
+    @torch.no_grad()
+    def generate_ilql(self, query: str, history: List[Tuple[str, str]] = None, **kwargs):
+        # 复用各模型族的 prompt 构造 , 用 ilql 头做 advantage 加权采样 , model 需带 generate_ilql
+        prompt, history = self.preprocess_inputs(query, history)
+        inputs = self.build_tokens(prompt, max_new_tokens=kwargs.get('max_new_tokens', 0))
+        if not isinstance(inputs, (dict, BatchEncoding)):
+            inputs = {"input_ids": inputs}
+        inputs = {k: inputs[k] for k in ("input_ids", "attention_mask", "position_ids") if k in inputs}
+        kwargs.setdefault('eos_token_id', self.tokenizer.eos_token_id)
+        kwargs.setdefault('pad_token_id', self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None
+                          else self.tokenizer.eos_token_id)
+        outputs = self.model.generate_ilql(**inputs, **kwargs)
+        prompt_length = 0
+        if not self.model.config.is_encoder_decoder:
+            prompt_length = len(inputs["input_ids"][0])
+        response = self.post_process_ilql(outputs, prompt_length)
+        return response, history
+
+    def post_process_ilql(self, outputs, prompt_length):
+        # 不走 post_process , 子类 (如 xverse) 的 post_process 签名不同
+        outputs = outputs.tolist()[0][prompt_length:]
+        return self.tokenizer.decode(outputs, skip_special_tokens=True)
+
     @torch.no_grad()
     def chat_stream(self, query: str, history: List[Tuple[str, str]] = None, **kwargs):
         raise NotImplemented
\ No newline at end of file
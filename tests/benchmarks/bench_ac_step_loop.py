@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 11:00
+# @FileName: bench_ac_step_loop.py
+"""
+    TrainerAC 训练循环的每步耗时 : 原循环 (每个 micro step .item() 同步 + 阻塞拷贝 + empty_cache)
+    与 low_overhead_loop (loss 在 device 上累积 , _DevicePrefetcher 在 side stream 上预取下一个 batch)
+    python tests/benchmarks/bench_ac_step_loop.py --batch 16 --seq_len 512 --hidden 1024 --steps 50
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+
+from deep_training.trainer.ac.trainer import _DevicePrefetcher  # noqa: E402
+
+
+class _Model(nn.Module):
+    def __init__(self, vocab, hidden, layers):
+        super().__init__()
+        self.embed = nn.Embedding(vocab, hidden)
+        self.layers = nn.Sequential(*[nn.Sequential(nn.Linear(hidden, hidden * 4), nn.GELU(),
+                                                    nn.Linear(hidden * 4, hidden)) for _ in range(layers)])
+        self.head = nn.Linear(hidden, vocab)
+
+    def forward(self, input_ids, labels):
+        logits = self.head(self.layers(self.embed(input_ids)))
+        return nn.functional.cross_entropy(logits.flatten(0, 1), labels.flatten())
+
+
+def _batches(n, batch, seq_len, vocab):
+    g = torch.Generator().manual_seed(0)
+    out = []
+    for _ in range(n):
+        input_ids = torch.randint(0, vocab, (batch, seq_len), generator=g)
+        out.append({'input_ids': input_ids.pin_memory(), 'labels': input_ids.clone().pin_memory()})
+    return out
+
+
+def run(model, optimizer, batches, device, low_overhead):
+    tr_loss = torch.tensor(0.0, device=device)
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    iterable = _DevicePrefetcher(batches, device) if low_overhead else batches
+    for batch in iterable:
+        batch = {k: v.to(device) for k, v in batch.items()}
+        loss = model(**batch)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if low_overhead:
+            tr_loss += torch.where(torch.isfinite(loss), loss.detach(), tr_loss)
+        else:
+            if torch.isnan(loss) or torch.isinf(loss):
+                tr_loss += tr_loss
+            else:
+                tr_loss += loss.detach()
+            loss.item()
+            torch.cuda.empty_cache()
+    torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / len(batches) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=512)
+    parser.add_argument('--hidden', type=int, default=1024)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--vocab', type=int, default=32000)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    args = parser.parse_args()
+    if not torch.cuda.is_available():
+        raise SystemExit('cuda is required')
+    device = torch.device('cuda', torch.cuda.current_device())
+    model = _Model(args.vocab, args.hidden, args.layers).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    warmup = _batches(args.warmup, args.batch, args.seq_len, args.vocab)
+    batches = _batches(args.steps, args.batch, args.seq_len, args.vocab)
+    results = {}
+    for name, low_overhead in (('default', False), ('low_overhead', True)):
+        run(model, optimizer, warmup, device, low_overhead)
+        results[name] = run(model, optimizer, batches, device, low_overhead)
+    print('default {:.2f} ms/step , low_overhead {:.2f} ms/step , speedup {:.2f}x'.format(
+        results['default'], results['low_overhead'], results['default'] / results['low_overhead']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 19:50
+# @FileName: bench_alibi_memory.py
+"""
+    baichuan 13b 单层 ALiBi attention 的峰值显存与上下文长度的关系 :
+    原实现 (稠密 (n_head, S, S) alibi buffer + [b, 1, S, S] padding mask 展开 , sdpa) 与 alibi_attention (按 query 分块)
+    先在短序列上校验两者输出一致
+    python tests/benchmarks/bench_alibi_memory.py --context_lens 2048 4096 8192 16384 --heads 40 --head_dim 128
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+
+from deep_training.nlp.layers.alibi import alibi_slopes, alibi_attention, _get_interleave  # noqa: E402
+
+
+def _gen_alibi_mask(n_head, max_pos, device):
+    # baichuan2_13b 原实现 , 推理时作为 buffer 常驻
+    slopes = torch.tensor(_get_interleave(n_head), device=device)
+    alibi = (slopes.view(-1, 1, 1) * torch.arange(max_pos, device=device).view(1, 1, -1))
+    future = torch.triu(torch.full((max_pos, max_pos), float('-inf'), device=device), 1)
+    return future.unsqueeze(0) + alibi
+
+
+def dense_attention(query, key, value, attention_mask, buffer):
+    q_len = query.size(2)
+    k_len = key.size(2)
+    alibi_mask = buffer[:, :k_len, :k_len]
+    expanded_mask = attention_mask.to(alibi_mask.dtype)
+    expanded_mask = torch.tril(torch.gt(expanded_mask[:, :, None] * expanded_mask[:, None, :], 0)) \
+        * torch.eq(expanded_mask[:, :, None] - expanded_mask[:, None, :], 0)
+    inverted_mask = 1.0 - expanded_mask.unsqueeze(1).to(alibi_mask.dtype)
+    inverted_mask = inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(alibi_mask.dtype).min)
+    mask = (inverted_mask + alibi_mask.unsqueeze(0))[..., -q_len:, :]
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=mask)
+
+
+def _inputs(context_len, args, device, dtype):
+    g = torch.Generator(device=device).manual_seed(context_len)
+    shape = (args.batch, args.heads, context_len, args.head_dim)
+    query, key, value = [torch.randn(shape, generator=g, device=device, dtype=dtype) for _ in range(3)]
+    attention_mask = torch.ones(args.batch, context_len, dtype=torch.long, device=device)
+    # 第一条样本左 padding 1/8
+    attention_mask[0, :context_len // 8] = 0
+    return query, key, value, attention_mask
+
+
+def _check(args, device, dtype):
+    query, key, value, attention_mask = _inputs(256, args, device, dtype)
+    buffer = _gen_alibi_mask(args.heads, 256, device).to(dtype)
+    expected = dense_attention(query, key, value, attention_mask, buffer)
+    out, _ = alibi_attention(query, key, value, alibi_slopes(args.heads, device), attention_mask=attention_mask,
+                             block_size=args.block_size)
+    # padding 的 query 行输出无意义 , 不比较
+    valid = attention_mask.bool()[:, None, :, None]
+    diff = ((out - expected).float() * valid).abs().max()
+    assert diff < 1e-2, diff
+    assert torch.isfinite(out).all()
+
+
+def measure(fn, device):
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    start = time.perf_counter()
+    try:
+        fn()
+        torch.cuda.synchronize(device)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return None, None
+    elapsed = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated(device) - base
+    torch.cuda.empty_cache()
+    return peak / 2 ** 30, elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--context_lens', type=int, nargs='+', default=[2048, 4096, 8192, 16384])
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--heads', type=int, default=40)
+    parser.add_argument('--head_dim', type=int, default=128)
+    parser.add_argument('--block_size', type=int, default=None, help='None 时按 alibi_attention 的显存预算推算')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'bfloat16'])
+    args = parser.parse_args()
+    if not torch.cuda.is_available():
+        raise SystemExit('cuda is required')
+    device = torch.device('cuda', torch.cuda.current_device())
+    dtype = getattr(torch, args.dtype)
+    _check(args, device, dtype)
+
+    # 峰值为 q / k / v 之外的增量 , dense 包含常驻的 (n_head, S, S) buffer , buffer 列为其理论大小
+    print('{:>8s} | {:>10s} | {:>20s} | {:>24s}'.format('context', 'buffer GB', 'dense GB (ms)',
+                                                        'alibi_attention GB (ms)'))
+    slopes = alibi_slopes(args.heads, device)
+    for context_len in args.context_lens:
+        query, key, value, attention_mask = _inputs(context_len, args, device, dtype)
+
+        def dense():
+            buffer = _gen_alibi_mask(args.heads, context_len, device).to(dtype)
+            dense_attention(query, key, value, attention_mask, buffer)
+
+        def blocked():
+            alibi_attention(query, key, value, slopes, attention_mask=attention_mask, block_size=args.block_size)
+
+        cells = []
+        for fn in (dense, blocked):
+            peak, ms = measure(fn, device)
+            cells.append('OOM' if peak is None else '{:.2f} ({:.0f})'.format(peak, ms))
+        buffer_gb = args.heads * context_len * context_len * torch.finfo(dtype).bits / 8 / 2 ** 30
+        print('{:>8d} | {:>10.2f} | {:>20s} | {:>24s}'.format(context_len, buffer_gb, *cells))
+        del query, key, value, attention_mask
+        torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    main()
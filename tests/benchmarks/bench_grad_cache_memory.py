@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 11:20
+# @FileName: bench_grad_cache_memory.py
+"""
+    句向量 in-batch 负例训练的峰值显存与 batch 大小的关系 : 直接编码 与 grad_cache_encode 分块编码
+    两个 dropout 视图 (simcse 形式) , loss 为 in-batch infonce , 先在小 batch 上校验两种方式梯度一致
+    python tests/benchmarks/bench_grad_cache_memory.py --batch_sizes 64 128 256 512 1024 --chunk_size 64
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from transformers import BertConfig, BertModel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+
+from deep_training.nlp.models.embedding_utils import encode_views  # noqa: E402
+
+
+def _loss(model, input_ids, attention_mask, chunk_size, temperature=0.05):
+    def encode_fn(input_ids, attention_mask):
+        return model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0]
+
+    a, b = encode_views(encode_fn, input_ids, attention_mask, chunk_size=chunk_size)
+    logits = F.normalize(a, dim=-1) @ F.normalize(b, dim=-1).T / temperature
+    return F.cross_entropy(logits.float(), torch.arange(logits.size(0), device=logits.device))
+
+
+def _inputs(batch_size, seq_len, vocab, device):
+    g = torch.Generator().manual_seed(batch_size)
+    input_ids = torch.randint(1, vocab, (batch_size, 1, seq_len), generator=g).repeat(1, 2, 1)
+    return input_ids.to(device), torch.ones_like(input_ids)
+
+
+def _check(model, device, args):
+    # 两种方式消耗随机数的顺序不同 , 关闭 dropout 比较
+    model.eval()
+    input_ids, attention_mask = _inputs(2 * args.chunk_size, args.seq_len, model.config.vocab_size, device)
+    grads = []
+    for chunk_size in (None, args.chunk_size):
+        model.zero_grad()
+        torch.manual_seed(0)
+        _loss(model, input_ids, attention_mask, chunk_size).backward()
+        grads.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+    for g0, g1 in zip(*grads):
+        assert torch.allclose(g0, g1, rtol=1e-3, atol=1e-4), (g0 - g1).abs().max()
+    model.zero_grad(set_to_none=True)
+    model.train()
+
+
+def measure(model, device, batch_size, chunk_size, args):
+    input_ids, attention_mask = _inputs(batch_size, args.seq_len, model.config.vocab_size, device)
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    start = time.perf_counter()
+    try:
+        _loss(model, input_ids, attention_mask, chunk_size).backward()
+        torch.cuda.synchronize(device)
+    except torch.cuda.OutOfMemoryError:
+        return None, None
+    finally:
+        model.zero_grad(set_to_none=True)
+    elapsed = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated(device) - base
+    torch.cuda.empty_cache()
+    return peak / 2 ** 30, elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 128, 256, 512, 1024])
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--hidden', type=int, default=768)
+    parser.add_argument('--layers', type=int, default=12)
+    args = parser.parse_args()
+    if not torch.cuda.is_available():
+        raise SystemExit('cuda is required')
+    device = torch.device('cuda', torch.cuda.current_device())
+    config = BertConfig(hidden_size=args.hidden, num_hidden_layers=args.layers,
+                        num_attention_heads=args.hidden // 64, intermediate_size=args.hidden * 4)
+    model = BertModel(config, add_pooling_layer=False).to(device).train()
+    _check(model, device, args)
+
+    print('{:>6s} | {:>22s} | {:>22s}'.format('batch', 'direct GB (ms)', f'grad cache {args.chunk_size} GB (ms)'))
+    for batch_size in args.batch_sizes:
+        cells = []
+        for chunk_size in (None, args.chunk_size):
+            peak, ms = measure(model, device, batch_size, chunk_size, args)
+            cells.append('OOM' if peak is None else '{:.2f} ({:.0f})'.format(peak, ms))
+        print('{:>6d} | {:>22s} | {:>22s}'.format(batch_size, *cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 14:40
+# @FileName: bench_kv_cache_ppl.py
+"""
+    kv_cache_bits 对困惑度的影响 : 逐 token 带 cache 解码 (每步都读取量化后的历史) , 与不量化的 cache 比较
+    python tests/benchmarks/bench_kv_cache_ppl.py --model_path ./chatglm3-6b \
+        --model_class deep_training.nlp.models.chatglm3.modeling_chatglm.ChatGLMForConditionalGeneration \
+        --config_class deep_training.nlp.models.chatglm3.configuration_chatglm.ChatGLMConfig \
+        --text_file ./wiki.test.txt --bits 8 4
+"""
+import argparse
+import importlib
+import math
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+
+
+def _import(name):
+    module, _, attr = name.rpartition('.')
+    return getattr(importlib.import_module(module), attr)
+
+
+@torch.inference_mode()
+def perplexity(model, windows, device, prefill):
+    '''
+        每个窗口先 prefill 前 prefill 个 token , 之后逐 token 解码 , 只统计解码部分的 nll
+    '''
+    nll, count = 0.0, 0
+    for ids in windows:
+        ids = ids.to(device)[None]
+        position_ids = torch.arange(ids.size(1), device=device)[None]
+        out = model(input_ids=ids[:, :prefill], position_ids=position_ids[:, :prefill], use_cache=True)
+        past, logits = out.past_key_values, out.logits[:, -1]
+        for t in range(prefill, ids.size(1)):
+            nll += F.cross_entropy(logits.float(), ids[:, t], reduction='sum').item()
+            count += 1
+            out = model(input_ids=ids[:, t: t + 1], position_ids=position_ids[:, t: t + 1],
+                        past_key_values=past, use_cache=True)
+            past, logits = out.past_key_values, out.logits[:, -1]
+    return math.exp(nll / max(count, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--model_class', required=True, help='dotted path of the CausalLM class')
+    parser.add_argument('--config_class', required=True, help='dotted path of the config class')
+    parser.add_argument('--text_file', required=True)
+    parser.add_argument('--bits', type=int, nargs='+', default=[8, 4])
+    parser.add_argument('--window', type=int, default=1024)
+    parser.add_argument('--prefill', type=int, default=128)
+    parser.add_argument('--num_windows', type=int, default=8)
+    parser.add_argument('--dtype', default='float16')
+    parser.add_argument('--device', default='cuda')
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    with open(args.text_file, mode='r', encoding='utf-8') as f:
+        ids = torch.tensor(tokenizer.encode(f.read()), dtype=torch.long)
+    windows = [w for w in ids.split(args.window) if w.numel() == args.window][:args.num_windows]
+    device = torch.device(args.device)
+    config_class, model_class = _import(args.config_class), _import(args.model_class)
+
+    results = {}
+    for bits in [None] + list(args.bits):
+        config = config_class.from_pretrained(args.model_path)
+        config.kv_cache_bits = bits
+        model = model_class.from_pretrained(args.model_path, config=config,
+                                            torch_dtype=getattr(torch, args.dtype)).to(device).eval()
+        start = time.perf_counter()
+        results[bits] = perplexity(model, windows, device, args.prefill)
+        print('kv_cache_bits {}: ppl {:.4f} , delta {:+.4f} , {:.1f}s'.format(
+            bits, results[bits], results[bits] - results[None], time.perf_counter() - start))
+        del model
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    main()
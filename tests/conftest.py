@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 9:00
+# @FileName: conftest.py
+import os
+import sys
+
+# 未安装 deep_training 时直接使用源码目录
+_SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 16:00
+# @FileName: test_adversarial.py
+"""
+    按行扰动 (默认) 与稠密扰动 : 扰动后的词表一致 , restore 只恢复 batch 中出现的行
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+from torch import nn  # noqa: E402
+
+from deep_training.nlp.utils.adversarial import FGM  # noqa: E402
+
+
+class _Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(16, 4)
+        self.head = nn.Linear(4, 1)
+
+    def get_input_embeddings(self):
+        return self.embedding
+
+    def forward(self, input_ids):
+        return self.head(self.embedding(input_ids)).sum()
+
+
+def _attacked(input_ids, sparse):
+    torch.manual_seed(0)
+    model = _Model()
+    model(input_ids).backward()
+    fgm = FGM(model, emb_name='embedding')
+    before = model.embedding.weight.detach().clone()
+    fgm.attack(epsilon=1.0, input_ids=input_ids if sparse else None)
+    return model, fgm, before
+
+
+def test_fgm_sparse_matches_dense():
+    input_ids = torch.tensor([[1, 3, 3, 7]])
+    sparse_model, _, before = _attacked(input_ids, sparse=True)
+    dense_model, _, _ = _attacked(input_ids, sparse=False)
+    assert torch.allclose(sparse_model.embedding.weight, dense_model.embedding.weight)
+
+    untouched = torch.ones(16, dtype=torch.bool)
+    untouched[input_ids.flatten()] = False
+    assert torch.equal(sparse_model.embedding.weight[untouched], before[untouched])
+
+
+def test_fgm_sparse_restores_touched_rows_only():
+    input_ids = torch.tensor([[2, 5]])
+    model, fgm, before = _attacked(input_ids, sparse=True)
+    assert fgm.backup['embedding.weight'].shape == (2, 4)
+    with torch.no_grad():
+        # 模拟 opt.step() 对全部行的更新
+        model.embedding.weight.add_(1.0)
+    fgm.restore()
+    weight = model.embedding.weight.detach()
+    assert torch.equal(weight[[2, 5]], before[[2, 5]])
+    assert torch.equal(weight[[0, 1, 3]], before[[0, 1, 3]] + 1.0)
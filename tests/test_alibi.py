@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 19:30
+# @FileName: test_alibi.py
+"""
+    alibi_attention (按 query 分块 , sdpa / eager) 与 baichuan 原实现 (稠密 _gen_alibi_mask + 2D mask 展开 + softmax) 一致
+    padding , packing 的 2D mask , 3D mask , 带 past 的 decode ; 整行被屏蔽时两条路径都有限且一致
+"""
+import math
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from deep_training.nlp.layers.alibi import alibi_slopes, alibi_attention  # noqa: E402
+
+N_HEAD = 6
+HEAD_DIM = 8
+SEQ_LEN = 8
+
+
+# ---- baichuan2_13b 原实现 ----
+def _get_interleave(n):
+    def _get_interleave_power_of_2(n):
+        start = 2 ** (-(2 ** -(math.log2(n) - 3)))
+        ratio = start
+        return [start * ratio**i for i in range(n)]
+
+    if math.log2(n).is_integer():
+        return _get_interleave_power_of_2(n)
+    else:
+        closest_power_of_2 = 2 ** math.floor(math.log2(n))
+        return (
+            _get_interleave_power_of_2(closest_power_of_2)
+            + _get_interleave(2 * closest_power_of_2)[0::2][: n - closest_power_of_2]
+        )
+
+
+def _fill_with_neg_inf(t):
+    return t.float().fill_(float("-inf")).type_as(t)
+
+
+def _gen_alibi_mask(tensor, n_head, max_pos):
+    slopes = torch.Tensor(_get_interleave(n_head))
+    position_point = torch.arange(max_pos) - max_pos + 1
+    position_point = position_point.unsqueeze(0).unsqueeze(0).expand(n_head, -1, -1)
+    diag = torch.diag(position_point[0])
+    position_point = position_point - diag.unsqueeze(0).unsqueeze(0).transpose(-1, -2)
+    alibi = slopes.unsqueeze(1).unsqueeze(1) * position_point
+    alibi = alibi.view(n_head, 1, max_pos)
+    alibi_mask = torch.triu(_fill_with_neg_inf(torch.zeros([max_pos, max_pos])), 1)
+    alibi_mask = alibi_mask.unsqueeze(0) + alibi
+    return alibi_mask
+
+
+def _old_mask(attention_mask, bsz, k_len, q_len, dtype=torch.float32):
+    alibi_mask = _gen_alibi_mask(None, N_HEAD, k_len).to(dtype)
+    if attention_mask is not None:
+        if len(attention_mask.shape) == 2:
+            expanded_mask = attention_mask.to(alibi_mask.dtype)
+            expanded_mask = torch.tril(
+                torch.gt(expanded_mask[:, :, None] * expanded_mask[:, None, :], 0)
+            ) * torch.eq(expanded_mask[:, :, None] - expanded_mask[:, None, :], 0)
+        else:
+            expanded_mask = attention_mask
+        src_len, tgt_len = alibi_mask.size()[-2:]
+        expanded_mask = expanded_mask.unsqueeze(1).expand(bsz, 1, src_len, tgt_len).to(alibi_mask.dtype)
+        inverted_mask = 1.0 - expanded_mask
+        inverted_mask = inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(alibi_mask.dtype).min)
+        attention_mask = inverted_mask + alibi_mask.unsqueeze(0)
+    else:
+        attention_mask = alibi_mask
+    if attention_mask.size(-2) != q_len:
+        attention_mask = attention_mask[..., -q_len:, :]
+    return attention_mask
+
+
+def _old_attention(query, key, value, attention_mask):
+    attn_weights = torch.matmul(query, key.transpose(2, 3)) / math.sqrt(HEAD_DIM)
+    attn_weights = attn_weights + _old_mask(attention_mask, query.size(0), key.size(2), query.size(2), query.dtype)
+    attn_weights = torch.max(attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min))
+    attn_weights = torch.nn.functional.softmax(attn_weights, dim=-1)
+    return torch.matmul(attn_weights, value), attn_weights
+
+
+# ---- 用例 ----
+MASKS = {
+    'none': None,
+    'left_padding': torch.tensor([[0, 0, 1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 1, 1, 1]]),
+    'right_padding': torch.tensor([[1, 1, 1, 1, 1, 0, 0, 0], [1, 1, 1, 1, 1, 1, 1, 0]]),
+    'packed': torch.tensor([[1, 1, 1, 2, 2, 3, 3, 0], [1, 1, 2, 2, 2, 2, 3, 3]]),
+}
+
+
+def _qkv(q_len, k_len, dtype=torch.float32, scale=1.0):
+    g = torch.Generator().manual_seed(0)
+    query = scale * torch.randn(2, N_HEAD, q_len, HEAD_DIM, generator=g)
+    key = torch.randn(2, N_HEAD, k_len, HEAD_DIM, generator=g)
+    value = torch.randn(2, N_HEAD, k_len, HEAD_DIM, generator=g)
+    return query.to(dtype), key.to(dtype), value.to(dtype)
+
+
+def _valid_rows(attention_mask, q_len):
+    # [b, q_len] , 原实现中整行被屏蔽 (padding query) 的行输出无意义 , 不比较
+    if attention_mask is None:
+        return torch.ones(2, q_len, dtype=torch.bool)
+    return (attention_mask[:, -q_len:] > 0) if attention_mask.dim() == 2 \
+        else attention_mask[:, -q_len:].gt(0).any(-1)
+
+
+def test_slopes_match():
+    for n_head in (6, 8, 40):
+        assert torch.equal(alibi_slopes(n_head), torch.Tensor(_get_interleave(n_head)))
+
+
+@pytest.mark.parametrize('mask_name', list(MASKS))
+@pytest.mark.parametrize('q_len', [SEQ_LEN, 3, 1], ids=['prefill', 'chunk', 'decode'])
+@pytest.mark.parametrize('block_size', [None, 1, 3])
+@pytest.mark.parametrize('output_attentions', [False, True], ids=['sdpa', 'eager'])
+def test_matches_dense_alibi(mask_name, q_len, block_size, output_attentions):
+    attention_mask = MASKS[mask_name]
+    query, key, value = _qkv(q_len, SEQ_LEN)
+    out, weights = alibi_attention(query, key, value, alibi_slopes(N_HEAD), attention_mask=attention_mask,
+                                   block_size=block_size, output_attentions=output_attentions)
+    expected, expected_weights = _old_attention(query, key, value, attention_mask)
+
+    assert torch.isfinite(out).all()
+    valid = _valid_rows(attention_mask, q_len)[:, None, :].expand(-1, N_HEAD, -1)
+    assert torch.allclose(out[valid], expected[valid], atol=1e-5)
+    if output_attentions:
+        assert torch.allclose(weights[valid], expected_weights[valid], atol=1e-5)
+
+
+def test_matches_dense_alibi_3d_mask():
+    packed = MASKS['packed']
+    mask_3d = (torch.tril(torch.gt(packed[:, :, None] * packed[:, None, :], 0))
+               * torch.eq(packed[:, :, None] - packed[:, None, :], 0)).long()
+    query, key, value = _qkv(SEQ_LEN, SEQ_LEN)
+    expected, _ = _old_attention(query, key, value, packed)
+    valid = _valid_rows(packed, SEQ_LEN)[:, None, :].expand(-1, N_HEAD, -1)
+    for output_attentions in (False, True):
+        out, _ = alibi_attention(query, key, value, alibi_slopes(N_HEAD), attention_mask=mask_3d, block_size=3,
+                                 output_attentions=output_attentions)
+        assert torch.allclose(out[valid], expected[valid], atol=1e-5)
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float16])
+def test_fully_masked_rows_are_finite(dtype):
+    # 很大的负分数 : float16 下 score + finfo.min 溢出为 -inf , 整行被屏蔽时不能出现 NaN
+    query, key, value = _qkv(SEQ_LEN, SEQ_LEN, dtype=dtype, scale=300.0)
+    key = -key.abs()
+    query = query.abs()
+    attention_mask = MASKS['left_padding']
+    try:
+        sdpa, _ = alibi_attention(query, key, value, alibi_slopes(N_HEAD), attention_mask=attention_mask)
+        eager, _ = alibi_attention(query, key, value, alibi_slopes(N_HEAD), attention_mask=attention_mask,
+                                   output_attentions=True)
+    except RuntimeError as e:
+        pytest.skip('{} attention is not supported on cpu: {}'.format(dtype, e))
+    assert torch.isfinite(sdpa).all() and torch.isfinite(eager).all()
+    if dtype == torch.float32:
+        # float16 下分数的量化误差过大 , 只比较 float32
+        assert torch.allclose(sdpa, eager, atol=1e-4)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 11:40
+# @FileName: test_distributed_gather.py
+"""
+    all_gather_with_grad 与 info_nce(distributed=True) 的梯度 : 本机 gloo 起 2 个 rank ,
+    与单进程在完整数据上计算的 (各 rank loss 之和的) 梯度比较
+"""
+import socket
+
+import pytest
+
+torch = pytest.importorskip('torch')
+dist = torch.distributed
+
+if not dist.is_available() or not dist.is_gloo_available():
+    pytest.skip('gloo backend is not available', allow_module_level=True)
+
+import torch.nn.functional as F  # noqa: E402
+
+from deep_training.nlp.losses.distributed import all_gather_with_grad  # noqa: E402
+from deep_training.nlp.losses.loss_infonce import info_nce  # noqa: E402
+
+WORLD_SIZE = 2
+DIM = 4
+NUM_NEGATIVES = 3
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _run(fn, *args):
+    port = _free_port()
+    torch.multiprocessing.spawn(_entry, args=(fn, port) + args, nprocs=WORLD_SIZE, join=True)
+
+
+def _entry(rank, fn, port, *args):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=WORLD_SIZE)
+    try:
+        fn(rank, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def _randn(sizes, *shape, seed):
+    # 每个 rank 都能构造出全部 rank 的数据 , 用于单进程参考计算
+    g = torch.Generator().manual_seed(seed)
+    return [torch.randn(n, *shape, generator=g, dtype=torch.float64) for n in sizes]
+
+
+def _gather_worker(rank, sizes, same_size):
+    xs = _randn(sizes, DIM, seed=0)
+    weights = _randn([sum(sizes)] * WORLD_SIZE, DIM, seed=1)
+    x = xs[rank].clone().requires_grad_(True)
+    gathered, offset = all_gather_with_grad(x, same_size=same_size)
+    assert offset == sum(sizes[:rank])
+    assert torch.equal(gathered.detach(), torch.cat(xs))
+    (gathered * weights[rank]).sum().backward()
+
+    # 参考 : 每个 rank 的 loss 都用到 x , 梯度为各 rank 权重在 x 对应行上的和
+    ref = [t.clone().requires_grad_(True) for t in xs]
+    full = torch.cat(ref)
+    sum((full * w).sum() for w in weights).backward()
+    assert torch.allclose(x.grad, ref[rank].grad)
+
+
+@pytest.mark.parametrize('sizes,same_size', [([3, 3], False), ([3, 3], True), ([3, 2], False)])
+def test_all_gather_with_grad(sizes, same_size):
+    _run(_gather_worker, sizes, same_size)
+
+
+def _paired_ref_loss(query, positive_key, negative_keys, rank, temperature):
+    # 与 info_nce paired + distributed 相同 : 其他 rank 的正例作为额外的负例
+    q = F.normalize(query[rank], dim=-1)
+    p = F.normalize(positive_key[rank], dim=-1)
+    n = F.normalize(negative_keys[rank], dim=-1)
+    others = torch.cat([F.normalize(k, dim=-1) for i, k in enumerate(positive_key) if i != rank])
+    logits = torch.cat([(q * p).sum(-1, keepdim=True), (q.unsqueeze(1) @ n.transpose(-2, -1)).squeeze(1),
+                        q @ others.T], dim=1)
+    labels = torch.zeros(len(logits), dtype=torch.long)
+    return F.cross_entropy(logits / temperature, labels, reduction='sum')
+
+
+def _paired_worker(rank, sizes):
+    temperature = 0.1
+    queries = _randn(sizes, DIM, seed=2)
+    positives = _randn(sizes, DIM, seed=3)
+    negatives = _randn(sizes, NUM_NEGATIVES, DIM, seed=4)
+    q = queries[rank].clone().requires_grad_(True)
+    p = positives[rank].clone().requires_grad_(True)
+    n = negatives[rank].clone().requires_grad_(True)
+    loss = info_nce(q, p, n, temperature=temperature, reduction='sum', negative_mode='paired', distributed=True)
+
+    ref_q = [t.clone().requires_grad_(True) for t in queries]
+    ref_p = [t.clone().requires_grad_(True) for t in positives]
+    ref_n = [t.clone().requires_grad_(True) for t in negatives]
+    ref_losses = [_paired_ref_loss(ref_q, ref_p, ref_n, r, temperature) for r in range(WORLD_SIZE)]
+    assert torch.allclose(loss.detach(), ref_losses[rank].detach())
+
+    loss.backward()
+    sum(ref_losses).backward()
+    assert torch.allclose(q.grad, ref_q[rank].grad)
+    assert torch.allclose(p.grad, ref_p[rank].grad)
+    assert torch.allclose(n.grad, ref_n[rank].grad)
+
+
+@pytest.mark.parametrize('sizes', [[3, 3], [3, 2]])
+def test_info_nce_paired_gathers_positives(sizes):
+    _run(_paired_worker, sizes)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 19:00
+# @FileName: test_glm_mask.py
+"""
+    chatglm / visualglm 的 mask 与 position_ids : layers.mask 中的向量化实现与原逐行循环一致
+    MASK / gMASK 混合 , 左 padding , 缺少 MASK / bos 的行
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from deep_training.nlp.layers.mask import (first_token_index, glm_mask_positions, glm_prefix_lm_mask,  # noqa: E402
+                                           glm_position_ids)
+
+PAD, MASK, GMASK, BOS = 0, 5, 6, 7
+
+
+def _index(seq, token, default):
+    # 原实现为 seq.index(token) , 不存在时抛出异常 ; 向量化实现取 default
+    return seq.index(token) if token in seq else default
+
+
+def _old_mask_positions(input_ids):
+    mask_positions, use_gmasks = [], []
+    for seq in input_ids.tolist():
+        mask_token = GMASK if GMASK in seq else MASK
+        use_gmask = mask_token == GMASK
+        mask_positions.append(_index(seq, mask_token, 0))
+        use_gmasks.append(use_gmask)
+    return mask_positions, use_gmasks
+
+
+def _old_context_lengths(input_ids):
+    return [_index(seq, BOS, len(seq)) for seq in input_ids.tolist()]
+
+
+def _old_get_masks(input_ids, padding_mask=None):
+    batch_size, seq_length = input_ids.shape
+    context_lengths = _old_context_lengths(input_ids)
+    attention_mask = torch.ones((batch_size, seq_length, seq_length))
+    attention_mask.tril_()
+    for i, context_length in enumerate(context_lengths):
+        attention_mask[i, :, :context_length] = 1
+    if padding_mask is not None:
+        attention_mask = attention_mask * padding_mask.unsqueeze(1) * padding_mask.unsqueeze(2)
+    attention_mask.unsqueeze_(1)
+    return (attention_mask < 0.5).bool()
+
+
+def _old_get_position_ids(input_ids, mask_positions, position_encoding_2d, use_gmasks=None):
+    batch_size, seq_length = input_ids.shape
+    if use_gmasks is None:
+        use_gmasks = [False] * batch_size
+    context_lengths = _old_context_lengths(input_ids)
+    position_ids = torch.arange(seq_length, dtype=torch.long).unsqueeze(0).repeat(batch_size, 1)
+    if position_encoding_2d:
+        for i, context_length in enumerate(context_lengths):
+            position_ids[i, context_length:] = mask_positions[i]
+        block_position_ids = [torch.cat((
+            torch.zeros(context_length, dtype=torch.long),
+            torch.arange(seq_length - context_length, dtype=torch.long) + 1
+        )) for context_length in context_lengths]
+        block_position_ids = torch.stack(block_position_ids, dim=0)
+        return torch.stack((position_ids, block_position_ids), dim=1)
+    for i, context_length in enumerate(context_lengths):
+        if not use_gmasks[i]:
+            position_ids[i, context_length:] = mask_positions[i]
+    return position_ids
+
+
+def _old_decode_position_ids(input_ids, mask_positions, position_encoding_2d):
+    # prepare_inputs_for_generation 中有 past 时的最后一个位置
+    seq_length = input_ids.size(1)
+    if position_encoding_2d:
+        return torch.tensor([[mask_position, seq_length - context_length] for mask_position, context_length in
+                             zip(mask_positions, _old_context_lengths(input_ids))], dtype=torch.long).unsqueeze(-1)
+    return torch.tensor(mask_positions, dtype=torch.long).unsqueeze(-1)
+
+
+# 左 padding , MASK / gMASK 混合 , 同时有两者时取 gMASK
+MIXED = torch.tensor([
+    [PAD, PAD, 11, 12, MASK, 13, BOS, 21, 22, 23],
+    [PAD, 11, GMASK, 12, 13, BOS, 21, 22, 23, 24],
+    [11, MASK, 12, GMASK, 13, BOS, 21, 22, 23, 24],
+    [PAD, PAD, PAD, PAD, 11, GMASK, BOS, 21, 22, 23],
+])
+# 没有 MASK / gMASK 的行 , 没有 bos 的行 (整行都是 context)
+MISSING = torch.tensor([
+    [PAD, PAD, 11, 12, MASK, 13, BOS, 21, 22, 23],
+    [PAD, PAD, PAD, 11, 12, 13, BOS, 21, 22, 23],
+    [PAD, 11, 12, GMASK, 13, 14, 15, 16, 17, 18],
+    [PAD, PAD, 11, 12, 13, 14, 15, 16, 17, 18],
+])
+
+
+def _new(input_ids, position_encoding_2d, padding_mask=None):
+    seq_length = input_ids.size(1)
+    context_lengths = first_token_index(input_ids, BOS)
+    mask_positions, use_gmasks = glm_mask_positions(input_ids, MASK, GMASK)
+    masks = glm_prefix_lm_mask(context_lengths, seq_length, padding_mask=padding_mask)
+    position_ids = glm_position_ids(context_lengths, mask_positions, seq_length,
+                                    position_encoding_2d=position_encoding_2d, use_gmasks=use_gmasks)
+    if position_encoding_2d:
+        decode = torch.stack((mask_positions, seq_length - context_lengths), dim=1).unsqueeze(-1)
+    else:
+        decode = mask_positions.unsqueeze(-1)
+    return (mask_positions, use_gmasks), masks, position_ids, decode
+
+
+def _old(input_ids, position_encoding_2d, padding_mask=None):
+    mask_positions, use_gmasks = _old_mask_positions(input_ids)
+    masks = _old_get_masks(input_ids, padding_mask=padding_mask)
+    position_ids = _old_get_position_ids(input_ids, mask_positions, position_encoding_2d, use_gmasks=use_gmasks)
+    decode = _old_decode_position_ids(input_ids, mask_positions, position_encoding_2d)
+    return (mask_positions, use_gmasks), masks, position_ids, decode
+
+
+@pytest.mark.parametrize('input_ids', [MIXED, MISSING], ids=['mixed', 'missing'])
+@pytest.mark.parametrize('position_encoding_2d', [True, False])
+@pytest.mark.parametrize('with_padding_mask', [False, True])
+def test_matches_row_loop(input_ids, position_encoding_2d, with_padding_mask):
+    padding_mask = (input_ids != PAD).long() if with_padding_mask else None
+    (mask_positions, use_gmasks), masks, position_ids, decode = _new(input_ids, position_encoding_2d, padding_mask)
+    (old_mask_positions, old_use_gmasks), old_masks, old_position_ids, old_decode = \
+        _old(input_ids, position_encoding_2d, padding_mask)
+
+    assert mask_positions.tolist() == old_mask_positions
+    assert use_gmasks.tolist() == old_use_gmasks
+    assert masks.dtype == torch.bool and torch.equal(masks, old_masks)
+    assert torch.equal(position_ids, old_position_ids)
+    assert torch.equal(decode, old_decode)
+
+
+def test_first_token_index_defaults():
+    assert first_token_index(MISSING, BOS).tolist() == [6, 6, 10, 10]
+    assert first_token_index(MISSING, BOS, default=-1).tolist() == [6, 6, -1, -1]
+    mask_positions, use_gmasks = glm_mask_positions(MISSING, MASK, GMASK)
+    assert mask_positions.tolist() == [4, 0, 3, 0]
+    assert use_gmasks.tolist() == [False, False, True, False]
+    # 没有 bos 的行整行双向可见
+    assert not glm_prefix_lm_mask(first_token_index(MISSING, BOS), MISSING.size(1))[2:].any()
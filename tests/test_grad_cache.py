@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 17:30
+# @FileName: test_grad_cache.py
+"""
+    grad_cache_encode : 分块编码 (backward 时重算) 的 loss 与参数梯度与不分块时一致
+    dropout 打开时 , 参考为在同一随机数序列下逐块带梯度编码 , 重算必须恢复每块的随机数状态才能一致
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+from torch import nn  # noqa: E402
+import torch.nn.functional as F  # noqa: E402
+
+from deep_training.nlp.models.embedding_utils import grad_cache_encode  # noqa: E402
+
+VOCAB = 32
+BATCH = 10
+SEQ_LEN = 7
+
+
+class _Encoder(nn.Module):
+    def __init__(self, dropout):
+        super().__init__()
+        self.embedding = nn.Embedding(VOCAB, 16)
+        self.dense = nn.Linear(16, 16)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, input_ids, attention_mask):
+        h = self.dropout(torch.tanh(self.dense(self.dropout(self.embedding(input_ids)))))
+        mask = attention_mask.unsqueeze(-1).to(h.dtype)
+        return (h * mask).sum(1) / mask.sum(1)
+
+
+def _inputs():
+    g = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(1, VOCAB, (BATCH, SEQ_LEN), generator=g)
+    lengths = torch.randint(2, SEQ_LEN + 1, (BATCH,), generator=g)
+    attention_mask = (torch.arange(SEQ_LEN)[None] < lengths[:, None]).long()
+    return dict(input_ids=input_ids * attention_mask, attention_mask=attention_mask)
+
+
+def _loss(embeddings):
+    # in-batch 负例 , 每个向量的梯度依赖全部块
+    a, b = F.normalize(embeddings, dim=-1).chunk(2)
+    logits = a @ b.T / 0.05
+    return F.cross_entropy(logits, torch.arange(logits.size(0)))
+
+
+def _run(model, embeddings_fn):
+    model.zero_grad()
+    torch.manual_seed(123)
+    loss = _loss(embeddings_fn())
+    loss.backward()
+    return loss.detach(), [p.grad.clone() for p in model.parameters()]
+
+
+def _assert_same(result, expected):
+    loss, grads = result
+    assert torch.allclose(loss, expected[0], atol=1e-6)
+    for g, e in zip(grads, expected[1]):
+        assert torch.allclose(g, e, atol=1e-6)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4])
+def test_matches_direct_with_dropout(chunk_size):
+    torch.manual_seed(0)
+    model = _Encoder(dropout=0.3).train()
+    inputs = _inputs()
+
+    def direct():
+        # 与 grad cache 的 forward 相同的分块和随机数消耗顺序 , 但整个图保留到 backward
+        chunks = zip(*(v.split(chunk_size) for v in inputs.values()))
+        return torch.cat([model(*chunk) for chunk in chunks])
+
+    expected = _run(model, direct)
+    result = _run(model, lambda: grad_cache_encode(model, inputs, chunk_size, trim=False))
+    _assert_same(result, expected)
+
+    # dropout 确实生效 : 换一组随机数时 loss 不同 , 重算若不恢复随机数状态梯度就会不一致
+    model.zero_grad()
+    torch.manual_seed(124)
+    assert not torch.allclose(_loss(direct()).detach(), expected[0])
+
+
+@pytest.mark.parametrize('chunk_size', [3, 4])
+def test_matches_unchunked_without_dropout(chunk_size):
+    torch.manual_seed(0)
+    model = _Encoder(dropout=0.0).train()
+    inputs = _inputs()
+    expected = _run(model, lambda: model(**inputs))
+    # trim=True 时每块单独裁剪尾部 padding , 带 mask 的平均池化不受影响
+    result = _run(model, lambda: grad_cache_encode(model, inputs, chunk_size, trim=True))
+    _assert_same(result, expected)
+
+
+def test_single_chunk_or_no_grad_calls_directly():
+    model = _Encoder(dropout=0.0)
+    inputs = _inputs()
+    out = grad_cache_encode(model, inputs, BATCH)
+    assert out.grad_fn is not None and 'GradCache' not in type(out.grad_fn).__name__
+    with torch.no_grad():
+        assert grad_cache_encode(model, inputs, 2).grad_fn is None
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 18:30
+# @FileName: test_kv_cache.py
+"""
+    KVCacheBuffer : 传回上次返回的 cache 时原地追加 , 重排后 (非本 buffer 所有) 的 cache 拷贝到新 buffer ,
+    需要梯度时退化为 torch.cat , 结果始终与 torch.cat 一致
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from deep_training.nlp.layers.kv_cache import KVCacheBuffer  # noqa: E402
+
+
+def _kv(seq_dim, n, seed, batch=3):
+    g = torch.Generator().manual_seed(seed)
+    shape = [batch, 2, 4]
+    shape.insert(seq_dim, n)
+    return torch.randn(shape, generator=g), torch.randn(shape, generator=g)
+
+
+def _cat(cache, kv, seq_dim):
+    return tuple(torch.cat((c, t), dim=seq_dim) for c, t in zip(cache, kv))
+
+
+def _assert_equal(out, expected):
+    assert all(torch.equal(a, b) for a, b in zip(out, expected))
+
+
+@pytest.mark.parametrize('seq_dim', [0, 2])
+@torch.no_grad()
+def test_append_in_place(seq_dim):
+    buffer = KVCacheBuffer(seq_dim=seq_dim, block_size=4)
+    expected = _kv(seq_dim, 3, seed=0)
+    past = buffer.append(None, *expected)
+    _assert_equal(past, expected)
+    ptr = past[0].data_ptr()
+
+    for step in range(1, 8):
+        kv = _kv(seq_dim, 1, seed=step)
+        expected = _cat(expected, kv, seq_dim)
+        capacity = buffer._buffers()[0].size(seq_dim)
+        past = buffer.append(past, *kv)
+        _assert_equal(past, expected)
+        assert buffer.length == past[0].size(seq_dim) == 3 + step
+        if past[0].size(seq_dim) <= capacity:
+            # 容量足够时写入同一块 buffer , 不重新分配
+            assert past[0].data_ptr() == ptr
+        else:
+            # 扩容至少翻倍 , 按 block_size 对齐
+            assert buffer._buffers()[0].size(seq_dim) == 2 * capacity
+            ptr = past[0].data_ptr()
+
+
+@pytest.mark.parametrize('seq_dim', [0, 2])
+@torch.no_grad()
+def test_reordered_cache_is_copied(seq_dim):
+    batch_dim = 1 if seq_dim == 0 else 0
+    buffer = KVCacheBuffer(seq_dim=seq_dim, block_size=16)
+    prompt = _kv(seq_dim, 4, seed=0)
+    past = buffer.append(None, *prompt)
+    snapshot = tuple(t.clone() for t in past)
+
+    # beam search 的 _reorder_cache : index_select 得到新张量 , 不属于 buffer
+    beam_idx = torch.tensor([2, 2, 0])
+    reordered = tuple(t.index_select(batch_dim, beam_idx) for t in past)
+    kv = _kv(seq_dim, 1, seed=1)
+    out = buffer.append(reordered, *kv)
+    _assert_equal(out, _cat(reordered, kv, seq_dim))
+    assert out[0].data_ptr() != past[0].data_ptr()
+    # 原 buffer 不被改写
+    _assert_equal(past, snapshot)
+
+    # 新 buffer 之后继续原地追加
+    kv2 = _kv(seq_dim, 1, seed=2)
+    out2 = buffer.append(out, *kv2)
+    assert out2[0].data_ptr() == out[0].data_ptr()
+    _assert_equal(out2, _cat(_cat(reordered, kv, seq_dim), kv2, seq_dim))
+
+    # 传回较早的前缀 (长度与 buffer 不符) 同样拷贝 , 不覆盖之后的内容
+    out3 = buffer.append(out, *kv2)
+    _assert_equal(out3, _cat(_cat(reordered, kv, seq_dim), kv2, seq_dim))
+    assert out3[0].data_ptr() != out2[0].data_ptr()
+    _assert_equal(out2, _cat(_cat(reordered, kv, seq_dim), kv2, seq_dim))
+
+
+def test_buffer_released_with_views():
+    buffer = KVCacheBuffer(seq_dim=0, block_size=4)
+    with torch.no_grad():
+        past = buffer.append(None, *_kv(0, 2, seed=0))
+    assert buffer._buffers()[0] is not None
+    del past
+    # 只保存弱引用 , 视图释放后 buffer 随之释放
+    assert buffer._buffers() == (None, None)
+
+
+def test_grad_falls_back_to_cat():
+    buffer = KVCacheBuffer(seq_dim=0, block_size=4)
+    cache = tuple(t.requires_grad_() for t in _kv(0, 3, seed=0))
+    kv = _kv(0, 1, seed=1)
+    out = buffer.append(cache, *kv)
+    _assert_equal(out, _cat(cache, kv, 0))
+    assert buffer._buffers() == (None, None)
+    # 梯度传回 prefix (p-tuning 的 past_key_values)
+    sum(t.sum() for t in out).backward()
+    assert all(torch.equal(t.grad, torch.ones_like(t)) for t in cache)
+
+    # 需要梯度但在 no_grad 下 , 仍原地追加
+    with torch.no_grad():
+        out = buffer.append(None, *cache)
+    assert buffer._buffers()[0] is not None and not out[0].requires_grad
+
+    # block_size <= 0 关闭预分配
+    disabled = KVCacheBuffer(seq_dim=0, block_size=0)
+    with torch.no_grad():
+        past = disabled.append(None, *kv)
+        out = disabled.append(past, *kv)
+    _assert_equal(out, _cat(kv, kv, 0))
+    assert disabled._buffers() == (None, None)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 14:10
+# @FileName: test_kv_cache_beam.py
+"""
+    量化 kv cache (kv_cache_bits) 下的 beam search : _reorder_cache 重排全部 4 个张量 ,
+    重排后的 cache 与直接按重排后的 batch prefill 得到的结果一致 ; 训练模式不量化
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+VOCAB = 128
+PROMPT_LEN = 6
+
+
+def _init_weights(model):
+    # skip_init 的参数未初始化 , 统一初始化为确定的小随机数
+    with torch.no_grad():
+        for p in model.parameters():
+            if p.dim() == 1:
+                p.fill_(1.0)
+            else:
+                p.normal_(0.0, 0.02)
+    return model
+
+
+def _build(name, bits):
+    kwargs = dict(num_layers=2, padded_vocab_size=VOCAB, hidden_size=64, ffn_hidden_size=128, kv_channels=16,
+                  num_attention_heads=4, seq_length=64, multi_query_attention=True, multi_query_group_num=2,
+                  kv_cache_bits=bits)
+    if name == 'chatglm2':
+        from deep_training.nlp.models.chatglm2.configuration_chatglm import ChatGLMConfig
+        from deep_training.nlp.models.chatglm2.modeling_chatglm import ChatGLMForConditionalGeneration
+        model = ChatGLMForConditionalGeneration(ChatGLMConfig(**kwargs))
+    else:
+        from deep_training.nlp.models.glm4.configuration_chatglm import ChatGLMConfig
+        from deep_training.nlp.models.glm4.modeling_chatglm import ChatGLMForConditionalGeneration
+        # original_rope 只在 checkpoint 的 config.json 中
+        model = ChatGLMForConditionalGeneration(ChatGLMConfig(original_rope=True, **kwargs), empty_init=False)
+    torch.manual_seed(0)
+    return _init_weights(model).eval()
+
+
+def _prefill(model, input_ids):
+    position_ids = torch.arange(input_ids.size(1)).expand(input_ids.size(0), -1)
+    return model(input_ids=input_ids, position_ids=position_ids, use_cache=True).past_key_values
+
+
+def _decode(model, next_ids, past):
+    position_ids = torch.full((next_ids.size(0), 1), PROMPT_LEN, dtype=torch.long)
+    return model(input_ids=next_ids, position_ids=position_ids, past_key_values=past, use_cache=True).logits
+
+
+@pytest.mark.parametrize('name', ['chatglm2', 'glm4'])
+@pytest.mark.parametrize('bits', [8, 4])
+@pytest.mark.parametrize('beam_idx', [[1, 0], [1, 1]])
+@torch.no_grad()
+def test_reorder_cache_keeps_quantized_cache(name, bits, beam_idx):
+    model = _build(name, bits)
+    g = torch.Generator().manual_seed(1)
+    prompts = torch.randint(0, VOCAB, (2, PROMPT_LEN), generator=g)
+    next_ids = torch.randint(0, VOCAB, (2, 1), generator=g)
+    beam_idx = torch.tensor(beam_idx)
+
+    past = _prefill(model, prompts)
+    assert all(len(layer_past) == 4 for layer_past in past)
+    reordered = model._reorder_cache(past, beam_idx)
+    assert all(len(layer_past) == 4 for layer_past in reordered)
+    logits = _decode(model, next_ids, reordered)
+
+    # 参考 : 按重排后的 batch 直接 prefill , 量化是逐 token 的 , cache 与重排结果完全相同
+    expected = _decode(model, next_ids, _prefill(model, prompts[beam_idx]))
+    assert torch.allclose(logits, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('name', ['chatglm2', 'glm4'])
+@torch.no_grad()
+def test_beam_search_with_quantized_cache(name):
+    model = _build(name, 8)
+    prompts = torch.randint(0, VOCAB, (2, PROMPT_LEN), generator=torch.Generator().manual_seed(2))
+    outputs = model.generate(input_ids=prompts, num_beams=3, num_return_sequences=3, do_sample=False,
+                             max_new_tokens=4, min_new_tokens=4)
+    assert outputs.shape == (6, PROMPT_LEN + 4)
+    assert torch.equal(outputs[:, :PROMPT_LEN], prompts.repeat_interleave(3, dim=0))
+
+
+@pytest.mark.parametrize('name', ['chatglm2', 'glm4'])
+def test_training_does_not_quantize(name):
+    model = _build(name, 8).train()
+    prompts = torch.randint(0, VOCAB, (2, PROMPT_LEN), generator=torch.Generator().manual_seed(3))
+    past = _prefill(model, prompts)
+    assert all(len(layer_past) == 2 and layer_past[0].is_floating_point() for layer_past in past)
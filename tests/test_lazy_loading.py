@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 15:20
+# @FileName: test_lazy_loading.py
+"""
+    lazy_load_pretrained 与 CLS.from_pretrained 加载结果一致 : 共享的词嵌入 , checkpoint 中缺失的参数 , dtype_map
+"""
+import threading
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+safetensors_torch = pytest.importorskip('safetensors.torch')
+
+from transformers import GPT2Config, GPT2LMHeadModel  # noqa: E402
+
+from deep_training.nlp.utils.lazy_loading import lazy_load_pretrained  # noqa: E402
+from deep_training.nlp.utils.torch_utils import init_empty_weights  # noqa: E402
+
+MISSING = 'transformer.ln_f.bias'
+
+
+class _NoInitGPT2(GPT2LMHeadModel):
+    # 与 chatglm2 / chatglm3 / glm4 相同 , _init_weights 为空操作
+    def _init_weights(self, module):
+        return
+
+
+def _save(path, drop_missing=False):
+    config = GPT2Config(vocab_size=128, n_positions=32, n_embd=32, n_layer=2, n_head=4, tie_word_embeddings=True)
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(config)
+    with torch.no_grad():
+        # 与 _init_weights 的结果 (weight 为 1) 不同 , 被重新初始化时能发现
+        model.transformer.ln_f.weight.normal_()
+        model.transformer.ln_f.bias.normal_()
+    model.save_pretrained(path, safe_serialization=True)
+    state_dict = safetensors_torch.load_file(str(path / 'model.safetensors'))
+    if drop_missing:
+        state_dict.pop(MISSING)
+        safetensors_torch.save_file(state_dict, str(path / 'model.safetensors'), metadata={'format': 'pt'})
+    return config, state_dict
+
+
+def _lazy(CLS, path, config, **kwargs):
+    return lazy_load_pretrained(CLS, str(path), config=config, **kwargs)
+
+
+@pytest.mark.parametrize('drop_missing', [False, True])
+def test_matches_from_pretrained(tmp_path, drop_missing):
+    config, _ = _save(tmp_path, drop_missing=drop_missing)
+    model = _lazy(GPT2LMHeadModel, tmp_path, config)
+    expected = GPT2LMHeadModel.from_pretrained(str(tmp_path)).eval()
+
+    assert model.lm_head.weight is model.transformer.wte.weight
+    assert all(p.device.type == 'cpu' for p in model.parameters())
+    state_dict, expected_state_dict = model.state_dict(), expected.state_dict()
+    assert state_dict.keys() == expected_state_dict.keys()
+    for k, v in expected_state_dict.items():
+        assert state_dict[k].dtype == v.dtype, k
+        assert torch.equal(state_dict[k], v), k
+
+
+def test_missing_keeps_loaded_in_same_module(tmp_path):
+    config, saved = _save(tmp_path, drop_missing=True)
+    model = _lazy(_NoInitGPT2, tmp_path, config)
+    # 同一模块中已加载的 weight 不被重新初始化 , _init_weights 为空操作时缺失的 bias 为 0
+    assert torch.equal(model.transformer.ln_f.weight, saved['transformer.ln_f.weight'])
+    assert torch.equal(model.transformer.ln_f.bias, torch.zeros_like(model.transformer.ln_f.bias))
+
+
+def test_dtype_map(tmp_path):
+    config, saved = _save(tmp_path, drop_missing=True)
+    model = _lazy(GPT2LMHeadModel, tmp_path, config, torch_dtype=torch.float16,
+                  dtype_map={'transformer.ln_f': torch.float32})
+    assert model.lm_head.weight is model.transformer.wte.weight
+    for name, p in model.named_parameters():
+        dtype = torch.float32 if name.startswith('transformer.ln_f.') else torch.float16
+        assert p.dtype == dtype, name
+        if name in saved:
+            assert torch.equal(p, saved[name].to(dtype)), name
+    assert torch.equal(model.transformer.ln_f.bias, torch.zeros(config.n_embd))
+
+
+def test_init_empty_weights_is_thread_local():
+    entered, done = threading.Event(), threading.Event()
+    result = {}
+
+    def build():
+        entered.wait()
+        result['linear'] = torch.nn.Linear(2, 2)
+        done.set()
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    with init_empty_weights():
+        entered.set()
+        done.wait()
+        meta = torch.nn.Linear(2, 2)
+    thread.join()
+    assert meta.weight.device.type == 'meta'
+    assert result['linear'].weight.device.type == 'cpu'
+    assert torch.nn.Linear(2, 2).weight.device.type == 'cpu'
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 17:00
+# @FileName: test_lora_svd_weighted.py
+"""
+    add_weighted_adapter(combination_type='svd') : 堆叠低秩因子上的 qr + 小核 svd 与稠密 ΔW 的 svd 截断一致
+    Linear , fan_in_fan_out (Conv1D) , Embedding , Conv2d
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from deep_training.nlp.layers.petl.lora.layer import Linear, Embedding, Conv2d  # noqa: E402
+from deep_training.nlp.models.petl.lora.model import LoraModule  # noqa: E402
+
+ADAPTERS = ('a', 'b')
+WEIGHTS = (0.7, -1.3)
+RANKS = (3, 5)
+
+
+def _linear(fan_in_fan_out=False):
+    return Linear('a', 12, 10, r=RANKS[0], lora_alpha=6, fan_in_fan_out=fan_in_fan_out)
+
+
+def _embedding():
+    return Embedding('a', 14, 9, r=RANKS[0], lora_alpha=6)
+
+
+def _conv2d():
+    return Conv2d('a', 4, 6, 3, r=RANKS[0], lora_alpha=6)
+
+
+def _add(layer, name, r):
+    if isinstance(layer, Embedding):
+        layer.update_layer_embedding(name, r, 2 * r, 0.0, True)
+    elif isinstance(layer, Conv2d):
+        layer.update_layer_conv2d(name, r, 2 * r, 0.0, True)
+    else:
+        layer.update_layer(name, r, 2 * r, 0.0, True)
+
+
+def _factors(layer, name):
+    if name in layer.lora_A:
+        return layer.lora_A[name].weight, layer.lora_B[name].weight
+    return layer.lora_embedding_A[name], layer.lora_embedding_B[name]
+
+
+def _build(factory, new_rank, seed):
+    torch.manual_seed(seed)
+    layer = factory()
+    _add(layer, 'b', RANKS[1])
+    with torch.no_grad():
+        # B 默认初始化为 0 , 随机化使 ΔW 非零
+        for name in ADAPTERS:
+            for t in _factors(layer, name):
+                t.normal_()
+    _add(layer, 'merged', new_rank)
+    return layer
+
+
+def _truncated(delta, rank):
+    U, S, Vh = torch.linalg.svd(delta.double().flatten(start_dim=1), full_matrices=False)
+    return (U[:, :rank] * S[:rank]) @ Vh[:rank]
+
+
+@pytest.mark.parametrize('factory', [_linear, lambda: _linear(fan_in_fan_out=True), _embedding, _conv2d],
+                         ids=['linear', 'conv1d', 'embedding', 'conv2d'])
+@pytest.mark.parametrize('new_rank', [4, 10])
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_svd_matches_dense(factory, new_rank, num_workers):
+    layers = [_build(factory, new_rank, seed) for seed in range(3)]
+    expected = []
+    for layer in layers:
+        with torch.no_grad():
+            delta = sum(w * layer.get_delta_weight(a) for a, w in zip(ADAPTERS, WEIGHTS))
+        expected.append(_truncated(delta, new_rank))
+
+    jobs = [(layer,) + _factors(layer, 'merged') for layer in layers]
+    LoraModule._svd_weighted_adapter(list(ADAPTERS), list(WEIGHTS), new_rank, jobs, num_workers=num_workers)
+
+    for layer, ref in zip(layers, expected):
+        lora_A, lora_B = _factors(layer, 'merged')
+        assert lora_A.shape[0] == new_rank and lora_B.shape[1] == new_rank
+        # 新 adapter 的 scaling = lora_alpha / r = 2 , 比较 B @ A
+        with torch.no_grad():
+            merged = layer.get_delta_weight('merged') / layer.scaling['merged']
+        assert torch.allclose(merged.double().flatten(start_dim=1), ref, rtol=1e-4, atol=1e-4)
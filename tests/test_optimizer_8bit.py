@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 9:40
+# @FileName: test_optimizer_8bit.py
+"""
+    8bit 优化器 state_dict 保存 -> 加载 -> step 与不中断训练一致
+"""
+import copy
+import io
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from deep_training.nlp.optimizer.quant_8bit import AdamW8bit, Lion8bit  # noqa: E402
+
+
+def _make_params():
+    g = torch.Generator().manual_seed(0)
+    # 第一个参数走 8bit 路径 (且不是 blocksize 的整数倍) , bf16 参数检查 absmax 不被转换 dtype , 最后一个保持 fp32 状态
+    return [torch.nn.Parameter(torch.randn(33, 31, generator=g)),
+            torch.nn.Parameter(torch.randn(40, 30, generator=g).to(torch.bfloat16)),
+            torch.nn.Parameter(torch.randn(7, generator=g))]
+
+
+def _set_grads(params, seed):
+    g = torch.Generator().manual_seed(seed)
+    for p in params:
+        p.grad = torch.randn(p.shape, generator=g).to(p.dtype)
+
+
+def _make(cls, params):
+    return cls(params, lr=1e-2, blocksize=64, min_8bit_size=256)
+
+
+@pytest.mark.parametrize('cls', [AdamW8bit, Lion8bit])
+def test_state_dict_round_trip(cls):
+    params = _make_params()
+    opt = _make(cls, params)
+    for i in range(3):
+        _set_grads(params, i)
+        opt.step()
+
+    buffer = io.BytesIO()
+    torch.save(opt.state_dict(), buffer)
+    buffer.seek(0)
+    resumed_params = copy.deepcopy(params)
+    resumed = _make(cls, resumed_params)
+    resumed.load_state_dict(torch.load(buffer))
+
+    for p, q in zip(params, resumed_params):
+        s, r = opt.state[p], resumed.state[q]
+        assert s['quantized'] == r['quantized']
+        for name, value in s.items():
+            if torch.is_tensor(value):
+                assert r[name].dtype == value.dtype and r[name].shape == value.shape, name
+                assert torch.equal(r[name], value), name
+    assert resumed.state[resumed_params[0]]['quantized']
+    assert resumed.state[resumed_params[1]]['exp_avg_absmax'].dtype == torch.float32
+    assert not resumed.state[resumed_params[2]]['quantized']
+    assert resumed.state[resumed_params[2]]['exp_avg'].dtype == torch.float32
+
+    for i in range(3, 6):
+        _set_grads(params, i)
+        _set_grads(resumed_params, i)
+        opt.step()
+        resumed.step()
+    for p, q in zip(params, resumed_params):
+        assert torch.equal(p, q)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 9:10
+# @FileName: test_optimizer_foreach.py
+"""
+    Lion / Lamb 的 foreach 路径与逐参数路径数值一致
+"""
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from deep_training.nlp.optimizer.lion import Lion  # noqa: E402
+from deep_training.nlp.optimizer.lamb import Lamb  # noqa: E402
+
+
+def _make_params(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    shapes = [((16, 8), torch.float32), ((8,), torch.float32), ((4, 4, 3), torch.float64), ((5,), torch.float64),
+              ((3, 2), torch.float32)]
+    return [torch.nn.Parameter(torch.randn(shape, generator=g, dtype=dtype)) for shape, dtype in shapes]
+
+
+def _param_groups(params, weight_decay):
+    # 混合 dtype 的两组参数 , 第二组不带 weight decay , 最后一个参数始终没有梯度
+    return [{'params': params[:3], 'weight_decay': weight_decay},
+            {'params': params[3:], 'weight_decay': 0.0}]
+
+
+def _run(optimizer_cls, foreach, steps=10, weight_decay=0.1, **kwargs):
+    params = _make_params()
+    opt = optimizer_cls(_param_groups(params, weight_decay), foreach=foreach, **kwargs)
+    g = torch.Generator().manual_seed(1)
+    for _ in range(steps):
+        for p in params[:-1]:
+            p.grad = torch.randn(p.shape, generator=g, dtype=p.dtype)
+        params[-1].grad = None
+        opt.step()
+    return params, opt
+
+
+def _assert_close(a_list, b_list):
+    for a, b in zip(a_list, b_list):
+        assert a.dtype == b.dtype
+        assert torch.allclose(a, b, rtol=1e-5, atol=1e-6), (a - b).abs().max()
+
+
+@pytest.mark.parametrize('weight_decay', [0.0, 0.1])
+def test_lion_foreach_matches_per_param(weight_decay):
+    ref, ref_opt = _run(Lion, foreach=False, lr=1e-3, weight_decay=weight_decay)
+    out, out_opt = _run(Lion, foreach=True, lr=1e-3, weight_decay=weight_decay)
+    _assert_close(ref, out)
+    _assert_close([ref_opt.state[p]['exp_avg'] for p in ref[:-1]],
+                  [out_opt.state[p]['exp_avg'] for p in out[:-1]])
+    assert len(out_opt.state[out[-1]]) == 0
+
+
+@pytest.mark.parametrize('adam', [False, True])
+@pytest.mark.parametrize('weight_decay', [0.0, 0.01])
+def test_lamb_foreach_matches_per_param(adam, weight_decay):
+    ref, ref_opt = _run(Lamb, foreach=False, lr=1e-2, weight_decay=weight_decay, adam=adam)
+    out, out_opt = _run(Lamb, foreach=True, lr=1e-2, weight_decay=weight_decay, adam=adam)
+    _assert_close(ref, out)
+    for p_ref, p_out in zip(ref[:-1], out[:-1]):
+        s_ref, s_out = ref_opt.state[p_ref], out_opt.state[p_out]
+        assert s_ref['step'] == s_out['step']
+        _assert_close([s_ref['exp_avg'], s_ref['exp_avg_sq']], [s_out['exp_avg'], s_out['exp_avg_sq']])
+        assert torch.allclose(torch.as_tensor(s_ref['trust_ratio'], dtype=torch.float64),
+                              torch.as_tensor(s_out['trust_ratio'], dtype=torch.float64), rtol=1e-5)
+    assert len(out_opt.state[out[-1]]) == 0
+
+
+def test_lion_foreach_state_dict_round_trip():
+    params, opt = _run(Lion, foreach=True, steps=3, lr=1e-3)
+    clone = copy.deepcopy(params)
+    opt2 = Lion(_param_groups(clone, 0.1), foreach=False, lr=1e-3)
+    opt2.load_state_dict(opt.state_dict())
+    for p in params[:-1]:
+        p.grad = torch.ones_like(p)
+    for p in clone[:-1]:
+        p.grad = torch.ones_like(p)
+    opt.step()
+    opt2.step()
+    _assert_close(params, clone)
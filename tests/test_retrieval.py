@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 18:00
+# @FileName: test_retrieval.py
+"""
+    retrieval : blocked_topk 与暴力 topk 一致 , IVFPQ 的 ADC 打分与解码后的向量一致且召回足够 ,
+    EmbeddingWriter / EmbeddingStore 读写一致 , RetrievalMetrics 与手算结果一致 ,
+    evaluate_spearman 与原 paired_distances 实现一致
+"""
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+import torch.nn.functional as F  # noqa: E402
+
+from deep_training.nlp.metrics.retrieval import RetrievalMetrics, evaluate_retrieval  # noqa: E402
+from deep_training.nlp.retrieval import EmbeddingWriter, EmbeddingStore, blocked_topk, IVFPQIndex  # noqa: E402
+
+
+def _clustered(num_clusters=16, per_cluster=128, dim=32, noise=0.1, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    centers = torch.randn(num_clusters, dim, generator=g)
+    x = centers.repeat_interleave(per_cluster, 0) + noise * torch.randn(num_clusters * per_cluster, dim, generator=g)
+    return F.normalize(x, dim=-1)
+
+
+@pytest.mark.parametrize('query_batch,block_size', [(4096, 65536), (7, 13)])
+def test_blocked_topk_matches_brute_force(query_batch, block_size):
+    g = torch.Generator().manual_seed(0)
+    queries, corpus = torch.randn(50, 16, generator=g), torch.randn(300, 16, generator=g)
+    scores, indices = blocked_topk(queries, corpus, k=10, query_batch=query_batch, block_size=block_size,
+                                   device='cpu')
+    expected_scores, expected_indices = (queries @ corpus.T).topk(10, dim=1)
+    assert torch.equal(indices, expected_indices)
+    assert torch.allclose(scores, expected_scores, atol=1e-5)
+
+    # numpy 输入 , k 大于语料
+    scores, indices = blocked_topk(queries.numpy(), corpus[:5].numpy(), k=10, block_size=2, device='cpu')
+    assert indices.shape == (50, 5)
+    assert torch.equal(indices, (queries @ corpus[:5].T).topk(5, dim=1).indices)
+
+
+def _trained(corpus, nlist=16, m=8, nbits=6):
+    index = IVFPQIndex(corpus.size(1), nlist=nlist, m=m, nbits=nbits, device='cpu')
+    index.train(corpus, niter=10)
+    # 分两次 add , 第二次 add 合并已有倒排表
+    index.add(corpus[:1000])
+    index.add(corpus[1000:])
+    return index
+
+
+def _decoded(index):
+    # 按倒排表解码 : coarse[list] + concat_j codebooks[j, code_j]
+    lists = torch.repeat_interleave(torch.arange(index.nlist), index.offsets.diff())
+    codes = index.codes.long()
+    residual = torch.stack([index.codebooks[j][codes[:, j]] for j in range(index.m)], dim=1).flatten(1)
+    out = torch.empty(index.ntotal, index.dim)
+    out[index.ids] = index.coarse[lists] + residual
+    return out
+
+
+@pytest.mark.parametrize('block_size', [65536, 5])
+def test_ivfpq_scores_match_decoded_vectors(block_size):
+    corpus = _clustered()
+    index = _trained(corpus)
+    g = torch.Generator().manual_seed(1)
+    queries = corpus[::37] + 0.01 * torch.randn(corpus[::37].shape, generator=g)
+    # 探测全部簇时 ADC 分数即 query 与解码后向量的内积
+    scores, ids = index.search(queries, k=10, nprobe=index.nlist, block_size=block_size)
+    decoded_scores = queries @ _decoded(index).T
+    assert torch.allclose(scores, decoded_scores.topk(10, dim=1).values, atol=1e-4)
+    assert torch.allclose(decoded_scores.gather(1, ids), scores, atol=1e-4)
+
+
+def test_ivfpq_recall_and_save_load(tmp_path):
+    corpus = _clustered()
+    index = _trained(corpus)
+    g = torch.Generator().manual_seed(1)
+    rows = torch.randperm(corpus.size(0), generator=g)[:200]
+    queries = F.normalize(corpus[rows] + 0.01 * torch.randn(200, corpus.size(1), generator=g), dim=-1)
+    exact = (queries @ corpus.T).argmax(-1)
+    _, ids = index.search(queries, k=10, nprobe=4)
+    recall = (ids == exact.unsqueeze(-1)).any(-1).float().mean()
+    assert recall >= 0.9
+
+    # 簇内分块不改变结果
+    _, ids_blocked = index.search(queries, k=10, nprobe=4, block_size=3)
+    assert torch.equal(ids_blocked, ids)
+
+    index.save(str(tmp_path / 'index.pt'))
+    loaded = IVFPQIndex.load(str(tmp_path / 'index.pt'), device='cpu')
+    assert len(loaded) == len(index)
+    assert torch.equal(loaded.search(queries, k=10, nprobe=4)[1], ids)
+
+    metrics = evaluate_retrieval(index, queries, exact.tolist(), ks=(1, 10), nprobe=4)
+    assert metrics['recall@10'] == pytest.approx(float(recall))
+
+
+def test_embedding_store_round_trip(tmp_path):
+    path = str(tmp_path / 'emb' / 'corpus.bin')
+    g = torch.Generator().manual_seed(0)
+    a, b = torch.randn(5, 8, generator=g), torch.randn(3, 8, generator=g)
+    with EmbeddingWriter(path) as writer:
+        writer.write(a)
+        writer.write(b.numpy())
+        with pytest.raises(ValueError):
+            writer.write(torch.randn(2, 4))
+    expected = F.normalize(torch.cat([a, b]), dim=-1)
+
+    store = EmbeddingStore(path)
+    assert store.shape == (8, 8) and store.normalized and store.data.dtype == np.float16
+    assert torch.allclose(store.get(0, 8, dtype=torch.float32), expected, atol=1e-3)
+    rows = np.array([6, 1, 6, 3])
+    assert np.array_equal(store.take(rows), store[:][rows])
+    blocks = [block for _, block in store.iter_blocks(block_size=3)]
+    assert [len(block) for block in blocks] == [3, 3, 2]
+    assert torch.equal(torch.cat(blocks), store.get(0, 8))
+
+    # 不归一化 , float32 原样保存
+    raw = str(tmp_path / 'raw.bin')
+    with EmbeddingWriter(raw, normalize=False, dtype='float32') as writer:
+        writer.write(a)
+    assert torch.equal(EmbeddingStore(raw).get(0, 5), a)
+
+    with EmbeddingWriter(str(tmp_path / 'empty.bin')):
+        pass
+    assert len(EmbeddingStore(str(tmp_path / 'empty.bin'))) == 0
+
+
+def test_retrieval_metrics_hand_computed():
+    indices = torch.tensor([[3, 1, 2], [5, 6, 7], [9, 8, -1]])
+    positives = [1, [6, 7], []]
+    # q0 : 第 2 位命中 ; q1 : 2 个正例在第 2 , 3 位 ; q2 : 无正例 , 检索结果的 -1 不与填充值相等
+    expected = {'recall@1': 0.0, 'recall@2': (1 + 0.5) / 3, 'recall@3': 2 / 3, 'mrr@3': (0.5 + 0.5) / 3}
+
+    metrics = RetrievalMetrics(ks=(3, 1, 2))
+    metrics.update(indices, positives)
+    assert metrics.compute() == pytest.approx(expected)
+
+    # 分批累加结果相同
+    metrics.reset()
+    metrics.update(indices[:1], positives[:1])
+    metrics.update(indices[1:], positives[1:])
+    assert metrics.compute() == pytest.approx(expected)
+
+    # k 大于检索结果列数时按全部列计算
+    metrics = RetrievalMetrics(ks=(1, 5))
+    metrics.update(indices[:1], positives[:1])
+    assert metrics.compute() == pytest.approx({'recall@1': 0.0, 'recall@5': 1.0, 'mrr@5': 0.5})
+
+
+@pytest.mark.parametrize('block_size', [65536, 7])
+def test_evaluate_spearman_matches_paired_distances(tmp_path, block_size):
+    pytest.importorskip('scipy')
+    paired_distances = pytest.importorskip('sklearn.metrics.pairwise').paired_distances
+    from deep_training.nlp.utils.spearman import evaluate_spearman, paired_cosine_similarity
+    from scipy.stats import spearmanr
+
+    rng = np.random.default_rng(0)
+    a, b = rng.normal(size=(40, 16)), rng.normal(size=(40, 16))
+    labels = rng.integers(0, 5, size=40).tolist()
+    # 原实现
+    sims = 1 - paired_distances(a, b, metric='cosine')
+    expected = spearmanr(labels, sims).correlation
+
+    assert np.allclose(paired_cosine_similarity(a, b, block_size=block_size), sims, atol=1e-6)
+    assert evaluate_spearman(a, b, labels, block_size=block_size) == pytest.approx(expected)
+
+    # EmbeddingStore (memmap) 输入
+    stores = []
+    for name, x in (('a', a), ('b', b)):
+        with EmbeddingWriter(str(tmp_path / name), normalize=False, dtype='float32') as writer:
+            writer.write(x)
+        stores.append(EmbeddingStore(str(tmp_path / name)))
+    assert evaluate_spearman(*stores, labels, block_size=block_size) == pytest.approx(expected, abs=1e-6)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2024/6/6 16:30
+# @FileName: test_rollout_planner.py
+"""
+    RolloutBatchPlanner : minibatch 为连续存储的切片视图 , 每个 epoch 每行恰好出现一次 , 只打乱优化步顺序 ,
+    token 预算 , store 缓存 planner
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from deep_training.nlp.rl.rl_base.rl_dataset import BaseRolloutStore, RolloutBatchPlanner  # noqa: E402
+
+
+class _Store(BaseRolloutStore):
+    length_fields = ('input_ids',)
+
+    def __init__(self, lengths):
+        super().__init__()
+        self.history = [dict(input_ids=torch.full((n,), i + 1, dtype=torch.long), rewards=torch.ones(n))
+                        for i, n in enumerate(lengths)]
+
+    def push(self, exps):
+        self.history += exps
+        self.invalidate_planner()
+
+    def create_loader(self, batch_size, shuffle, prep_fn=None, num_workers=0):
+        raise NotImplementedError
+
+
+LENGTHS = [3, 9, 1, 7, 5, 2, 8, 4, 6, 10, 11, 12]
+
+
+def _rows(mb):
+    # 每行的 id 即 input_ids 的非 pad 值
+    return mb['input_ids'].max(dim=1).values.tolist()
+
+
+def _epoch(planner):
+    return [[(_rows(mb), weight, share) for mb, weight, share in step] for step in planner]
+
+
+def test_minibatches_are_views_of_the_store():
+    planner = _Store(LENGTHS).create_planner(4, mb_size=2)
+    for step in planner:
+        for mb, _, _ in step:
+            for k, t in mb.items():
+                assert t.untyped_storage().data_ptr() == planner.data[planner.keys.index(k)].untyped_storage().data_ptr()
+            # 按本 minibatch 最大长度裁剪列
+            assert mb['input_ids'].size(1) == max(LENGTHS[i - 1] for i in _rows(mb))
+
+
+def test_every_row_once_and_step_order_shuffled():
+    planner = _Store(LENGTHS).create_planner(4, mb_size=2, seed=0)
+    epochs = [_epoch(planner) for _ in range(4)]
+    for steps in epochs:
+        rows = sorted(r for step in steps for mb_rows, _, _ in step for r in mb_rows)
+        assert rows == list(range(1, len(LENGTHS) + 1))
+    # 优化步本身 (按长度分组) 不变 , 顺序每个 epoch 不同
+    assert all(sorted(map(str, steps)) == sorted(map(str, epochs[0])) for steps in epochs)
+    assert len({str(steps) for steps in epochs}) > 1
+
+
+def test_token_budget_and_loss_weights():
+    planner = _Store(LENGTHS).create_planner(4, mb_size=4, max_tokens=24, shuffle=False, loss_reduction='sum')
+    for step in planner:
+        assert sum(share for _, _, share in step) == pytest.approx(1.0)
+        for mb, weight, share in step:
+            assert mb['input_ids'].numel() <= 24 or mb['input_ids'].size(0) == 1
+            assert weight == pytest.approx(mb['input_ids'].size(0) / 4)
+
+    planner = _Store(LENGTHS).create_planner(4, mb_size=4, max_tokens=24, shuffle=False, loss_reduction='mean')
+    for step in planner:
+        assert [weight for _, weight, _ in step] == [share for _, _, share in step]
+
+
+def test_store_caches_planner():
+    store = _Store(LENGTHS)
+    planner = store.create_planner(4, mb_size=2)
+    assert store.create_planner(4, mb_size=2) is planner
+    assert store.create_planner(4, mb_size=4) is not planner
+    store.push([dict(input_ids=torch.ones(2, dtype=torch.long), rewards=torch.ones(2))])
+    assert len(store.create_planner(4, mb_size=2).data[0]) == len(LENGTHS) + 1
+
+
+def test_replicas_split_steps():
+    elements = _Store(LENGTHS).history
+    planners = [RolloutBatchPlanner(elements, 2, length_fields=('input_ids',), num_replicas=2, rank=r, seed=3)
+                for r in range(2)]
+    rows = [sorted(r for step in p for mb, _, _ in step for r in _rows(mb)) for p in planners]
+    assert len(planners[0]) == len(planners[1]) == 3
+    assert not set(rows[0]) & set(rows[1])
+    assert sorted(rows[0] + rows[1]) == list(range(1, len(LENGTHS) + 1))